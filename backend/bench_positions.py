@@ -0,0 +1,194 @@
+# backend/bench_positions.py
+"""
+列車位置レスポンスのシリアライズのベンチマーク
+
+/api/trains/{line_id}/positions/v4 と同じ形のレスポンスを合成した列車で組み立て、
+列車1本あたりのエンコード時間を比較する。
+
+- legacy:   列車ごとの辞書 → FastAPI の既定のエンコード（jsonable_encoder + JSONResponse）
+- json:     PositionRow → 標準 json（orjson が無い環境のフォールバック）
+- direct:   PositionRow → キー断片を連結して行ごとに直接 JSON を組み立てる（辞書を作らない, 比較用）
+- orjson:   PositionRow → orjson の default フック（本番の経路）
+
+direct は本番と同じバイト列になるが、Python で値を1つずつ書き出すぶん
+辞書を orjson (C 実装) に渡すより遅いので採用していない。
+
+使い方:
+    python bench_positions.py [--trains 300] [--repeat 200]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from position_encoder import ORJSON_AVAILABLE, PositionRow, encode_json_fallback, encode_positions_json
+from train_position_v4 import SegmentProgress
+
+
+def make_rows(n: int, seed: int = 0) -> List[PositionRow]:
+    """中央線快速程度の列車を n 本合成する"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        progress = SegmentProgress(
+            trip_id=f"JR-East.ChuoRapid.{1000 + i}T.Weekday",
+            train_number=f"{1000 + i}T",
+            direction=rng.choice(["Inbound", "Outbound"]),
+            prev_station_id="JR-East.ChuoRapid.Tokyo",
+            next_station_id="JR-East.ChuoRapid.Kanda",
+            prev_seq=1,
+            next_seq=2,
+            now_ts=1760000000,
+            t0_departure=1759999900,
+            t1_arrival=1760000100,
+            progress=rng.random(),
+            status=rng.choice(["running", "running", "stopped"]),
+            feed_timestamp=1759999990,
+            delay=rng.choice([0, 0, 30, 120]),
+            is_starting_station=rng.random() < 0.05,
+        )
+        coord = (35.6 + rng.random() * 0.1, 139.6 + rng.random() * 0.2, rng.random() * 360)
+        rows.append(PositionRow.from_coord(progress, coord))
+    return rows
+
+
+def _content(positions: List) -> Dict:
+    return {
+        "source": "tripupdate_v4",
+        "line_id": "chuo_rapid",
+        "line_name": "中央線快速",
+        "status": "success",
+        "timestamp": 1760000000,
+        "total_trains": len(positions),
+        "positions": positions,
+        "time_travel": None,
+        "debug": {"direction_stats": {}, "status_stats": {}, "schedules_count": len(positions)},
+    }
+
+
+def encode_legacy(rows: List[PositionRow]) -> bytes:
+    positions = [row.to_dict() for row in rows]
+    positions.sort(key=lambda p: (p["direction"] or "", p["train_number"] or ""))
+    return JSONResponse(content=None).render(jsonable_encoder(_content(positions)))
+
+
+def encode_rows_json(rows: List[PositionRow]) -> bytes:
+    return encode_json_fallback(_content(sorted(rows, key=PositionRow.sort_key)))
+
+
+def _direct_string(value: str) -> str:
+    if value.isprintable() and '"' not in value and "\\" not in value:
+        return '"' + value + '"'
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _direct_float(value: Optional[float]) -> str:
+    return "null" if value is None or not math.isfinite(value) else float.__repr__(value)
+
+
+def _direct_scalar(value: Any) -> str:
+    if value is None:
+        return "null"
+    if type(value) is int:
+        return int.__repr__(value)
+    if type(value) is str:
+        return _direct_string(value)
+    if type(value) is float:
+        return _direct_float(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _direct_row(row: PositionRow) -> str:
+    """PositionRow.to_dict と同じ内容をキー断片の連結で書き出す"""
+    r = row.progress
+    return (
+        '{"trip_id":' + _direct_scalar(r.trip_id)
+        + ',"train_number":' + _direct_scalar(r.train_number)
+        + ',"direction":' + _direct_scalar(r.direction)
+        + ',"status":' + _direct_scalar(r.status)
+        + ',"progress":' + _direct_float(round(r.progress, 4) if r.progress is not None else None)
+        + ',"delay":' + _direct_scalar(r.delay)
+        + ',"location":{"latitude":' + _direct_float(round(row.lat, 6) if row.lat is not None else None)
+        + ',"longitude":' + _direct_float(round(row.lon, 6) if row.lon is not None else None)
+        + ',"bearing":' + (_direct_float(round(row.bearing, 2)) if row.bearing is not None else "0.0")
+        + '},"segment":{"prev_seq":' + _direct_scalar(r.prev_seq)
+        + ',"next_seq":' + _direct_scalar(r.next_seq)
+        + ',"prev_station_id":' + _direct_scalar(r.prev_station_id)
+        + ',"next_station_id":' + _direct_scalar(r.next_station_id)
+        + '},"times":{"now_ts":' + _direct_scalar(r.now_ts)
+        + ',"t0_departure":' + _direct_scalar(r.t0_departure)
+        + ',"t1_arrival":' + _direct_scalar(r.t1_arrival)
+        + '},"debug":{"feed_timestamp":' + _direct_scalar(r.feed_timestamp)
+        + ('},"is_starting_station":true}' if r.is_starting_station else "}}")
+    )  # fmt: skip
+
+
+def _direct_write(value: Any, out: List[str]) -> None:
+    if isinstance(value, PositionRow):
+        out.append(_direct_row(value))
+    elif isinstance(value, dict):
+        out.append("{")
+        for i, (key, item) in enumerate(value.items()):
+            out.append(("," if i else "") + _direct_string(key) + ":")
+            _direct_write(item, out)
+        out.append("}")
+    elif isinstance(value, (list, tuple)):
+        out.append("[")
+        for i, item in enumerate(value):
+            if i:
+                out.append(",")
+            _direct_write(item, out)
+        out.append("]")
+    else:
+        out.append(_direct_scalar(value))
+
+
+def encode_rows_direct(rows: List[PositionRow]) -> bytes:
+    out: List[str] = []
+    _direct_write(_content(sorted(rows, key=PositionRow.sort_key)), out)
+    return "".join(out).encode("utf-8")
+
+
+def encode_rows_orjson(rows: List[PositionRow]) -> bytes:
+    return encode_positions_json(_content(sorted(rows, key=PositionRow.sort_key)))
+
+
+def measure(encode: Callable[[List[PositionRow]], bytes], rows: List[PositionRow], repeat: int) -> float:
+    """列車1本あたりの時間 (µs)"""
+    encode(rows)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode(rows)
+    return (time.perf_counter() - start) / repeat / len(rows) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trains", type=int, default=300, help="列車数")
+    parser.add_argument("--repeat", type=int, default=200, help="繰り返し回数")
+    args = parser.parse_args()
+
+    rows = make_rows(args.trains)
+    candidates = [("legacy", encode_legacy), ("json", encode_rows_json), ("direct", encode_rows_direct)]
+    if ORJSON_AVAILABLE:
+        candidates.append(("orjson", encode_rows_orjson))
+
+    baseline = None
+    print(f"{args.trains} trains x {args.repeat} runs")
+    for name, encode in candidates:
+        per_train = measure(encode, rows, args.repeat)
+        baseline = baseline or per_train
+        size = len(encode(rows))
+        print(f"  {name:<8} {per_train:8.2f} us/train  x{baseline / per_train:5.1f}  {size} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,3 +21,46 @@ SERVICE_TYPE_UNKNOWN = "Unknown"
 
 # HTTP timeout (seconds)
 HTTP_TIMEOUT = 10.0
+
+# GTFS-RT 共有ポーラーの取得間隔 (seconds)
+# ODPT のフィード更新周期（概ね30秒）より短くして鮮度を確保する
+FEED_POLL_INTERVAL = 15.0
+
+# GTFS-RT デコード・正規化を実行する executor ("thread" / "process") とワーカー数
+# （"process" は正規化キャッシュをワーカー間で共有できないので常に1ワーカー）
+FEED_DECODE_EXECUTOR = "thread"
+FEED_DECODE_WORKERS = 1
+
+# 1ポーリング周期でイベントループを占有してよい時間の上限 (seconds)
+# 超過した場合は警告ログを出す
+FEED_LOOP_BLOCK_BUDGET = 0.02
+
+# 列車位置の進捗計算方式 ("scalar" / "vectorized")
+# vectorized は numpy が必要（未導入ならスカラー版で計算する）
+PROGRESS_ENGINE = "scalar"
+
+# 列車位置 (/api/trains/{line_id}/positions/v4) の短命キャッシュの時間バケット幅 (seconds)
+# 同じバケット内のリクエストは1回の計算結果を共有する。0 で無効
+POSITIONS_CACHE_TTL = 1.0
+
+# 列車位置の差分 (/api/trains/{line_id}/positions/v4?since=<version>)
+# 路線ごとに保持する直近のスナップショット数と、位置の変化とみなす移動距離 (m)
+POSITIONS_DELTA_HISTORY = 8
+POSITIONS_DELTA_THRESHOLD_M = 5.0
+
+# 列車位置のプッシュ配信 (/api/trains/positions/stream) の計算・配信間隔 (seconds)
+# 購読中の路線ごとに1周期1回だけ計算し、全購読者に配る
+POSITIONS_PUSH_INTERVAL = 2.0
+
+# 再起動まで変わらない静的データ（路線一覧・線路形状・ベクタータイル）をクライアントが再検証なしで使ってよい秒数
+# 超過後は ETag で再検証する（変わっていなければ 304）。0 なら毎回再検証
+STATIC_CACHE_MAX_AGE = 300
+
+# ベクタータイル (/tiles/{z}/{x}/{y}.mvt) のメモリキャッシュのタイル数
+TILE_MEMORY_CACHE_SIZE = 4096
+
+# ベクタータイルのディスクキャッシュのディレクトリ（空ならディスクには保存しない）
+TILE_CACHE_DIR = ""
+
+# コンパイル済み線路形状・駅座標のファイル（DataCache の data_dir からの相対パス, 各ワーカーが mmap する）
+COMPILED_GEOMETRY_PATH = "compiled/geometry.bin"
@@ -4,8 +4,10 @@ from __future__ import annotations
 import json
 import logging
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Mapping, Optional
 
+from constants import COMPILED_GEOMETRY_PATH
+from spatial_index import GridIndex, RailwayIndex
 from timetable_models import StopTime, TimetableTrain
 from train_state import TrainSegment, build_yamanote_segments
 
@@ -16,6 +18,13 @@ except ImportError:
     from database import SessionLocal, Station, StationRank
     from station_ranks import get_station_dwell_time as get_static_dwell_time
 
+if TYPE_CHECKING:
+    from geometry_compiler import CompiledGeometry
+    from shape_store import ShapeStore
+    from topology import Topology
+    from track_geometry import LineGeometry
+    from vector_tiles import TileCache
+
 logger = logging.getLogger(__name__)
 
 
@@ -293,16 +302,39 @@ class DataCache:
         # MS3-2: 山手線のセグメント（TrainSegment の配列）
         self.yamanote_segments: List[TrainSegment] = []
 
-        # MS3-3: 駅座標インデックス
-        self.station_positions: Dict[str, tuple[float, float]] = {}
+        # MS3-3: 駅座標インデックス（コンパイル済みファイルを読み込んだ後は mmap 上の配列を参照する）
+        self.station_positions: Mapping[str, tuple[float, float]] = {}
 
         # 駅ランクキャッシュ (station_id -> {"rank": str, "dwell_time": int})
         self.station_rank_cache: Dict[str, Dict[str, Any]] = {}
+        # 静的データ（路線・駅）の読み込み回数。路線一覧・駅一覧のレスポンスキャッシュの無効化に使う
+        self.data_version: int = 0
+        # 駅ランク（停車時間）の更新回数。列車ごとの実質発車時刻キャッシュの無効化に使う
+        self.rank_version: int = 0
 
         # MS3-5: 線路形状追従用
         self.track_points: List[tuple[float, float]] = []  # 山手線全周の座標リスト
         self.station_track_indices: Dict[str, int] = {}  # 駅ID → track_pointsのインデックス
 
+        # 全路線の線路頂点の空間インデックス（最近傍探索用, 線路形状のコンパイル時に構築）
+        self.railway_index: Optional[RailwayIndex] = None
+
+        # /api/shapes 用の事前コンパイル済み線路形状（マージ済み座標・JSON・圧縮済みバイト列）
+        self.shape_store: Optional[ShapeStore] = None
+
+        # /api/shapes/topology 用の路線間で共有するアーク（初回リクエスト時に構築）
+        self.shape_topology: Optional[Topology] = None
+
+        # /tiles/{z}/{x}/{y}.mvt 用のベクタータイルキャッシュ（起動時に main が構築。タイル自体は初回要求時に生成）
+        self.tile_cache: Optional[TileCache] = None
+
+        # 全対応路線の線形参照ジオメトリ (mt3d_id → LineGeometry)
+        self.line_geometries: Dict[str, LineGeometry] = {}
+
+        # コンパイル済みの全路線の線路形状（マージ済み座標・累積距離・方位角・駅の対応頂点）と駅座標
+        self.compiled_geometry_path: Path = data_dir / COMPILED_GEOMETRY_PATH
+        self.compiled_geometry: Optional[CompiledGeometry] = None
+
         # MS1-TripUpdate: 列車番号から静的列車データへのインデックス
         # key: (train_number, service_type, direction), value: TimetableTrain
         self._train_lookup: Dict[tuple[str, str, str], TimetableTrain] = {}
@@ -317,6 +349,46 @@ class DataCache:
         # self.railways_by_id: Dict[str, Dict[str, Any]] = {}
         # self.stations_by_id: Dict[str, Dict[str, Any]] = {}
 
+    # ------------------------------------------------------------------------
+    # pickle（プロセスプールのワーカーへ渡す）
+    # ------------------------------------------------------------------------
+
+    # 配信用のキャッシュ（mmap 上の配列を参照する）。フィードのデコードには不要なので送らない
+    _UNPICKLED_FIELDS = ("shape_store", "shape_topology", "tile_cache")
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        コンパイル済みファイル上の配列を参照する属性は送らず、ワーカー側で mmap し直した
+        CompiledGeometry から復元する（CompiledGeometry 自体はパスとハッシュだけが送られる）。
+        """
+        state = self.__dict__.copy()
+        for name in self._UNPICKLED_FIELDS:
+            state[name] = None
+        compiled = self.compiled_geometry
+        if compiled is not None:
+            # コンパイル済みの路線は ID だけ送り、遅延構築した路線（array 上の LineGeometry）はそのまま送る
+            compiled_ids = [
+                line_id for line_id, geometry in self.line_geometries.items() if compiled.lines.get(line_id) is geometry
+            ]
+            state["line_geometries"] = {
+                line_id: geometry for line_id, geometry in self.line_geometries.items() if line_id not in compiled_ids
+            }
+            state["_compiled_line_ids"] = compiled_ids
+            if self.station_positions is compiled.station_positions:
+                state["station_positions"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        state = dict(state)
+        compiled_ids = state.pop("_compiled_line_ids", [])
+        self.__dict__.update(state)
+        compiled = self.compiled_geometry
+        if compiled is not None:
+            for line_id in compiled_ids:
+                self.line_geometries[line_id] = compiled.lines[line_id]
+            if self.station_positions is None:
+                self.station_positions = compiled.station_positions
+
     def _load_json(self, rel_path: str) -> Any:
         path = self.data_dir / rel_path
         if not path.exists():
@@ -324,13 +396,70 @@ class DataCache:
         with path.open("r", encoding="utf-8") as f:
             return json.load(f)
 
-    def load_all(self) -> None:
-        """全ての静的データを読み込む（MS1+MS2+MS3-1 用）"""
-        # 1) MS2 までのデータ
+    def load_geometry_sources(self) -> None:
+        """
+        線路形状のコンパイルに使う元データ（railways.json・coordinates.json）を読み込む。
+
+        駅座標は DB から読み直すので、前回の読み込み結果は捨てる（load_compiled_geometry で設定される）。
+        """
         self.railways = self._load_json("mini-tokyo-3d/railways.json")
         # Step 2: Stop loading stations.json
         # self.stations = self._load_json("mini-tokyo-3d/stations.json")
         self.coordinates = self._load_json("mini-tokyo-3d/coordinates.json")
+        self.station_positions = {}
+        self.data_version += 1
+
+    def _station_positions_sha256(self) -> str:
+        """
+        駅座標のハッシュ。
+
+        読み込み済み（テストなどで設定済み）ならその内容から、未読み込みなら DB の行を流し込んで求める。
+        コンパイル済みファイルが有効なら駅座標の辞書は作らずに済む。
+        """
+        from geometry_compiler import station_positions_sha256, station_rows_sha256
+
+        if self.station_positions:
+            return station_positions_sha256(self.station_positions)
+        return station_rows_sha256(self.iter_station_positions_from_db())
+
+    def load_compiled_geometry(self, force: bool = False) -> "CompiledGeometry":
+        """
+        コンパイル済みの線路形状と駅座標を mmap で読み込む。
+
+        元データのハッシュが保存時と異なる（または force=True）場合は再コンパイルして保存し直す。
+        読み込み後の station_positions はファイル上の配列を参照する（ワーカー間で共有される）。
+        """
+        from geometry_compiler import compile_geometry, load_compiled_geometry, source_hashes
+
+        hashes = source_hashes(
+            self.data_dir / "mini-tokyo-3d/coordinates.json",
+            self.data_dir / "mini-tokyo-3d/railways.json",
+            self._station_positions_sha256(),
+        )
+        compiled = None if force else load_compiled_geometry(self.compiled_geometry_path, hashes)
+        if compiled is not None:
+            logger.info(
+                "Loaded compiled geometry for %d lines from %s", len(compiled.lines), self.compiled_geometry_path
+            )
+        else:
+            if not self.station_positions:
+                # MS3-3: 駅座標インデックスの構築 (DBから, コンパイル時だけ必要)
+                self.load_station_positions_from_db()
+            if self.railway_index is None:
+                # 参照解決の最近傍探索はコンパイル時だけ必要
+                self.railway_index = RailwayIndex.from_coordinates(self.coordinates)
+            compiled = compile_geometry(self, self.compiled_geometry_path, hashes)
+        self.compiled_geometry = compiled
+        self.station_positions = compiled.station_positions
+        return compiled
+
+    def load_all(self) -> None:
+        """全ての静的データを読み込む（MS1+MS2+MS3-1 用）"""
+        # 1) MS2 までのデータ（路線・線路形状・駅座標）
+        self.load_geometry_sources()
+        # マージ済みの線路形状はコンパイル済みのものを読み込む（元データが変わっていれば再コンパイル）
+        self.load_compiled_geometry()
+        self.build_shape_store()
 
         logger.info("Loaded %d railways", len(self.railways))
 
@@ -389,8 +518,7 @@ class DataCache:
         # MS1-TripUpdate: 列車検索インデックスを構築 (全路線対象)
         self._build_train_lookup_index()
 
-        # MS3-3: 駅座標インデックスの構築 (DBから)
-        self.load_station_positions_from_db()
+        # MS3-3: 駅座標インデックスは load_compiled_geometry で設定済み（コンパイル済みファイル上の配列）
 
         # 駅ランクの読み込み (DBから)
         self.load_station_ranks_from_db()
@@ -401,6 +529,9 @@ class DataCache:
         # MS3-5: 線路形状データの読み込みと駅マッピング
         self._load_track_coordinates()
 
+        # 全対応路線の累積距離・駅位置の事前計算
+        self._build_line_geometries()
+
         # MS3-3: 山手線時刻表の駅IDが station_positions に存在するか検証
         if not self.yamanote_trains:
             logger.info("Skipping Yamanote station position validation (no timetable data).")
@@ -472,28 +603,75 @@ class DataCache:
             for stop in train.stops:
                 yamanote_station_ids.add(stop.station_id)
 
+        track_index = GridIndex.from_coords(self.track_points)
         mapped_count = 0
         for station_id in yamanote_station_ids:
             coord = self.station_positions.get(station_id)
             if not coord:
                 continue
 
-            # 最も近い点を探索
-            min_dist = float("inf")
-            min_idx = 0
-
-            for i, track_coord in enumerate(self.track_points):
-                # ユークリッド距離の2乗で比較（平方根計算を省略）
-                dist_sq = (coord[0] - track_coord[0]) ** 2 + (coord[1] - track_coord[1]) ** 2
-                if dist_sq < min_dist:
-                    min_dist = dist_sq
-                    min_idx = i
+            # 最も近い点を探索（空間インデックス）
+            min_idx = track_index.nearest_by_degrees(coord[0], coord[1])
+            if min_idx is None:
+                continue
 
             self.station_track_indices[station_id] = min_idx
             mapped_count += 1
 
         logger.info("Mapped %d stations to track indices", mapped_count)
 
+    def build_shape_store(self) -> "ShapeStore":
+        """全路線の線路形状をマージし、/api/shapes のレスポンスを事前にエンコードしておく"""
+        from shape_store import ShapeStore
+
+        compiled_lines = self.compiled_geometry.lines if self.compiled_geometry is not None else None
+        self.shape_store = ShapeStore.build(self.coordinates, self.railway_index, compiled_lines)
+        return self.shape_store
+
+    def build_shape_topology(self) -> "Topology":
+        """線路形状ストアのマージ済み座標から路線間で共有するアークを切り出す"""
+        from topology import Topology
+
+        shape_store = self.shape_store if self.shape_store is not None else self.build_shape_store()
+        self.shape_topology = Topology.build(shape_store)
+        return self.shape_topology
+
+    def build_tile_cache(self, max_entries: int, cache_dir: Optional[Path] = None) -> "TileCache":
+        """線路形状ストアと stations テーブルからベクタータイルの生成元を作る"""
+        from vector_tiles import TileCache, TileSource
+
+        shape_store = self.shape_store if self.shape_store is not None else self.build_shape_store()
+        source = TileSource.build(shape_store, self.load_station_features_from_db())
+        self.tile_cache = TileCache(source, max_entries=max_entries, cache_dir=cache_dir)
+        return self.tile_cache
+
+    def _build_line_geometries(self) -> None:
+        """
+        SUPPORTED_LINES の全路線について線路の累積距離と駅の対応頂点を計算する。
+        列車位置のスナップ (calculate_coordinates) はこの結果を二分探索するだけになる。
+        """
+        from config import SUPPORTED_LINES
+        from track_geometry import build_line_geometries
+
+        if not self.coordinates:
+            logger.warning("Coordinates data not loaded, skipping line geometry build")
+            return
+
+        if self.compiled_geometry is not None:
+            # コンパイル済みなら全路線分が揃っている
+            self.line_geometries = dict(self.compiled_geometry.lines)
+            logger.info("Using compiled line geometries for %d lines", len(self.line_geometries))
+            return
+
+        line_ids = sorted({conf.mt3d_id for conf in SUPPORTED_LINES.values()})
+        self.line_geometries = build_line_geometries(self, line_ids)
+        logger.info(
+            "Built line geometries for %d/%d lines (%d stations)",
+            len(self.line_geometries),
+            len(line_ids),
+            sum(len(g.stations) for g in self.line_geometries.values()),
+        )
+
     # ========================================================================
     # MS1-TripUpdate: 列車検索・駅マッピングメソッド
     # ========================================================================
@@ -654,22 +832,41 @@ class DataCache:
             return int(cached.get("dwell_time", get_static_dwell_time(station_id)))
         return get_static_dwell_time(station_id)
 
-    def load_station_positions_from_db(self) -> None:
-        """DBから駅座標キャッシュを構築する (Step 2)"""
-        self.station_positions.clear()
+    def iter_station_positions_from_db(self) -> Iterator[tuple[str, float, float]]:
+        """DBの駅座標を駅IDの昇順に (station_id, lon, lat) で返す（全行をリストにしない）"""
         with SessionLocal() as db:
             # 高速化のため必要なカラムのみ取得
-            rows = db.query(Station.id, Station.lon, Station.lat).all()
+            rows = db.query(Station.id, Station.lon, Station.lat).order_by(Station.id).yield_per(1000)
             for s_id, lon, lat in rows:
                 if lon is None or lat is None:
                     continue
                 # 簡易チェック
                 if not _is_valid_coord(lon, lat):
                     continue
-                self.station_positions[s_id] = (lon, lat)
+                yield s_id, lon, lat
 
+    def load_station_positions_from_db(self) -> None:
+        """DBから駅座標キャッシュを構築する (Step 2)"""
+        self.station_positions = {s_id: (lon, lat) for s_id, lon, lat in self.iter_station_positions_from_db()}
         logger.info("Loaded %d station positions from DB", len(self.station_positions))
 
+    def load_station_features_from_db(self) -> List[Dict[str, Any]]:
+        """DBから地図表示用の駅情報（ID・路線・駅名・座標）を取得する"""
+        stations: List[Dict[str, Any]] = []
+        with SessionLocal() as db:
+            rows = db.query(
+                Station.id, Station.line_id, Station.name_ja, Station.name_en, Station.lon, Station.lat
+            ).all()
+            for s_id, line_id, name_ja, name_en, lon, lat in rows:
+                if lon is None or lat is None:
+                    continue
+                if not _is_valid_coord(lon, lat):
+                    continue
+                stations.append(
+                    {"id": s_id, "line_id": line_id, "name_ja": name_ja, "name_en": name_en, "lon": lon, "lat": lat}
+                )
+        return stations
+
     def load_station_ranks_from_db(self) -> None:
         """DBから駅ランクキャッシュを構築する"""
         self.station_rank_cache.clear()
@@ -682,6 +879,7 @@ class DataCache:
                     "rank": rank,
                     "dwell_time": int(dwell_time),
                 }
+        self.rank_version += 1
         logger.info("Loaded %d station ranks from DB", len(self.station_rank_cache))
 
     def build_station_search_index(self) -> None:
@@ -803,3 +1001,4 @@ class DataCache:
             "rank": rank,
             "dwell_time": int(dwell_time),
         }
+        self.rank_version += 1
@@ -0,0 +1,241 @@
+# backend/feed_decoder.py
+"""
+GTFS-RT フィードのデコード・正規化ステージ（イベントループ外で実行）
+
+feed.ParseFromString と TripUpdate の正規化ループは CPU バウンドで、
+イベントループ上で実行すると他のリクエスト（/api/health など）が止まる。
+このモジュールの処理はスレッドプール / プロセスプールで実行し、
+結果はプレーンなデータ（dict / dataclass）としてループに返す。
+
+プロセスプールでは DataCache をワーカー起動時に1回だけ渡し、
+以降の呼び出しではフィードのバイト列だけを送る。
+コンパイル済みの線路形状（mmap）はファイルのパスだけが送られ、ワーカー側で mmap し直す
+（spawn / forkserver でも DataCache を pickle できる）。
+
+列車単位の正規化キャッシュはワーカーごとに持つ（モジュールのグローバル）。
+スレッドプールでは全ワーカーで共有されるが、プロセスプールではプロセスごとに別になり、
+フィードが毎回別のワーカーに渡ると再利用がほとんど効かない。
+ポーラーはフィードを1周期ずつ順に投入するのでワーカーを増やしても並列にはならないため、
+プロセスプールのワーカー数は1に固定する。
+静的データの再読み込み（DataCache.data_version の変化）でキャッシュは破棄する。
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple
+
+from gtfs_rt_tripupdate import (
+    TrainSchedule,
+    TripNormalizationCache,
+    normalize_trip_update_entities,
+    parse_feed_message,
+)
+from gtfs_rt_vehicle import YamanoteTrainPosition, parse_vehicle_entities, partition_entities_by_route
+from train_position_v4 import precompute_effective_times
+
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
+logger = logging.getLogger(__name__)
+
+# 正規化の単位: (gtfs_route_id, mt3d_prefix)
+LineKey = Tuple[str, str]
+
+# 実行方式
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass
+class DecodedFeed:
+    """1フィード分のデコード結果"""
+
+    ok: bool  # デコードに成功したか
+    header_timestamp: Optional[int] = None
+    normalized: bool = False  # header.timestamp が前回と同じなら False（正規化を省略）
+
+
+@dataclass
+class DecodeResult:
+    """デコード・正規化ステージの出力（executor からループへ返すプレーンデータ）"""
+
+    trip: Optional[DecodedFeed] = None
+    vehicle: Optional[DecodedFeed] = None
+    total_entities: int = 0
+    route_id_summary: Dict[str, Dict] = field(default_factory=dict)
+    schedules: Dict[LineKey, Dict[str, TrainSchedule]] = field(default_factory=dict)
+    vehicles: Dict[LineKey, Dict[str, YamanoteTrainPosition]] = field(default_factory=dict)
+    elapsed: float = 0.0  # ワーカー内での処理時間 (seconds)
+    trip_cache_stats: Dict[str, int] = field(default_factory=dict)  # {"reused", "normalized", "evicted"}
+
+
+def summarize_route_ids(feed) -> Dict[str, Dict]:
+    """デバッグ用: フィードに含まれる route_id ごとの件数とサンプル trip_id を集計する"""
+    route_ids: Dict[str, Dict] = {}
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        route_id = entity.trip_update.trip.route_id or "(empty)"
+        trip_id = entity.trip_update.trip.trip_id
+        if route_id not in route_ids:
+            route_ids[route_id] = {"count": 0, "sample_trip_ids": []}
+        route_ids[route_id]["count"] += 1
+        if len(route_ids[route_id]["sample_trip_ids"]) < 3:
+            route_ids[route_id]["sample_trip_ids"].append(trip_id)
+    return route_ids
+
+
+# ============================================================================
+# Decode + Normalize
+# ============================================================================
+
+# プロセスプールのワーカーが保持する DataCache（initializer で設定）
+_worker_data_cache: Optional["DataCache"] = None
+
+
+# 路線ごとの列車単位正規化キャッシュ。
+# executor のワーカー（スレッド / プロセス）側で保持し、フィード間で再利用する。
+# ポーラーは1周期ずつ順に投入するため、同じキャッシュに同時アクセスはしない。
+_trip_caches: Dict[LineKey, TripNormalizationCache] = {}
+# _trip_caches を作ったときの DataCache.data_version（変わったら破棄する）
+_trip_caches_version: Optional[int] = None
+
+
+def _sync_trip_caches(data_version: Optional[int]) -> None:
+    """静的データが再読み込みされていれば正規化キャッシュを破棄する"""
+    global _trip_caches_version
+    if data_version is None or data_version == _trip_caches_version:
+        return
+    if _trip_caches:
+        logger.info("Static data reloaded (version %s): clearing trip normalization caches", data_version)
+    _trip_caches.clear()
+    _trip_caches_version = data_version
+
+
+def _get_trip_cache(key: LineKey) -> TripNormalizationCache:
+    cache = _trip_caches.get(key)
+    if cache is None:
+        cache = _trip_caches[key] = TripNormalizationCache()
+    return cache
+
+
+def _init_worker(data_cache: "DataCache") -> None:
+    global _worker_data_cache
+    _worker_data_cache = data_cache
+
+
+def _header_timestamp(feed) -> Optional[int]:
+    return feed.header.timestamp if feed.header.HasField("timestamp") else None
+
+
+def decode_and_normalize(
+    trip_content: Optional[bytes],
+    vehicle_content: Optional[bytes],
+    line_keys: Iterable[LineKey],
+    prev_trip_timestamp: Optional[int] = None,
+    prev_vehicle_timestamp: Optional[int] = None,
+    data_cache: Optional["DataCache"] = None,
+    data_version: Optional[int] = None,
+) -> DecodeResult:
+    """
+    フィードのバイト列をデコードし、路線ごとに正規化する。
+
+    header.timestamp が前回 (prev_*_timestamp) と同じフィードは正規化を省略する。
+    data_cache が None の場合はワーカーに設定済みのものを使う（プロセスプール）。
+    data_version は呼び出し元（メインプロセス）の DataCache.data_version。
+    前回と異なれば列車単位の正規化キャッシュを破棄してから正規化する。
+    """
+    started = time.perf_counter()
+    # 実質時刻のキャッシュは DataCache 本体に紐づくので、同一プロセス（スレッドプール）のときだけ事前計算する
+    precompute = data_cache is not None
+    data_cache = data_cache if data_cache is not None else _worker_data_cache
+    line_keys = list(line_keys)
+    result = DecodeResult()
+
+    if trip_content is not None:
+        feed = parse_feed_message(trip_content)
+        if feed is None:
+            result.trip = DecodedFeed(ok=False)
+        else:
+            ts = _header_timestamp(feed)
+            same = ts is not None and ts == prev_trip_timestamp
+            result.trip = DecodedFeed(ok=True, header_timestamp=ts, normalized=not same)
+            if not same:
+                result.total_entities = len(feed.entity)
+                result.route_id_summary = summarize_route_ids(feed)
+                # フィードは1回だけ走査して route_id -> [entity] に振り分ける
+                index = partition_entities_by_route(feed, "trip_update")
+                _sync_trip_caches(data_version)
+                totals = {"reused": 0, "normalized": 0, "evicted": 0}
+                for route_id, mt3d_prefix in line_keys:
+                    cache = _get_trip_cache((route_id, mt3d_prefix))
+                    result.schedules[(route_id, mt3d_prefix)] = normalize_trip_update_entities(
+                        index.get(route_id, []),
+                        ts,
+                        data_cache,
+                        target_route_id=route_id,
+                        mt3d_prefix=mt3d_prefix,
+                        cache=cache,
+                    )
+                    if precompute:
+                        precompute_effective_times(result.schedules[(route_id, mt3d_prefix)], data_cache)
+                    for name, count in cache.last_stats.items():
+                        totals[name] += count
+                result.trip_cache_stats = totals
+
+    if vehicle_content is not None:
+        feed = parse_feed_message(vehicle_content)
+        if feed is None:
+            result.vehicle = DecodedFeed(ok=False)
+        else:
+            ts = _header_timestamp(feed)
+            same = ts is not None and ts == prev_vehicle_timestamp
+            result.vehicle = DecodedFeed(ok=True, header_timestamp=ts, normalized=not same)
+            if not same:
+                index = partition_entities_by_route(feed, "vehicle")
+                for route_id, mt3d_prefix in line_keys:
+                    vehicles = parse_vehicle_entities(index.get(route_id, []), route_id)
+                    result.vehicles[(route_id, mt3d_prefix)] = {vp.trip_id: vp for vp in vehicles}
+
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+# ============================================================================
+# Executor
+# ============================================================================
+
+
+def create_decode_executor(kind: str, workers: int, data_cache: "DataCache") -> Executor:
+    """
+    デコード用の executor を作成する。
+
+    Args:
+        kind: "thread" / "process"
+        workers: ワーカー数
+        data_cache: プロセスプールのワーカーに渡す静的データ
+
+    プロセスプールのワーカー数は1に固定する（正規化キャッシュをプロセス間で共有できないため）。
+    """
+    kind = (kind or EXECUTOR_THREAD).strip().lower()
+    workers = max(1, int(workers))
+    if kind == EXECUTOR_PROCESS:
+        if workers > 1:
+            logger.warning(
+                "FEED_DECODE_WORKERS=%d ignored for process pool: using 1 worker to keep the trip cache warm", workers
+            )
+        logger.info("Feed decode executor: process pool (workers=1)")
+        return ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(data_cache,))
+    if kind != EXECUTOR_THREAD:
+        logger.warning("Unknown FEED_DECODE_EXECUTOR=%r, falling back to thread pool", kind)
+    logger.info("Feed decode executor: thread pool (workers=%d)", workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feed-decode")
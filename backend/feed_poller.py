@@ -0,0 +1,344 @@
+# backend/feed_poller.py
+"""
+GTFS-RT 共有ポーラー
+
+JR東日本の TripUpdate / VehiclePosition フィードをバックグラウンドで
+1周期に1回だけ取得・デコードし、全路線分の正規化結果を
+イミュータブルなスナップショットとして公開する。
+
+各エンドポイントはフィードを自前で取得せず、最新スナップショットを参照する。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional
+
+import httpx
+
+from config import SUPPORTED_LINES, LineConfig
+from constants import FEED_LOOP_BLOCK_BUDGET, FEED_POLL_INTERVAL, TRIP_UPDATE_URL, VEHICLE_POSITION_URL
+from feed_decoder import DecodedFeed, DecodeResult, LineKey, decode_and_normalize
+from feed_version import FETCH_ERROR, ConditionalFeedFetcher, FeedFetchResult
+from gtfs_rt_tripupdate import TrainSchedule
+from gtfs_rt_vehicle import YamanoteTrainPosition
+
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass(frozen=True)
+class LineFeed:
+    """1路線分の正規化済みフィード"""
+
+    route_id: str
+    schedules: Mapping[str, TrainSchedule]  # {trip_id: TrainSchedule}
+    vehicle_positions: Mapping[str, YamanoteTrainPosition]  # {trip_id: VehiclePosition}
+
+
+@dataclass(frozen=True)
+class FeedSnapshot:
+    """1ポーリング周期分のフィード全体のスナップショット（読み取り専用）"""
+
+    fetched_at: float  # 取得完了時刻 (unix seconds)
+    feed_timestamp: Optional[int]  # TripUpdate feed.header.timestamp
+    total_entities: int  # TripUpdate フィードの全エンティティ数
+    lines: Mapping[str, LineFeed]  # {line_id: LineFeed}
+    route_id_summary: Mapping[str, Mapping]  # {route_id: {"count", "sample_trip_ids"}}
+    version: str = ""  # フィード版（TripUpdate と VehiclePosition の版を連結したもの）
+
+    def get_line(self, line_id: str) -> Optional[LineFeed]:
+        return self.lines.get(line_id)
+
+
+# ============================================================================
+# Poller
+# ============================================================================
+
+
+class FeedPoller:
+    """
+    バックグラウンドで GTFS-RT フィードを定期取得し、最新スナップショットを保持する。
+
+    スナップショットは毎周期まるごと差し替えるため、読み手はロック不要。
+    取得に失敗した周期、およびフィードが前回から変わっていない周期は
+    直前のスナップショットを維持する。
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        api_key: str,
+        data_cache: "DataCache",
+        interval: float = FEED_POLL_INTERVAL,
+        lines: Optional[Dict[str, LineConfig]] = None,
+        executor: Optional[Executor] = None,
+        loop_block_budget: float = FEED_LOOP_BLOCK_BUDGET,
+    ) -> None:
+        self.client = client
+        self.api_key = api_key
+        self.data_cache = data_cache
+        self.interval = interval
+        self.lines = lines if lines is not None else SUPPORTED_LINES
+        # デコード・正規化を実行する executor（None ならイベントループ既定のスレッドプール）
+        self.executor = executor
+        self.loop_block_budget = loop_block_budget
+        self.loop_stats: Dict[str, float] = {
+            "polls": 0,
+            "last_loop_blocking_ms": 0.0,
+            "max_loop_blocking_ms": 0.0,
+            "last_decode_ms": 0.0,
+            "budget_exceeded": 0,
+        }
+        # 直近に正規化した周期の列車単位キャッシュ統計 {"reused", "normalized", "evicted"}
+        self.trip_cache_stats: Dict[str, int] = {}
+
+        self._snapshot: Optional[FeedSnapshot] = None
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        # 条件付き取得（ETag / Last-Modified / 本文ハッシュ / header.timestamp）で
+        # 変化のない周期はデコード以降をすべて省略する
+        self.trip_fetcher = ConditionalFeedFetcher("TripUpdate")
+        self.vehicle_fetcher = ConditionalFeedFetcher("VehiclePosition")
+
+    @property
+    def snapshot(self) -> Optional[FeedSnapshot]:
+        return self._snapshot
+
+    def start(self) -> None:
+        """ポーリングタスクを開始する（二重起動はしない）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="gtfs-rt-feed-poller")
+            logger.info("FeedPoller started (interval=%.1fs, lines=%d)", self.interval, len(self.lines))
+
+    async def stop(self) -> None:
+        """ポーリングタスクを停止する"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("FeedPoller stopped")
+
+    async def wait_for_snapshot(self, timeout: float) -> Optional[FeedSnapshot]:
+        """
+        最初のスナップショットが公開されるまで待つ。
+        既に公開済みなら即座に返す。タイムアウト時は None。
+        """
+        if self._snapshot is not None:
+            return self._snapshot
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self._snapshot
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"FeedPoller cycle failed: {e}")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(0.0, self.interval - elapsed))
+
+    @property
+    def feed_version(self) -> Optional[str]:
+        """現在公開中のフィード版（キャッシュのキーに使う）。未取得なら None。"""
+        return self._snapshot.version if self._snapshot is not None else None
+
+    def get_status(self) -> Dict:
+        """デバッグ/API用の状態"""
+        snapshot = self._snapshot
+        return {
+            "version": snapshot.version if snapshot else None,
+            "fetched_at": snapshot.fetched_at if snapshot else None,
+            "feed_timestamp": snapshot.feed_timestamp if snapshot else None,
+            "interval": self.interval,
+            "executor": type(self.executor).__name__ if self.executor is not None else "default",
+            "loop_block_budget_ms": self.loop_block_budget * 1000,
+            "loop": dict(self.loop_stats),
+            "trip_cache": dict(self.trip_cache_stats),
+            "trip_update": self.trip_fetcher.get_status(),
+            "vehicle_position": self.vehicle_fetcher.get_status(),
+        }
+
+    async def poll_once(self) -> Optional[FeedSnapshot]:
+        """
+        両フィードを条件付きで1回ずつ取得し、変化があったときだけ
+        デコード・正規化して全路線分のスナップショットを公開する。
+
+        デコード・正規化は executor 上で行い、イベントループ上では
+        条件付き取得の判定とスナップショットの組み立てだけを行う。
+
+        Returns:
+            公開したスナップショット。どちらのフィードも新しい版でなければ None（旧スナップショットを維持）。
+        """
+        params = {"acl:consumerKey": self.api_key}
+        trip_result, vehicle_result = await asyncio.gather(
+            self.trip_fetcher.fetch(self.client, TRIP_UPDATE_URL, params=params),
+            self.vehicle_fetcher.fetch(self.client, VEHICLE_POSITION_URL, params=params, timeout=30.0),
+        )
+
+        if not trip_result.changed and not vehicle_result.changed:
+            if trip_result.status == FETCH_ERROR:
+                logger.warning("FeedPoller: TripUpdate unavailable, keeping previous snapshot")
+            return None
+        if self._snapshot is None and not trip_result.changed:
+            # 初回は TripUpdate が得られるまで公開しない
+            return None
+
+        decoded = await self._run_decode(trip_result, vehicle_result)
+
+        # ここからスナップショット公開までがイベントループを占有する区間
+        blocking_started = time.perf_counter()
+        trip_updated = self._commit(trip_result, decoded.trip, self.trip_fetcher)
+        vehicle_updated = self._commit(vehicle_result, decoded.vehicle, self.vehicle_fetcher)
+
+        snapshot = None
+        if trip_updated or (vehicle_updated and self._snapshot is not None):
+            snapshot = self._build_snapshot(decoded, trip_updated, vehicle_updated)
+            self._snapshot = snapshot
+            self._ready.set()
+        self._record_loop_blocking(time.perf_counter() - blocking_started, decoded)
+        return snapshot
+
+    async def _run_decode(self, trip_result: FeedFetchResult, vehicle_result: FeedFetchResult) -> DecodeResult:
+        """変化のあったフィードだけを executor でデコード・正規化する"""
+        prev_trip = self.trip_fetcher.version
+        prev_vehicle = self.vehicle_fetcher.version
+        # プロセスプールのワーカーは起動時に DataCache を受け取っている
+        data_cache = None if isinstance(self.executor, ProcessPoolExecutor) else self.data_cache
+        job = functools.partial(
+            decode_and_normalize,
+            trip_result.content if trip_result.changed else None,
+            vehicle_result.content if vehicle_result.changed else None,
+            self._line_keys(),
+            prev_trip_timestamp=prev_trip.header_timestamp if prev_trip else None,
+            prev_vehicle_timestamp=prev_vehicle.header_timestamp if prev_vehicle else None,
+            data_cache=data_cache,
+            # ワーカーの DataCache は起動時のコピーなので、再読み込みの検知にはメインプロセスの版を渡す
+            data_version=getattr(self.data_cache, "data_version", None),
+        )
+        return await asyncio.get_running_loop().run_in_executor(self.executor, job)
+
+    def _line_keys(self) -> List[LineKey]:
+        """正規化の単位 (gtfs_route_id, mt3d_prefix) を重複なく列挙する"""
+        return list(dict.fromkeys((conf.gtfs_route_id, conf.mt3d_id) for conf in self.lines.values()))
+
+    @staticmethod
+    def _commit(result: FeedFetchResult, decoded: Optional[DecodedFeed], fetcher: ConditionalFeedFetcher) -> bool:
+        """デコード結果を見て新しい版として確定する。新しい版なら True。"""
+        if not result.changed or decoded is None:
+            return False
+        if not decoded.ok:
+            fetcher.invalidate()
+            return False
+        if not fetcher.commit(result, decoded.header_timestamp):
+            logger.debug("FeedPoller: %s header.timestamp unchanged, skipping", fetcher.name)
+            return False
+        return True
+
+    def _record_loop_blocking(self, blocking: float, decode: DecodeResult) -> None:
+        """1周期あたりのイベントループ占有時間を記録し、予算超過を警告する"""
+        stats = self.loop_stats
+        stats["polls"] += 1
+        stats["last_loop_blocking_ms"] = round(blocking * 1000, 3)
+        stats["max_loop_blocking_ms"] = max(stats["max_loop_blocking_ms"], stats["last_loop_blocking_ms"])
+        stats["last_decode_ms"] = round(decode.elapsed * 1000, 3)
+        if decode.trip_cache_stats:
+            self.trip_cache_stats = dict(decode.trip_cache_stats)
+        if blocking > self.loop_block_budget:
+            stats["budget_exceeded"] += 1
+            logger.warning(
+                "FeedPoller: event loop blocked for %.1fms (budget %.1fms)",
+                blocking * 1000,
+                self.loop_block_budget * 1000,
+            )
+
+    def _build_snapshot(self, decoded: DecodeResult, trip_updated: bool, vehicle_updated: bool) -> FeedSnapshot:
+        """
+        デコード結果からスナップショットを組み立てる。
+        更新されなかった側のフィードは直前のスナップショットの結果を使い回す。
+        """
+        previous = self._snapshot
+        if trip_updated:
+            feed_timestamp = decoded.trip.header_timestamp
+            total_entities = decoded.total_entities
+            route_id_summary = MappingProxyType(decoded.route_id_summary)
+        else:
+            feed_timestamp = previous.feed_timestamp
+            total_entities = previous.total_entities
+            route_id_summary = previous.route_id_summary
+
+        # 同じ (route_id, mt3d_prefix) の路線は LineFeed を共有する
+        built: Dict[LineKey, LineFeed] = {}
+        lines: Dict[str, LineFeed] = {}
+
+        for line_id, conf in self.lines.items():
+            key = (conf.gtfs_route_id, conf.mt3d_id)
+            line_feed = built.get(key)
+            if line_feed is None:
+                prev_line = previous.get_line(line_id) if previous is not None else None
+                empty = MappingProxyType({})
+
+                if trip_updated:
+                    schedules = MappingProxyType(decoded.schedules.get(key, {}))
+                else:
+                    schedules = prev_line.schedules if prev_line is not None else empty
+
+                if vehicle_updated:
+                    vehicle_positions = MappingProxyType(decoded.vehicles.get(key, {}))
+                else:
+                    vehicle_positions = prev_line.vehicle_positions if prev_line is not None else empty
+
+                line_feed = LineFeed(
+                    route_id=conf.gtfs_route_id,
+                    schedules=schedules,
+                    vehicle_positions=vehicle_positions,
+                )
+                built[key] = line_feed
+            lines[line_id] = line_feed
+
+        version = self._combined_version()
+        logger.info(
+            "FeedPoller: published snapshot (version=%s, trip_updated=%s, vehicle_updated=%s, decode=%.1fms)",
+            version,
+            trip_updated,
+            vehicle_updated,
+            decoded.elapsed * 1000,
+        )
+
+        return FeedSnapshot(
+            fetched_at=time.time(),
+            feed_timestamp=feed_timestamp,
+            total_entities=total_entities,
+            lines=MappingProxyType(lines),
+            route_id_summary=route_id_summary,
+            version=version,
+        )
+
+    def _combined_version(self) -> str:
+        """TripUpdate / VehiclePosition 両方の版を合わせた識別子"""
+        trip = self.trip_fetcher.version.tag if self.trip_fetcher.version else "none"
+        vehicle = self.vehicle_fetcher.version.tag if self.vehicle_fetcher.version else "none"
+        return f"{trip}.{vehicle}"
@@ -0,0 +1,165 @@
+# backend/feed_version.py
+"""
+GTFS-RT フィードのバージョン管理（条件付き取得と重複排除）
+
+ODPT のフィードが前回から変わっていない場合に、
+再ダウンロード・再デコード・再正規化をすべて省略するための層。
+
+判定は以下の順で行う:
+  1. ETag / Last-Modified による条件付きリクエスト（304 Not Modified）
+  2. レスポンス本文のハッシュ比較（サーバーが条件付きリクエスト非対応の場合）
+  3. デコード後の feed.header.timestamp 比較（本文が変わっても時刻が同じなら同一とみなす）
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import httpx
+
+from constants import HTTP_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# FeedFetchResult.status の値
+FETCH_UPDATED = "updated"  # 新しい本文を取得した（要デコード）
+FETCH_NOT_MODIFIED = "not_modified"  # 304 が返った
+FETCH_UNCHANGED = "unchanged"  # 200 だが本文ハッシュが前回と同じ
+FETCH_ERROR = "error"  # 取得失敗
+
+
+@dataclass(frozen=True)
+class FeedVersion:
+    """フィード1版を識別する情報"""
+
+    header_timestamp: Optional[int]  # feed.header.timestamp
+    content_hash: str  # 本文の SHA-1
+
+    @property
+    def tag(self) -> str:
+        """キャッシュキーに使う短い文字列表現"""
+        return f"{self.header_timestamp or 0}-{self.content_hash[:12]}"
+
+
+@dataclass(frozen=True)
+class FeedFetchResult:
+    """条件付き取得の結果"""
+
+    status: str
+    content: Optional[bytes] = None  # status == FETCH_UPDATED のときのみ
+    content_hash: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return self.status == FETCH_UPDATED
+
+
+class ConditionalFeedFetcher:
+    """
+    1つのフィードURLについて、前回取得時の検証情報を保持する取得器。
+
+    使い方:
+        result = await fetcher.fetch(client, url, params)
+        if result.changed:
+            feed = parse_feed_message(result.content)
+            if fetcher.commit(result, header_timestamp):
+                ...  # 新しい版としてデコード結果を使う
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.version: Optional[FeedVersion] = None
+        # 直近に受信した本文のハッシュ（版が据え置きでも更新する）
+        self._last_content_hash: Optional[str] = None
+        self.stats: Dict[str, int] = {
+            FETCH_UPDATED: 0,
+            FETCH_NOT_MODIFIED: 0,
+            FETCH_UNCHANGED: 0,
+            FETCH_ERROR: 0,
+            "same_header_timestamp": 0,
+        }
+
+    def _conditional_headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    async def fetch(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        params: Optional[Dict[str, str]] = None,
+        timeout: float = HTTP_TIMEOUT,
+    ) -> FeedFetchResult:
+        """
+        条件付きでフィードを取得する。例外は送出せず FETCH_ERROR を返す。
+        """
+        try:
+            response = await client.get(url, params=params, headers=self._conditional_headers(), timeout=timeout)
+            if response.status_code == 304:
+                self.stats[FETCH_NOT_MODIFIED] += 1
+                return FeedFetchResult(status=FETCH_NOT_MODIFIED)
+            response.raise_for_status()
+        except Exception as e:
+            logger.error(f"Failed to fetch {self.name} feed: {e}")
+            self.stats[FETCH_ERROR] += 1
+            return FeedFetchResult(status=FETCH_ERROR)
+
+        # 次回の条件付きリクエスト用に検証情報を保存
+        self.etag = response.headers.get("ETag") or self.etag
+        self.last_modified = response.headers.get("Last-Modified") or self.last_modified
+
+        content = response.content
+        content_hash = hashlib.sha1(content).hexdigest()
+        if content_hash == self._last_content_hash:
+            self.stats[FETCH_UNCHANGED] += 1
+            return FeedFetchResult(status=FETCH_UNCHANGED, content_hash=content_hash)
+
+        return FeedFetchResult(status=FETCH_UPDATED, content=content, content_hash=content_hash)
+
+    def commit(self, result: FeedFetchResult, header_timestamp: Optional[int]) -> bool:
+        """
+        デコード後の header.timestamp を見て、新しい版として確定するか判定する。
+
+        Returns:
+            新しい版なら True。header.timestamp が前回と同じなら False（下流の処理は不要）。
+        """
+        self._last_content_hash = result.content_hash
+        if (
+            self.version is not None
+            and header_timestamp is not None
+            and header_timestamp == self.version.header_timestamp
+        ):
+            self.stats["same_header_timestamp"] += 1
+            return False
+
+        self.version = FeedVersion(header_timestamp=header_timestamp, content_hash=result.content_hash or "")
+        self.stats[FETCH_UPDATED] += 1
+        return True
+
+    def invalidate(self) -> None:
+        """
+        検証情報を破棄する。デコードに失敗した本文を 304 / ハッシュ一致で
+        使い回さないよう、次回は必ず本文を取り直す。
+        """
+        self.etag = None
+        self.last_modified = None
+        self._last_content_hash = None
+
+    def get_status(self) -> Dict:
+        """デバッグ/API用の状態"""
+        return {
+            "version": self.version.tag if self.version else None,
+            "header_timestamp": self.version.header_timestamp if self.version else None,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "stats": dict(self.stats),
+        }
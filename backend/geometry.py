@@ -1,5 +1,9 @@
 # backend/geometry.py
-from typing import Dict, List, Optional, Tuple
+import math
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from spatial_index import RailwayIndex
 
 
 def build_all_railways_cache(coordinates: Dict) -> Dict[str, List[List[float]]]:
@@ -27,7 +31,11 @@ def build_all_railways_cache(coordinates: Dict) -> Dict[str, List[List[float]]]:
     return cache
 
 
-def resolve_subline_coords(subline: Dict, all_railways_cache: Dict[str, List[List[float]]]) -> List[List[float]]:
+def resolve_subline_coords(
+    subline: Dict,
+    all_railways_cache: Dict[str, List[List[float]]],
+    spatial_index: Optional["RailwayIndex"] = None,
+) -> List[List[float]]:
     """
     sublineの座標を解決する。
     - type=main: subline自身のcoordsを返す
@@ -36,6 +44,7 @@ def resolve_subline_coords(subline: Dict, all_railways_cache: Dict[str, List[Lis
     Args:
         subline: coordinates.jsonのsublineオブジェクト
         all_railways_cache: 全路線の座標キャッシュ
+        spatial_index: all_railways_cache と同じ座標から構築した空間インデックス（省略時は線形探索）
 
     Returns:
         解決された座標リスト
@@ -66,7 +75,11 @@ def resolve_subline_coords(subline: Dict, all_railways_cache: Dict[str, List[Lis
     start_point = coords[0]
     end_point = coords[-1]
 
+    ref_index = spatial_index.line(ref_railway) if spatial_index is not None else None
+
     def find_nearest_idx(point, coord_list):
+        if ref_index is not None:
+            return ref_index.nearest_by_degrees(point[0], point[1])
         min_dist = float("inf")
         min_idx = 0
         for i, c in enumerate(coord_list):
@@ -88,7 +101,10 @@ def resolve_subline_coords(subline: Dict, all_railways_cache: Dict[str, List[Lis
 
 
 def merge_sublines_v2(
-    sublines: List[Dict], is_loop: bool = False, all_railways_cache: Optional[Dict[str, List[List[float]]]] = None
+    sublines: List[Dict],
+    is_loop: bool = False,
+    all_railways_cache: Optional[Dict[str, List[List[float]]]] = None,
+    spatial_index: Optional["RailwayIndex"] = None,
 ) -> List[List[float]]:
     """
     sublinesを正しい順序でマージし、連続した座標配列を返す。
@@ -98,6 +114,7 @@ def merge_sublines_v2(
         sublines: coordinates.jsonのsublines配列
         is_loop: 環状路線かどうか
         all_railways_cache: 全路線の座標キャッシュ（参照解決用）
+        spatial_index: 参照先の最近傍探索に使う空間インデックス（省略可）
 
     Returns:
         マージされた座標のリスト [[lon, lat], ...]
@@ -119,7 +136,7 @@ def merge_sublines_v2(
     valid_sublines: List[Tuple[int, List[List[float]]]] = []
     for i, sub in enumerate(sublines):
         # 参照解決: type=subなら参照先の座標を使用
-        coords = resolve_subline_coords(sub, all_railways_cache)
+        coords = resolve_subline_coords(sub, all_railways_cache, spatial_index)
         if len(coords) >= 2:
             valid_sublines.append((i, coords))
 
@@ -269,3 +286,133 @@ def merge_sublines_fallback(sublines: List[Dict]) -> List[List[float]]:
         current_end = result[-1]
 
     return result
+
+
+def merge_railway_sublines(
+    entry: Dict,
+    all_railways_cache: Dict[str, List[List[float]]],
+    spatial_index: Optional["RailwayIndex"] = None,
+) -> List[List[float]]:
+    """
+    coordinates.json の路線エントリのsublinesをマージする。
+    グラフベースのマージ (merge_sublines_v2) に失敗した場合は距離ベースの貪欲法で接続する。
+    """
+    sublines = entry.get("sublines", [])
+    merged = merge_sublines_v2(
+        sublines,
+        is_loop=entry.get("loop", False),
+        all_railways_cache=all_railways_cache,
+        spatial_index=spatial_index,
+    )
+    if not merged:
+        merged = merge_sublines_fallback(sublines)
+    return merged
+
+
+class LonLatView(Sequence[Tuple[float, float]]):
+    """
+    経度・緯度の配列（array / mmap 上の memoryview）を [(lon, lat), ...] として読む読み取り専用ビュー
+
+    コンパイル済みの線路形状を座標リストに展開せずに、座標列を受け取る関数へ渡すのに使う。
+    """
+
+    __slots__ = ("lons", "lats")
+
+    def __init__(self, lons: Sequence[float], lats: Sequence[float]) -> None:
+        self.lons = lons
+        self.lats = lats
+
+    def __len__(self) -> int:
+        return len(self.lons)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(zip(self.lons[i], self.lats[i]))
+        return (self.lons[i], self.lats[i])
+
+    def __iter__(self) -> Iterator[Tuple[float, float]]:
+        return zip(self.lons, self.lats)
+
+
+def douglas_peucker_importance(coords: Sequence[Sequence[float]]) -> List[float]:
+    """
+    Douglas-Peucker 法で各頂点が残る許容誤差の上限 (m) を求める。
+
+    頂点 i は許容誤差 tolerance に対して importance[i] > tolerance のとき残る。
+    1回の計算で任意の許容誤差の結果が得られるので、複数の詳細度レベルをまとめて作れる。
+    始点・終点は常に残る (inf)。
+    """
+    if isinstance(coords, LonLatView):
+        return douglas_peucker_importance_lonlat(coords.lons, coords.lats)
+    return douglas_peucker_importance_lonlat([c[0] for c in coords], [c[1] for c in coords])
+
+
+def douglas_peucker_importance_lonlat(lons: Sequence[float], lats: Sequence[float]) -> List[float]:
+    """
+    経度・緯度の配列から douglas_peucker_importance を求める。
+
+    経緯度は座標列の平均緯度を基準に正距円筒図法でメートルに換算して距離を測る。
+    """
+    n = len(lons)
+    importance = [math.inf] * n
+    if n <= 2:
+        return importance
+
+    ref_lat = sum(lats) / n
+    kx = 111320.0 * math.cos(math.radians(ref_lat))
+    ky = 110540.0
+    xs = [lon * kx for lon in lons]
+    ys = [lat * ky for lat in lats]
+
+    # 再帰の代わりに区間スタックで処理（長い路線でも再帰上限に当たらない）
+    # (first, last, 親の分割点の重要度): 子の重要度は親を超えない
+    stack: List[Tuple[int, int, float]] = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        seg_sq = dx * dx + dy * dy
+        max_sq = -1.0
+        max_idx = first
+        for i in range(first + 1, last):
+            px, py = xs[i] - ax, ys[i] - ay
+            if seg_sq == 0:
+                d_sq = px * px + py * py
+            else:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / seg_sq))
+                ex, ey = px - t * dx, py - t * dy
+                d_sq = ex * ex + ey * ey
+            if d_sq > max_sq:
+                max_sq = d_sq
+                max_idx = i
+        weight = min(math.sqrt(max_sq), parent)
+        importance[max_idx] = weight
+        stack.append((first, max_idx, weight))
+        stack.append((max_idx, last, weight))
+
+    return importance
+
+
+def simplify_douglas_peucker(
+    coords: List[List[float]],
+    tolerance_m: float,
+    importance: Optional[List[float]] = None,
+) -> List[List[float]]:
+    """
+    Douglas-Peucker 法で折れ線を間引く（ズームに応じた詳細度 LOD 用）。
+
+    Args:
+        coords: [[lon, lat], ...]
+        tolerance_m: 許容誤差 (m)。0以下なら間引かない
+        importance: douglas_peucker_importance の結果（複数レベルを作るときに使い回す）
+
+    Returns:
+        間引いた座標のリスト（元の座標オブジェクトをそのまま含む）
+    """
+    if tolerance_m <= 0 or len(coords) <= 2:
+        return list(coords)
+    if importance is None:
+        importance = douglas_peucker_importance(coords)
+    return [c for c, w in zip(coords, importance) if w > tolerance_m]
@@ -0,0 +1,449 @@
+# backend/geometry_compiler.py
+"""
+線路形状のオフラインコンパイル
+
+coordinates.json の sublines のマージ（merge_sublines_v2 のグラフ構築・DFS と
+resolve_subline_coords の参照解決）と、累積距離・方位角・駅の対応頂点の計算を
+ビルド時に1回だけ行い、駅座標と合わせて1つのバイナリファイルに保存する。
+
+DataCache は起動時にこのファイルを読み取り専用で mmap し、頂点・駅座標の配列を
+コピーせずに参照する。複数ワーカーで起動しても配列はページキャッシュを共有するので、
+ワーカーを増やしてもメモリはほとんど増えない。
+元データ（coordinates.json・railways.json・駅座標）のハッシュが一致しない場合だけ再コンパイルする。
+
+使い方:
+    python geometry_compiler.py [--data-dir DIR] [--out FILE]
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from geometry import build_all_railways_cache, merge_railway_sublines
+from track_geometry import LineGeometry, StationChainage, build_line_geometry
+
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
+logger = logging.getLogger(__name__)
+
+# ファイル形式のバージョン（レイアウトや距離・方位角の求め方を変えたら上げる）
+FORMAT_VERSION = 3
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+# ============================================================================
+# Source Hashes
+# ============================================================================
+
+
+def file_sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def station_rows_sha256(rows: Iterable[Tuple[str, float, float]]) -> str:
+    """駅ID の昇順に並んだ (station_id, lon, lat) の列のハッシュ（DB の行を辞書にせずに流し込める）"""
+    digest = hashlib.sha256()
+    for station_id, lon, lat in rows:
+        digest.update(f"{station_id}\t{lon!r}\t{lat!r}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def station_positions_sha256(station_positions: Mapping[str, Tuple[float, float]]) -> str:
+    return station_rows_sha256((sid, *station_positions[sid]) for sid in sorted(station_positions))
+
+
+def source_hashes(coordinates_path: Path, railways_path: Path, station_positions_hash: str) -> Dict[str, str]:
+    """コンパイル結果が依存する元データのハッシュ"""
+    return {
+        "coordinates": file_sha256(coordinates_path),
+        "railways": file_sha256(railways_path),
+        "station_positions": station_positions_hash,
+    }
+
+
+# ============================================================================
+# Binary Format
+# ============================================================================
+#
+# 1ファイル（リトルエンディアン）に全路線の頂点と駅をまとめ、各ワーカーは mmap で共有する。
+#
+#   ヘッダ (magic, version, manifest 長) + manifest (JSON) + 8バイト境界に揃えたセクション
+#
+#   vertex_lon / vertex_lat / vertex_cumulative   float64[全頂点数]
+#   edge_forward / edge_backward                  float64[全頂点数]（路線 i の辺は先頭 n_i - 1 個）
+#   station_lon / station_lat                     float64[駅数]（駅IDの UTF-8 バイト列順）
+#   station_id_offsets                            uint32[駅数 + 1]（station_ids 内の位置）
+#   chainage_offset                               float64[路線駅数]（最寄り頂点までの距離 m）
+#   chainage_vertex / chainage_station            uint32[路線駅数]（路線内の頂点・駅の番号）
+#   station_ids                                   UTF-8 の駅IDを連結したバイト列
+#
+# manifest には元データのハッシュ・セクションの位置・路線表（ID・色・頂点と駅の範囲）を持つ。
+
+_MAGIC = b"NTGM"
+_HEADER = struct.Struct("<4sHxxI")
+
+_SECTIONS = (
+    ("vertex_lon", "d"),
+    ("vertex_lat", "d"),
+    ("vertex_cumulative", "d"),
+    ("edge_forward", "d"),
+    ("edge_backward", "d"),
+    ("station_lon", "d"),
+    ("station_lat", "d"),
+    ("station_id_offsets", "I"),
+    ("chainage_offset", "d"),
+    ("chainage_vertex", "I"),
+    ("chainage_station", "I"),
+    ("station_ids", "B"),
+)
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _to_le_bytes(values: array) -> bytes:
+    if _LITTLE_ENDIAN or values.itemsize == 1:
+        return values.tobytes()
+    swapped = array(values.typecode, values)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+class MappedStationPositions(Mapping[str, Tuple[float, float]]):
+    """
+    駅ID → (lon, lat) の読み取り専用マッピング。座標は mmap 上の配列を直接参照する。
+
+    駅IDの番号引きの辞書だけは各ワーカーが持つ（駅数分の小さな辞書）。
+    """
+
+    def __init__(self, ids: List[str], lons: Sequence[float], lats: Sequence[float]) -> None:
+        self._index = {station_id: i for i, station_id in enumerate(ids)}
+        self._lons = lons
+        self._lats = lats
+
+    def __getitem__(self, station_id: str) -> Tuple[float, float]:
+        i = self._index[station_id]
+        return (self._lons[i], self._lats[i])
+
+    def __contains__(self, station_id: object) -> bool:
+        return station_id in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+@dataclass
+class CompiledGeometry:
+    """
+    コンパイル済みの線路形状と駅座標（mmap したファイルを参照する）
+
+    配列は mmap 上のビューなのでそのままでは pickle できない。
+    プロセスプール（spawn / forkserver）のワーカーへ渡すときはファイルのパスと元データのハッシュだけを送り、
+    ワーカー側で同じファイルを mmap し直す（ファイルに書き出せなかった場合だけバイト列を送る）。
+    """
+
+    lines: Dict[str, LineGeometry]
+    colors: Dict[str, str]
+    station_positions: Mapping[str, Tuple[float, float]]
+    buffer: Any = field(default=None, repr=False)  # mmap（配列のビューが参照している間は開いたままにする）
+    path: Optional[Path] = None  # mmap したファイル（メモリ上のバイト列から読み込んだ場合は None）
+    sources: Dict[str, str] = field(default_factory=dict)  # manifest に記録された元データのハッシュ
+
+    def __getstate__(self) -> Dict[str, Any]:
+        if self.path is not None:
+            return {"path": self.path, "sources": self.sources}
+        return {"body": bytes(self.buffer)}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        if "body" in state:
+            compiled = decode_compiled_geometry(state["body"])
+        else:
+            compiled = load_compiled_geometry(state["path"], state["sources"])
+            if compiled is None:
+                # 送り出した後に再コンパイルされた（または消された）ファイルは別の内容なので使えない
+                raise ValueError(f"Compiled geometry {state['path']} is missing or was recompiled")
+        self.__dict__.update(compiled.__dict__)
+
+
+def encode_compiled_geometry(
+    geometries: Dict[str, LineGeometry],
+    colors: Dict[str, str],
+    station_positions: Mapping[str, Tuple[float, float]],
+    hashes: Dict[str, str],
+) -> bytes:
+    """全路線の LineGeometry と駅座標を1ファイル分のバイト列にする"""
+    station_ids = sorted(station_positions, key=lambda sid: sid.encode("utf-8"))
+    station_number = {station_id: i for i, station_id in enumerate(station_ids)}
+
+    data: Dict[str, array] = {name: array(typecode) for name, typecode in _SECTIONS}
+    data["station_id_offsets"].append(0)
+    for station_id in station_ids:
+        lon, lat = station_positions[station_id]
+        data["station_lon"].append(lon)
+        data["station_lat"].append(lat)
+        data["station_ids"].frombytes(station_id.encode("utf-8"))
+        data["station_id_offsets"].append(len(data["station_ids"]))
+
+    lines = []
+    for line_id, geometry in geometries.items():
+        n = len(geometry)
+        vertex_start = len(data["vertex_lon"])
+        data["vertex_lon"].extend(geometry.lons)
+        data["vertex_lat"].extend(geometry.lats)
+        data["vertex_cumulative"].extend(geometry.cumulative)
+        data["edge_forward"].extend(geometry.forward_bearing)
+        data["edge_backward"].extend(geometry.backward_bearing)
+        # 辺は n - 1 本なので頂点と位置を揃えるために詰める
+        data["edge_forward"].extend([0.0] * (n - len(geometry.forward_bearing)))
+        data["edge_backward"].extend([0.0] * (n - len(geometry.backward_bearing)))
+
+        chainage_start = len(data["chainage_vertex"])
+        for station_id, chainage in geometry.stations.items():
+            if station_id not in station_number:
+                # 駅座標の無い駅は保存しない（初回のスナップ時に再登録される）
+                continue
+            data["chainage_vertex"].append(chainage.vertex)
+            data["chainage_offset"].append(chainage.offset)
+            data["chainage_station"].append(station_number[station_id])
+        lines.append(
+            {
+                "id": line_id,
+                "color": colors.get(line_id, "#000000"),
+                "vertex_start": vertex_start,
+                "vertex_count": n,
+                "chainage_start": chainage_start,
+                "chainage_count": len(data["chainage_vertex"]) - chainage_start,
+            }
+        )
+
+    # セクションの位置はデータ領域（manifest の直後の8バイト境界）の先頭からのオフセット
+    sections: Dict[str, List[int]] = {}
+    offset = 0
+    for name, _typecode in _SECTIONS:
+        sections[name] = [offset, len(data[name])]
+        offset = _pad8(offset + len(data[name]) * data[name].itemsize)
+    manifest = {"format_version": FORMAT_VERSION, "sources": hashes, "sections": sections, "lines": lines}
+    encoded_manifest = json.dumps(manifest, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data_start = _pad8(_HEADER.size + len(encoded_manifest))
+
+    out = bytearray(data_start + offset)
+    out[: _HEADER.size] = _HEADER.pack(_MAGIC, FORMAT_VERSION, len(encoded_manifest))
+    out[_HEADER.size : _HEADER.size + len(encoded_manifest)] = encoded_manifest
+    for name, _typecode in _SECTIONS:
+        chunk = _to_le_bytes(data[name])
+        start = data_start + sections[name][0]
+        out[start : start + len(chunk)] = chunk
+    return bytes(out)
+
+
+def _read_manifest(buffer: Any) -> Tuple[Dict[str, Any], int]:
+    """(manifest, データ領域の先頭位置)"""
+    magic, version, manifest_len = _HEADER.unpack_from(buffer, 0)
+    if magic != _MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported compiled geometry: {magic!r} v{version}")
+    manifest = json.loads(bytes(buffer[_HEADER.size : _HEADER.size + manifest_len]).decode("utf-8"))
+    return manifest, _pad8(_HEADER.size + manifest_len)
+
+
+def decode_compiled_geometry(buffer: Any) -> CompiledGeometry:
+    """
+    encode_compiled_geometry の逆変換。
+
+    buffer が mmap ならリトルエンディアン環境では配列をコピーせずにビューとして参照する。
+    """
+    manifest, data_start = _read_manifest(buffer)
+    view = memoryview(buffer)
+    sections: Dict[str, Sequence[Any]] = {}
+    for name, typecode in _SECTIONS:
+        offset, count = manifest["sections"][name]
+        offset += data_start
+        itemsize = array(typecode).itemsize
+        if offset + count * itemsize > len(view):
+            raise ValueError(f"Section {name} is out of range")
+        chunk = view[offset : offset + count * itemsize]
+        if _LITTLE_ENDIAN or itemsize == 1:
+            sections[name] = chunk.cast(typecode)
+        else:
+            values = array(typecode, bytes(chunk))
+            values.byteswap()
+            sections[name] = values
+
+    id_offsets = sections["station_id_offsets"]
+    id_bytes = sections["station_ids"]
+    station_ids = [
+        bytes(id_bytes[id_offsets[i] : id_offsets[i + 1]]).decode("utf-8") for i in range(len(id_offsets) - 1)
+    ]
+
+    lines: Dict[str, LineGeometry] = {}
+    colors: Dict[str, str] = {}
+    for entry in manifest["lines"]:
+        start, n = entry["vertex_start"], entry["vertex_count"]
+        edges = max(n - 1, 0)
+        geometry = LineGeometry(
+            entry["id"],
+            sections["vertex_lon"][start : start + n],
+            sections["vertex_lat"][start : start + n],
+            sections["vertex_cumulative"][start : start + n],
+            sections["edge_forward"][start : start + edges],
+            sections["edge_backward"][start : start + edges],
+        )
+        c_start = entry["chainage_start"]
+        for i in range(c_start, c_start + entry["chainage_count"]):
+            station_id = station_ids[sections["chainage_station"][i]]
+            geometry.stations[station_id] = StationChainage(
+                vertex=sections["chainage_vertex"][i], offset=sections["chainage_offset"][i]
+            )
+        lines[entry["id"]] = geometry
+        colors[entry["id"]] = entry["color"]
+
+    positions = MappedStationPositions(station_ids, sections["station_lon"], sections["station_lat"])
+    return CompiledGeometry(
+        lines=lines, colors=colors, station_positions=positions, buffer=buffer, sources=manifest.get("sources", {})
+    )
+
+
+# ============================================================================
+# Compile / Load
+# ============================================================================
+
+
+def compile_line_geometries(cache: "DataCache") -> Dict[str, LineGeometry]:
+    """
+    coordinates.json の全路線をマージし、累積距離・方位角と
+    railways.json の駅の対応頂点を計算する。
+    """
+    spatial_index = getattr(cache, "railway_index", None)
+    if spatial_index is not None:
+        all_railways_cache = spatial_index.coords
+    else:
+        all_railways_cache = build_all_railways_cache(cache.coordinates)
+
+    geometries: Dict[str, LineGeometry] = {}
+    for entry in cache.coordinates.get("railways", []):
+        line_id = entry.get("id")
+        if not line_id or line_id in geometries:
+            continue
+        merged = merge_railway_sublines(entry, all_railways_cache, spatial_index)
+        if len(merged) < 2:
+            continue
+        geometry = build_line_geometry(cache, line_id, [(c[0], c[1]) for c in merged])
+        if geometry is not None:
+            geometries[line_id] = geometry
+    return geometries
+
+
+def write_compiled_geometry(path: Path, body: bytes) -> None:
+    """
+    コンパイル結果を書き出す。
+
+    一時ファイルから置き換えるので、他のワーカーが mmap している古いファイルは壊さない。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(body)
+    os.replace(tmp, path)
+
+
+def load_compiled_geometry(path: Path, hashes: Dict[str, str]) -> Optional[CompiledGeometry]:
+    """コンパイル済みファイルを読み取り専用で mmap する。無い・古い・壊れている場合は None"""
+    try:
+        with path.open("rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Failed to map compiled geometry %s: %s", path, e)
+        return None
+
+    try:
+        manifest, _ = _read_manifest(buffer)
+        if manifest.get("sources") != hashes:
+            logger.info("Compiled geometry %s is stale", path)
+            buffer.close()
+            return None
+        compiled = decode_compiled_geometry(buffer)
+        compiled.path = path
+        return compiled
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        logger.warning("Failed to load compiled geometry %s: %s", path, e)
+        return None
+
+
+def compile_geometry(cache: "DataCache", path: Path, hashes: Dict[str, str]) -> CompiledGeometry:
+    """
+    全路線をコンパイルして書き出し、書き出したファイルを mmap して返す。
+
+    書き込みに失敗した場合はメモリ上のバイト列から読み込む。
+    """
+    started = time.perf_counter()
+    geometries = compile_line_geometries(cache)
+    colors = {
+        entry["id"]: entry.get("color", "#000000")
+        for entry in cache.coordinates.get("railways", [])
+        if entry.get("id") in geometries
+    }
+    body = encode_compiled_geometry(geometries, colors, cache.station_positions, hashes)
+    logger.info(
+        "Compiled geometry for %d lines in %.2fs (%d bytes)",
+        len(geometries),
+        time.perf_counter() - started,
+        len(body),
+    )
+    try:
+        write_compiled_geometry(path, body)
+    except OSError as e:
+        logger.warning("Failed to write compiled geometry to %s: %s", path, e)
+    else:
+        compiled = load_compiled_geometry(path, hashes)
+        if compiled is not None:
+            return compiled
+    return decode_compiled_geometry(body)
+
+
+# ============================================================================
+# CLI
+# ============================================================================
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    from data_cache import DataCache
+
+    parser = argparse.ArgumentParser(description="線路形状をコンパイルしてディスクに保存する")
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=Path(__file__).resolve().parent.parent / "data",
+        help="mini-tokyo-3d/ を含むデータディレクトリ",
+    )
+    parser.add_argument("--out", type=Path, default=None, help="出力ファイル（省略時は DataCache と同じ場所）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    cache = DataCache(args.data_dir)
+    if args.out is not None:
+        cache.compiled_geometry_path = args.out
+    cache.load_geometry_sources()
+    cache.load_compiled_geometry(force=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,10 +7,15 @@ MS1: リアルタイム駅時刻テーブルへの正規化を行う。
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import logging
-from dataclasses import dataclass, field
+import threading
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
 from datetime import datetime
-from typing import TYPE_CHECKING, Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 import httpx
@@ -21,7 +26,7 @@ from constants import (
     TRIP_UPDATE_URL,
     YAMANOTE_ROUTE_ID,  # デフォルト値用に維持
 )
-from gtfs_rt_vehicle import get_direction, get_train_number, identify_routes_by_trip_id, is_yamanote
+from gtfs_rt_vehicle import get_direction, get_train_number, is_yamanote, partition_entities_by_route
 from train_state import determine_service_type
 
 if TYPE_CHECKING:
@@ -49,17 +54,328 @@ class RealtimeStationSchedule:
     delay: int = 0  # MS6: 遅延秒数 (デフォルト0)
 
 
-@dataclass
+# 列指向ストレージの欠損値（時刻・文字列インデックス）
+MISSING = -1
+
+
+class StringTable:
+    """
+    駅IDなどの文字列をプロセス内で一意な整数インデックスに変換する（interning）。
+    列車ごとの列には文字列ではなくこのインデックスを格納する。
+
+    デコード用のスレッドプール・asyncio.to_thread・イベントループから同時に呼ばれるので、
+    登録済みの文字列は dict.get だけで返し、未登録の文字列の追加だけをロックの中で行う。
+    """
+
+    def __init__(self) -> None:
+        self._ids: Dict[str, int] = {}
+        self._values: List[str] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def intern(self, value: Optional[str]) -> int:
+        if value is None:
+            return MISSING
+        index = self._ids.get(value)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self._ids.get(value)
+            if index is None:
+                # 値を追加してからインデックスを公開する（ロック外の読み手が範囲外を引かないように）
+                index = len(self._values)
+                self._values.append(value)
+                self._ids[value] = index
+        return index
+
+    def lookup(self, index: int) -> Optional[str]:
+        return self._values[index] if index >= 0 else None
+
+
+STATION_TABLE = StringTable()
+
+
+class ScheduleColumns:
+    """
+    1本の列車の駅時刻テーブルを列指向で保持する。
+
+    int64 の array 1本に [seq | arrival | departure | delay | station | raw_stop | flags]
+    の各列をブロック単位で連結して格納する（stop_sequence の昇順）。
+    駅ごとの RealtimeStationSchedule を作らないため、1列車あたりのオブジェクト数は
+    駅数に依らず一定で、array は GC の追跡対象にもならない。
+
+    station / raw_stop は STATION_TABLE のインデックス、欠損は MISSING (-1)。
+    """
+
+    __slots__ = ("_data", "size", "effective")
+
+    SEQ = 0
+    ARRIVAL = 1
+    DEPARTURE = 2
+    DELAY = 3
+    STATION = 4
+    RAW_STOP = 5
+    FLAGS = 6  # bit0: resolved
+    NUM_COLUMNS = 7
+
+    def __init__(self, data: array, size: int) -> None:
+        self._data = data
+        self.size = size
+        # 停車時間を反映した実質時刻のキャッシュ (train_position_v4.get_effective_times が設定)
+        self.effective = None
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple]) -> "ScheduleColumns":
+        """
+        rows: stop_sequence 昇順の
+            (seq, arrival, departure, delay, station_id, raw_stop_id, resolved) のリスト
+        """
+        size = len(rows)
+        data = array("q", bytes(8 * size * cls.NUM_COLUMNS))
+        intern = STATION_TABLE.intern
+        for i, (seq, arr, dep, delay, station_id, raw_stop_id, resolved) in enumerate(rows):
+            data[i] = seq
+            data[size + i] = MISSING if arr is None else arr
+            data[2 * size + i] = MISSING if dep is None else dep
+            data[3 * size + i] = delay or 0
+            data[4 * size + i] = intern(station_id)
+            data[5 * size + i] = intern(raw_stop_id)
+            data[6 * size + i] = 1 if resolved else 0
+        return cls(data, size)
+
+    @classmethod
+    def from_schedules(cls, schedules_by_seq: Mapping[int, "RealtimeStationSchedule"]) -> "ScheduleColumns":
+        """従来の {seq: RealtimeStationSchedule} から変換する（互換用）"""
+        return cls.from_rows(
+            [
+                (seq, s.arrival_time, s.departure_time, s.delay, s.station_id, s.raw_stop_id, s.resolved)
+                for seq, s in sorted(schedules_by_seq.items())
+            ]
+        )
+
+    def column(self, col: int) -> memoryview:
+        """列をコピーせずに参照する"""
+        return memoryview(self._data)[col * self.size : (col + 1) * self.size]
+
+    @property
+    def buffer(self) -> array:
+        """全列を連結した int64 配列（NumPy などからのゼロコピー参照用）"""
+        return self._data
+
+    def index_of(self, seq: int) -> int:
+        """stop_sequence の行番号。無ければ -1。"""
+        data = self._data
+        i = bisect_left(data, seq, 0, self.size)
+        return i if i < self.size and data[i] == seq else -1
+
+    def value(self, col: int, i: int) -> int:
+        return self._data[col * self.size + i]
+
+    def time_or_none(self, col: int, i: int) -> Optional[int]:
+        v = self._data[col * self.size + i]
+        return None if v == MISSING else v
+
+    def station_id(self, i: int) -> Optional[str]:
+        return STATION_TABLE.lookup(self._data[self.STATION * self.size + i])
+
+    def row(self, i: int) -> "RealtimeStationSchedule":
+        """i 行目を RealtimeStationSchedule として取り出す（必要なときだけ生成）"""
+        data, n = self._data, self.size
+        return RealtimeStationSchedule(
+            stop_sequence=data[i],
+            station_id=STATION_TABLE.lookup(data[4 * n + i]),
+            arrival_time=None if data[n + i] == MISSING else data[n + i],
+            departure_time=None if data[2 * n + i] == MISSING else data[2 * n + i],
+            resolved=bool(data[6 * n + i] & 1),
+            raw_stop_id=STATION_TABLE.lookup(data[5 * n + i]),
+            delay=data[3 * n + i],
+        )
+
+    def to_rows(self) -> List[Tuple]:
+        """from_rows() と同じ形式のタプル列（文字列は解決済み）"""
+        rows = []
+        for i in range(self.size):
+            r = self.row(i)
+            rows.append(
+                (r.stop_sequence, r.arrival_time, r.departure_time, r.delay, r.station_id, r.raw_stop_id, r.resolved)
+            )
+        return rows
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ScheduleColumns):
+            return NotImplemented
+        return self.to_rows() == other.to_rows()
+
+    # プロセス間で受け渡すときはインデックスではなく文字列で送る（interning 表はプロセスごと）
+    def __getstate__(self) -> Tuple[List[Tuple]]:
+        return (self.to_rows(),)
+
+    def __setstate__(self, state: Tuple[List[Tuple]]) -> None:
+        other = ScheduleColumns.from_rows(state[0])
+        self._data = other._data
+        self.size = other.size
+        self.effective = None
+
+
+class ScheduleView(Mapping):
+    """
+    ScheduleColumns を {stop_sequence: RealtimeStationSchedule} として見せる読み取り専用ビュー。
+    要素はアクセスされたときに生成する（互換用。ホットパスでは列を直接参照すること）。
+    """
+
+    __slots__ = ("_columns",)
+
+    def __init__(self, columns: ScheduleColumns) -> None:
+        self._columns = columns
+
+    def __getitem__(self, seq: int) -> RealtimeStationSchedule:
+        i = self._columns.index_of(seq)
+        if i < 0:
+            raise KeyError(seq)
+        return self._columns.row(i)
+
+    def __iter__(self):
+        return iter(self._columns.column(ScheduleColumns.SEQ).tolist())
+
+    def __len__(self) -> int:
+        return self._columns.size
+
+
 class TrainSchedule:
-    """1本の列車のリアルタイム時刻テーブル"""
+    """
+    1本の列車のリアルタイム時刻テーブル
+
+    駅時刻は ScheduleColumns に列指向で保持する。
+    schedules_by_seq / ordered_sequences は従来形式の互換ビュー。
+    """
+
+    __slots__ = ("trip_id", "train_number", "start_date", "direction", "feed_timestamp", "columns")
+
+    def __init__(
+        self,
+        trip_id: str,  # 主キー
+        train_number: Optional[str],
+        start_date: Optional[str],
+        direction: Optional[str],  # "InnerLoop" / "OuterLoop"
+        feed_timestamp: Optional[int],  # feed.header.timestamp
+        schedules_by_seq: Optional[Mapping[int, RealtimeStationSchedule]] = None,
+        ordered_sequences: Optional[List[int]] = None,
+        columns: Optional[ScheduleColumns] = None,
+    ) -> None:
+        self.trip_id = trip_id
+        self.train_number = train_number
+        self.start_date = start_date
+        self.direction = direction
+        self.feed_timestamp = feed_timestamp
+        if columns is None:
+            # ordered_sequences は schedules_by_seq のキーの昇順と一致する前提
+            columns = ScheduleColumns.from_schedules(schedules_by_seq or {})
+        self.columns = columns
+
+    @property
+    def schedules_by_seq(self) -> ScheduleView:
+        return ScheduleView(self.columns)
+
+    @property
+    def ordered_sequences(self) -> List[int]:
+        return self.columns.column(ScheduleColumns.SEQ).tolist()
+
+    def with_feed_timestamp(self, feed_timestamp: Optional[int]) -> "TrainSchedule":
+        """feed_timestamp だけを差し替えた複製（駅時刻の列は共有する）"""
+        return TrainSchedule(
+            trip_id=self.trip_id,
+            train_number=self.train_number,
+            start_date=self.start_date,
+            direction=self.direction,
+            feed_timestamp=feed_timestamp,
+            columns=self.columns,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, TrainSchedule):
+            return NotImplemented
+        return (
+            self.trip_id == other.trip_id
+            and self.train_number == other.train_number
+            and self.start_date == other.start_date
+            and self.direction == other.direction
+            and self.feed_timestamp == other.feed_timestamp
+            and self.columns == other.columns
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"TrainSchedule(trip_id={self.trip_id!r}, train_number={self.train_number!r}, "
+            f"direction={self.direction!r}, feed_timestamp={self.feed_timestamp!r}, stops={self.columns.size})"
+        )
+
+    # __slots__ クラスのため明示的に pickle 対応する（プロセスプールからの受け渡し用）
+    def __getstate__(self) -> Tuple:
+        return (self.trip_id, self.train_number, self.start_date, self.direction, self.feed_timestamp, self.columns)
+
+    def __setstate__(self, state: Tuple) -> None:
+        (self.trip_id, self.train_number, self.start_date, self.direction, self.feed_timestamp, self.columns) = state
+
+
+# ============================================================================
+# Incremental Normalization Cache
+# ============================================================================
+
+
+class TripNormalizationCache:
+    """
+    列車単位の正規化結果キャッシュ（1路線につき1インスタンス）。
 
-    trip_id: str  # 主キー
-    train_number: Optional[str]
-    start_date: Optional[str]
-    direction: Optional[str]  # "InnerLoop" / "OuterLoop"
-    feed_timestamp: Optional[int]  # feed.header.timestamp
-    schedules_by_seq: Dict[int, RealtimeStationSchedule] = field(default_factory=dict)
-    ordered_sequences: List[int] = field(default_factory=list)
+    キーは trip_id、検証値はシリアライズした TripUpdate のハッシュと
+    サービスタイプ。どちらかが変わった列車だけを再正規化する。
+    フィードから消えた列車は finish_batch() で破棄する。
+
+    除外された列車（キャンセル・駅数不足）も None として記録し、
+    内容が変わらない限り再判定しない。
+    """
+
+    def __init__(self) -> None:
+        # {trip_id: (digest, service_type, TrainSchedule | None)}
+        self._entries: Dict[str, Tuple[bytes, str, Optional[TrainSchedule]]] = {}
+        self._seen: set = set()
+        self.last_stats: Dict[str, int] = {"reused": 0, "normalized": 0, "evicted": 0}
+        self._batch_stats: Dict[str, int] = {"reused": 0, "normalized": 0, "evicted": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def digest(entity: gtfs_realtime_pb2.FeedEntity) -> bytes:
+        """TripUpdate の内容ハッシュ（エンティティIDなど周辺情報は含めない）"""
+        return hashlib.blake2b(entity.trip_update.SerializeToString(deterministic=True), digest_size=16).digest()
+
+    def lookup(self, trip_id: str, digest: bytes, service_type: str) -> Tuple[bool, Optional[TrainSchedule]]:
+        """
+        Returns:
+            (ヒットしたか, キャッシュ済みの結果)。除外済みの列車は (True, None)。
+        """
+        self._seen.add(trip_id)
+        entry = self._entries.get(trip_id)
+        if entry is not None and entry[0] == digest and entry[1] == service_type:
+            self._batch_stats["reused"] += 1
+            return True, entry[2]
+        return False, None
+
+    def store(self, trip_id: str, digest: bytes, service_type: str, schedule: Optional[TrainSchedule]) -> None:
+        self._entries[trip_id] = (digest, service_type, schedule)
+        self._batch_stats["normalized"] += 1
+
+    def finish_batch(self) -> None:
+        """今回のフィードに現れなかった列車を破棄し、統計を確定する"""
+        vanished = [trip_id for trip_id in self._entries if trip_id not in self._seen]
+        for trip_id in vanished:
+            del self._entries[trip_id]
+        self._batch_stats["evicted"] = len(vanished)
+        self.last_stats = self._batch_stats
+        self._batch_stats = {"reused": 0, "normalized": 0, "evicted": 0}
+        self._seen = set()
 
 
 # ============================================================================
@@ -67,6 +383,42 @@ class TrainSchedule:
 # ============================================================================
 
 
+async def fetch_trip_update_content(client: httpx.AsyncClient, api_key: str) -> Optional[bytes]:
+    """
+    GTFS-RT TripUpdate フィードの生バイト列を取得する。
+
+    Returns:
+        レスポンスボディ。取得に失敗した場合は None。
+    """
+    try:
+        url = f"{TRIP_UPDATE_URL}?acl:consumerKey={api_key}"
+        response = await client.get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to fetch TripUpdate: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error fetching TripUpdate: {e}")
+        return None
+
+
+def parse_feed_message(content: bytes) -> Optional[gtfs_realtime_pb2.FeedMessage]:
+    """
+    GTFS-RT の protobuf バイト列を FeedMessage にデコードする。
+
+    Returns:
+        FeedMessage。デコードに失敗した場合は None。
+    """
+    try:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(content)
+        return feed
+    except Exception as e:
+        logger.error(f"Failed to parse TripUpdate protobuf: {e}")
+        return None
+
+
 async def fetch_trip_updates(
     client: httpx.AsyncClient,
     api_key: str,
@@ -85,208 +437,272 @@ async def fetch_trip_updates(
     Returns:
         {trip_id: TrainSchedule} の辞書
     """
-    results: Dict[str, TrainSchedule] = {}
-
     # 1. APIリクエスト
-    try:
-        url = f"{TRIP_UPDATE_URL}?acl:consumerKey={api_key}"
-        response = await client.get(url, timeout=HTTP_TIMEOUT)
-        response.raise_for_status()
-        content = response.content
-    except httpx.HTTPError as e:
-        logger.error(f"Failed to fetch TripUpdate: {e}")
-        return {}
-    except Exception as e:
-        logger.error(f"Unexpected error fetching TripUpdate: {e}")
+    content = await fetch_trip_update_content(client, api_key)
+    if content is None:
         return {}
 
-    # 2. Protobuf解析
-    try:
-        feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(content)
-    except Exception as e:
-        logger.error(f"Failed to parse TripUpdate protobuf: {e}")
+    # 2. Protobuf解析 + 正規化（CPU バウンドなのでイベントループ外で実行）
+    return await asyncio.to_thread(_decode_and_normalize, content, data_cache, target_route_id, mt3d_prefix)
+
+
+def _decode_and_normalize(
+    content: bytes,
+    data_cache: "DataCache",
+    target_route_id: str,
+    mt3d_prefix: Optional[str],
+) -> Dict[str, TrainSchedule]:
+    feed = parse_feed_message(content)
+    if feed is None:
         return {}
+    return normalize_trip_updates(feed, data_cache, target_route_id=target_route_id, mt3d_prefix=mt3d_prefix)
 
-    feed_timestamp = feed.header.timestamp if feed.header.HasField("timestamp") else None
-    logger.info(f"TripUpdate feed: {len(feed.entity)} entities, timestamp={feed_timestamp}")
 
-    # 現在時刻からサービスタイプを推定
-    now_jst = datetime.now(JST)
-    current_service_type = determine_service_type(now_jst)
+def normalize_trip_updates(
+    feed: gtfs_realtime_pb2.FeedMessage,
+    data_cache: "DataCache",
+    target_route_id: str = YAMANOTE_ROUTE_ID,
+    mt3d_prefix: str = None,
+) -> Dict[str, TrainSchedule]:
+    """
+    デコード済みの TripUpdate フィードから、指定路線の列車を
+    リアルタイム駅時刻テーブルに正規化する。
 
-    # デバッグ用: route_id のサンプルを収集
-    route_id_samples: List[str] = []
+    複数路線をまとめて扱う場合は、partition_entities_by_route() で1回だけ
+    振り分けてから normalize_trip_update_entities() を路線ごとに呼ぶこと。
 
-    # 3. エンティティを処理
-    for entity in feed.entity:
-        if not entity.HasField("trip_update"):
-            continue
+    Args:
+        feed: デコード済みの FeedMessage
+        data_cache: 静的データキャッシュ
+        target_route_id: 対象路線の route_id
+        mt3d_prefix: 駅IDプレフィックス
 
-        trip_update = entity.trip_update
-        trip = trip_update.trip
-        trip_id = trip.trip_id
-        route_id = trip.route_id
+    Returns:
+        {trip_id: TrainSchedule} の辞書
+    """
+    feed_timestamp = feed.header.timestamp if feed.header.HasField("timestamp") else None
+    logger.info(f"TripUpdate feed: {len(feed.entity)} entities, timestamp={feed_timestamp}")
 
-        # route_id サンプル収集 (最初の5件)
-        if len(route_id_samples) < 5 and trip.route_id:
-            route_id_samples.append(trip.route_id)
+    # 3-4. MS11: 路線フィルタ（route_id または trip_id で判定）を1パスで実施
+    entities = partition_entities_by_route(feed, "trip_update").get(target_route_id, [])
 
-        # 4. MS11: 路線フィルタ（route_id または trip_id で判定）
-        is_target_train = False
+    return normalize_trip_update_entities(
+        entities, feed_timestamp, data_cache, target_route_id=target_route_id, mt3d_prefix=mt3d_prefix
+    )
 
-        # route_id が取得でき、かつ target_route_id と一致する場合
-        if route_id and route_id == target_route_id:
-            is_target_train = True
 
-        # route_id が空の場合は trip_id から路線を推定
-        if not is_target_train:
-            possible_routes = identify_routes_by_trip_id(trip_id)
-            if target_route_id in possible_routes:
-                is_target_train = True
+def normalize_trip_update_entities(
+    entities: List[gtfs_realtime_pb2.FeedEntity],
+    feed_timestamp: Optional[int],
+    data_cache: "DataCache",
+    target_route_id: str = YAMANOTE_ROUTE_ID,
+    mt3d_prefix: str = None,
+    cache: Optional[TripNormalizationCache] = None,
+) -> Dict[str, TrainSchedule]:
+    """
+    路線ごとに振り分け済みの TripUpdate エンティティを正規化する。
+    対象路線のエンティティだけを処理するので、コストは路線の列車数に比例する。
 
-        if not is_target_train:
-            continue
+    cache を渡すと、前回から TripUpdate の内容が変わっていない列車は
+    正規化を省略して前回の結果を再利用する（コストは変化した列車数に比例）。
 
-        # 5. キャンセル除外
-        if trip.HasField("schedule_relationship"):
-            if trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED:
-                logger.debug(f"Skipping canceled trip: {trip_id}")
-                continue
+    Args:
+        entities: partition_entities_by_route() で振り分けた対象路線のエンティティ
+        feed_timestamp: feed.header.timestamp
+        data_cache: 静的データキャッシュ
+        target_route_id: 対象路線の route_id
+        mt3d_prefix: 駅IDプレフィックス
+        cache: 列車単位の正規化キャッシュ（路線ごとに1つ）
 
-        # 6. 列車情報の抽出
-        train_number = get_train_number(trip_id)
-        start_date = trip.start_date if trip.start_date else None
+    Returns:
+        {trip_id: TrainSchedule} の辞書
+    """
+    results: Dict[str, TrainSchedule] = {}
 
-        # 7. direction を先に推定（route_id を渡して路線固有の方向名を取得）
-        direction = get_direction(trip_id, target_route_id)
+    # 現在時刻からサービスタイプを推定
+    now_jst = datetime.now(JST)
+    current_service_type = determine_service_type(now_jst)
 
-        # 8. 静的データ紐付け（direction を含めて検索）
-        static_train = data_cache.get_static_train(train_number, current_service_type, direction)
+    for entity in entities:
+        trip_id = entity.trip_update.trip.trip_id
+
+        digest = None
+        if cache is not None:
+            digest = TripNormalizationCache.digest(entity)
+            found, schedule = cache.lookup(trip_id, digest, current_service_type)
+            if found:
+                if schedule is not None:
+                    if schedule.feed_timestamp != feed_timestamp:
+                        schedule = schedule.with_feed_timestamp(feed_timestamp)
+                    results[trip_id] = schedule
+                continue
 
-        # static_train が見つかれば、その direction を使用（より正確）
-        if static_train:
-            direction = static_train.direction
+        schedule = _normalize_trip_update_entity(
+            entity,
+            feed_timestamp,
+            data_cache,
+            target_route_id,
+            mt3d_prefix,
+            current_service_type,
+            verbose=len(results),
+        )
+        if cache is not None:
+            cache.store(trip_id, digest, current_service_type, schedule)
+        if schedule is not None:
+            results[trip_id] = schedule
+
+    if cache is not None:
+        cache.finish_batch()
+        logger.info(
+            f"Parsed {len(results)} TripUpdates for {target_route_id} "
+            f"({len(entities)} candidate entities, {cache.last_stats['reused']} reused)"
+        )
+    else:
+        logger.info(f"Parsed {len(results)} TripUpdates for {target_route_id} ({len(entities)} candidate entities)")
 
-        # デバッグ: 最初の数件の trip_id と direction をログ出力
-        if len(results) < 5:
-            logger.info(
-                f"[DIRECTION-DEBUG] trip_id={trip_id}, train_number={train_number}, "
-                f"direction={direction}, static_train={'found' if static_train else 'none'}"
-            )
+    return results
 
-        # 9. stop_sequence -> station_id マップを取得（direction を含めて検索）
-        seq_to_station = data_cache.get_seq_to_station_map(train_number, current_service_type, direction)
-
-        # 9. stop_time_update の展開
-        schedules_by_seq: Dict[int, RealtimeStationSchedule] = {}
-
-        for stu in trip_update.stop_time_update:
-            stop_seq = stu.stop_sequence
-            raw_stop_id = stu.stop_id if stu.stop_id else None
-
-            # Debug: log first few raw_stop_id values
-            if len(results) < 2 and stop_seq <= 2:
-                logger.info(f"[MS11-DEBUG] trip={trip_id[:10]}, seq={stop_seq}, raw_stop_id={raw_stop_id}")
-
-            # 駅ID解決
-            station_id: Optional[str] = None
-            resolved = False
-
-            # 優先順位1: raw_stop_id が静的データの station_id 体系と一致するか確認
-            if raw_stop_id:
-                # 静的データの駅IDは "JR-East.XXX" 形式
-                # TripUpdate の stop_id が同形式なら採用
-                if raw_stop_id.startswith("JR-East."):
-                    station_id = raw_stop_id
-                    resolved = True
-                elif mt3d_prefix:
-                    # MS11: プレフィックスを付与して変換 (e.g., "Tokyo" -> "JR-East.ChuoRapid.Tokyo")
-                    station_id = f"{mt3d_prefix}.{raw_stop_id}"
-                    resolved = True
-                    # Debug log (first few)
-                    if len(results) < 3 and stop_seq <= 3:
-                        logger.info(f"[MS11] Station prefix: {raw_stop_id} -> {station_id}")
-
-            # 優先順位2: seq_to_station マップから解決
-            if not resolved and seq_to_station:
-                mapped_station = seq_to_station.get(stop_seq)
-                if mapped_station:
-                    station_id = mapped_station
-                    resolved = True
-
-            # 優先順位3: stop_sequence による駅解決は無効化
-            # 注意: stop_sequence は列車の旅程内での相対的な順序であり、
-            # 路線の絶対的な駅インデックスではない。
-            # 例: 橋本発の列車は stop_seq=1 が橋本だが、
-            # stations_list[0] は東神奈川になり、誤った座標を返してしまう。
-            # この問題を避けるため、stop_sequence によるフォールバックは使用しない。
-            if not resolved and mt3d_prefix:
-                # raw_stop_id が無い場合は解決不可
-                if len(results) < 3 and stop_seq <= 3:
-                    logger.warning(
-                        f"[STATION-RESOLVE] Cannot resolve station: trip={trip_id[:15]}, "
-                        f"seq={stop_seq}, raw_stop_id={raw_stop_id}, mt3d_prefix={mt3d_prefix}"
-                    )
-
-            # 到着・発車時刻の抽出
-            arrival_time: Optional[int] = None
-            departure_time: Optional[int] = None
-
-            if stu.HasField("arrival") and stu.arrival.HasField("time"):
-                arrival_time = stu.arrival.time
-
-            if stu.HasField("departure") and stu.departure.HasField("time"):
-                departure_time = stu.departure.time
-
-            # MS6: 遅延情報の抽出
-            delay = 0
-            if stu.HasField("arrival") and stu.arrival.HasField("delay"):
-                delay = stu.arrival.delay
-            elif stu.HasField("departure") and stu.departure.HasField("delay"):
-                delay = stu.departure.delay
-
-            # 到着も発車も無いレコードはスキップ
-            if arrival_time is None and departure_time is None:
-                continue
 
-            # SKIPPED 駅は除外
-            if stu.HasField("schedule_relationship"):
-                if stu.schedule_relationship == gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED:
-                    continue
-
-            schedules_by_seq[stop_seq] = RealtimeStationSchedule(
-                stop_sequence=stop_seq,
-                station_id=station_id,
-                arrival_time=arrival_time,
-                departure_time=departure_time,
-                resolved=resolved,
-                raw_stop_id=raw_stop_id,
-                delay=delay,
-            )
+def _normalize_trip_update_entity(
+    entity: gtfs_realtime_pb2.FeedEntity,
+    feed_timestamp: Optional[int],
+    data_cache: "DataCache",
+    target_route_id: str,
+    mt3d_prefix: Optional[str],
+    current_service_type: str,
+    verbose: int = 0,
+) -> Optional[TrainSchedule]:
+    """
+    TripUpdate エンティティ1件を正規化する。除外対象の列車は None。
 
-        # 10. ordered_sequences を作成（昇順ソート）
-        ordered_sequences = sorted(schedules_by_seq.keys())
+    verbose はそれまでに正規化できた列車数で、先頭数件だけデバッグログを出すために使う。
+    """
+    trip_update = entity.trip_update
+    trip = trip_update.trip
+    trip_id = trip.trip_id
+
+    # 5. キャンセル除外
+    if trip.HasField("schedule_relationship"):
+        if trip.schedule_relationship == gtfs_realtime_pb2.TripDescriptor.CANCELED:
+            logger.debug(f"Skipping canceled trip: {trip_id}")
+            return None
+
+    # 6. 列車情報の抽出
+    train_number = get_train_number(trip_id)
+    start_date = trip.start_date if trip.start_date else None
+
+    # 7. direction を先に推定（route_id を渡して路線固有の方向名を取得）
+    direction = get_direction(trip_id, target_route_id)
+
+    # 8. 静的データ紐付け（direction を含めて検索）
+    static_train = data_cache.get_static_train(train_number, current_service_type, direction)
+
+    # static_train が見つかれば、その direction を使用（より正確）
+    if static_train:
+        direction = static_train.direction
+
+    # デバッグ: 最初の数件の trip_id と direction をログ出力
+    if verbose < 5:
+        logger.info(
+            f"[DIRECTION-DEBUG] trip_id={trip_id}, train_number={train_number}, "
+            f"direction={direction}, static_train={'found' if static_train else 'none'}"
+        )
 
-        # 要素数が2未満の列車は無効として除外
-        if len(ordered_sequences) < 2:
+    # 9. stop_sequence -> station_id マップを取得（direction を含めて検索）
+    seq_to_station = data_cache.get_seq_to_station_map(train_number, current_service_type, direction)
+
+    # 9. stop_time_update の展開（駅ごとのオブジェクトは作らず、行タプルを集めて列に詰める）
+    rows_by_seq: Dict[int, Tuple] = {}
+
+    for stu in trip_update.stop_time_update:
+        stop_seq = stu.stop_sequence
+        raw_stop_id = stu.stop_id if stu.stop_id else None
+
+        # Debug: log first few raw_stop_id values
+        if verbose < 2 and stop_seq <= 2:
+            logger.info(f"[MS11-DEBUG] trip={trip_id[:10]}, seq={stop_seq}, raw_stop_id={raw_stop_id}")
+
+        # 駅ID解決
+        station_id: Optional[str] = None
+        resolved = False
+
+        # 優先順位1: raw_stop_id が静的データの station_id 体系と一致するか確認
+        if raw_stop_id:
+            # 静的データの駅IDは "JR-East.XXX" 形式
+            # TripUpdate の stop_id が同形式なら採用
+            if raw_stop_id.startswith("JR-East."):
+                station_id = raw_stop_id
+                resolved = True
+            elif mt3d_prefix:
+                # MS11: プレフィックスを付与して変換 (e.g., "Tokyo" -> "JR-East.ChuoRapid.Tokyo")
+                station_id = f"{mt3d_prefix}.{raw_stop_id}"
+                resolved = True
+                # Debug log (first few)
+                if verbose < 3 and stop_seq <= 3:
+                    logger.info(f"[MS11] Station prefix: {raw_stop_id} -> {station_id}")
+
+        # 優先順位2: seq_to_station マップから解決
+        if not resolved and seq_to_station:
+            mapped_station = seq_to_station.get(stop_seq)
+            if mapped_station:
+                station_id = mapped_station
+                resolved = True
+
+        # 優先順位3: stop_sequence による駅解決は無効化
+        # 注意: stop_sequence は列車の旅程内での相対的な順序であり、
+        # 路線の絶対的な駅インデックスではない。
+        # 例: 橋本発の列車は stop_seq=1 が橋本だが、
+        # stations_list[0] は東神奈川になり、誤った座標を返してしまう。
+        # この問題を避けるため、stop_sequence によるフォールバックは使用しない。
+        if not resolved and mt3d_prefix:
+            # raw_stop_id が無い場合は解決不可
+            if verbose < 3 and stop_seq <= 3:
+                logger.warning(
+                    f"[STATION-RESOLVE] Cannot resolve station: trip={trip_id[:15]}, "
+                    f"seq={stop_seq}, raw_stop_id={raw_stop_id}, mt3d_prefix={mt3d_prefix}"
+                )
+
+        # 到着・発車時刻の抽出
+        arrival_time: Optional[int] = None
+        departure_time: Optional[int] = None
+
+        if stu.HasField("arrival") and stu.arrival.HasField("time"):
+            arrival_time = stu.arrival.time
+
+        if stu.HasField("departure") and stu.departure.HasField("time"):
+            departure_time = stu.departure.time
+
+        # MS6: 遅延情報の抽出
+        delay = 0
+        if stu.HasField("arrival") and stu.arrival.HasField("delay"):
+            delay = stu.arrival.delay
+        elif stu.HasField("departure") and stu.departure.HasField("delay"):
+            delay = stu.departure.delay
+
+        # 到着も発車も無いレコードはスキップ
+        if arrival_time is None and departure_time is None:
             continue
 
-        # 11. 結果に追加
-        results[trip_id] = TrainSchedule(
-            trip_id=trip_id,
-            train_number=train_number,
-            start_date=start_date,
-            direction=direction,
-            feed_timestamp=feed_timestamp,
-            schedules_by_seq=schedules_by_seq,
-            ordered_sequences=ordered_sequences,
-        )
+        # SKIPPED 駅は除外
+        if stu.HasField("schedule_relationship"):
+            if stu.schedule_relationship == gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SKIPPED:
+                continue
 
-    # デバッグ: route_id サンプル出力
-    if route_id_samples:
-        logger.debug(f"TripUpdate route_id samples: {route_id_samples}")
+        rows_by_seq[stop_seq] = (stop_seq, arrival_time, departure_time, delay, station_id, raw_stop_id, resolved)
 
-    logger.info(f"Parsed {len(results)} TripUpdates for {target_route_id} (feed had {len(feed.entity)} entities)")
+    # 要素数が2未満の列車は無効として除外
+    if len(rows_by_seq) < 2:
+        return None
 
-    return results
+    # 10. stop_sequence の昇順で列指向に格納
+    columns = ScheduleColumns.from_rows([rows_by_seq[seq] for seq in sorted(rows_by_seq)])
+
+    # 11. 結果を返す
+    return TrainSchedule(
+        trip_id=trip_id,
+        train_number=train_number,
+        start_date=start_date,
+        direction=direction,
+        feed_timestamp=feed_timestamp,
+        columns=columns,
+    )
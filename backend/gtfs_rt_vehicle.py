@@ -8,7 +8,7 @@ import asyncio
 import os
 import re
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import httpx
 from google.transit import gtfs_realtime_pb2
@@ -59,6 +59,42 @@ def identify_route_by_trip_id(trip_id: str) -> str | None:
     return routes[0] if routes else None
 
 
+# trip_id サフィックス → 候補路線
+# JR東日本のtrip_id命名規則:
+# - G: 山手線
+# - H/T: 中央線快速, 横須賀線
+# - A/B: 京浜東北線, 中央・総武各駅停車
+# - C: 中央・総武各駅停車
+# - K: 横浜線, 埼京線
+# - F: 南武線, 埼京線, 総武快速線
+# - M: 常磐線, 京葉線, 東海道線, 総武本線 等
+# - Y: 横須賀線, 京葉線, 東海道線
+# - S: 埼京線, 横須賀線
+# - E: 武蔵野線, 東海道線
+SUFFIX_TO_ROUTES: Dict[str, Tuple[str, ...]] = {
+    "G": ("JR-East.Yamanote",),
+    "H": ("JR-East.ChuoRapid", "JR-East.Yokosuka"),
+    "T": ("JR-East.ChuoRapid",),
+    "A": ("JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"),
+    "B": ("JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"),
+    "C": ("JR-East.ChuoSobuLocal",),
+    "K": ("JR-East.Yokohama", "JR-East.SaikyoKawagoe"),
+    "F": ("JR-East.Nambu", "JR-East.SaikyoKawagoe", "JR-East.SobuRapid"),
+    "M": (
+        "JR-East.Joban",
+        "JR-East.JobanRapid",
+        "JR-East.SaikyoKawagoe",
+        "JR-East.Keiyo",
+        "JR-East.Tokaido",
+        "JR-East.Sobu",
+        "JR-East.SobuRapid",
+    ),
+    "Y": ("JR-East.Yokosuka", "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.ChuoSobuLocal"),
+    "S": ("JR-East.SaikyoKawagoe", "JR-East.Yokosuka"),
+    "E": ("JR-East.Musashino", "JR-East.Tokaido"),
+}
+
+
 def identify_routes_by_trip_id(trip_id: str) -> list[str]:
     """
     trip_idのサフィックスから候補となる路線リストを返す。
@@ -66,48 +102,51 @@ def identify_routes_by_trip_id(trip_id: str) -> list[str]:
     ODPT APIのGTFS-RTはroute_idが空で返されるため、
     trip_idの末尾文字から路線を推定する必要がある。
     同じサフィックスが複数路線で使用されるため、リストで返す。
-
-    JR東日本のtrip_id命名規則:
-    - G: 山手線
-    - H/T: 中央線快速, 横須賀線
-    - A/B: 京浜東北線, 中央・総武各駅停車
-    - C: 中央・総武各駅停車
-    - K: 横浜線, 埼京線
-    - F: 南武線, 埼京線, 総武快速線
-    - M: 常磐線, 京葉線, 東海道線, 総武本線 等
-    - Y: 横須賀線, 京葉線, 東海道線
-    - S: 埼京線, 横須賀線
-    - E: 武蔵野線, 東海道線
+    命名規則は SUFFIX_TO_ROUTES を参照。
     """
     if not trip_id:
         return []
 
-    suffix = trip_id[-1].upper() if trip_id else ""
-
-    SUFFIX_TO_ROUTES = {
-        "G": ["JR-East.Yamanote"],
-        "H": ["JR-East.ChuoRapid", "JR-East.Yokosuka"],
-        "T": ["JR-East.ChuoRapid"],
-        "A": ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
-        "B": ["JR-East.KeihinTohokuNegishi", "JR-East.ChuoSobuLocal"],
-        "C": ["JR-East.ChuoSobuLocal"],
-        "K": ["JR-East.Yokohama", "JR-East.SaikyoKawagoe"],
-        "F": ["JR-East.Nambu", "JR-East.SaikyoKawagoe", "JR-East.SobuRapid"],
-        "M": [
-            "JR-East.Joban",
-            "JR-East.JobanRapid",
-            "JR-East.SaikyoKawagoe",
-            "JR-East.Keiyo",
-            "JR-East.Tokaido",
-            "JR-East.Sobu",
-            "JR-East.SobuRapid",
-        ],
-        "Y": ["JR-East.Yokosuka", "JR-East.Keiyo", "JR-East.Tokaido", "JR-East.ChuoSobuLocal"],
-        "S": ["JR-East.SaikyoKawagoe", "JR-East.Yokosuka"],
-        "E": ["JR-East.Musashino", "JR-East.Tokaido"],
-    }
+    suffix = trip_id[-1].upper()
+    return list(SUFFIX_TO_ROUTES.get(suffix, ()))
+
+
+def partition_entities_by_route(feed: gtfs_realtime_pb2.FeedMessage, kind: str) -> Dict[str, list]:
+    """
+    フィードを1回だけ走査し、route_id -> [entity] のインデックスを構築する。
 
-    return SUFFIX_TO_ROUTES.get(suffix, [])
+    1つのエンティティは以下の全ての路線に振り分けられる:
+      - trip.route_id（空でなければ）
+      - trip_id サフィックスから推定される全候補路線
+    サフィックスが複数路線に対応する曖昧なケースも、この1パスで全候補に登録する
+    （従来の路線ごとのフィルタと同じ判定結果になる）。
+
+    Args:
+        feed: デコード済みの FeedMessage
+        kind: "trip_update" または "vehicle"
+
+    Returns:
+        {route_id: [entity, ...]}（各リスト内はフィード内の出現順）
+    """
+    index: Dict[str, list] = {}
+
+    for entity in feed.entity:
+        if not entity.HasField(kind):
+            continue
+
+        trip = getattr(entity, kind).trip
+        route_id = trip.route_id
+        trip_id = trip.trip_id
+
+        if route_id:
+            index.setdefault(route_id, []).append(entity)
+
+        suffix = trip_id[-1].upper() if trip_id else ""
+        for candidate in SUFFIX_TO_ROUTES.get(suffix, ()):
+            if candidate != route_id:
+                index.setdefault(candidate, []).append(entity)
+
+    return index
 
 
 def get_direction(trip_id: str, route_id: str = None) -> str:
@@ -211,46 +250,88 @@ def get_train_number(trip_id: str) -> str:
     return trip_id
 
 
-async def fetch_vehicle_positions(api_key: str, target_route_id: Optional[str] = None) -> list[YamanoteTrainPosition]:
+async def fetch_vehicle_positions(
+    api_key: str,
+    target_route_id: Optional[str] = None,
+    client: Optional[httpx.AsyncClient] = None,
+) -> list[YamanoteTrainPosition]:
     """
     GTFS-RT VehiclePosition から列車位置を取得（汎用版）
 
     Args:
         api_key: ODPT APIキー
         target_route_id: 対象路線ID (例: "JR-East.ChuoRapid")。指定時はフィルタリングを行う。
+        client: 共有の httpx.AsyncClient。None なら都度生成する。
 
     Returns:
         列車位置のリスト
     """
+    content = await fetch_vehicle_position_content(api_key, client)
+
+    # デコードはイベントループ外で実行する
+    return await asyncio.to_thread(_decode_vehicle_positions, content, target_route_id)
+
+
+def _decode_vehicle_positions(content: bytes, target_route_id: Optional[str]) -> list[YamanoteTrainPosition]:
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return parse_vehicle_positions(feed, target_route_id)
+
+
+async def fetch_vehicle_position_content(api_key: str, client: Optional[httpx.AsyncClient] = None) -> bytes:
+    """
+    GTFS-RT VehiclePosition フィードの生バイト列を取得する。
+    HTTP エラーは呼び出し元にそのまま送出する。
+    """
     url = "https://api-challenge.odpt.org/api/v4/gtfs/realtime/jreast_odpt_train_vehicle"
 
-    async with httpx.AsyncClient() as client:
+    if client is None:
+        async with httpx.AsyncClient() as own_client:
+            response = await own_client.get(url, params={"acl:consumerKey": api_key}, timeout=30.0)
+    else:
         response = await client.get(url, params={"acl:consumerKey": api_key}, timeout=30.0)
-        response.raise_for_status()
+    response.raise_for_status()
+    return response.content
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(response.content)
 
-    positions = []
+def parse_vehicle_positions(
+    feed: gtfs_realtime_pb2.FeedMessage, target_route_id: Optional[str] = None
+) -> list[YamanoteTrainPosition]:
+    """
+    デコード済みの VehiclePosition フィードから列車位置を抽出する。
 
-    for entity in feed.entity:
-        if not entity.HasField("vehicle"):
-            continue
+    Args:
+        feed: デコード済みの FeedMessage
+        target_route_id: 対象路線ID。指定時はフィルタリングを行う。
+
+    Returns:
+        列車位置のリスト
+    """
+    if target_route_id:
+        entities = partition_entities_by_route(feed, "vehicle").get(target_route_id, [])
+    else:
+        entities = [entity for entity in feed.entity if entity.HasField("vehicle")]
+
+    return parse_vehicle_entities(entities, target_route_id)
+
+
+def parse_vehicle_entities(entities: list, target_route_id: Optional[str] = None) -> list[YamanoteTrainPosition]:
+    """
+    路線ごとに振り分け済みの VehiclePosition エンティティを列車位置に変換する。
+
+    Args:
+        entities: partition_entities_by_route() で振り分けたエンティティのリスト
+        target_route_id: 対象路線ID（方向名の決定に使用）
 
+    Returns:
+        列車位置のリスト
+    """
+    positions = []
+
+    for entity in entities:
         vp = entity.vehicle
         trip_id = vp.trip.trip_id
 
-        # 路線フィルタ
-        if target_route_id:
-            # 1. route_id があればそれで判定
-            if vp.trip.route_id == target_route_id:
-                pass  # マッチ
-            else:
-                # 2. trip_id から推定
-                possible_routes = identify_routes_by_trip_id(trip_id)
-                if target_route_id not in possible_routes:
-                    continue
-
         positions.append(
             YamanoteTrainPosition(
                 trip_id=trip_id,
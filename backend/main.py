@@ -6,20 +6,56 @@ import os
 from dataclasses import asdict
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 import httpx
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 
-from config import get_line_config  # MS10: 路線設定のインポート
+from config import LineConfig, get_line_config  # MS10: 路線設定のインポート
+from constants import (
+    FEED_DECODE_EXECUTOR,
+    FEED_DECODE_WORKERS,
+    FEED_POLL_INTERVAL,
+    HTTP_TIMEOUT,
+    POSITIONS_CACHE_TTL,
+    POSITIONS_DELTA_HISTORY,
+    POSITIONS_DELTA_THRESHOLD_M,
+    POSITIONS_PUSH_INTERVAL,
+    PROGRESS_ENGINE,
+    STATIC_CACHE_MAX_AGE,
+    TILE_CACHE_DIR,
+    TILE_MEMORY_CACHE_SIZE,
+)
 from data_cache import DataCache
 from database import SessionLocal, StationRank
-from geometry import build_all_railways_cache, merge_sublines_fallback, merge_sublines_v2
+from position_delta import PositionsSnapshot, SnapshotRing, diff_rows
+from position_encoder import (
+    POSITIONS_COLUMNAR_MEDIA_TYPE,
+    PositionRow,
+    encode_positions_columnar,
+    encode_positions_json,
+)
+from position_stream import Frame, PositionBroadcaster, sse_stream
+from response_cache import MicroTTLCache, VersionedCache
+from shape_store import (
+    COLLECTION_GZIP_LEVEL,
+    EncodedBody,
+    ShapeEntry,
+    ShapeStore,
+    build_collection,
+    encode_json,
+    tolerance_for_zoom,
+)
+from spatial_index import GridIndex
+from topology import Topology
+from vector_tiles import MVT_MEDIA_TYPE, TileCache, is_valid_tile
 
 # Sentry エラートラッキング初期化 (環境変数が設定されている場合のみ)
 load_dotenv()  # 先に環境変数を読み込む
@@ -110,6 +146,64 @@ def resolve_line_id(input_id: str) -> str:
     return input_id
 
 
+def _get_feed_snapshot():
+    """共有ポーラーが公開中の最新スナップショットを返す（未起動・未取得なら None）"""
+    poller = getattr(app.state, "feed_poller", None)
+    if poller is None:
+        return None
+    return poller.snapshot
+
+
+async def _get_line_feed(
+    line_id: str,
+    line_config: LineConfig,
+    client: httpx.AsyncClient,
+    api_key: str,
+    with_vehicles: bool = False,
+) -> tuple[Mapping[str, Any], Mapping[str, Any]]:
+    """
+    路線の TripUpdate（と必要なら VehiclePosition）を取得する。
+
+    共有ポーラーのスナップショットがあればそれを参照し、
+    ポーラー未起動時のみ従来通りフィードを直接取得する。
+
+    Returns:
+        ({trip_id: TrainSchedule}, {trip_id: VehiclePosition})
+    """
+    poller = getattr(app.state, "feed_poller", None)
+    if poller is not None:
+        snapshot = await poller.wait_for_snapshot(timeout=HTTP_TIMEOUT)
+        if snapshot is not None:
+            line_feed = snapshot.get_line(line_id)
+            if line_feed is not None:
+                return line_feed.schedules, line_feed.vehicle_positions
+
+    # フォールバック: 直接取得
+    import asyncio
+
+    from gtfs_rt_tripupdate import fetch_trip_updates
+    from gtfs_rt_vehicle import fetch_vehicle_positions
+
+    trip_update_task = fetch_trip_updates(
+        client,
+        api_key,
+        data_cache,
+        target_route_id=line_config.gtfs_route_id,
+        mt3d_prefix=line_config.mt3d_id,
+    )
+    if not with_vehicles:
+        return await trip_update_task, {}
+
+    vehicle_position_task = fetch_vehicle_positions(api_key, target_route_id=line_config.gtfs_route_id)
+    schedules, vehicle_positions_list = await asyncio.gather(trip_update_task, vehicle_position_task)
+    return schedules, {vp.trip_id: vp for vp in vehicle_positions_list}
+
+
+def _progress_engine() -> str:
+    """進捗計算方式（環境変数 PROGRESS_ENGINE で切り替え）"""
+    return os.getenv("PROGRESS_ENGINE", PROGRESS_ENGINE)
+
+
 @app.on_event("startup")
 async def startup_event():
     # CI/E2Eでは外部ファイル(mini-tokyo-3d/*.json)に依存しない
@@ -118,6 +212,8 @@ async def startup_event():
         return
 
     data_cache.load_all()
+    # タイル生成元（線路形状の投影・駅）も形状ストアと合わせて起動時に作る（初回のタイル要求で作らない）
+    _get_tile_cache()
     logger.info(
         "Data loaded: %d railways, %d stations",
         len(data_cache.railways),
@@ -127,6 +223,30 @@ async def startup_event():
     app.state.http_client = httpx.AsyncClient()
     logger.info("httpx.AsyncClient initialized")
 
+    # GTFS-RT 共有ポーラー: フィードを1周期1回だけ取得し全路線に配信する
+    api_key = os.getenv("ODPT_API_KEY", "").strip()
+    if api_key:
+        from feed_decoder import create_decode_executor
+        from feed_poller import FeedPoller
+
+        poll_interval = float(os.getenv("FEED_POLL_INTERVAL", FEED_POLL_INTERVAL))
+        # デコード・正規化はイベントループ外の executor で実行する
+        app.state.feed_decode_executor = create_decode_executor(
+            os.getenv("FEED_DECODE_EXECUTOR", FEED_DECODE_EXECUTOR),
+            int(os.getenv("FEED_DECODE_WORKERS", FEED_DECODE_WORKERS)),
+            data_cache,
+        )
+        app.state.feed_poller = FeedPoller(
+            app.state.http_client,
+            api_key,
+            data_cache,
+            interval=poll_interval,
+            executor=app.state.feed_decode_executor,
+        )
+        app.state.feed_poller.start()
+    else:
+        logger.warning("ODPT_API_KEY not set: FeedPoller disabled")
+
     # タイムトラベル: VIRTUAL_TIME 環境変数でモック時刻を設定
     from time_manager import time_mgr
 
@@ -141,6 +261,14 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if _position_broadcaster is not None:
+        await _position_broadcaster.stop()
+    # 共有ポーラーを先に止める（クライアントのクローズ後に取得しないように）
+    if getattr(app.state, "feed_poller", None) is not None:
+        await app.state.feed_poller.stop()
+    if getattr(app.state, "feed_decode_executor", None) is not None:
+        app.state.feed_decode_executor.shutdown(wait=False, cancel_futures=True)
+
     # MS1-TripUpdate: httpx.AsyncClient をクローズ
     if hasattr(app.state, "http_client"):
         await app.state.http_client.aclose()
@@ -166,10 +294,34 @@ def health():
     return {"status": "ok"}
 
 
+# ============================================================================
+# 静的データのレスポンスキャッシュ（路線一覧・駅一覧）
+# ============================================================================
+
+# (エンドポイント, パラメータ) → データ版ごとのエンコード済み本文
+_static_responses: VersionedCache[EncodedBody] = VersionedCache()
+
+
+def _static_cache_control() -> str:
+    """再起動まで変わらないデータの Cache-Control（max-age 経過後は ETag で再検証）"""
+    max_age = int(os.getenv("STATIC_CACHE_MAX_AGE", STATIC_CACHE_MAX_AGE))
+    return f"public, max-age={max_age}" if max_age > 0 else "no-cache"
+
+
+def _encode_json_body(content: Any) -> EncodedBody:
+    return EncodedBody.encode(encode_json(content), gzip_level=COLLECTION_GZIP_LEVEL)
+
+
 @app.get("/api/lines")
-async def get_lines(operator: Optional[str] = None):
+async def get_lines(request: Request, operator: Optional[str] = None):
     logger.info("GET /api/lines called with operator=%s", operator)
+    encoded = _static_responses.get_or_build(
+        ("lines", operator), data_cache.data_version, lambda: _encode_json_body(_line_summaries(operator))
+    )
+    return _encoded_response(request, encoded, cache_control=_static_cache_control())
 
+
+def _line_summaries(operator: Optional[str]) -> Dict[str, Any]:
     lines = data_cache.railways
 
     if operator:
@@ -195,17 +347,21 @@ async def get_lines(operator: Optional[str] = None):
 
 
 @app.get("/api/lines/{line_id}")
-async def get_line(line_id: str):
+async def get_line(request: Request, line_id: str):
     logger.info("GET /api/lines/%s", line_id)
 
     # MS11: ID解決
     target_id = resolve_line_id(line_id)
+    encoded = _static_responses.get_or_build(
+        ("line", target_id), data_cache.data_version, lambda: _encode_json_body(_line_detail(line_id, target_id))
+    )
+    return _encoded_response(request, encoded, cache_control=_static_cache_control())
 
+
+def _line_detail(line_id: str, target_id: str) -> Dict[str, Any]:
     raw = next((railway for railway in data_cache.railways if railway.get("id") == target_id), None)
     if not raw:
         raise HTTPException(status_code=404, detail=f"Line not found: {line_id} (resolved: {target_id})")
-    if not raw:
-        raise HTTPException(status_code=404, detail=f"Line not found: {line_id} (resolved: {target_id})")
 
     title = raw.get("title", {})
     operator_id = target_id.split(".")[0] if "." in target_id else ""
@@ -225,6 +381,7 @@ async def get_line(line_id: str):
 
 @app.get("/api/stations")
 async def get_stations(
+    request: Request,
     lineId: Optional[str] = None,
     line_id: Optional[str] = None,  # エイリアス対応
 ):
@@ -240,6 +397,18 @@ async def get_stations(
     logger.info(f"Resolving Stations ID: '{target_param}' -> '{target_id}'")
 
     # 3. データ検索 (FROM DB)
+    # 駅の属性は起動時に読み込んだ版、ランク・停車時間は rank_version で管理しているので、
+    # どちらも変わっていなければ DB を引かずに前回のエンコード結果を返す
+    # （ランクは実行中に更新されるので、クライアントには毎回 ETag で再検証させる）
+    encoded = _static_responses.get_or_build(
+        ("stations", target_id),
+        (data_cache.data_version, data_cache.rank_version),
+        lambda: _encode_json_body(_line_stations(target_param, target_id)),
+    )
+    return _encoded_response(request, encoded)
+
+
+def _line_stations(target_param: str, target_id: str) -> Dict[str, Any]:
     exists = any(railway.get("id") == target_id for railway in data_cache.railways)
     if not exists:
         logger.warning(f"Station lookup failed: Line ID '{target_id}' not found in railways.")
@@ -322,6 +491,7 @@ async def update_station_rank(
         "rank": rank_obj.rank,
         "dwell_time": rank_obj.dwell_time,
     }
+    data_cache.rank_version += 1
 
     logger.info(
         "Station Rank Updated: %s -> %s (%ds)",
@@ -345,79 +515,165 @@ async def update_station_rank(
 # ============================================================
 
 
+def _get_shape_store() -> ShapeStore:
+    shape_store = data_cache.shape_store
+    if shape_store is None:
+        shape_store = data_cache.build_shape_store()
+    return shape_store
+
+
+def _lookup_shape(target_param: str, shape_store: ShapeStore) -> ShapeEntry:
+    """路線パラメータから事前コンパイル済みの形状を引く（見つからなければ 404）"""
+    target_id = resolve_line_id(target_param)
+    logger.info(f"Resolving Shape ID: '{target_param}' -> '{target_id}'")
+
+    # Railwaysデータの確認
+    exists = any(railway.get("id") == target_id for railway in data_cache.railways)
+    if not exists:
+        logger.error(f"Shape lookup failed: ID '{target_id}' not found in railways.")
+        raise HTTPException(status_code=404, detail=f"Line not found in railways: {target_id}")
+
+    shape = shape_store.get(target_id)
+    if shape is None:
+        if target_id not in shape_store.known_ids:
+            logger.error(f"Target ID {target_id} not found in coordinates.json")
+            raise HTTPException(
+                status_code=404, detail=f"Shape not found in coordinates: {target_param} -> {target_id}"
+            )
+        logger.error(f"Merged coords empty for {target_id}")
+        raise HTTPException(status_code=404, detail=f"Shape coordinates are empty: {target_param}")
+    return shape
+
+
+def _encoded_response(
+    request: Request,
+    encoded: EncodedBody,
+    media_type: str = "application/json",
+    cache_control: str = "no-cache",
+    vary: str = "Accept-Encoding",
+) -> Response:
+    """
+    エンコード済み本文を ETag 付きで返す（If-None-Match が一致すれば 304）
+
+    cache_control は既定で no-cache（毎回 ETag で再検証させる）。
+    再起動まで変わらないデータは _static_cache_control() を渡す。
+    Accept で本文の形式を選ぶエンドポイントは vary に Accept を含める。
+    """
+    headers = {"ETag": encoded.etag, "Vary": vary, "Cache-Control": cache_control}
+    if_none_match = request.headers.get("if-none-match", "")
+    if encoded.etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    body, encoding = encoded.select(request.headers.get("accept-encoding"))
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
 @app.get("/api/shapes")
 async def get_shapes(
+    request: Request,
     lineId: Optional[str] = None,
     line_id: Optional[str] = None,  # エイリアス対応
+    lineIds: Optional[str] = Query(None, description="複数路線（カンマ区切り）"),
+    zoom: Optional[float] = Query(None, ge=0, le=24, description="地図のズームレベル（詳細度の選択に使う）"),
+    tolerance: Optional[float] = Query(None, ge=0, description="許容誤差 (m)。zoom より優先"),
 ):
+    """
+    線路形状を GeoJSON FeatureCollection で返す。
+
+    形状は起動時にマージ・エンコード済み（shape_store）。zoom / tolerance を指定すると
+    Douglas-Peucker で間引いた詳細度レベルから、誤差が許容範囲に収まる最も粗いものを返す。
+    lineIds を指定すると複数路線の Feature をまとめて返す。
+    """
     # 1. パラメータの正規化
     target_param = lineId or line_id
-    logger.info(f"GET /api/shapes called. Param: {target_param}")
+    logger.info(f"GET /api/shapes called. Param: {target_param or lineIds}")
 
-    if target_param is None:
-        raise HTTPException(status_code=400, detail="lineId (or line_id) query parameter is required")
+    if target_param is None and not lineIds:
+        raise HTTPException(status_code=400, detail="lineId (or line_id / lineIds) query parameter is required")
 
-    # 2. ID解決
-    target_id = resolve_line_id(target_param)
-    logger.info(f"Resolving Shape ID: '{target_param}' -> '{target_id}'")
+    if tolerance is None:
+        tolerance = tolerance_for_zoom(zoom) if zoom is not None else 0.0
 
-    # 3. Railwaysデータの確認
-    exists = any(railway.get("id") == target_id for railway in data_cache.railways)
-    if not exists:
-        logger.error(f"Shape lookup failed: ID '{target_id}' not found in railways.")
-        raise HTTPException(status_code=404, detail=f"Line not found in railways: {target_id}")
+    # 2. 事前コンパイル済みの形状を引く（マージ・エンコード・圧縮は起動時に実施済み）
+    shape_store = _get_shape_store()
+    if target_param is not None:
+        return _encoded_response(
+            request,
+            _lookup_shape(target_param, shape_store).level(tolerance).response,
+            cache_control=_static_cache_control(),
+        )
 
-    # 2. Coordinatesデータの検索
-    railway_coords = data_cache.coordinates.get("railways", [])
-    entry = next((c for c in railway_coords if c.get("id") == target_id), None)
+    params = [p.strip() for p in lineIds.split(",") if p.strip()]
+    levels = [_lookup_shape(p, shape_store).level(tolerance) for p in dict.fromkeys(params)]
+    return _encoded_response(request, build_collection(levels), cache_control=_static_cache_control())
 
-    if not entry:
-        logger.error(f"Target ID {target_id} not found in coordinates.json")
-        # デバッグ: 近いIDがないか探す
-        candidates = [c.get("id") for c in railway_coords if "Chuo" in c.get("id", "")]
-        logger.info(f"Did you mean one of these? {candidates}")
-        raise HTTPException(status_code=404, detail=f"Shape not found in coordinates: {lineId} -> {target_id}")
 
-    # 3. 座標結合処理 (MS12: グラフベースのマージに改善 + 参照解決)
-    sublines = entry.get("sublines", [])
-    is_loop = entry.get("loop", False)
+def _get_shape_topology() -> Topology:
+    topology = data_cache.shape_topology
+    if topology is None:
+        topology = data_cache.build_shape_topology()
+    return topology
 
-    logger.info(f"Found entry for {target_id}, has {len(sublines)} sublines, loop={is_loop}")
 
-    # 参照解決用のキャッシュを構築（全路線の座標）
-    all_railways_cache = build_all_railways_cache(data_cache.coordinates)
+@app.get("/api/shapes/topology")
+async def get_shapes_topology(
+    request: Request,
+    lineIds: Optional[str] = Query(None, description="路線（カンマ区切り）。省略時は対応路線すべて"),
+    zoom: Optional[float] = Query(None, ge=0, le=24, description="地図のズームレベル（詳細度の選択に使う）"),
+    tolerance: Optional[float] = Query(None, ge=0, description="許容誤差 (m)。zoom より優先"),
+):
+    """
+    複数路線の線路形状を TopoJSON で返す。
 
-    # グラフベースのマージを試行（参照解決を含む）
-    merged_coords = merge_sublines_v2(sublines, is_loop=is_loop, all_railways_cache=all_railways_cache)
+    路線間で共有している区間（type=sub のサブラインや Base.* 路線の参照）を1本のアークにまとめ、
+    座標は整数に量子化して差分で表すので、全路線を1回の小さなレスポンスで取得できる。
+    """
+    if tolerance is None:
+        tolerance = tolerance_for_zoom(zoom) if zoom is not None else 0.0
+
+    topology = _get_shape_topology()
+    if lineIds:
+        shape_store = _get_shape_store()
+        params = [p.strip() for p in lineIds.split(",") if p.strip()]
+        line_ids = [_lookup_shape(p, shape_store).line_id for p in dict.fromkeys(params)]
+    else:
+        from config import SUPPORTED_LINES
 
-    # フォールバック: グラフベースが失敗した場合
-    if not merged_coords:
-        logger.warning(f"Graph-based merge failed for {target_id}, trying fallback")
-        merged_coords = merge_sublines_fallback(sublines)
+        line_ids = [config.mt3d_id for config in SUPPORTED_LINES.values() if config.mt3d_id in topology]
+    return _encoded_response(
+        request, topology.encode(list(dict.fromkeys(line_ids)), tolerance), cache_control=_static_cache_control()
+    )
 
-    if not merged_coords:
-        logger.error(f"Merged coords empty for {target_id}")
-        raise HTTPException(status_code=404, detail=f"Shape coordinates are empty: {lineId}")
 
-    logger.info(f"Successfully merged {len(merged_coords)} points for {target_id}")
+def _get_tile_cache() -> TileCache:
+    tile_cache = data_cache.tile_cache
+    if tile_cache is None:
+        cache_dir = os.getenv("TILE_CACHE_DIR", TILE_CACHE_DIR).strip()
+        tile_cache = data_cache.build_tile_cache(
+            max_entries=int(os.getenv("TILE_MEMORY_CACHE_SIZE", TILE_MEMORY_CACHE_SIZE)),
+            cache_dir=Path(cache_dir) if cache_dir else None,
+        )
+    return tile_cache
 
-    feature = {
-        "type": "Feature",
-        "geometry": {
-            "type": "LineString",
-            "coordinates": merged_coords,
-        },
-        "properties": {
-            "line_id": target_id,
-            "color": entry.get("color", "#000000"),
-            "segment_type": "main",
-        },
-    }
 
-    return {
-        "type": "FeatureCollection",
-        "features": [feature],
-    }
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_vector_tile(request: Request, z: int, x: int, y: int):
+    """
+    線路形状（rail レイヤー）と駅（stations レイヤー）の Mapbox Vector Tile を返す。
+
+    タイルは初回リクエスト時に生成し、以降はキャッシュ済みのバイト列を返す。
+    何も含まれないタイルは空の本文になる。
+    メモリ上に無いタイルの生成・ディスク I/O はイベントループ外（スレッドプール）で行う。
+    """
+    if not is_valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail=f"Tile out of range: {z}/{x}/{y}")
+    tile_cache = data_cache.tile_cache
+    encoded = tile_cache.cached(z, x, y) if tile_cache is not None else None
+    if encoded is None:
+        encoded = await run_in_threadpool(lambda: _get_tile_cache().get(z, x, y))
+    return _encoded_response(request, encoded, media_type=MVT_MEDIA_TYPE, cache_control=_static_cache_control())
 
 
 # ▼▼▼ 追加: デバッグ用エンドポイント (ファイルの末尾などに追加) ▼▼▼
@@ -454,9 +710,14 @@ async def get_yamanote_positions():
     api_key = os.getenv("ODPT_API_KEY", "").strip()
 
     try:
-        from gtfs_rt_vehicle import fetch_vehicle_positions
+        snapshot = _get_feed_snapshot()
+        line_feed = snapshot.get_line("yamanote") if snapshot else None
+        if line_feed is not None:
+            positions = list(line_feed.vehicle_positions.values())
+        else:
+            from gtfs_rt_vehicle import fetch_vehicle_positions
 
-        positions = await fetch_vehicle_positions(api_key, target_route_id="JR-East.Yamanote")
+            positions = await fetch_vehicle_positions(api_key, target_route_id="JR-East.Yamanote")
 
         return {
             "timestamp": positions[0].timestamp if positions else 0,
@@ -486,9 +747,33 @@ async def get_yamanote_positions_v2():
     api_key = os.getenv("ODPT_API_KEY", "").strip()
 
     try:
-        from gtfs_rt_vehicle import fetch_yamanote_positions_with_schedule
-
-        positions = await fetch_yamanote_positions_with_schedule(api_key)
+        from gtfs_rt_vehicle import YamanoteTrainPositionWithSchedule, fetch_yamanote_positions_with_schedule
+
+        snapshot = _get_feed_snapshot()
+        line_feed = snapshot.get_line("yamanote") if snapshot else None
+        if line_feed is not None:
+            # 共有スナップショットの VehiclePosition と TripUpdate を統合
+            positions = []
+            for vp in line_feed.vehicle_positions.values():
+                schedule = line_feed.schedules.get(vp.trip_id)
+                current = schedule.schedules_by_seq.get(vp.stop_sequence) if schedule else None
+                following = schedule.schedules_by_seq.get(vp.stop_sequence + 1) if schedule else None
+                positions.append(
+                    YamanoteTrainPositionWithSchedule(
+                        trip_id=vp.trip_id,
+                        train_number=vp.train_number,
+                        direction=vp.direction,
+                        latitude=vp.latitude,
+                        longitude=vp.longitude,
+                        stop_sequence=vp.stop_sequence,
+                        status=vp.status,
+                        timestamp=vp.timestamp,
+                        departure_time=current.departure_time if current else None,
+                        next_arrival_time=following.arrival_time if following else None,
+                    )
+                )
+        else:
+            positions = await fetch_yamanote_positions_with_schedule(api_key)
 
         return {
             "timestamp": positions[0].timestamp if positions else 0,
@@ -529,15 +814,13 @@ async def debug_trip_updates():
     MS1 TripUpdate デバッグ用エンドポイント。
     TripUpdate の取得結果をサンプルとして返す。
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-
     api_key = os.getenv("ODPT_API_KEY", "").strip()
     if not api_key:
         raise HTTPException(status_code=500, detail="ODPT_API_KEY not set")
 
     try:
         client = app.state.http_client
-        schedules = await fetch_trip_updates(client, api_key, data_cache)
+        schedules, _ = await _get_line_feed("yamanote", get_line_config("yamanote"), client, api_key)
 
         # サンプル3件を抽出
         sample_keys = list(schedules.keys())[:3]
@@ -616,6 +899,15 @@ async def debug_gtfs_route_ids():
     if not api_key:
         raise HTTPException(status_code=500, detail="ODPT_API_KEY not set")
 
+    # 共有ポーラーのスナップショットがあれば再取得しない
+    snapshot = _get_feed_snapshot()
+    if snapshot is not None:
+        return {
+            "total_entities": snapshot.total_entities,
+            "unique_route_ids": len(snapshot.route_id_summary),
+            "route_ids": dict(snapshot.route_id_summary),
+        }
+
     try:
         async with httpx.AsyncClient() as client:
             url = f"{TRIP_UPDATE_URL}?acl:consumerKey={api_key}"
@@ -651,8 +943,6 @@ async def debug_gtfs_stop_ids(line_id: str):
     """
     デバッグ用: 特定路線のGTFS stop_id をサンプル表示
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-
     line_config = get_line_config(line_id)
     if not line_config:
         raise HTTPException(status_code=404, detail=f"Line '{line_id}' not found")
@@ -663,9 +953,7 @@ async def debug_gtfs_stop_ids(line_id: str):
 
     try:
         client = app.state.http_client
-        schedules = await fetch_trip_updates(
-            client, api_key, data_cache, target_route_id=line_config.gtfs_route_id, mt3d_prefix=line_config.mt3d_id
-        )
+        schedules, _ = await _get_line_feed(line_id, line_config, client, api_key)
 
         samples = []
         for trip_id, schedule in list(schedules.items())[:3]:
@@ -778,10 +1066,9 @@ async def get_yamanote_positions_v4():
     TripUpdate から列車位置を計算し、線路形状に沿った座標付きで返す。
     タイムトラベルモード時はモックデータを使用。
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
     from mock_trip_generator import generate_mock_schedules
     from time_manager import time_mgr
-    from train_position_v4 import calculate_coordinates, compute_all_progress
+    from train_position_v4 import compute_all_progress
 
     try:
         # タイムトラベルモード: モックデータを使用
@@ -804,7 +1091,7 @@ async def get_yamanote_positions_v4():
                     "positions": [],
                 }
             client = app.state.http_client
-            schedules = await fetch_trip_updates(client, api_key, data_cache)
+            schedules, _ = await _get_line_feed("yamanote", get_line_config("yamanote"), client, api_key)
 
         if not schedules:
             return {
@@ -817,7 +1104,7 @@ async def get_yamanote_positions_v4():
 
         # 2. MS2: 進捗計算 (タイムトラベル時は仮想時刻を使う)
         mock_now = time_mgr.now() if time_mgr.is_virtual() else None
-        results = compute_all_progress(schedules, now_ts=mock_now, data_cache=data_cache)
+        results = compute_all_progress(schedules, now_ts=mock_now, data_cache=data_cache, engine=_progress_engine())
 
         # 3. レスポンス構築
         positions = []
@@ -897,22 +1184,128 @@ async def get_yamanote_positions_v4():
 # ============================================================================
 
 
+# 計算結果: (status, エンコード済み本文, 差分の基準になるスナップショット（エラー時は None）, レスポンス本体)
+# 複数路線の計算結果はエンコード済み本文を持たない（None。必要になったときに _batch_responses で作る）
+PositionsResult = Tuple[str, Optional[EncodedBody], Optional[PositionsSnapshot], Dict[str, Any]]
+
+_positions_cache: Optional[MicroTTLCache[PositionsResult]] = None
+_position_snapshots: Optional[SnapshotRing] = None
+# (路線, since) → 最新版との差分（最新版が変わったら作り直す）
+_delta_responses: VersionedCache[EncodedBody] = VersionedCache()
+# 計算結果 → 列指向バイナリ形式の本文（JSON 本文の ETag を版にして、計算1回につき1回だけ作る）
+_columnar_responses: VersionedCache[EncodedBody] = VersionedCache()
+
+# 列車位置の本文の形式（format= / Accept で選ぶ）
+POSITIONS_FORMATS = ("json", "columnar")
+_POSITIONS_VARY = "Accept, Accept-Encoding"
+
+
+def _get_positions_cache() -> MicroTTLCache[PositionsResult]:
+    global _positions_cache
+    if _positions_cache is None:
+        _positions_cache = MicroTTLCache(float(os.getenv("POSITIONS_CACHE_TTL", POSITIONS_CACHE_TTL)))
+    return _positions_cache
+
+
+def _get_position_snapshots() -> SnapshotRing:
+    global _position_snapshots
+    if _position_snapshots is None:
+        _position_snapshots = SnapshotRing(
+            int(os.getenv("POSITIONS_DELTA_HISTORY", POSITIONS_DELTA_HISTORY)),
+            float(os.getenv("POSITIONS_DELTA_THRESHOLD_M", POSITIONS_DELTA_THRESHOLD_M)),
+        )
+    return _position_snapshots
+
+
+def _wants_columnar(request: Request, format: Optional[str]) -> bool:
+    """format= を優先し、無ければ Accept に列指向バイナリ形式のメディアタイプがあるかで判定する"""
+    if format is not None:
+        if format not in POSITIONS_FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(POSITIONS_FORMATS)}")
+        return format == "columnar"
+    return POSITIONS_COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _build_versioned(cache: VersionedCache, key: Any, version: Any, build: Callable[[], Any]) -> Any:
+    """version が None（キャッシュしない計算結果）なら毎回作る"""
+    return build() if version is None else cache.get_or_build(key, version, build)
+
+
+def _columnar_response(
+    request: Request, key: Any, version: Any, lines: List[Dict[str, Any]], meta: Optional[Dict[str, Any]] = None
+) -> Response:
+    """列指向形式の本文。version は元の計算結果の版（JSON 本文の ETag など, None ならキャッシュしない）"""
+    columnar = _build_versioned(
+        _columnar_responses,
+        key,
+        version,
+        lambda: EncodedBody.encode(
+            encode_positions_columnar(lines, meta), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False
+        ),
+    )
+    return _encoded_response(request, columnar, media_type=POSITIONS_COLUMNAR_MEDIA_TYPE, vary=_POSITIONS_VARY)
+
+
 @app.get("/api/trains/{line_id}/positions/v4")
-async def get_train_positions_v4(line_id: str):
+async def get_train_positions_v4(
+    request: Request,
+    line_id: str,
+    since: Optional[str] = Query(None, description="前回のレスポンスの version。指定すると差分だけを返す"),
+    format: Optional[str] = Query(None, description="本文の形式 (json / columnar)。省略時は Accept で選ぶ"),
+):
     """
     MS10: 汎用路線の列車位置 v4 API。
 
     URLパスパラメータから路線を動的に切り替えて列車位置を取得する。
+    同じ路線・フィード版・時間バケット（POSITIONS_CACHE_TTL 秒）のリクエストは
+    1回の計算結果（エンコード・圧縮済みの本文と ETag）を共有する。
+    If-None-Match が共有中の結果の ETag と一致すれば、本文を作り直さず 304 を返す。
+
+    レスポンスの version を since に渡すと、その版から追加・変化した列車 (positions) と
+    消えた列車の trip_id (removed) だけを delta=true で返す。
+    版が古すぎる（POSITIONS_DELTA_HISTORY 回より前）・不明な場合は通常どおり全件を返す。
+
+    format=columnar または Accept: application/vnd.nowtrain.positions+columnar で、
+    同じ内容を列指向のバイナリ形式（position_encoder.encode_positions_columnar）で返す。
+    この形式は常に全件で、since は無視する。
 
     Args:
         line_id: 路線識別子 ("yamanote", "chuo_rapid", "keihin_tohoku", "sobu_local")
+        since: 前回のレスポンスの version
+        format: 本文の形式 ("json" / "columnar")
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
-    from mock_trip_generator import generate_mock_schedules
-    from time_manager import time_mgr
-    from train_position_v4 import calculate_coordinates, compute_all_progress
-
     # 1. 路線設定のロード
+    line_config = _require_line_config(line_id)
+    columnar = _wants_columnar(request, format)
+    _, encoded, snapshot, content = await _get_positions(line_id, line_config)
+    if columnar:
+        return _columnar_response(request, ("v4", line_id), encoded.etag, [content])
+
+    # 2. 差分の要求: クライアントの版がリングに残っていれば差分だけを返す
+    if since and snapshot is not None:
+        base = _get_position_snapshots().get(line_id, since)
+        if base is not None:
+            delta = _delta_responses.get_or_build(
+                (line_id, since), snapshot.version, lambda: _encode_positions_delta(base, snapshot)
+            )
+            return _encoded_response(request, delta, vary=_POSITIONS_VARY)
+    return _encoded_response(request, encoded, vary=_POSITIONS_VARY)
+
+
+def _encode_positions_delta(base: PositionsSnapshot, snapshot: PositionsSnapshot) -> EncodedBody:
+    changed, removed = diff_rows(base.rows, snapshot.rows)
+    content = {
+        **snapshot.header,
+        "delta": True,
+        "since": base.version,
+        "total_trains": len(snapshot.rows),
+        "positions": changed,
+        "removed": removed,
+    }
+    return EncodedBody.encode(encode_positions_json(content), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False)
+
+
+def _require_line_config(line_id: str) -> LineConfig:
     line_config = get_line_config(line_id)
     if not line_config:
         # 利用可能な路線一覧を取得
@@ -922,6 +1315,360 @@ async def get_train_positions_v4(line_id: str):
         raise HTTPException(
             status_code=404, detail=f"Line '{line_id}' is not supported. Available lines: {available} (51 lines total)"
         )
+    return line_config
+
+
+async def _get_positions(line_id: str, line_config: LineConfig) -> PositionsResult:
+    """路線の列車位置（エンコード済み）。同じ路線・フィード版・時間バケットの計算は共有する"""
+    from time_manager import time_mgr
+
+    async def compute() -> PositionsResult:
+        content = await _build_train_positions_v4(line_id, line_config)
+        positions_snapshot = None
+        if content["status"] != "error":
+            # 差分の基準として記録し、その版をレスポンスに載せる
+            header = {k: v for k, v in content.items() if k not in ("positions", "total_trains", "debug")}
+            positions_snapshot = _get_position_snapshots().append(line_id, content["positions"], header)
+            content["version"] = header["version"] = positions_snapshot.version
+        # 毎バケット作り直すので圧縮は gzip（速度優先）のみ
+        encoded = EncodedBody.encode(encode_positions_json(content), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False)
+        return content["status"], encoded, positions_snapshot, content
+
+    feed_snapshot = _get_feed_snapshot()
+    key = (line_id, feed_snapshot.version if feed_snapshot is not None else None, time_mgr.offset_sec)
+    # エラー応答はキャッシュしない（次のリクエストで再試行する）
+    return await _get_positions_cache().get_or_compute(key, compute, cacheable=lambda v: v[0] != "error")
+
+
+# ============================================================================
+# 列車位置のプッシュ配信 (Server-Sent Events)
+# ============================================================================
+
+
+_position_broadcaster: Optional[PositionBroadcaster] = None
+
+
+async def _positions_frame(line_id: str) -> Optional[Frame]:
+    line_config = get_line_config(line_id)
+    if not line_config:
+        return None
+    _, encoded, _, _ = await _get_positions(line_id, line_config)
+    return Frame(line_id, encoded.body, encoded.etag)
+
+
+def _get_position_broadcaster() -> PositionBroadcaster:
+    global _position_broadcaster
+    if _position_broadcaster is None:
+        interval = float(os.getenv("POSITIONS_PUSH_INTERVAL", POSITIONS_PUSH_INTERVAL))
+        _position_broadcaster = PositionBroadcaster(_positions_frame, interval)
+    return _position_broadcaster
+
+
+@app.get("/api/trains/positions/stream")
+async def stream_train_positions(
+    lines: str = Query(..., description="購読する路線（カンマ区切り, 例: chuo_rapid,yamanote）"),
+):
+    """
+    列車位置を Server-Sent Events で配信する。
+
+    購読中の路線は POSITIONS_PUSH_INTERVAL 秒ごとに1回だけ計算し、
+    全購読者に /api/trains/{line_id}/positions/v4 と同じ本文を positions イベントとして送る。
+    読み出しが遅いクライアントには路線ごとに最新のフレームだけを送る。
+    """
+    line_ids = [p.strip() for p in lines.split(",") if p.strip()]
+    if not line_ids:
+        raise HTTPException(status_code=400, detail="lines query parameter is required")
+    for line_id in line_ids:
+        _require_line_config(line_id)
+
+    logger.info("GET /api/trains/positions/stream subscribed: %s", line_ids)
+    return StreamingResponse(
+        sse_stream(_get_position_broadcaster(), line_ids),
+        media_type="text/event-stream",
+        # プロキシ（nginx 等）でバッファリングさせない
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ============================================================================
+# 複数路線の列車位置（1回のフィード参照・1回の進捗計算）
+# ============================================================================
+
+
+# 全路線の列車の空間インデックス（bbox 検索用）のセルサイズ (m)。列車の間隔は数百m〜数km
+FLEET_INDEX_CELL_METERS = 1000.0
+
+# 全路線の計算結果 → 列車の空間インデックス（キーは (路線ID, positions 内の位置)）。
+# 版は計算結果と同じ (位置キャッシュのキー, 時間バケット) なので、計算1回につき1回だけ作る
+_fleet_indexes: VersionedCache[GridIndex] = VersionedCache(max_entries=1)
+
+# 複数路線のエンコード済み JSON 本文（bbox なしの要求だけが作る）。版は _fleet_indexes と同じ
+_batch_responses: VersionedCache[EncodedBody] = VersionedCache(max_entries=64)
+
+
+@app.get("/api/trains/positions")
+async def get_train_positions_batch(
+    request: Request,
+    lines: Optional[str] = Query(
+        None, description="路線（カンマ区切り, 例: yamanote,chuo_rapid）。all で対応路線すべて"
+    ),
+    bbox: Optional[str] = Query(
+        None, description="表示範囲 minLon,minLat,maxLon,maxLat。指定すると範囲内の列車だけを返す"
+    ),
+    format: Optional[str] = Query(None, description="本文の形式 (json / columnar)。省略時は Accept で選ぶ"),
+):
+    """
+    複数路線の列車位置をまとめて返す。
+
+    フィード（モック時は静的時刻表）を1回だけ参照して路線ごとに振り分け、
+    全路線の列車の進捗をまとめて compute_all_progress で計算する
+    （複数路線に振り分けられた列車は路線ごとに計算するので、結果は路線ごとの v4 と同じ）。
+    lines の各路線の値は /api/trains/{line_id}/positions/v4 と同じ形式。
+    列指向のバイナリ形式では全路線の列車を lines の順に1つの配列に並べる。
+
+    bbox を指定すると、全対応路線（lines を指定した場合はその路線）のうち範囲内の列車だけを返す。
+    範囲内の列車は全路線の計算結果ごとに1回だけ構築する空間インデックスから引き、
+    範囲内の列車が無い路線は lines に含めない。
+    """
+    from config import SUPPORTED_LINES
+
+    bounds = _parse_bbox(bbox) if bbox is not None else None
+    if lines is None or lines.strip() == "all":
+        if lines is None and bounds is None:
+            raise HTTPException(status_code=400, detail="lines or bbox query parameter is required")
+        line_ids = list(SUPPORTED_LINES)
+    else:
+        line_ids = list(dict.fromkeys(p.strip() for p in lines.split(",") if p.strip()))
+    if not line_ids:
+        raise HTTPException(status_code=400, detail="lines query parameter is required")
+    line_configs = {line_id: _require_line_config(line_id) for line_id in line_ids}
+    columnar = _wants_columnar(request, format)
+
+    if bounds is not None:
+        return await _get_train_positions_in_bbox(request, bounds, line_ids, columnar)
+
+    version, content = await _get_batch_positions(line_configs)
+    if columnar:
+        meta = {k: v for k, v in content.items() if k != "lines"}
+        return _columnar_response(
+            request, ("batch", tuple(line_configs)), version, list(content["lines"].values()), meta
+        )
+    encoded = _build_versioned(
+        _batch_responses,
+        tuple(line_configs),
+        version,
+        lambda: EncodedBody.encode(encode_positions_json(content), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False),
+    )
+    return _encoded_response(request, encoded, vary=_POSITIONS_VARY)
+
+
+async def _get_batch_positions(line_configs: Dict[str, LineConfig]) -> Tuple[Optional[Tuple], Dict[str, Any]]:
+    """
+    複数路線の列車位置の (版, レスポンス本体)。同じ路線の組・フィード版・時間バケットの計算は共有する。
+
+    版は位置キャッシュのキーと時間バケットの組で、本文・空間インデックスなど計算結果から作るものの版に使う。
+    キャッシュされない計算結果（エラーを含む・キャッシュ無効）は None。
+    """
+    from time_manager import time_mgr
+
+    async def compute() -> PositionsResult:
+        content = await _build_train_positions_batch(line_configs)
+        return content["status"], None, None, content
+
+    feed_snapshot = _get_feed_snapshot()
+    key = (
+        "batch",
+        tuple(line_configs),
+        feed_snapshot.version if feed_snapshot is not None else None,
+        time_mgr.offset_sec,
+    )
+    cache = _get_positions_cache()
+    bucket = cache.bucket() if cache.enabled else None
+    # 一部の路線でもエラーになった応答はキャッシュしない
+    status, _, _, content = await cache.get_or_compute(
+        key, compute, cacheable=lambda v: v[0] == "success", bucket=bucket
+    )
+    version = (key, bucket) if bucket is not None and status == "success" else None
+    return version, content
+
+
+def _parse_bbox(bbox: str) -> Tuple[float, float, float, float]:
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be minLon,minLat,maxLon,maxLat") from None
+    if not (min_lon <= max_lon and min_lat <= max_lat):
+        raise HTTPException(status_code=400, detail="bbox must satisfy minLon <= maxLon and minLat <= maxLat")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def _build_fleet_index(content: Dict[str, Any]) -> GridIndex:
+    index = GridIndex(cell_size=FLEET_INDEX_CELL_METERS)
+    for line_id, line in content["lines"].items():
+        for i, row in enumerate(line["positions"]):
+            if row.lat is not None and row.lon is not None:
+                index.insert(row.lon, row.lat, (line_id, i))
+    return index
+
+
+async def _get_train_positions_in_bbox(
+    request: Request, bounds: Tuple[float, float, float, float], line_ids: List[str], columnar: bool
+) -> Response:
+    """
+    表示範囲内の列車だけのレスポンス（全路線の計算結果は lines=all と共有する）。
+
+    全路線分の本文はエンコードせず、計算結果から空間インデックスだけを作る。
+    """
+    from config import SUPPORTED_LINES
+
+    version, content = await _get_batch_positions({line_id: get_line_config(line_id) for line_id in SUPPORTED_LINES})
+    index = _build_versioned(_fleet_indexes, "fleet", version, lambda: _build_fleet_index(content))
+
+    # 範囲内の列車だけを路線ごとに集める（インデックスは登録順 = 路線順・positions の順で返す）
+    wanted = set(line_ids)
+    selected: Dict[str, List[PositionRow]] = {}
+    for line_id, i in index.within_bbox(*bounds):
+        if line_id in wanted:
+            selected.setdefault(line_id, []).append(content["lines"][line_id]["positions"][i])
+
+    lines_content = {}
+    for line_id, rows in selected.items():
+        line = content["lines"][line_id]
+        lines_content[line_id] = {
+            **{k: v for k, v in line.items() if k not in ("positions", "debug")},
+            "total_trains": len(rows),
+            "positions": rows,
+        }
+    result = {
+        "status": content["status"],
+        "timestamp": content["timestamp"],
+        "bbox": list(bounds),
+        "total_trains": sum(len(rows) for rows in selected.values()),
+        "lines": lines_content,
+    }
+    if columnar:
+        meta = {k: v for k, v in result.items() if k != "lines"}
+        body = encode_positions_columnar(list(lines_content.values()), meta)
+        return _encoded_response(
+            request,
+            EncodedBody.encode(body, gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False),
+            media_type=POSITIONS_COLUMNAR_MEDIA_TYPE,
+            vary=_POSITIONS_VARY,
+        )
+    encoded_result = EncodedBody.encode(
+        encode_positions_json(result), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False
+    )
+    return _encoded_response(request, encoded_result, vary=_POSITIONS_VARY)
+
+
+async def _build_train_positions_batch(line_configs: Dict[str, LineConfig]) -> Dict[str, Any]:
+    """get_train_positions_batch のレスポンス本体"""
+    import asyncio
+    import time
+
+    from mock_trip_generator import generate_mock_schedules_by_route
+    from time_manager import time_mgr
+    from train_position_v4 import compute_all_progress
+
+    try:
+        # 1. 路線ごとの (schedules, vehicle_positions) を1回のフィード参照で揃える
+        if time_mgr.is_virtual():
+            by_route = generate_mock_schedules_by_route(
+                data_cache, time_mgr.now(), [conf.gtfs_route_id for conf in line_configs.values()]
+            )
+            feeds = {line_id: (by_route[conf.gtfs_route_id], {}) for line_id, conf in line_configs.items()}
+        else:
+            api_key = os.getenv("ODPT_API_KEY", "").strip()
+            if not api_key:
+                return _batch_positions_content(
+                    {
+                        line_id: _error_positions_content(line_id, conf, "ODPT_API_KEY not set")
+                        for line_id, conf in line_configs.items()
+                    }
+                )
+            client = app.state.http_client
+            # 共有ポーラーのスナップショット（1回のデコードで路線ごとに振り分け済み）を参照する
+            fetched = await asyncio.gather(
+                *(
+                    _get_line_feed(line_id, conf, client, api_key, with_vehicles=True)
+                    for line_id, conf in line_configs.items()
+                )
+            )
+            feeds = dict(zip(line_configs, fetched))
+
+        # 2. 進捗計算をまとめる。1つの列車 (trip_id) は trip_id の接尾辞から推定される全路線に振り分けられ、
+        #    路線ごとに駅IDの異なるスケジュールを持つので、trip_id が重ならない路線どうしだけを1回の計算にまとめる
+        #    （モック時は route_id ごとに振り分けているので全路線が1回にまとまる）
+        groups: List[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, str]]] = []
+        for line_id, (line_schedules, line_vehicles) in feeds.items():
+            if not line_schedules:
+                continue
+            for schedules, vehicle_positions, owners in groups:
+                if schedules.keys().isdisjoint(line_schedules):
+                    break
+            else:
+                schedules, vehicle_positions, owners = {}, {}, {}
+                groups.append((schedules, vehicle_positions, owners))
+            for trip_id, schedule in line_schedules.items():
+                owners[trip_id] = line_id
+                schedules[trip_id] = schedule
+                vehicle = line_vehicles.get(trip_id)
+                if vehicle is not None:
+                    vehicle_positions[trip_id] = vehicle
+
+        # 全グループで同じ時刻を使う
+        now_ts = time_mgr.now() if time_mgr.is_virtual() else int(time.time())
+        grouped: Dict[str, List[Any]] = {line_id: [] for line_id in line_configs}
+        for schedules, vehicle_positions, owners in groups:
+            results = compute_all_progress(
+                schedules,
+                now_ts=now_ts,
+                data_cache=data_cache,
+                vehicle_positions=vehicle_positions,
+                engine=_progress_engine(),
+            )
+            for r in results:
+                grouped[owners[r.trip_id]].append(r)
+
+        # 3. 路線ごとにレスポンスを組み立てる
+        contents = {}
+        for line_id, conf in line_configs.items():
+            schedules_count = len(feeds[line_id][0])
+            if not schedules_count:
+                contents[line_id] = _no_data_positions_content(line_id, conf)
+            else:
+                contents[line_id] = _line_positions_content(line_id, conf, grouped[line_id], schedules_count)
+        return _batch_positions_content(contents)
+
+    except Exception as e:
+        logger.error(f"Error in batch positions endpoint for {list(line_configs)}: {e}")
+        return _batch_positions_content(
+            {line_id: _error_positions_content(line_id, conf, str(e)) for line_id, conf in line_configs.items()}
+        )
+
+
+def _batch_positions_content(contents: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """路線ごとのレスポンスをまとめる（一部の路線がエラーなら partial、全路線なら error）"""
+    errors = sum(1 for content in contents.values() if content["status"] == "error")
+    if errors == 0:
+        status = "success"
+    elif errors < len(contents):
+        status = "partial"
+    else:
+        status = "error"
+    return {
+        "status": status,
+        "timestamp": max((content["timestamp"] for content in contents.values()), default=None),
+        "total_trains": sum(content["total_trains"] for content in contents.values()),
+        "lines": contents,
+    }
+
+
+async def _build_train_positions_v4(line_id: str, line_config: LineConfig) -> Dict[str, Any]:
+    """get_train_positions_v4 のレスポンス本体（positions は PositionRow のリスト）"""
+    from mock_trip_generator import generate_mock_schedules
+    from time_manager import time_mgr
+    from train_position_v4 import compute_all_progress
 
     try:
         # タイムトラベルモード: モックデータを使用
@@ -935,48 +1682,16 @@ async def get_train_positions_v4(line_id: str):
             # 実データモード: ODPT API から取得
             api_key = os.getenv("ODPT_API_KEY", "").strip()
             if not api_key:
-                return {
-                    "source": "tripupdate_v4",
-                    "line_id": line_id,
-                    "line_name": line_config.name,
-                    "status": "error",
-                    "error": "ODPT_API_KEY not set",
-                    "timestamp": int(datetime.now(JST).timestamp()),
-                    "total_trains": 0,
-                    "positions": [],
-                }
+                return _error_positions_content(line_id, line_config, "ODPT_API_KEY not set")
             client = app.state.http_client
 
-            # MS13: VehiclePosition も取得して統合
-            # 並行取得
-            import asyncio
-
-            from gtfs_rt_vehicle import fetch_vehicle_positions
-
-            trip_update_task = fetch_trip_updates(
-                client,
-                api_key,
-                data_cache,
-                target_route_id=line_config.gtfs_route_id,
-                mt3d_prefix=line_config.mt3d_id,
+            # MS13: VehiclePosition も取得して統合（共有スナップショットから参照）
+            schedules, vehicle_positions_map = await _get_line_feed(
+                line_id, line_config, client, api_key, with_vehicles=True
             )
-            vehicle_position_task = fetch_vehicle_positions(api_key, target_route_id=line_config.gtfs_route_id)
-
-            schedules, vehicle_positions_list = await asyncio.gather(trip_update_task, vehicle_position_task)
-
-            # VehiclePosition を trip_id でマップ化
-            vehicle_positions_map = {vp.trip_id: vp for vp in vehicle_positions_list}
 
         if not schedules:
-            return {
-                "source": "mock_v4" if time_mgr.is_virtual() else "tripupdate_v4",
-                "line_id": line_id,
-                "line_name": line_config.name,
-                "status": "no_data",
-                "timestamp": time_mgr.now() if time_mgr.is_virtual() else int(datetime.now(JST).timestamp()),
-                "total_trains": 0,
-                "positions": [],
-            }
+            return _no_data_positions_content(line_id, line_config)
 
         # 3. MS2: 進捗計算 (タイムトラベル時は仮想時刻を使う)
         mock_now = time_mgr.now() if time_mgr.is_virtual() else None
@@ -984,98 +1699,93 @@ async def get_train_positions_v4(line_id: str):
         # VehiclePosition マップを渡す（実データ時のみ有効、モック時は空）
         v_map = vehicle_positions_map if not time_mgr.is_virtual() else {}
 
-        results = compute_all_progress(schedules, now_ts=mock_now, data_cache=data_cache, vehicle_positions=v_map)
+        results = compute_all_progress(
+            schedules, now_ts=mock_now, data_cache=data_cache, vehicle_positions=v_map, engine=_progress_engine()
+        )
 
         # 4. レスポンス構築
-        positions = []
-        now_ts = None
+        return _line_positions_content(line_id, line_config, results, len(schedules))
 
-        # デバッグ: direction 分布の統計
-        direction_stats = {}
-        status_stats = {}
+    except Exception as e:
+        logger.error(f"Error in generic v4 endpoint for {line_id}: {e}")
+        return _error_positions_content(line_id, line_config, str(e))
 
-        for r in results:
-            # 統計収集（invalidも含む）
-            d = r.direction or "None"
-            direction_stats[d] = direction_stats.get(d, 0) + 1
-            status_stats[r.status] = status_stats.get(r.status, 0) + 1
 
-            if r.status == "invalid":
-                continue
+def _line_positions_content(
+    line_id: str, line_config: LineConfig, results: List[Any], schedules_count: int
+) -> Dict[str, Any]:
+    """1路線分の進捗計算結果からレスポンス本体を組み立てる（列車ごとの辞書は作らず、エンコード時に直接書き出す）"""
+    from time_manager import time_mgr
+    from train_position_v4 import calculate_coordinates
 
-            # MS5: 座標計算（線路形状追従）
-            coord = calculate_coordinates(r, data_cache, line_config.mt3d_id)
-            lat = coord[0] if coord else None
-            lon = coord[1] if coord else None
-            bearing = coord[2] if coord and len(coord) > 2 else 0.0
+    positions: List[PositionRow] = []
+    now_ts = None
 
-            if now_ts is None:
-                now_ts = r.now_ts
+    # デバッグ: direction 分布の統計
+    direction_stats = {}
+    status_stats = {}
 
-            pos_entry = {
-                "trip_id": r.trip_id,
-                "train_number": r.train_number,
-                "direction": r.direction,
-                "status": r.status,
-                "progress": round(r.progress, 4) if r.progress is not None else None,
-                "delay": r.delay,
-                "location": {
-                    "latitude": round(lat, 6) if lat is not None else None,
-                    "longitude": round(lon, 6) if lon is not None else None,
-                    "bearing": round(bearing, 2) if bearing is not None else 0.0,
-                },
-                "segment": {
-                    "prev_seq": r.prev_seq,
-                    "next_seq": r.next_seq,
-                    "prev_station_id": r.prev_station_id,
-                    "next_station_id": r.next_station_id,
-                },
-                "times": {
-                    "now_ts": r.now_ts,
-                    "t0_departure": r.t0_departure,
-                    "t1_arrival": r.t1_arrival,
-                },
-                "debug": {
-                    "feed_timestamp": r.feed_timestamp,
-                },
-            }
-            # MS14: 始発駅フラグ
-            if r.is_starting_station:
-                pos_entry["is_starting_station"] = True
-            positions.append(pos_entry)
+    for r in results:
+        # 統計収集（invalidも含む）
+        d = r.direction or "None"
+        direction_stats[d] = direction_stats.get(d, 0) + 1
+        status_stats[r.status] = status_stats.get(r.status, 0) + 1
 
-        # ソート: direction -> train_number
-        positions.sort(key=lambda p: (p["direction"] or "", p["train_number"] or ""))
+        if r.status == "invalid":
+            continue
 
-        return {
-            "source": "mock_v4" if time_mgr.is_virtual() else "tripupdate_v4",
-            "line_id": line_id,
-            "line_name": line_config.name,
-            "status": "success",
-            "timestamp": now_ts or (time_mgr.now() if time_mgr.is_virtual() else int(datetime.now(JST).timestamp())),
-            "total_trains": len(positions),
-            "positions": positions,
-            "time_travel": time_mgr.get_status() if time_mgr.is_virtual() else None,
-            # デバッグ情報
-            "debug": {
-                "direction_stats": direction_stats,
-                "status_stats": status_stats,
-                "schedules_count": len(schedules),
-            },
-        }
+        if now_ts is None:
+            now_ts = r.now_ts
 
-    except Exception as e:
-        logger.error(f"Error in generic v4 endpoint for {line_id}: {e}")
-        return {
-            "source": "tripupdate_v4",
-            "line_id": line_id,
-            "line_name": line_config.name,
-            "status": "error",
-            "error": str(e),
-            "timestamp": int(datetime.now(JST).timestamp()),
-            "total_trains": 0,
-            "positions": [],
-        }
+        # MS5: 座標計算（線路形状追従）
+        positions.append(PositionRow.from_coord(r, calculate_coordinates(r, data_cache, line_config.mt3d_id)))
+
+    # ソート: direction -> train_number
+    positions.sort(key=PositionRow.sort_key)
+
+    return {
+        "source": "mock_v4" if time_mgr.is_virtual() else "tripupdate_v4",
+        "line_id": line_id,
+        "line_name": line_config.name,
+        "status": "success",
+        "timestamp": now_ts or (time_mgr.now() if time_mgr.is_virtual() else int(datetime.now(JST).timestamp())),
+        "total_trains": len(positions),
+        "positions": positions,
+        "time_travel": time_mgr.get_status() if time_mgr.is_virtual() else None,
+        # デバッグ情報
+        "debug": {
+            "direction_stats": direction_stats,
+            "status_stats": status_stats,
+            "schedules_count": schedules_count,
+        },
+    }
+
+
+def _no_data_positions_content(line_id: str, line_config: LineConfig) -> Dict[str, Any]:
+    from time_manager import time_mgr
+
+    return {
+        "source": "mock_v4" if time_mgr.is_virtual() else "tripupdate_v4",
+        "line_id": line_id,
+        "line_name": line_config.name,
+        "status": "no_data",
+        "timestamp": time_mgr.now() if time_mgr.is_virtual() else int(datetime.now(JST).timestamp()),
+        "total_trains": 0,
+        "positions": [],
+    }
+
+
+def _error_positions_content(line_id: str, line_config: LineConfig, error: str) -> Dict[str, Any]:
+    return {
+        "source": "tripupdate_v4",
+        "line_id": line_id,
+        "line_name": line_config.name,
+        "status": "error",
+        "error": error,
+        "timestamp": int(datetime.now(JST).timestamp()),
+        "total_trains": 0,
+        "positions": [],
+    }
 
 
 # ============================================================================
@@ -1123,6 +1833,15 @@ async def get_time_status():
     return time_mgr.get_status()
 
 
+@app.get("/api/debug/feed_status")
+async def debug_feed_status():
+    """GTFS-RT 共有ポーラーの状態（フィード版・条件付き取得の統計）を返す"""
+    poller = getattr(app.state, "feed_poller", None)
+    if poller is None:
+        return {"enabled": False}
+    return {"enabled": True, **poller.get_status()}
+
+
 # ============================================================================
 # Route Search API (OTP + Train Position Integration)
 # ============================================================================
@@ -1183,7 +1902,6 @@ async def _get_train_positions_for_lines(
     Returns:
         { "trip_id_suffix": position_dict, ... }
     """
-    from gtfs_rt_tripupdate import fetch_trip_updates
     from train_position_v4 import calculate_coordinates, compute_all_progress
 
     all_positions: Dict[str, Dict] = {}
@@ -1194,15 +1912,13 @@ async def _get_train_positions_for_lines(
             continue
 
         try:
-            schedules = await fetch_trip_updates(
-                client, api_key, data_cache, target_route_id=line_config.gtfs_route_id, mt3d_prefix=line_config.mt3d_id
-            )
+            schedules, _ = await _get_line_feed(line_id, line_config, client, api_key)
             logger.info(f"[ROUTE-SEARCH] line={line_id}: {len(schedules)} schedules found")
 
             if not schedules:
                 continue
 
-            results = compute_all_progress(schedules, data_cache=data_cache)
+            results = compute_all_progress(schedules, data_cache=data_cache, engine=_progress_engine())
             valid = [r for r in results if r.status != "invalid"]
             logger.info(f"[ROUTE-SEARCH] line={line_id}: {len(valid)} valid positions")
 
@@ -10,7 +10,7 @@ from __future__ import annotations
 
 import logging
 from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, Dict, List, Optional
+from typing import TYPE_CHECKING, Collection, Dict, Iterator, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
 from gtfs_rt_tripupdate import RealtimeStationSchedule, TrainSchedule
@@ -153,12 +153,43 @@ def generate_mock_schedules(
     Returns:
         {trip_id: TrainSchedule} の辞書
     """
+    route_ids = {target_route_id} if target_route_id else None
+    result: Dict[str, TrainSchedule] = {}
+    for _, schedule in _iter_active_schedules(data_cache, virtual_now_ts, route_ids, window_minutes):
+        result[schedule.trip_id] = schedule
+    return result
+
+
+def generate_mock_schedules_by_route(
+    data_cache: "DataCache",
+    virtual_now_ts: int,
+    route_ids: Collection[str],
+    window_minutes: int = 30,
+) -> Dict[str, Dict[str, TrainSchedule]]:
+    """
+    複数路線分の TrainSchedule を、静的時刻表を1回だけ走査して路線ごとに振り分ける。
+
+    Returns:
+        {route_id: {trip_id: TrainSchedule}}（列車が無い路線は空の辞書）
+    """
+    result: Dict[str, Dict[str, TrainSchedule]] = {route_id: {} for route_id in route_ids}
+    for route_id, schedule in _iter_active_schedules(data_cache, virtual_now_ts, set(result), window_minutes):
+        result[route_id][schedule.trip_id] = schedule
+    return result
+
+
+def _iter_active_schedules(
+    data_cache: "DataCache",
+    virtual_now_ts: int,
+    route_ids: Optional[Collection[str]],
+    window_minutes: int,
+) -> Iterator[Tuple[str, TrainSchedule]]:
+    """仮想時刻に走行中の列車の (route_id, TrainSchedule)。route_ids が None なら全路線"""
     dt = datetime.fromtimestamp(virtual_now_ts, tz=JST)
     service_type = determine_service_type(dt)
     midnight_unix = _get_midnight_unix(virtual_now_ts)
     window_sec = window_minutes * 60
 
-    result: Dict[str, TrainSchedule] = {}
     filtered_count = 0
     active_count = 0
 
@@ -171,7 +202,7 @@ def generate_mock_schedules(
             continue
 
         # 2. 路線フィルタ（指定時のみ）
-        if target_route_id and train.line_id != target_route_id:
+        if route_ids is not None and train.line_id not in route_ids:
             continue
 
         filtered_count += 1
@@ -187,16 +218,18 @@ def generate_mock_schedules(
         if len(schedule.ordered_sequences) < 2:
             continue
 
-        result[schedule.trip_id] = schedule
         active_count += 1
+        yield train.line_id, schedule
 
     logger.info(
         "MockGenerator: service=%s, route=%s, candidates=%d, active=%d (window=±%dmin)",
         service_type,
-        target_route_id or "ALL",
+        "ALL"
+        if route_ids is None
+        else ",".join(sorted(route_ids))
+        if len(route_ids) <= 3
+        else f"{len(route_ids)} routes",
         filtered_count,
         active_count,
         window_minutes,
     )
-
-    return result
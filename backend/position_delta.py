@@ -0,0 +1,142 @@
+# backend/position_delta.py
+"""
+列車位置レスポンスの差分（/api/trains/{line_id}/positions/v4?since=<version>）
+
+連続する2回のレスポンスでは大半の列車がほとんど動いておらず、停車中の列車は全く動かない。
+それでも毎回すべての列車の segment・times・debug を送っていた。
+
+ここでは路線ごとに直近のスナップショット（trip_id → PositionRow）をリングに保持し、
+クライアントが持っている版 (since) との差分だけを返せるようにする。
+
+- 版は計算ごとに発行する（プロセスごとの接頭辞 + 連番）。
+  リングに無い版（古すぎる・別プロセス・再起動前）を指定された場合は全件を返す
+- 位置が閾値 (m) 以上動いた列車と、状態・区間・遅延などが変わった列車を「変化あり」とする。
+  進捗率・現在時刻のように毎回変わる値だけの変化は送らない
+- 閾値の判定は版を記録するときに直前の版の行と比べて1回だけ行い、変化が無ければ直前の行をそのまま引き継ぐ。
+  差分は行が入れ替わった列車だけなので、少しずつ動く列車でもクライアントとのずれが積み重ならない
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import math
+import secrets
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from position_encoder import PositionRow
+from projection import LocalProjection
+
+logger = logging.getLogger(__name__)
+
+# 路線ごとに保持するスナップショットの数
+DEFAULT_HISTORY = 8
+
+# 位置の変化とみなす移動距離 (m)
+DEFAULT_THRESHOLD_M = 5.0
+
+_PROJECTION = LocalProjection()
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass
+class PositionsSnapshot:
+    """1回の計算結果（差分の基準）"""
+
+    version: str
+    rows: Dict[str, PositionRow]  # trip_id → その版で配った行（閾値未満の変化なら前の版の行）
+    header: Dict[str, Any]  # positions 以外のレスポンス項目（source・timestamp など）
+
+
+# ============================================================================
+# Diff
+# ============================================================================
+
+
+def _state(row: PositionRow) -> Tuple:
+    """位置以外で、変われば送り直す値"""
+    r = row.progress
+    return (
+        r.status,
+        r.direction,
+        r.delay,
+        r.prev_station_id,
+        r.next_station_id,
+        r.prev_seq,
+        r.next_seq,
+        r.t0_departure,
+        r.t1_arrival,
+        r.is_starting_station,
+    )
+
+
+def row_changed(old: PositionRow, new: PositionRow, threshold_m: float) -> bool:
+    """old から new への変化を送る必要があるか"""
+    if _state(old) != _state(new):
+        return True
+    if old.lat is None or new.lat is None:
+        return (old.lat is None) != (new.lat is None)
+    dx = (new.lon - old.lon) * _PROJECTION.kx
+    dy = (new.lat - old.lat) * _PROJECTION.ky
+    return math.hypot(dx, dy) >= threshold_m
+
+
+def diff_rows(old: Dict[str, PositionRow], new: Dict[str, PositionRow]) -> Tuple[List[PositionRow], List[str]]:
+    """(追加・変化した列車, 消えた列車の trip_id)。変化は行が入れ替わったかどうかで判定する"""
+    changed = [row for trip_id, row in new.items() if old.get(trip_id) is not row]
+    removed = [trip_id for trip_id in old if trip_id not in new]
+    changed.sort(key=PositionRow.sort_key)
+    return changed, removed
+
+
+# ============================================================================
+# Snapshot Ring
+# ============================================================================
+
+
+class SnapshotRing:
+    """路線ごとの直近のスナップショット"""
+
+    def __init__(self, history: int = DEFAULT_HISTORY, threshold_m: float = DEFAULT_THRESHOLD_M) -> None:
+        self.history = history
+        self.threshold_m = threshold_m
+        self._rings: Dict[str, Deque[PositionsSnapshot]] = {}
+        # 版はこのプロセス内でだけ有効（別プロセスの版は見つからないので全件を返す）
+        self._prefix = secrets.token_hex(4)
+        self._counter = itertools.count(1)
+
+    def append(self, line_id: str, rows: List[PositionRow], header: Dict[str, Any]) -> PositionsSnapshot:
+        """計算結果を新しい版として記録する（閾値未満しか変わっていない列車は直前の版の行を引き継ぐ）"""
+        ring = self._rings.get(line_id)
+        if ring is None:
+            ring = self._rings[line_id] = deque(maxlen=self.history)
+        prev_rows = ring[-1].rows if ring else {}
+
+        published: Dict[str, PositionRow] = {}
+        for row in rows:
+            trip_id = row.progress.trip_id
+            prev = prev_rows.get(trip_id)
+            published[trip_id] = prev if prev is not None and not row_changed(prev, row, self.threshold_m) else row
+
+        snapshot = PositionsSnapshot(
+            version=f"{self._prefix}-{next(self._counter)}",
+            rows=published,
+            header=header,
+        )
+        ring.append(snapshot)
+        return snapshot
+
+    def get(self, line_id: str, version: str) -> Optional[PositionsSnapshot]:
+        for snapshot in reversed(self._rings.get(line_id, ())):
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    def clear(self) -> None:
+        self._rings.clear()
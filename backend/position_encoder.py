@@ -0,0 +1,279 @@
+# backend/position_encoder.py
+"""
+列車位置レスポンスの高速エンコード（/api/trains/{line_id}/positions/v4 用）
+
+従来は列車ごとに入れ子の辞書を組み立ててから FastAPI の既定のエンコーダ
+（jsonable_encoder で全体を走査 → json.dumps）に渡していたため、
+大きな路線では列車あたりのシリアライズがリクエスト時間の大きな割合を占めていた。
+
+ここでは列車ごとの結果を PositionRow（SegmentProgress と座標の組）のまま持ち、
+orjson の default フックで1行ずつ辞書（入れ子を含め列車あたり5個）にして orjson に書き出させる。
+辞書はエンコード中に作って捨てるだけで、jsonable_encoder によるレスポンス全体の走査は行わない。
+辞書を作らずにキー断片を連結して行を直接組み立てる方式も試したが、Python で値を1つずつ
+書き出すぶん orjson (C 実装) に辞書を渡すより遅い（bench_positions.py の direct）。
+
+orjson は任意依存。インストールされていなければ標準の json で同じ形式に書き出す。
+
+全路線表示のように列車数が多い場合向けに、列指向のバイナリ形式 (encode_positions_columnar) も用意する。
+緯度・経度・方位角・状態・遅延を型付き配列のまま並べるので、フロントエンドは
+JSON を解析せずに Float32Array などのビューをそのまま地図レイヤーに渡せる。
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:  # pragma: no cover - 任意依存
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+if TYPE_CHECKING:
+    from train_position_v4 import SegmentProgress
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass
+class PositionRow:
+    """1列車分の出力（MS2 の進捗と MS5 の座標）"""
+
+    __slots__ = ("progress", "lat", "lon", "bearing")
+
+    progress: "SegmentProgress"
+    lat: Optional[float]
+    lon: Optional[float]
+    bearing: Optional[float]
+
+    @classmethod
+    def from_coord(cls, progress: "SegmentProgress", coord: Optional[Tuple[float, ...]]) -> "PositionRow":
+        """calculate_coordinates の結果 (lat, lon[, bearing]) から作る"""
+        if not coord:
+            return cls(progress, None, None, 0.0)
+        return cls(progress, coord[0], coord[1], coord[2] if len(coord) > 2 else 0.0)
+
+    def sort_key(self) -> Tuple[str, str]:
+        """direction → train_number の順"""
+        return (self.progress.direction or "", self.progress.train_number or "")
+
+    def to_dict(self) -> Dict[str, Any]:
+        r = self.progress
+        lat, lon, bearing = self.lat, self.lon, self.bearing
+        entry = {
+            "trip_id": r.trip_id,
+            "train_number": r.train_number,
+            "direction": r.direction,
+            "status": r.status,
+            "progress": round(r.progress, 4) if r.progress is not None else None,
+            "delay": r.delay,
+            "location": {
+                "latitude": round(lat, 6) if lat is not None else None,
+                "longitude": round(lon, 6) if lon is not None else None,
+                "bearing": round(bearing, 2) if bearing is not None else 0.0,
+            },
+            "segment": {
+                "prev_seq": r.prev_seq,
+                "next_seq": r.next_seq,
+                "prev_station_id": r.prev_station_id,
+                "next_station_id": r.next_station_id,
+            },
+            "times": {
+                "now_ts": r.now_ts,
+                "t0_departure": r.t0_departure,
+                "t1_arrival": r.t1_arrival,
+            },
+            "debug": {
+                "feed_timestamp": r.feed_timestamp,
+            },
+        }
+        # MS14: 始発駅フラグ
+        if r.is_starting_station:
+            entry["is_starting_station"] = True
+        return entry
+
+
+# ============================================================================
+# Encoding
+# ============================================================================
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, PositionRow):
+        return obj.to_dict()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def encode_positions_json(content: Dict[str, Any]) -> bytes:
+    """PositionRow を含むレスポンスを JSON のバイト列にする"""
+    if ORJSON_AVAILABLE:
+        # dataclass は orjson が独自にフィールドを書き出すので、default に回す
+        return orjson.dumps(content, default=_default, option=orjson.OPT_PASSTHROUGH_DATACLASS)
+    return encode_json_fallback(content)
+
+
+def encode_json_fallback(content: Dict[str, Any]) -> bytes:
+    """orjson が無い環境用（FastAPI の JSONResponse と同じ形式）"""
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"), default=_default
+    ).encode("utf-8")
+
+
+# ============================================================================
+# Columnar Binary Format
+# ============================================================================
+#
+# リトルエンディアン。セクションは8バイト境界に揃えるので、クライアントは
+# ArrayBuffer から Float32Array / Uint8Array / Int16Array / Uint32Array をコピーせずに作れる。
+#
+#   ヘッダ (magic, version, manifest 長) + manifest (JSON) + 8バイト境界に揃えたセクション
+#
+#   lat / lon / bearing               float32[列車数]（座標が無い列車の lat・lon は NaN）
+#   status                            uint8[列車数]（manifest の statuses の番号）
+#   delay                             int16[列車数]（遅延秒数, ±32767 で打ち切り）
+#   trip_id_offsets                   uint32[列車数 + 1]（trip_ids 内の位置）
+#   trip_ids                          UTF-8 の trip_id を行順に連結したバイト列
+#   train_number_offsets / train_numbers  同上（列車番号, 無ければ空文字列）
+#
+# manifest にはセクションの位置・路線表（路線ごとの position 以外の項目と行の範囲 start・count）を持つ。
+
+POSITIONS_COLUMNAR_MEDIA_TYPE = "application/vnd.nowtrain.positions+columnar"
+
+COLUMNAR_FORMAT_VERSION = 1
+
+# status 列の番号（未知の状態は 0 = unknown）
+STATUS_NAMES = ("unknown", "running", "stopped", "invalid")
+_STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+_COLUMNAR_MAGIC = b"NTPC"
+_COLUMNAR_HEADER = struct.Struct("<4sHxxI")
+_INT16_MAX = 32767
+
+_COLUMNAR_SECTIONS = (
+    ("lat", "f"),
+    ("lon", "f"),
+    ("bearing", "f"),
+    ("status", "B"),
+    ("delay", "h"),
+    ("trip_id_offsets", "I"),
+    ("trip_ids", "B"),
+    ("train_number_offsets", "I"),
+    ("train_numbers", "B"),
+)
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _pad8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _to_le_bytes(values: array) -> bytes:
+    if _LITTLE_ENDIAN or values.itemsize == 1:
+        return values.tobytes()
+    swapped = array(values.typecode, values)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def _append_string(blob: array, offsets: array, value: Optional[str]) -> None:
+    if value:
+        blob.frombytes(value.encode("utf-8"))
+    offsets.append(len(blob))
+
+
+def encode_positions_columnar(lines: Sequence[Dict[str, Any]], meta: Optional[Dict[str, Any]] = None) -> bytes:
+    """
+    路線ごとのレスポンス本体（positions は PositionRow のリスト）を列指向のバイナリにする
+
+    Args:
+        lines: /api/trains/{line_id}/positions/v4 のレスポンス本体のリスト（行は路線順に連結する）
+        meta: manifest の最上位に載せる項目（まとめ取得の status・timestamp など）
+    """
+    data: Dict[str, array] = {name: array(typecode) for name, typecode in _COLUMNAR_SECTIONS}
+    data["trip_id_offsets"].append(0)
+    data["train_number_offsets"].append(0)
+    nan = math.nan
+
+    line_table = []
+    for content in lines:
+        start = len(data["lat"])
+        for row in content.get("positions", ()):
+            r = row.progress
+            data["lat"].append(row.lat if row.lat is not None else nan)
+            data["lon"].append(row.lon if row.lon is not None else nan)
+            data["bearing"].append(row.bearing if row.bearing is not None else 0.0)
+            data["status"].append(_STATUS_CODES.get(r.status, 0))
+            data["delay"].append(max(-_INT16_MAX, min(_INT16_MAX, int(r.delay or 0))))
+            _append_string(data["trip_ids"], data["trip_id_offsets"], r.trip_id)
+            _append_string(data["train_numbers"], data["train_number_offsets"], r.train_number)
+        entry = {k: v for k, v in content.items() if k not in ("positions", "debug")}
+        entry["start"] = start
+        entry["count"] = len(data["lat"]) - start
+        line_table.append(entry)
+
+    # セクションの位置はデータ領域（manifest の直後の8バイト境界）の先頭からのオフセット
+    sections: Dict[str, List[int]] = {}
+    offset = 0
+    for name, _typecode in _COLUMNAR_SECTIONS:
+        sections[name] = [offset, len(data[name])]
+        offset = _pad8(offset + len(data[name]) * data[name].itemsize)
+    manifest = {
+        **(meta or {}),
+        "format_version": COLUMNAR_FORMAT_VERSION,
+        "count": len(data["lat"]),
+        "statuses": list(STATUS_NAMES),
+        "sections": sections,
+        "lines": line_table,
+    }
+    encoded_manifest = json.dumps(manifest, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    data_start = _pad8(_COLUMNAR_HEADER.size + len(encoded_manifest))
+
+    out = bytearray(data_start + offset)
+    out[: _COLUMNAR_HEADER.size] = _COLUMNAR_HEADER.pack(
+        _COLUMNAR_MAGIC, COLUMNAR_FORMAT_VERSION, len(encoded_manifest)
+    )
+    out[_COLUMNAR_HEADER.size : _COLUMNAR_HEADER.size + len(encoded_manifest)] = encoded_manifest
+    for name, _typecode in _COLUMNAR_SECTIONS:
+        chunk = _to_le_bytes(data[name])
+        start = data_start + sections[name][0]
+        out[start : start + len(chunk)] = chunk
+    return bytes(out)
+
+
+def decode_positions_columnar(buffer: bytes) -> Tuple[Dict[str, Any], Dict[str, array]]:
+    """encode_positions_columnar の逆変換 (manifest, {セクション名: array})。テスト・デバッグ用"""
+    magic, version, manifest_len = _COLUMNAR_HEADER.unpack_from(buffer, 0)
+    if magic != _COLUMNAR_MAGIC or version != COLUMNAR_FORMAT_VERSION:
+        raise ValueError(f"unsupported columnar positions format: {magic!r} v{version}")
+    manifest = json.loads(bytes(buffer[_COLUMNAR_HEADER.size : _COLUMNAR_HEADER.size + manifest_len]))
+    data_start = _pad8(_COLUMNAR_HEADER.size + manifest_len)
+
+    columns: Dict[str, array] = {}
+    for name, typecode in _COLUMNAR_SECTIONS:
+        offset, count = manifest["sections"][name]
+        values = array(typecode)
+        start = data_start + offset
+        values.frombytes(bytes(buffer[start : start + count * values.itemsize]))
+        if not _LITTLE_ENDIAN and values.itemsize > 1:
+            values.byteswap()
+        columns[name] = values
+    return manifest, columns
+
+
+def columnar_strings(columns: Dict[str, array], name: str) -> List[str]:
+    """decode_positions_columnar の結果から文字列の列（trip_ids / train_numbers）を取り出す"""
+    blob = columns[name].tobytes()
+    offsets = columns[name.removesuffix("s") + "_offsets"]
+    return [blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
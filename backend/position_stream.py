@@ -0,0 +1,192 @@
+# backend/position_stream.py
+"""
+列車位置のプッシュ配信（Server-Sent Events 用）
+
+フロントエンドは表示中の路線ごとに /api/trains/{line_id}/positions/v4 を一定間隔でポーリングしていた。
+このモジュールは購読中の路線について一定間隔で1回だけ列車位置を計算し、
+エンコード済みの SSE フレームを全購読者に配る。
+
+- 路線ごとの計算は購読者数によらず1周期1回（ポーリング用の短命キャッシュとも共有する）
+- 購読者ごとのキューは路線ごとに最新フレーム1つだけを保持する。
+  読み出しが遅いクライアントには古いフレームを捨てて最新のものだけを渡す
+- 配信ループは最初の購読で起動し、購読者がいなくなると停止する
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SSE_EVENT = b"positions"
+
+# フレームが無い間もこの間隔でコメント行を送り、接続を維持する (seconds)
+HEARTBEAT_INTERVAL = 15.0
+
+# 切断時にクライアント (EventSource) が再接続するまでの待ち時間 (ms)
+RETRY_MS = 3000
+
+
+# ============================================================================
+# Frames / Subscriptions
+# ============================================================================
+
+
+class Frame:
+    """1路線・1周期分の SSE フレーム（全購読者で共有する）"""
+
+    __slots__ = ("line_id", "etag", "data")
+
+    def __init__(self, line_id: str, body: bytes, etag: str) -> None:
+        self.line_id = line_id
+        self.etag = etag
+        # 本文（JSON）は改行を含まないので data 行1行にそのまま入れる
+        self.data = b"event: " + SSE_EVENT + b"\ndata: " + body + b"\n\n"
+
+
+class Subscription:
+    """1クライアント分の購読（路線ごとに最新フレームだけを保持する）"""
+
+    def __init__(self, line_ids: Iterable[str]) -> None:
+        self.line_ids = tuple(dict.fromkeys(line_ids))
+        self._pending: Dict[str, Frame] = {}
+        self._event = asyncio.Event()
+        self.dropped = 0  # 読み出される前に新しいフレームで置き換えた数
+
+    def push(self, frame: Frame) -> None:
+        if frame.line_id in self._pending:
+            self.dropped += 1
+        self._pending[frame.line_id] = frame
+        self._event.set()
+
+    async def next_frames(self) -> List[Frame]:
+        """未読のフレームを返す（無ければ届くまで待つ）"""
+        await self._event.wait()
+        self._event.clear()
+        frames = list(self._pending.values())
+        self._pending.clear()
+        return frames
+
+
+# 路線ID → その時点のフレーム（計算できなかった路線は None）
+PositionsSource = Callable[[str], Awaitable[Optional[Frame]]]
+
+
+# ============================================================================
+# Broadcaster
+# ============================================================================
+
+
+class PositionBroadcaster:
+    """購読中の路線の列車位置を一定間隔で計算し、全購読者に配る"""
+
+    def __init__(self, source: PositionsSource, interval: float) -> None:
+        self._source = source
+        self.interval = interval
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._latest: Dict[str, Frame] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"ticks": 0, "computed": 0, "published": 0}
+
+    @property
+    def line_ids(self) -> List[str]:
+        return list(self._subscribers)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len({sub for subs in self._subscribers.values() for sub in subs})
+
+    def subscribe(self, line_ids: Iterable[str]) -> Subscription:
+        """購読を開始する。配信済みのフレームがあればすぐに渡す"""
+        sub = Subscription(line_ids)
+        for line_id in sub.line_ids:
+            self._subscribers.setdefault(line_id, set()).add(sub)
+            latest = self._latest.get(line_id)
+            if latest is not None:
+                sub.push(latest)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        for line_id in sub.line_ids:
+            subs = self._subscribers.get(line_id)
+            if subs is None:
+                continue
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[line_id]
+                self._latest.pop(line_id, None)
+        if not self._subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._subscribers:
+            started = loop.time()
+            await self.tick()
+            await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+
+    async def tick(self) -> None:
+        """購読中の各路線を1回ずつ計算し、変化があれば配る"""
+        self.stats["ticks"] += 1
+        line_ids = self.line_ids
+        results = await asyncio.gather(*(self._source(line_id) for line_id in line_ids), return_exceptions=True)
+        for line_id, frame in zip(line_ids, results):
+            if isinstance(frame, BaseException):
+                logger.warning("PositionBroadcaster: failed to compute %s: %s", line_id, frame)
+                continue
+            self.stats["computed"] += 1
+            if frame is None:
+                continue
+            self.publish(frame)
+
+    def publish(self, frame: Frame) -> None:
+        """フレームを購読者に配る（前回と同じ内容なら何もしない）"""
+        subs = self._subscribers.get(frame.line_id)
+        if not subs:
+            return
+        latest = self._latest.get(frame.line_id)
+        if latest is not None and latest.etag == frame.etag:
+            return
+        self._latest[frame.line_id] = frame
+        self.stats["published"] += 1
+        for sub in subs:
+            sub.push(frame)
+
+
+# ============================================================================
+# SSE Stream
+# ============================================================================
+
+
+async def sse_stream(
+    broadcaster: PositionBroadcaster,
+    line_ids: Iterable[str],
+    heartbeat: float = HEARTBEAT_INTERVAL,
+) -> AsyncIterator[bytes]:
+    """1クライアント分の SSE 本文（切断でジェネレータが閉じられると購読を解除する）"""
+    sub = broadcaster.subscribe(line_ids)
+    try:
+        yield b"retry: %d\n\n" % RETRY_MS
+        while True:
+            try:
+                frames = await asyncio.wait_for(sub.next_frames(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            yield b"".join(frame.data for frame in frames)
+    finally:
+        broadcaster.unsubscribe(sub)
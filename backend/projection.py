@@ -0,0 +1,122 @@
+# backend/projection.py
+"""
+線路形状のローカルなメートル平面への投影
+
+経緯度のまま距離・方位角を求めると頂点ごとに Haversine（三角関数）が必要になる。
+首都圏程度の範囲なら、基準緯度での正距円筒図法（x = 経度 × kx, y = 緯度 × ky）で
+メートル平面に投影しても、駅間のスナップに使う距離の誤差は無視できる。
+
+- 投影は線路形状ごとに1回だけ行い（基準緯度は点列の平均緯度）、
+  ホットループでは平面上の四則演算と hypot だけで距離を求める
+- 投影は経緯度の一次変換なので、平面上の線形補間は経緯度の線形補間と一致する
+  （逆投影も割り算2回で済む）
+- 路線全体の累積距離・方位角 (segment_metrics) は辺ごとに中点緯度の縮尺で測る。
+  宇都宮線のように南北に長い路線（緯度差1.3度）を1つの平面に投影すると、
+  端で経度方向の縮尺が1%近くずれ、方位角が数度狂うため
+"""
+
+from __future__ import annotations
+
+import math
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, Sequence, Tuple
+
+EARTH_RADIUS_M = 6371000.0
+
+# 投影の基準緯度（首都圏）。点列から決められない場合に使う
+DEFAULT_REF_LAT = 35.68
+
+
+# ============================================================================
+# Projection
+# ============================================================================
+
+
+@dataclass
+class LocalProjection:
+    """基準緯度 ref_lat での正距円筒図法（原点は経度0・緯度0、単位 m）"""
+
+    ref_lat: float = DEFAULT_REF_LAT
+    kx: float = field(init=False, repr=False)  # 経度1度あたりの距離 (m)
+    ky: float = field(init=False, repr=False)  # 緯度1度あたりの距離 (m)
+
+    def __post_init__(self) -> None:
+        self.kx = EARTH_RADIUS_M * math.cos(math.radians(self.ref_lat)) * math.pi / 180.0
+        self.ky = EARTH_RADIUS_M * math.pi / 180.0
+
+    @classmethod
+    def for_coords(cls, coords: Sequence[Sequence[float]]) -> "LocalProjection":
+        """点列 [(lon, lat), ...] の平均緯度を基準にする"""
+        if not coords:
+            return cls()
+        return cls(sum(c[1] for c in coords) / len(coords))
+
+    def project(self, lon: float, lat: float) -> Tuple[float, float]:
+        return (lon * self.kx, lat * self.ky)
+
+    def unproject(self, x: float, y: float) -> Tuple[float, float]:
+        """投影平面 (m) から (lon, lat) に戻す"""
+        return (x / self.kx, y / self.ky)
+
+    def project_coords(self, coords: Iterable[Sequence[float]]) -> Tuple[array, array]:
+        """点列を投影した (xs, ys)"""
+        kx, ky = self.kx, self.ky
+        xs, ys = array("d"), array("d")
+        for c in coords:
+            xs.append(c[0] * kx)
+            ys.append(c[1] * ky)
+        return xs, ys
+
+
+# ============================================================================
+# Planar Metrics
+# ============================================================================
+
+
+def planar_bearing(dx: float, dy: float) -> float:
+    """平面上の向き (dx, dy) の方位角（北=0度, 時計回り, 0-360）"""
+    return math.degrees(math.atan2(dx, dy)) % 360.0
+
+
+def segment_metrics(lons: Sequence[float], lats: Sequence[float]) -> Tuple[array, array, array]:
+    """
+    点列の累積距離 (m) と辺ごとの方位角を求める（起動時・コンパイル時に1回だけ）。
+
+    辺ごとに中点緯度の正距円筒図法で測るので、Haversine との差は辺長の 1e-6 程度。
+
+    Returns:
+        (cumulative, forward_bearing, backward_bearing)
+        cumulative は頂点数、方位角は辺数の長さ。
+    """
+    ky = EARTH_RADIUS_M * math.pi / 180.0
+    cumulative = array("d", [0.0])
+    forward = array("d")
+    backward = array("d")
+    total = 0.0
+    for i in range(len(lons) - 1):
+        kx = ky * math.cos(math.radians((lats[i] + lats[i + 1]) * 0.5))
+        dx, dy = (lons[i + 1] - lons[i]) * kx, (lats[i + 1] - lats[i]) * ky
+        total += math.hypot(dx, dy)
+        cumulative.append(total)
+        forward.append(planar_bearing(dx, dy))
+        backward.append(planar_bearing(-dx, -dy))
+    return cumulative, forward, backward
+
+
+def closest_point_on_segment(
+    px: float, py: float, ax: float, ay: float, bx: float, by: float
+) -> Tuple[float, float, float, float]:
+    """
+    点 P から線分 AB 上の最近点を求める（すべて投影平面の座標）。
+
+    Returns:
+        (距離 m, 最近点の x, 最近点の y, 線分上の位置 t ∈ [0, 1])
+    """
+    dx, dy = bx - ax, by - ay
+    seg_sq = dx * dx + dy * dy
+    if seg_sq == 0:
+        return math.hypot(px - ax, py - ay), ax, ay, 0.0
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / seg_sq))
+    nx, ny = ax + t * dx, ay + t * dy
+    return math.hypot(px - nx, py - ny), nx, ny, t
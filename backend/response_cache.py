@@ -0,0 +1,163 @@
+# backend/response_cache.py
+"""
+エンコード済みレスポンスのキャッシュ
+
+1. MicroTTLCache: 列車位置レスポンスの短命キャッシュ（single-flight 付き）
+
+同じ秒に多数のクライアントが /api/trains/{line_id}/positions/v4 をポーリングすると、
+それぞれがフィード参照・compute_all_progress・calculate_coordinates を独立に実行していた。
+
+このモジュールは (呼び出し側のキー, 時間バケット) ごとにエンコード済みの結果を保持する。
+
+- 時間バケットは floor(時刻 / ttl)。バケットが変われば自動的に別のキーになる
+- 同じキーの同時ミスは1つの計算を待ち合わせる（single-flight）。
+  計算は独立したタスクで行うので、先頭のリクエストが切断されても待機中のリクエストには結果が届く
+- 計算が例外になった場合や cacheable が偽を返した結果はキャッシュしない
+
+2. VersionedCache: 路線一覧・駅一覧など、データ版が変わるまで同じ内容を返すレスポンスのキャッシュ。
+   キーごとに作成時のデータ版を持ち、版が一致する間はエンコード済みの本文（と ETag）を使い回す。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+
+# 保持するキーの上限（路線数 × 時間帯程度で十分）
+DEFAULT_MAX_ENTRIES = 256
+
+# VersionedCache の保持するキーの上限（路線 × クエリの組み合わせ程度で十分）
+DEFAULT_VERSIONED_MAX_ENTRIES = 512
+
+
+class MicroTTLCache(Generic[V]):
+    """時間バケット単位の短命キャッシュ + 同一キーの計算の待ち合わせ"""
+
+    def __init__(
+        self,
+        ttl: float,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: OrderedDict[Tuple[Hashable, int], V] = OrderedDict()
+        self._inflight: Dict[Tuple[Hashable, int], asyncio.Task] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def bucket(self) -> int:
+        """現在の時間バケット"""
+        return int(self._clock() // self.ttl)
+
+    def _store(self, full_key: Tuple[Hashable, int], value: V) -> None:
+        entries = self._entries
+        # 古いバケットの結果はもう使われないので捨てる（挿入順なので先頭から）
+        current = full_key[1]
+        while entries and next(iter(entries))[1] < current:
+            entries.popitem(last=False)
+        entries[full_key] = value
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    async def get_or_compute(
+        self,
+        key: Hashable,
+        compute: Callable[[], Awaitable[V]],
+        cacheable: Optional[Callable[[V], bool]] = None,
+        bucket: Optional[int] = None,
+    ) -> V:
+        """
+        key の現在のバケットの結果を返す。無ければ compute() を1回だけ実行する。
+
+        Args:
+            key: 呼び出し側のキー（路線・フィード版など）
+            compute: 結果を作るコルーチン関数
+            cacheable: 結果をキャッシュしてよいか（省略時は常にキャッシュ）
+            bucket: 時間バケット（省略時は現在）。結果から派生するキャッシュの版に
+                同じバケットを使うときは、呼び出し側で bucket() を1回だけ求めて渡す
+        """
+        if not self.enabled:
+            return await compute()
+
+        full_key = (key, self.bucket() if bucket is None else bucket)
+        if full_key in self._entries:
+            self.stats["hits"] += 1
+            return self._entries[full_key]
+
+        task = self._inflight.get(full_key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(compute())
+            self._inflight[full_key] = task
+
+            def _done(done: asyncio.Task) -> None:
+                self._inflight.pop(full_key, None)
+                if done.cancelled() or done.exception() is not None:
+                    return
+                value = done.result()
+                if cacheable is None or cacheable(value):
+                    self._store(full_key, value)
+
+            task.add_done_callback(_done)
+
+        # 待機側がキャンセルされても計算は続ける（他の待機者と次のヒットのため）
+        return await asyncio.shield(task)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class VersionedCache(Generic[V]):
+    """データ版ごとのキャッシュ（版が変わったキーは次の参照時に作り直す）"""
+
+    def __init__(self, max_entries: int = DEFAULT_VERSIONED_MAX_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, Tuple[Hashable, V]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_build(self, key: Hashable, version: Hashable, build: Callable[[], V]) -> V:
+        """
+        key の結果が version で作ったものなら返す。そうでなければ build() で作り直す。
+
+        Args:
+            key: エンドポイントとパラメータの組
+            version: 結果が依存するデータの版
+            build: 結果を作る関数
+        """
+        entries = self._entries
+        entry = entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.stats["hits"] += 1
+            entries.move_to_end(key)
+            return entry[1]
+
+        self.stats["misses"] += 1
+        value = build()
+        entries[key] = (version, value)
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
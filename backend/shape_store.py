@@ -0,0 +1,335 @@
+# backend/shape_store.py
+"""
+線路形状ストア（/api/shapes 用の事前コンパイル済み GeoJSON）
+
+線路形状は起動後に変化しないので、全路線について
+サブラインのマージ・FeatureCollection の JSON エンコード・圧縮を起動時に1回だけ行い、
+リクエスト時は辞書引きでバイト列を返すだけにする。
+座標はコンパイル済みジオメトリ (LineGeometry) の経度・緯度配列を参照するだけで、
+座標リストとしては保持しない（各レベルは残す頂点の番号とエンコード済みのバイト列だけを持つ）。
+
+広域表示では全解像度の形状は不要なので、Douglas-Peucker で間引いた
+詳細度レベル (LOD) も合わせて用意し、ズーム / 許容誤差に応じて選ぶ。
+
+brotli は任意依存。インストールされていなければ gzip のみ用意する。
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import math
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+from geometry import (
+    LonLatView,
+    build_all_railways_cache,
+    douglas_peucker_importance_lonlat,
+    merge_railway_sublines,
+)
+
+try:
+    import brotli
+
+    BROTLI_AVAILABLE = True
+except ImportError:  # pragma: no cover - 任意依存
+    brotli = None
+    BROTLI_AVAILABLE = False
+
+if TYPE_CHECKING:
+    from spatial_index import RailwayIndex
+    from track_geometry import LineGeometry
+
+logger = logging.getLogger(__name__)
+
+# 圧縮率優先（起動時に1回だけなので最大レベル）
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+ENCODING_BROTLI = "br"
+ENCODING_GZIP = "gzip"
+
+
+def encode_json(content: Any) -> bytes:
+    """FastAPI の JSONResponse と同じ形式で JSON をエンコードする"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+# 事前計算する詳細度レベル（Douglas-Peucker の許容誤差 m）。0 は間引きなし
+LOD_TOLERANCES = (0.0, 4.0, 16.0, 60.0, 250.0, 1000.0)
+
+# ズームから許容誤差を決めるときの画素数（0.5px 未満の誤差は描画に現れない）
+LOD_PIXEL_TOLERANCE = 0.5
+
+# 複数路線の FeatureCollection はリクエスト時に組み立てるので、圧縮は速度優先
+COLLECTION_GZIP_LEVEL = 6
+
+_EARTH_CIRCUMFERENCE_M = 40075016.686
+_LOD_REF_LAT = 35.68
+
+
+def meters_per_pixel(zoom: float, lat: float = _LOD_REF_LAT) -> float:
+    """Web メルカトル（512px タイル, MapLibre のズーム）での1画素あたりの距離 (m)"""
+    return _EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (2 ** (zoom + 9))
+
+
+def tolerance_for_zoom(zoom: float) -> float:
+    """ズームレベルに対応する許容誤差 (m)"""
+    return meters_per_pixel(zoom) * LOD_PIXEL_TOLERANCE
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass
+class EncodedBody:
+    """エンコード済みのレスポンス本文と圧縮版"""
+
+    body: bytes
+    gzip_body: bytes
+    brotli_body: Optional[bytes]
+    etag: str  # 強い ETag（本文のハッシュ）
+
+    @classmethod
+    def encode(cls, body: bytes, gzip_level: int = GZIP_LEVEL, use_brotli: bool = True) -> "EncodedBody":
+        return cls(
+            body=body,
+            gzip_body=gzip.compress(body, compresslevel=gzip_level, mtime=0),
+            brotli_body=brotli.compress(body, quality=BROTLI_QUALITY) if use_brotli and BROTLI_AVAILABLE else None,
+            etag=_etag(body),
+        )
+
+    def select(self, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        """Accept-Encoding に応じて (本文, Content-Encoding) を選ぶ"""
+        accepted = _parse_accept_encoding(accept_encoding)
+        if self.brotli_body is not None and ENCODING_BROTLI in accepted:
+            return self.brotli_body, ENCODING_BROTLI
+        if ENCODING_GZIP in accepted:
+            return self.gzip_body, ENCODING_GZIP
+        return self.body, None
+
+
+@dataclass
+class ShapeLevel:
+    """1路線・1詳細度分の形状"""
+
+    tolerance: float  # 許容誤差 (m)
+    lons: Sequence[float]  # 路線の全頂点の経度（ShapeEntry と共有）
+    lats: Sequence[float]
+    indices: Optional[array]  # 残す頂点の番号（None は間引きなし）
+    feature: bytes  # Feature 単体の JSON（複数路線の FeatureCollection はこれを連結して作る）
+    response: EncodedBody  # 単一路線の FeatureCollection
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.lons) if self.indices is None else len(self.indices)
+
+    def points(self) -> Iterator[Tuple[float, float]]:
+        """間引いた座標 (lon, lat) を順に返す"""
+        if self.indices is None:
+            return zip(self.lons, self.lats)
+        lons, lats = self.lons, self.lats
+        return ((lons[i], lats[i]) for i in self.indices)
+
+    @property
+    def coords(self) -> List[List[float]]:
+        """間引いた座標 [[lon, lat], ...]（呼び出しのたびに組み立てる）"""
+        return [[lon, lat] for lon, lat in self.points()]
+
+
+@dataclass
+class ShapeEntry:
+    """1路線分の事前コンパイル済み形状（詳細度レベルごと）"""
+
+    line_id: str
+    color: str
+    lons: Sequence[float]  # マージ済み座標の経度（間引きなし, コンパイル済みなら mmap 上の memoryview）
+    lats: Sequence[float]
+    levels: List[ShapeLevel]  # tolerance の昇順。levels[0] は間引きなし
+
+    def level(self, tolerance: float = 0.0) -> ShapeLevel:
+        """許容誤差 tolerance (m) を超えない範囲で最も粗いレベルを返す"""
+        chosen = self.levels[0]
+        for level in self.levels:
+            if level.tolerance > tolerance:
+                break
+            chosen = level
+        return chosen
+
+    def points(self) -> LonLatView:
+        """マージ済み座標を [(lon, lat), ...] として読むビュー"""
+        return LonLatView(self.lons, self.lats)
+
+    @property
+    def coords(self) -> List[List[float]]:
+        """マージ済み座標 [[lon, lat], ...]（呼び出しのたびに組み立てる）"""
+        return [[lon, lat] for lon, lat in zip(self.lons, self.lats)]
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _parse_accept_encoding(header: Optional[str]) -> set[str]:
+    """q=0 で明示的に拒否されたものを除いた符号化方式の集合"""
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name)
+    return accepted
+
+
+def _collection(features: List[bytes]) -> bytes:
+    """エンコード済みの Feature を連結して FeatureCollection の JSON を作る"""
+    return b'{"type":"FeatureCollection","features":[' + b",".join(features) + b"]}"
+
+
+def _feature_json(line_id: str, color: str, coordinates: Iterator[Tuple[float, float]]) -> bytes:
+    """LineString の Feature を encode_json と同じ形式でエンコードする（座標リストは一時的にだけ作る）"""
+    return encode_json(
+        {
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [[lon, lat] for lon, lat in coordinates],
+            },
+            "properties": {
+                "line_id": line_id,
+                "color": color,
+                "segment_type": "main",
+            },
+        }
+    )
+
+
+def build_shape_entry(
+    line_id: str,
+    coords: Sequence[Sequence[float]],
+    color: str,
+    tolerances: Tuple[float, ...] = LOD_TOLERANCES,
+) -> ShapeEntry:
+    """
+    マージ済み座標から詳細度レベルごとの Feature を組み立ててエンコード・圧縮する。
+
+    coords が LonLatView なら経度・緯度の配列をそのまま参照する（コピーしない）。
+    """
+    if isinstance(coords, LonLatView):
+        lons, lats = coords.lons, coords.lats
+    else:
+        lons = array("d", (c[0] for c in coords))
+        lats = array("d", (c[1] for c in coords))
+
+    levels: List[ShapeLevel] = []
+    importance = douglas_peucker_importance_lonlat(lons, lats)
+    for tolerance in sorted(set(tolerances) | {0.0}):
+        indices: Optional[array] = None
+        if tolerance > 0 and len(lons) > 2:
+            indices = array("I", (i for i, w in enumerate(importance) if w > tolerance))
+        count = len(lons) if indices is None else len(indices)
+        if levels and count == levels[-1].vertex_count:
+            # これ以上間引けない（前のレベルと同じ）ならレベルを増やさない
+            continue
+        points = zip(lons, lats) if indices is None else ((lons[i], lats[i]) for i in indices)
+        feature = _feature_json(line_id, color, points)
+        levels.append(ShapeLevel(tolerance, lons, lats, indices, feature, EncodedBody.encode(_collection([feature]))))
+    return ShapeEntry(line_id=line_id, color=color, lons=lons, lats=lats, levels=levels)
+
+
+def build_collection(levels: List[ShapeLevel]) -> EncodedBody:
+    """複数路線の FeatureCollection を組み立てる（リクエスト時。brotli は使わない）"""
+    return EncodedBody.encode(
+        _collection([level.feature for level in levels]),
+        gzip_level=COLLECTION_GZIP_LEVEL,
+        use_brotli=False,
+    )
+
+
+# ============================================================================
+# Shape Store
+# ============================================================================
+
+
+class ShapeStore:
+    """全路線の ShapeEntry を保持する（起動時に構築、以降は読み取りのみ）"""
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, ShapeEntry] = {}
+        # coordinates.json に存在する路線ID（座標が空でマージできなかった路線を含む）
+        self.known_ids: set[str] = set()
+
+    @classmethod
+    def build(
+        cls,
+        coordinates: Dict[str, Any],
+        spatial_index: Optional["RailwayIndex"] = None,
+        compiled_lines: Optional[Mapping[str, "LineGeometry"]] = None,
+    ) -> "ShapeStore":
+        """
+        coordinates.json の全路線をマージして ShapeStore を構築する。
+
+        Args:
+            coordinates: coordinates.json の内容
+            spatial_index: 参照解決に使う空間インデックス（DataCache.railway_index）
+            compiled_lines: コンパイル済みジオメトリの路線。含まれる路線はマージを省略し、経度・緯度配列を参照する
+        """
+        store = cls()
+        compiled_lines = compiled_lines or {}
+        all_railways_cache: Optional[Dict[str, List[List[float]]]] = None
+
+        total_bytes = 0
+        for entry in coordinates.get("railways", []):
+            line_id = entry.get("id")
+            if not line_id:
+                continue
+            store.known_ids.add(line_id)
+            geometry = compiled_lines.get(line_id)
+            if geometry is not None:
+                merged: Sequence[Sequence[float]] = LonLatView(geometry.lons, geometry.lats)
+            else:
+                if all_railways_cache is None:
+                    if spatial_index is not None:
+                        all_railways_cache = spatial_index.coords
+                    else:
+                        all_railways_cache = build_all_railways_cache(coordinates)
+                merged = merge_railway_sublines(entry, all_railways_cache, spatial_index)
+            if not merged:
+                logger.warning("Shape coordinates are empty for %s", line_id)
+                continue
+            shape = build_shape_entry(line_id, merged, entry.get("color", "#000000"))
+            store.entries[line_id] = shape
+            total_bytes += len(shape.levels[0].response.body)
+
+        logger.info(
+            "Shape store built: %d lines, %d bytes JSON (brotli=%s)",
+            len(store.entries),
+            total_bytes,
+            BROTLI_AVAILABLE,
+        )
+        return store
+
+    def __contains__(self, line_id: str) -> bool:
+        return line_id in self.entries
+
+    def get(self, line_id: str) -> Optional[ShapeEntry]:
+        return self.entries.get(line_id)
+
+    def coords(self, line_id: str) -> Optional[List[List[float]]]:
+        """マージ済み座標 [[lon, lat], ...]（無ければ None。呼び出しのたびに組み立てる）"""
+        entry = self.entries.get(line_id)
+        return entry.coords if entry is not None else None
@@ -0,0 +1,351 @@
+# backend/spatial_index.py
+"""
+線路頂点の空間インデックス（一様グリッド）
+
+coordinates.json の頂点に対する最近傍探索は、これまで各所で全頂点の線形走査をしていた。
+このモジュールは経緯度を正距円筒図法でメートル平面に投影し (projection.LocalProjection)、一様グリッドのセルに
+頂点を振り分けておくことで、最近傍 (k-nearest)・半径内・矩形 (bbox) 内の検索をセル近傍の走査だけで行う。
+
+- GridIndex: 任意の点列に対するインデックス（キーは頂点インデックス・列車など任意）
+- RailwayIndex: 全路線の頂点をまとめたインデックス（路線ごと・路線横断の両方を検索可能）
+
+返す距離は投影平面上の近似値 (m)。厳密な距離が必要な呼び出し側は Haversine で再計算する。
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+from geometry import build_all_railways_cache
+from projection import DEFAULT_REF_LAT, LocalProjection
+
+# グリッドのセルサイズ (m)。駅間・線路頂点の間隔（数十〜数百m）に合わせる
+DEFAULT_CELL_METERS = 250.0
+
+# nearest_by で Haversine 距離に並べ直すときの候補半径の倍率（投影の縮尺誤差を吸収）
+HAVERSINE_SLACK = 1.05
+
+
+def squared_degree_distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """経緯度の差の2乗和（既存の線形探索が使っていた距離）"""
+    return (lon1 - lon2) ** 2 + (lat1 - lat2) ** 2
+
+
+# ============================================================================
+# Grid Index
+# ============================================================================
+
+
+class GridIndex:
+    """
+    一様グリッドによる点の空間インデックス
+
+    点は (lon, lat) で登録し、キー（任意の比較可能な値）付きで検索結果を返す。
+    距離が等しい候補はキーの昇順に並ぶ（線形走査で「最初に見つかった頂点」を選んでいた挙動と揃える）。
+    """
+
+    def __init__(self, cell_size: float = DEFAULT_CELL_METERS, ref_lat: float = DEFAULT_REF_LAT) -> None:
+        self.cell_size = float(cell_size)
+        self.ref_lat = ref_lat
+        self.projection = LocalProjection(ref_lat)
+        self._lons: List[float] = []
+        self._lats: List[float] = []
+        self._xs: List[float] = []
+        self._ys: List[float] = []
+        self._keys: List[Hashable] = []
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        # 登録済みセルの範囲（探索リングの上限）
+        self._min_cx = self._min_cy = 0
+        self._max_cx = self._max_cy = -1
+
+    @classmethod
+    def from_coords(
+        cls,
+        coords: Sequence[Sequence[float]],
+        keys: Optional[Iterable[Hashable]] = None,
+        cell_size: float = DEFAULT_CELL_METERS,
+    ) -> "GridIndex":
+        """[(lon, lat), ...] から構築する。keys を省略した場合は頂点インデックスをキーにする"""
+        index = cls(cell_size=cell_size, ref_lat=LocalProjection.for_coords(coords).ref_lat)
+        for c, key in zip(coords, keys if keys is not None else range(len(coords))):
+            index.insert(c[0], c[1], key)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def project(self, lon: float, lat: float) -> Tuple[float, float]:
+        """経緯度を投影平面 (m) に変換する"""
+        return self.projection.project(lon, lat)
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def insert(self, lon: float, lat: float, key: Hashable) -> None:
+        x, y = self.project(lon, lat)
+        cx, cy = self._cell(x, y)
+        self._cells.setdefault((cx, cy), []).append(len(self._keys))
+        self._lons.append(lon)
+        self._lats.append(lat)
+        self._xs.append(x)
+        self._ys.append(y)
+        self._keys.append(key)
+        if len(self._keys) == 1:
+            self._min_cx, self._max_cx, self._min_cy, self._max_cy = cx, cx, cy, cy
+        else:
+            self._min_cx = min(self._min_cx, cx)
+            self._max_cx = max(self._max_cx, cx)
+            self._min_cy = min(self._min_cy, cy)
+            self._max_cy = max(self._max_cy, cy)
+
+    # ------------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------------
+
+    def _ring(self, cx: int, cy: int, r: int) -> Iterable[int]:
+        """中心セルからチェビシェフ距離 r のセルに含まれる点のインデックス"""
+        cells = self._cells
+        if r == 0:
+            yield from cells.get((cx, cy), ())
+            return
+        for dx in range(-r, r + 1):
+            yield from cells.get((cx + dx, cy - r), ())
+            yield from cells.get((cx + dx, cy + r), ())
+        for dy in range(-r + 1, r):
+            yield from cells.get((cx - r, cy + dy), ())
+            yield from cells.get((cx + r, cy + dy), ())
+
+    def _max_ring(self, cx: int, cy: int) -> int:
+        """これ以上リングを広げても新しいセルが無い半径"""
+        return max(cx - self._min_cx, self._max_cx - cx, cy - self._min_cy, self._max_cy - cy, 0)
+
+    def nearest(
+        self,
+        lon: float,
+        lat: float,
+        k: int = 1,
+        max_distance: float = math.inf,
+    ) -> List[Tuple[float, Hashable]]:
+        """
+        近い順に最大 k 点を返す。
+
+        Returns:
+            [(distance_m, key), ...]（距離の昇順、同距離はキーの昇順）
+        """
+        if not self._keys or k <= 0:
+            return []
+        x, y = self.project(lon, lat)
+        cx, cy = self._cell(x, y)
+        xs, ys, keys = self._xs, self._ys, self._keys
+        max_ring = self._max_ring(cx, cy)
+        if max_distance != math.inf:
+            max_ring = min(max_ring, int(max_distance // self.cell_size) + 1)
+        limit_sq = max_distance * max_distance
+
+        found: List[Tuple[float, Hashable]] = []
+        r = 0
+        while r <= max_ring:
+            if (2 * r + 1) ** 2 > len(self._cells):
+                # 点列から遠いクエリは空セルの走査が嵩むので、残りは全点走査に切り替える
+                found = []
+                for i in range(len(keys)):
+                    dx, dy = xs[i] - x, ys[i] - y
+                    d_sq = dx * dx + dy * dy
+                    if d_sq <= limit_sq:
+                        found.append((d_sq, keys[i]))
+                break
+            for i in self._ring(cx, cy, r):
+                dx, dy = xs[i] - x, ys[i] - y
+                d_sq = dx * dx + dy * dy
+                if d_sq <= limit_sq:
+                    found.append((d_sq, keys[i]))
+            # リング r の外側の点は少なくとも r * cell_size 離れている
+            if len(found) >= k:
+                kth = heapq.nsmallest(k, found)[-1][0]
+                bound = r * self.cell_size
+                if kth < bound * bound:
+                    break
+            r += 1
+
+        return [(math.sqrt(d_sq), key) for d_sq, key in heapq.nsmallest(k, found)]
+
+    def nearest_key(self, lon: float, lat: float, max_distance: float = math.inf) -> Optional[Hashable]:
+        """最近傍点のキー（見つからなければ None）"""
+        result = self.nearest(lon, lat, 1, max_distance)
+        return result[0][1] if result else None
+
+    def _within_indices(self, lon: float, lat: float, radius: float) -> List[Tuple[float, int]]:
+        x, y = self.project(lon, lat)
+        cx, cy = self._cell(x, y)
+        xs, ys = self._xs, self._ys
+        radius_sq = radius * radius
+        rings = min(self._max_ring(cx, cy), int(radius // self.cell_size) + 1)
+        if (2 * rings + 1) ** 2 > len(self._cells):
+            candidates: Iterable[int] = range(len(xs))
+        else:
+            candidates = (i for r in range(rings + 1) for i in self._ring(cx, cy, r))
+        found = []
+        for i in candidates:
+            dx, dy = xs[i] - x, ys[i] - y
+            d_sq = dx * dx + dy * dy
+            if d_sq <= radius_sq:
+                found.append((d_sq, i))
+        return found
+
+    def within(self, lon: float, lat: float, radius: float) -> List[Tuple[float, Hashable]]:
+        """
+        半径 radius (m) 以内の点を返す。
+
+        Returns:
+            [(distance_m, key), ...]（距離の昇順、同距離はキーの昇順）
+        """
+        if not self._keys or radius < 0:
+            return []
+        keys = self._keys
+        found = sorted((d_sq, keys[i]) for d_sq, i in self._within_indices(lon, lat, radius))
+        return [(math.sqrt(d_sq), key) for d_sq, key in found]
+
+    def within_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> List[Hashable]:
+        """
+        経緯度の矩形（境界を含む）内の点のキーを登録順に返す。
+
+        投影は経緯度の一次変換なので、矩形は投影平面でも矩形になる。
+        矩形に重なるセルだけを走査し、セルが登録済みセルより多ければ登録済みセルを走査する。
+        """
+        if not self._keys or min_lon > max_lon or min_lat > max_lat:
+            return []
+        min_cx, min_cy = self._cell(*self.project(min_lon, min_lat))
+        max_cx, max_cy = self._cell(*self.project(max_lon, max_lat))
+        min_cx, min_cy = max(min_cx, self._min_cx), max(min_cy, self._min_cy)
+        max_cx, max_cy = min(max_cx, self._max_cx), min(max_cy, self._max_cy)
+        if min_cx > max_cx or min_cy > max_cy:
+            return []
+
+        cells = self._cells
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(cells):
+            candidates: Iterable[int] = (
+                i
+                for (cx, cy), indices in cells.items()
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy
+                for i in indices
+            )
+        else:
+            candidates = (
+                i
+                for cx in range(min_cx, max_cx + 1)
+                for cy in range(min_cy, max_cy + 1)
+                for i in cells.get((cx, cy), ())
+            )
+        lons, lats, keys = self._lons, self._lats, self._keys
+        found = sorted(i for i in candidates if min_lon <= lons[i] <= max_lon and min_lat <= lats[i] <= max_lat)
+        return [keys[i] for i in found]
+
+    def nearest_by(
+        self,
+        lon: float,
+        lat: float,
+        distance: Callable[[float, float, float, float], float],
+        slack: float = HAVERSINE_SLACK,
+    ) -> Optional[Tuple[float, Hashable]]:
+        """
+        投影平面で最近傍を絞り込んだうえで、distance(lon, lat, 点lon, 点lat) が最小の点を返す。
+
+        投影距離の最小値 × slack 以内の候補だけを比較するので、
+        slack は「distance と投影距離の比」の最大/最小以上にする。
+
+        Returns:
+            (distance の値, key)。点が無ければ None
+        """
+        first = self.nearest(lon, lat, 1)
+        if not first:
+            return None
+        radius = first[0][0] * slack + 1e-6
+        lons, lats, keys = self._lons, self._lats, self._keys
+        return min((distance(lon, lat, lons[i], lats[i]), keys[i]) for _, i in self._within_indices(lon, lat, radius))
+
+    def nearest_by_degrees(self, lon: float, lat: float) -> Optional[Hashable]:
+        """
+        経緯度の差の2乗和で最も近い点のキー。
+
+        既存の線形探索（度単位のユークリッド距離）と同じ結果を返す。
+        投影では経度方向だけ cos(基準緯度) 倍に縮むので、候補半径は 1/cos(基準緯度) 倍で足りる。
+        """
+        result = self.nearest_by(lon, lat, squared_degree_distance, slack=1.0 / math.cos(math.radians(self.ref_lat)))
+        return result[1] if result is not None else None
+
+
+# ============================================================================
+# Railway Index
+# ============================================================================
+
+
+class RailwayIndex:
+    """
+    全路線の頂点インデックス
+
+    路線横断の検索はキー (railway_id, 頂点インデックス) を返し、
+    路線ごとの検索は頂点インデックスを返す。頂点インデックスは coords[railway_id] の位置。
+    """
+
+    def __init__(self, coords: Dict[str, List[List[float]]], cell_size: float = DEFAULT_CELL_METERS) -> None:
+        self.coords = coords
+        self.cell_size = cell_size
+        self._lines: Dict[str, GridIndex] = {}
+        self._all: Optional[GridIndex] = None
+
+    @classmethod
+    def from_coordinates(cls, coordinates: Dict[str, Any], cell_size: float = DEFAULT_CELL_METERS) -> "RailwayIndex":
+        """coordinates.json から構築する（頂点は build_all_railways_cache と同じ並び）"""
+        return cls(build_all_railways_cache(coordinates), cell_size=cell_size)
+
+    def __contains__(self, railway_id: str) -> bool:
+        return railway_id in self.coords
+
+    def line(self, railway_id: str) -> Optional[GridIndex]:
+        """路線ごとのインデックス（初回アクセス時に構築）"""
+        index = self._lines.get(railway_id)
+        if index is None:
+            coords = self.coords.get(railway_id)
+            if not coords:
+                return None
+            index = self._lines[railway_id] = GridIndex.from_coords(coords, cell_size=self.cell_size)
+        return index
+
+    def all_lines(self) -> GridIndex:
+        """路線横断のインデックス（初回アクセス時に構築）"""
+        if self._all is None:
+            index = GridIndex(cell_size=self.cell_size)
+            for railway_id, coords in self.coords.items():
+                for i, c in enumerate(coords):
+                    index.insert(c[0], c[1], (railway_id, i))
+            self._all = index
+        return self._all
+
+    def nearest(
+        self,
+        lon: float,
+        lat: float,
+        k: int = 1,
+        railway_id: Optional[str] = None,
+        max_distance: float = math.inf,
+    ) -> List[Tuple[float, Hashable]]:
+        """railway_id を指定すると路線内、省略すると全路線から近い順に k 点を返す"""
+        if railway_id is None:
+            return self.all_lines().nearest(lon, lat, k, max_distance)
+        index = self.line(railway_id)
+        return index.nearest(lon, lat, k, max_distance) if index is not None else []
+
+    def within(
+        self,
+        lon: float,
+        lat: float,
+        radius: float,
+        railway_id: Optional[str] = None,
+    ) -> List[Tuple[float, Hashable]]:
+        """railway_id を指定すると路線内、省略すると全路線から半径 radius (m) 以内の点を返す"""
+        if railway_id is None:
+            return self.all_lines().within(lon, lat, radius)
+        index = self.line(railway_id)
+        return index.within(lon, lat, radius) if index is not None else []
@@ -0,0 +1,279 @@
+# backend/tests/test_batch_positions.py
+"""
+複数路線の列車位置 (/api/trains/positions) のテスト
+
+全路線の列車が1回の compute_all_progress で計算され、路線ごとに
+/api/trains/{line_id}/positions/v4 と同じ形式で振り分けられることを検証する。
+bbox 指定では、全路線の計算結果から範囲内の列車だけが返ることを検証する。
+実データモードでは、複数路線に振り分けられた列車も路線ごとの v4 と同じ結果になることを検証する。
+"""
+
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+import mock_trip_generator
+import train_position_v4
+from config import SUPPORTED_LINES
+from feed_poller import FeedSnapshot, LineFeed
+from gtfs_rt_tripupdate import RealtimeStationSchedule, TrainSchedule
+from response_cache import MicroTTLCache, VersionedCache
+from time_manager import time_mgr
+from train_position_v4 import SegmentProgress
+
+
+def progress_for(schedules, now_ts=None, **kwargs):
+    """スケジュールごとに running の進捗を返す compute_all_progress の代役"""
+    return [
+        SegmentProgress(
+            trip_id=trip_id,
+            train_number=trip_id,
+            direction="Outbound",
+            prev_station_id=None,
+            next_station_id=None,
+            prev_seq=1,
+            next_seq=2,
+            now_ts=now_ts,
+            t0_departure=None,
+            t1_arrival=None,
+            progress=0.5,
+            status="running",
+        )
+        for trip_id in schedules
+    ]
+
+
+class TestBatchPositionsEndpoint(unittest.TestCase):
+    def setUp(self):
+        time_mgr.set_virtual_time("2026-02-12T08:30:00+09:00")
+        self.saved = (main._positions_cache, main._fleet_indexes, main._batch_responses)
+        main._positions_cache = MicroTTLCache(0.0)
+        main._fleet_indexes = VersionedCache(max_entries=1)
+        main._batch_responses = VersionedCache()
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        time_mgr.reset()
+        main._positions_cache, main._fleet_indexes, main._batch_responses = self.saved
+
+    def get(self, lines, by_route, coords=None, **params):
+        with (
+            mock.patch.object(
+                mock_trip_generator,
+                "generate_mock_schedules_by_route",
+                side_effect=lambda cache, now, route_ids: {r: dict(by_route.get(r, {})) for r in route_ids},
+            ) as generate,
+            mock.patch.object(train_position_v4, "compute_all_progress", side_effect=progress_for) as compute,
+            mock.patch.object(
+                train_position_v4,
+                "calculate_coordinates",
+                side_effect=lambda r, *args: (coords or {}).get(r.trip_id, (35.68, 139.76, 90.0)),
+            ),
+        ):
+            if lines is not None:
+                params["lines"] = lines
+            response = self.client.get("/api/trains/positions", params=params)
+        return response, generate, compute
+
+    def test_one_pass_for_all_lines(self):
+        """フィードの参照と進捗計算は路線数によらず1回で、結果は路線ごとに振り分ける"""
+        by_route = {
+            "JR-East.Yamanote": {"Y1": object()},
+            "JR-East.ChuoRapid": {"C1": object(), "C2": object()},
+        }
+        response, generate, compute = self.get("yamanote,chuo_rapid,keihin_tohoku", by_route)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(sorted(compute.call_args.args[0]), ["C1", "C2", "Y1"])
+
+        body = response.json()
+        self.assertEqual(body["status"], "success")
+        self.assertEqual(body["total_trains"], 3)
+        lines = body["lines"]
+        self.assertEqual(list(lines), ["yamanote", "chuo_rapid", "keihin_tohoku"])
+        self.assertEqual([p["trip_id"] for p in lines["chuo_rapid"]["positions"]], ["C1", "C2"])
+        self.assertEqual(lines["yamanote"]["line_name"], "山手線")
+        self.assertEqual(lines["yamanote"]["positions"][0]["location"]["bearing"], 90.0)
+        self.assertEqual(lines["keihin_tohoku"]["status"], "no_data")
+
+    def test_all_lines(self):
+        """lines=all で対応路線すべてを返す"""
+        response, _, compute = self.get("all", {})
+        self.assertEqual(list(response.json()["lines"]), list(SUPPORTED_LINES))
+        self.assertEqual(compute.call_count, 0)
+
+    def test_bbox_returns_trains_in_viewport(self):
+        """bbox 内の列車だけを全路線から返し、範囲内の列車が無い路線は含めない"""
+        by_route = {
+            "JR-East.Yamanote": {"Y1": object(), "Y2": object()},
+            "JR-East.ChuoRapid": {"C1": object()},
+            "JR-East.KeihinTohoku": {"K1": object()},
+        }
+        coords = {
+            "Y1": (35.681, 139.767, 0.0),  # 東京
+            "Y2": (35.729, 139.711, 0.0),  # 池袋
+            "C1": (35.690, 139.700, 0.0),  # 新宿
+            "K1": (35.466, 139.622, 0.0),  # 横浜
+        }
+        response, _, compute = self.get(None, by_route, coords, bbox="139.69,35.67,139.78,35.70")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(compute.call_count, 1)
+        body = response.json()
+        self.assertEqual(body["total_trains"], 2)
+        self.assertEqual(body["bbox"], [139.69, 35.67, 139.78, 35.70])
+        self.assertEqual(sorted(body["lines"]), ["chuo_rapid", "yamanote"])
+        self.assertEqual([p["trip_id"] for p in body["lines"]["yamanote"]["positions"]], ["Y1"])
+        self.assertEqual(body["lines"]["yamanote"]["total_trains"], 1)
+
+        # lines を指定するとその路線に絞る
+        response, _, _ = self.get("yamanote", by_route, coords, bbox="139.69,35.67,139.78,35.70")
+        self.assertEqual(list(response.json()["lines"]), ["yamanote"])
+
+    def test_bbox_index_per_computation(self):
+        """bbox の空間インデックスは計算結果（フィード版・時間バケット）ごとに1回だけ作り、全路線分の本文は作らない"""
+        clock = [0.0]
+        main._positions_cache = MicroTTLCache(1.0, clock=lambda: clock[0])
+        by_route = {"JR-East.Yamanote": {"Y1": object()}, "JR-East.ChuoRapid": {"C1": object()}}
+        with (
+            mock.patch.object(main, "_build_fleet_index", wraps=main._build_fleet_index) as build,
+            mock.patch.object(main, "encode_positions_json", wraps=main.encode_positions_json) as encode,
+        ):
+            _, _, first = self.get(None, by_route, bbox="139.69,35.67,139.78,35.70")
+            _, _, second = self.get(None, by_route, bbox="139.0,35.0,140.0,36.0")
+            self.assertEqual((first.call_count, second.call_count), (1, 0))
+            self.assertEqual(build.call_count, 1)
+            # エンコードするのは範囲内の列車だけの本文
+            self.assertTrue(all("bbox" in call.args[0] for call in encode.call_args_list))
+
+            # lines=all は同じ計算結果を使い、そのとき初めて全路線分の本文を作る
+            response, _, compute = self.get("all", by_route)
+            self.assertEqual(compute.call_count, 0)
+            self.assertEqual(response.json()["total_trains"], 2)
+
+            # 時間バケットが変われば計算し直し、インデックスも作り直す
+            clock[0] = 1.5
+            _, _, third = self.get(None, by_route, bbox="139.69,35.67,139.78,35.70")
+            self.assertEqual(third.call_count, 1)
+            self.assertEqual(build.call_count, 2)
+
+    def test_invalid_bbox(self):
+        """bbox は4つの数値で min <= max"""
+        for bbox in ("139.7,35.6,139.8", "a,b,c,d", "139.8,35.6,139.7,35.7"):
+            self.assertEqual(self.client.get("/api/trains/positions", params={"bbox": bbox}).status_code, 400)
+        self.assertEqual(self.client.get("/api/trains/positions").status_code, 400)
+
+    def test_invalid_lines(self):
+        """未対応の路線や空の指定はエラー"""
+        self.assertEqual(self.client.get("/api/trains/positions", params={"lines": ","}).status_code, 400)
+        self.assertEqual(
+            self.client.get("/api/trains/positions", params={"lines": "yamanote,no_such_line"}).status_code, 404
+        )
+
+
+NOW = 1792000000
+
+# 路線ごとの駅IDの接頭辞 → 列車の座標
+LINE_COORDS = {
+    "JR-East.Joban": (35.80, 139.90, 0.0),
+    "JR-East.Keiyo": (35.60, 140.00, 0.0),
+    "JR-East.ChuoRapid": (35.69, 139.70, 0.0),
+}
+
+
+def schedule(trip_id, prefix):
+    """接頭辞 prefix の駅を走る列車（NOW には1駅目と2駅目の間にいる）"""
+    stops = {
+        seq: RealtimeStationSchedule(seq, f"{prefix}.S{seq}", NOW - 300 + seq * 200, NOW - 280 + seq * 200, True, None)
+        for seq in range(1, 4)
+    }
+    return TrainSchedule(trip_id, trip_id, None, "Outbound", NOW, schedules_by_seq=stops)
+
+
+def coords_by_station(r, *args):
+    return LINE_COORDS[r.prev_station_id.rsplit(".", 1)[0]]
+
+
+class FakePoller:
+    """共有ポーラーの代役（スナップショットを1つだけ持つ。lines に無い路線は列車なし）"""
+
+    def __init__(self, lines):
+        self.snapshot = FeedSnapshot(
+            fetched_at=NOW,
+            feed_timestamp=NOW,
+            total_entities=0,
+            lines={line_id: LineFeed(line_id, lines.get(line_id, {}), {}) for line_id in SUPPORTED_LINES},
+            route_id_summary={},
+            version="v1",
+        )
+
+    async def wait_for_snapshot(self, timeout):
+        return self.snapshot
+
+
+class TestBatchPositionsRealtime(unittest.TestCase):
+    """実データモード: 接尾辞から複数路線に振り分けられた列車 (例: "M") も路線ごとに返す"""
+
+    def setUp(self):
+        self.saved = (main._positions_cache, main._fleet_indexes, main._position_snapshots)
+        self.saved_state = {k: getattr(main.app.state, k, None) for k in ("feed_poller", "http_client")}
+        main._positions_cache = MicroTTLCache(0.0)
+        main._fleet_indexes = VersionedCache(max_entries=1)
+        # 1234M は常磐線と京葉線の両方に、路線ごとに別の駅IDで振り分けられている
+        main.app.state.feed_poller = FakePoller(
+            {
+                "joban": {"1234M": schedule("1234M", "JR-East.Joban")},
+                "keiyo": {"1234M": schedule("1234M", "JR-East.Keiyo"), "5678M": schedule("5678M", "JR-East.Keiyo")},
+                "chuo_rapid": {"1001T": schedule("1001T", "JR-East.ChuoRapid")},
+            }
+        )
+        main.app.state.http_client = None
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        main._positions_cache, main._fleet_indexes, main._position_snapshots = self.saved
+        for k, v in self.saved_state.items():
+            setattr(main.app.state, k, v)
+
+    def get(self, path, **params):
+        with (
+            mock.patch.object(time, "time", return_value=NOW),
+            mock.patch.object(train_position_v4, "calculate_coordinates", side_effect=coords_by_station),
+        ):
+            response = self.client.get(path, params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_shared_trip_matches_per_line_v4(self):
+        """複数路線に振り分けられた列車を、路線ごとの v4 と同じ内容で各路線に返す"""
+        batch = self.get("/api/trains/positions", lines="joban,keiyo,chuo_rapid")["lines"]
+        for line_id, trip_ids in (("joban", ["1234M"]), ("keiyo", ["1234M", "5678M"]), ("chuo_rapid", ["1001T"])):
+            single = self.get(f"/api/trains/{line_id}/positions/v4")
+            self.assertEqual(sorted(p["trip_id"] for p in batch[line_id]["positions"]), trip_ids)
+            self.assertEqual(batch[line_id]["positions"], single["positions"])
+            self.assertEqual(batch[line_id]["total_trains"], single["total_trains"])
+        self.assertEqual(batch["joban"]["positions"][0]["segment"]["prev_station_id"], "JR-East.Joban.S1")
+        self.assertEqual(batch["keiyo"]["positions"][0]["segment"]["prev_station_id"], "JR-East.Keiyo.S1")
+
+    def test_bbox_with_shared_trip(self):
+        """bbox でも、複数路線に振り分けられた列車を路線ごとの位置で返す"""
+        joban = self.get("/api/trains/positions", bbox="139.85,35.75,139.95,35.85")
+        self.assertEqual(list(joban["lines"]), ["joban"])
+        self.assertEqual([p["trip_id"] for p in joban["lines"]["joban"]["positions"]], ["1234M"])
+
+        everything = self.get("/api/trains/positions", bbox="139.0,35.0,141.0,36.0")
+        self.assertEqual(everything["total_trains"], 4)
+        self.assertEqual(sorted(p["trip_id"] for p in everything["lines"]["keiyo"]["positions"]), ["1234M", "5678M"])
+        self.assertEqual(everything["lines"]["joban"]["positions"][0]["location"]["latitude"], 35.80)
+
+
+if __name__ == "__main__":
+    unittest.main()
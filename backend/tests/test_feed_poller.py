@@ -0,0 +1,413 @@
+# backend/tests/test_feed_poller.py
+"""
+GTFS-RT 共有ポーラーのテスト
+
+フィードを1周期1回だけ取得し、全路線分のスナップショットを公開できるかを検証する。
+外部APIには接続せず、合成した protobuf をフェイククライアントで返す。
+"""
+
+import asyncio
+import hashlib
+import threading
+import unittest
+from unittest import mock
+
+from google.transit import gtfs_realtime_pb2
+
+import feed_decoder
+from config import LineConfig
+from feed_decoder import create_decode_executor, decode_and_normalize
+from feed_poller import FeedPoller
+from gtfs_rt_tripupdate import TripNormalizationCache, normalize_trip_update_entities
+from gtfs_rt_vehicle import identify_routes_by_trip_id, partition_entities_by_route
+
+
+def build_trip_update_feed(trips, timestamp=1700000000):
+    """trips: [(trip_id, route_id, [(seq, stop_id, arr, dep), ...]), ...]"""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = timestamp
+    for trip_id, route_id, stops in trips:
+        entity = feed.entity.add()
+        entity.id = trip_id
+        tu = entity.trip_update
+        tu.trip.trip_id = trip_id
+        if route_id:
+            tu.trip.route_id = route_id
+        for seq, stop_id, arr, dep in stops:
+            stu = tu.stop_time_update.add()
+            stu.stop_sequence = seq
+            stu.stop_id = stop_id
+            if arr is not None:
+                stu.arrival.time = arr
+            if dep is not None:
+                stu.departure.time = dep
+    return feed
+
+
+def build_vehicle_feed(vehicles, timestamp=1700000000):
+    """vehicles: [(trip_id, lat, lon, seq), ...]"""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = timestamp
+    for trip_id, lat, lon, seq in vehicles:
+        entity = feed.entity.add()
+        entity.id = f"v_{trip_id}"
+        entity.vehicle.trip.trip_id = trip_id
+        entity.vehicle.position.latitude = lat
+        entity.vehicle.position.longitude = lon
+        entity.vehicle.current_stop_sequence = seq
+        entity.vehicle.current_status = 1
+        entity.vehicle.timestamp = timestamp
+    return feed
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        return None
+
+
+class FakeClient:
+    """URL に応じて TripUpdate / VehiclePosition のバイト列を返すフェイククライアント"""
+
+    def __init__(self, trip_bytes, vehicle_bytes, etag=False):
+        self.trip_bytes = trip_bytes
+        self.vehicle_bytes = vehicle_bytes
+        self.etag = etag  # True なら ETag を返し、If-None-Match 一致時は 304
+        self.calls = []
+        self.request_headers = []
+
+    async def get(self, url, headers=None, **kwargs):
+        self.calls.append(url)
+        self.request_headers.append(dict(headers or {}))
+        if self.trip_bytes is None and "trip_update" in url:
+            raise RuntimeError("network down")
+        content = self.trip_bytes if "trip_update" in url else self.vehicle_bytes
+        if not self.etag:
+            return FakeResponse(content)
+        tag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if (headers or {}).get("If-None-Match") == tag:
+            return FakeResponse(b"", status_code=304)
+        return FakeResponse(content, headers={"ETag": tag})
+
+
+class FakeDataCache:
+    """静的時刻表が無い状態の DataCache"""
+
+    def get_static_train(self, *args, **kwargs):
+        return None
+
+    def get_seq_to_station_map(self, *args, **kwargs):
+        return None
+
+
+LINES = {
+    "yamanote": LineConfig(name="山手線", gtfs_route_id="JR-East.Yamanote", mt3d_id="JR-East.Yamanote"),
+    "chuo_rapid": LineConfig(name="中央線快速", gtfs_route_id="JR-East.ChuoRapid", mt3d_id="JR-East.ChuoRapid"),
+}
+
+
+def make_feeds():
+    trip_feed = build_trip_update_feed(
+        [
+            ("4201301G", "", [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1100, 1120)]),
+            ("1100T", "", [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1100, 1120)]),
+            ("1200T", "JR-East.ChuoRapid", [(1, "Tokyo", None, 1030)]),  # 駅が1つだけ → 除外
+        ]
+    )
+    vehicle_feed = build_vehicle_feed([("4201301G", 35.68, 139.76, 1)])
+    return trip_feed.SerializeToString(), vehicle_feed.SerializeToString()
+
+
+class TestFeedPoller(unittest.TestCase):
+    def test_poll_once_fetches_each_feed_once_for_all_lines(self):
+        """全路線分のスナップショットを、各フィード1回の取得で構築する"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        client = FakeClient(trip_bytes, vehicle_bytes)
+        poller = FeedPoller(client, "dummy", FakeDataCache(), lines=LINES)
+
+        snapshot = asyncio.run(poller.poll_once())
+
+        self.assertIsNotNone(snapshot)
+        self.assertEqual(len(client.calls), 2)
+        self.assertEqual(snapshot.feed_timestamp, 1700000000)
+        self.assertEqual(snapshot.total_entities, 3)
+
+        yamanote = snapshot.get_line("yamanote")
+        self.assertEqual(list(yamanote.schedules.keys()), ["4201301G"])
+        self.assertEqual(yamanote.schedules["4201301G"].schedules_by_seq[1].station_id, "JR-East.Yamanote.Tokyo")
+        self.assertIn("4201301G", yamanote.vehicle_positions)
+
+        chuo = snapshot.get_line("chuo_rapid")
+        self.assertEqual(list(chuo.schedules.keys()), ["1100T"])
+        self.assertEqual(chuo.vehicle_positions, {})
+
+    def test_snapshot_is_read_only(self):
+        """公開されたスナップショットは書き換えられない"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        poller = FeedPoller(FakeClient(trip_bytes, vehicle_bytes), "dummy", FakeDataCache(), lines=LINES)
+        snapshot = asyncio.run(poller.poll_once())
+
+        with self.assertRaises(TypeError):
+            snapshot.lines["new_line"] = None
+        with self.assertRaises(TypeError):
+            snapshot.get_line("yamanote").schedules["x"] = None
+
+    def test_failed_fetch_keeps_previous_snapshot(self):
+        """取得に失敗した周期は直前のスナップショットを維持する"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        client = FakeClient(trip_bytes, vehicle_bytes)
+        poller = FeedPoller(client, "dummy", FakeDataCache(), lines=LINES)
+
+        async def scenario():
+            first = await poller.poll_once()
+            client.trip_bytes = None
+            second = await poller.poll_once()
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        self.assertIs(poller.snapshot, first)
+
+
+class TestFeedVersionDedup(unittest.TestCase):
+    def _poll_twice(self, client, mutate=None):
+        poller = FeedPoller(client, "dummy", FakeDataCache(), lines=LINES)
+
+        async def scenario():
+            first = await poller.poll_once()
+            if mutate is not None:
+                mutate(client)
+            with mock.patch("feed_decoder.normalize_trip_update_entities") as normalize:
+                second = await poller.poll_once()
+            return first, second, normalize
+
+        first, second, normalize = asyncio.run(scenario())
+        return poller, first, second, normalize
+
+    def test_not_modified_skips_downstream(self):
+        """304 が返ったらデコード・正規化を行わず、版も変えない"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        client = FakeClient(trip_bytes, vehicle_bytes, etag=True)
+        poller, first, second, normalize = self._poll_twice(client)
+
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        normalize.assert_not_called()
+        self.assertIn("If-None-Match", client.request_headers[-1])
+        self.assertIs(poller.snapshot, first)
+        self.assertEqual(poller.feed_version, first.version)
+        self.assertEqual(poller.trip_fetcher.stats["not_modified"], 1)
+
+    def test_same_content_hash_skips_downstream(self):
+        """条件付きリクエスト非対応でも、本文が同じなら再デコードしない"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        poller, first, second, normalize = self._poll_twice(FakeClient(trip_bytes, vehicle_bytes))
+
+        self.assertIsNone(second)
+        normalize.assert_not_called()
+        self.assertEqual(poller.trip_fetcher.stats["unchanged"], 1)
+
+    def test_same_header_timestamp_skips_normalize(self):
+        """本文が変わっても header.timestamp が同じなら正規化しない"""
+        trip_bytes, vehicle_bytes = make_feeds()
+
+        def mutate(client):
+            feed = build_trip_update_feed([("4201301G", "", [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1100, 1130)])])
+            client.trip_bytes = feed.SerializeToString()
+
+        poller, first, second, normalize = self._poll_twice(FakeClient(trip_bytes, vehicle_bytes), mutate)
+
+        self.assertIsNone(second)
+        normalize.assert_not_called()
+        self.assertEqual(poller.trip_fetcher.stats["same_header_timestamp"], 1)
+
+    def test_vehicle_only_update_reuses_schedules(self):
+        """VehiclePosition だけ更新された周期は TripUpdate の正規化結果を使い回す"""
+        trip_bytes, vehicle_bytes = make_feeds()
+
+        def mutate(client):
+            feed = build_vehicle_feed([("4201301G", 35.69, 139.77, 2)], timestamp=1700000015)
+            client.vehicle_bytes = feed.SerializeToString()
+
+        poller, first, second, normalize = self._poll_twice(FakeClient(trip_bytes, vehicle_bytes), mutate)
+
+        self.assertIsNotNone(second)
+        normalize.assert_not_called()
+        self.assertNotEqual(second.version, first.version)
+        self.assertIs(second.get_line("yamanote").schedules, first.get_line("yamanote").schedules)
+        self.assertEqual(second.get_line("yamanote").vehicle_positions["4201301G"].stop_sequence, 2)
+
+
+class TestDecodeExecutor(unittest.TestCase):
+    def test_decode_runs_off_event_loop_thread(self):
+        """デコード・正規化はイベントループのスレッド外で実行され、占有時間が記録される"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        executor = create_decode_executor("thread", 1, FakeDataCache())
+        poller = FeedPoller(
+            FakeClient(trip_bytes, vehicle_bytes), "dummy", FakeDataCache(), lines=LINES, executor=executor
+        )
+        threads = []
+
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread().name)
+            return {}
+
+        async def scenario():
+            with mock.patch("feed_decoder.normalize_trip_update_entities", side_effect=record_thread):
+                return await poller.poll_once(), threading.current_thread().name
+
+        try:
+            snapshot, loop_thread = asyncio.run(scenario())
+        finally:
+            executor.shutdown()
+
+        self.assertIsNotNone(snapshot)
+        self.assertTrue(threads)
+        self.assertNotIn(loop_thread, threads)
+        self.assertEqual(poller.loop_stats["polls"], 1)
+        self.assertGreater(poller.loop_stats["last_decode_ms"], 0)
+        self.assertIn("loop", poller.get_status())
+
+    def test_process_pool_matches_inline_result(self):
+        """プロセスプールでも同じ正規化結果がプレーンデータとして返る"""
+        trip_bytes, vehicle_bytes = make_feeds()
+        executor = create_decode_executor("process", 1, FakeDataCache())
+        try:
+            pooled = asyncio.run(
+                FeedPoller(
+                    FakeClient(trip_bytes, vehicle_bytes), "dummy", FakeDataCache(), lines=LINES, executor=executor
+                ).poll_once()
+            )
+        finally:
+            executor.shutdown()
+        inline = asyncio.run(
+            FeedPoller(FakeClient(trip_bytes, vehicle_bytes), "dummy", FakeDataCache(), lines=LINES).poll_once()
+        )
+
+        for line_id in LINES:
+            self.assertEqual(dict(pooled.get_line(line_id).schedules), dict(inline.get_line(line_id).schedules))
+            self.assertEqual(
+                dict(pooled.get_line(line_id).vehicle_positions), dict(inline.get_line(line_id).vehicle_positions)
+            )
+
+    def test_process_pool_uses_single_worker(self):
+        """プロセスプールは正規化キャッシュを使い回せるようにワーカー1つに固定する"""
+        executor = create_decode_executor("process", 4, FakeDataCache())
+        try:
+            self.assertEqual(executor._max_workers, 1)
+        finally:
+            executor.shutdown()
+
+
+class CountingDataCache(FakeDataCache):
+    def __init__(self):
+        self.lookups = 0
+
+    def get_static_train(self, *args, **kwargs):
+        self.lookups += 1
+        return None
+
+
+class TestIncrementalNormalization(unittest.TestCase):
+    ROUTE = "JR-East.Yamanote"
+
+    def _normalize(self, feed, data_cache, cache=None):
+        entities = partition_entities_by_route(feed, "trip_update").get(self.ROUTE, [])
+        return normalize_trip_update_entities(
+            entities, feed.header.timestamp, data_cache, target_route_id=self.ROUTE, mt3d_prefix=self.ROUTE, cache=cache
+        )
+
+    def test_only_changed_trips_are_renormalized(self):
+        """内容が変わった列車だけを再正規化し、消えた列車は破棄する"""
+        stops = [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1100, 1120)]
+        first_feed = build_trip_update_feed(
+            [("4201301G", "", stops), ("4202302G", "", stops), ("4203303G", "", stops)], timestamp=1700000000
+        )
+        second_feed = build_trip_update_feed(
+            [
+                ("4201301G", "", stops),  # 変化なし → 再利用
+                ("4202302G", "", [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1160, 1180)]),  # 遅延 → 再正規化
+                # 4203303G は運行終了 → 破棄
+            ],
+            timestamp=1700000030,
+        )
+        cache = TripNormalizationCache()
+        data_cache = CountingDataCache()
+
+        first = self._normalize(first_feed, data_cache, cache)
+        self.assertEqual(cache.last_stats, {"reused": 0, "normalized": 3, "evicted": 0})
+        self.assertEqual(data_cache.lookups, 3)
+
+        second = self._normalize(second_feed, data_cache, cache)
+        self.assertEqual(cache.last_stats, {"reused": 1, "normalized": 1, "evicted": 1})
+        self.assertEqual(data_cache.lookups, 4)
+        self.assertEqual(len(cache), 2)
+
+        # 再利用した列車は feed_timestamp だけ差し替え、駅時刻テーブルは共有する
+        self.assertEqual(second["4201301G"].feed_timestamp, 1700000030)
+        self.assertIs(second["4201301G"].columns, first["4201301G"].columns)
+        self.assertEqual(second, self._normalize(second_feed, FakeDataCache()))
+
+    def test_cache_cleared_when_static_data_reloads(self):
+        """DataCache.data_version が変わったら正規化キャッシュを破棄して全列車を正規化し直す"""
+        stops = [(1, "Tokyo", 1000, 1030), (2, "Kanda", 1100, 1120)]
+        line_keys = [(self.ROUTE, self.ROUTE)]
+        data_cache = FakeDataCache()
+        saved = dict(feed_decoder._trip_caches), feed_decoder._trip_caches_version
+        feed_decoder._trip_caches.clear()
+        try:
+            stats = []
+            for timestamp, version in ((1700000000, 1), (1700000030, 1), (1700000060, 2)):
+                content = build_trip_update_feed([("4201301G", "", stops)], timestamp=timestamp).SerializeToString()
+                result = decode_and_normalize(content, None, line_keys, data_cache=data_cache, data_version=version)
+                stats.append(result.trip_cache_stats)
+        finally:
+            feed_decoder._trip_caches.clear()
+            feed_decoder._trip_caches.update(saved[0])
+            feed_decoder._trip_caches_version = saved[1]
+
+        self.assertEqual([(s["reused"], s["normalized"]) for s in stats], [(0, 1), (1, 0), (0, 1)])
+
+
+class TestRoutePartition(unittest.TestCase):
+    def test_partition_matches_per_route_filter(self):
+        """1パスの振り分け結果が、従来の路線ごとのフィルタと一致する"""
+        feed = build_trip_update_feed(
+            [
+                ("4201301G", "", []),  # G → 山手線のみ
+                ("1001H", "", []),  # H → 中央線快速 / 横須賀線（曖昧）
+                ("1002M", "JR-East.Joban", []),  # route_id が候補にも含まれる → 重複登録しない
+                ("1003Z", "JR-East.Chuo", []),  # 未知サフィックスでも route_id で振り分け
+                ("1004Z", "", []),  # どの路線にも属さない
+            ]
+        )
+
+        index = partition_entities_by_route(feed, "trip_update")
+
+        def legacy_filter(route):
+            return [
+                e.trip_update.trip.trip_id
+                for e in feed.entity
+                if e.trip_update.trip.route_id == route
+                or route in identify_routes_by_trip_id(e.trip_update.trip.trip_id)
+            ]
+
+        for route in set(index) | {"JR-East.Yamanote", "JR-East.Nambu"}:
+            got = [e.trip_update.trip.trip_id for e in index.get(route, [])]
+            self.assertEqual(got, legacy_filter(route), route)
+
+        self.assertEqual([e.id for e in index["JR-East.ChuoRapid"]], ["1001H"])
+        self.assertEqual([e.id for e in index["JR-East.Yokosuka"]], ["1001H"])
+        self.assertEqual([e.id for e in index["JR-East.Joban"]], ["1002M"])
+        self.assertEqual([e.id for e in index["JR-East.Chuo"]], ["1003Z"])
+
+
+if __name__ == "__main__":
+    unittest.main()
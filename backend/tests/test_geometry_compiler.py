@@ -0,0 +1,221 @@
+# backend/tests/test_geometry_compiler.py
+"""
+線路形状のオフラインコンパイル (geometry_compiler) のテスト
+
+mmap したファイルから元と同じ LineGeometry・駅座標が復元され、
+元データのハッシュが変わったときだけ再コンパイルされることを検証する。
+"""
+
+import json
+import multiprocessing
+import pickle
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+import feed_decoder
+import geometry_compiler
+from data_cache import DataCache
+from geometry_compiler import (
+    compile_geometry,
+    decode_compiled_geometry,
+    encode_compiled_geometry,
+    load_compiled_geometry,
+    station_positions_sha256,
+    station_rows_sha256,
+)
+from train_position_v4 import get_merged_coords
+
+COORDINATES = {
+    "railways": [
+        {
+            "id": "Test.Compiled",
+            "sublines": [
+                {"type": "main", "coords": [[139.700, 35.600], [139.702, 35.603], [139.706, 35.605]]},
+                {"type": "main", "coords": [[139.706, 35.605], [139.710, 35.611]]},
+            ],
+        },
+        {"id": "Test.Empty", "sublines": []},
+    ]
+}
+RAILWAYS = [{"id": "Test.Compiled", "stations": ["Test.Compiled.A", "Test.Compiled.B", "Test.Compiled.Far"]}]
+STATION_POSITIONS = {
+    "Test.Compiled.A": (139.7001, 35.6001),
+    "Test.Compiled.B": (139.7099, 35.6110),
+    "Test.Compiled.Far": (139.800, 35.700),
+}
+HASHES = {"coordinates": "c1", "railways": "r1", "station_positions": "s1"}
+
+
+class FakeCache:
+    def __init__(self):
+        self.coordinates = COORDINATES
+        self.railways = RAILWAYS
+        self.station_positions = dict(STATION_POSITIONS)
+        self.railway_index = None
+
+
+def assert_same_geometry(test, a, b):
+    test.assertEqual(a.line_id, b.line_id)
+    for name in ("lons", "lats", "cumulative", "forward_bearing", "backward_bearing"):
+        test.assertEqual(getattr(a, name), getattr(b, name), name)
+    test.assertEqual(a.stations, b.stations)
+
+
+def worker_geometry(station_id, line_id):
+    """プロセスプールのワーカー内で、initializer で受け取った DataCache の駅座標と線路形状を読む"""
+    cache = feed_decoder._worker_data_cache
+    geometry = cache.line_geometries[line_id]
+    return cache.station_positions.get(station_id), list(geometry.lons), isinstance(geometry.lons, memoryview)
+
+
+class TestGeometryCompiler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "compiled" / "geometry.bin"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        """マージ済み座標・累積距離・方位角・駅の対応頂点と駅座標がファイルから復元される"""
+        compiled = compile_geometry(FakeCache(), self.path, HASHES)
+        self.assertEqual(list(compiled.lines), ["Test.Compiled"])
+        geometry = compiled.lines["Test.Compiled"]
+        self.assertEqual(len(geometry), 4)
+        self.assertEqual(set(geometry.stations), set(STATION_POSITIONS))
+        self.assertIsInstance(geometry.lons, memoryview)  # mmap 上の配列を直接参照する
+
+        self.assertEqual(dict(compiled.station_positions), STATION_POSITIONS)
+        self.assertIsNone(compiled.station_positions.get("Unknown"))
+
+        body = encode_compiled_geometry(compiled.lines, compiled.colors, compiled.station_positions, HASHES)
+        assert_same_geometry(self, decode_compiled_geometry(body).lines["Test.Compiled"], geometry)
+        self.assertEqual(self.path.read_bytes(), body)
+
+    def test_pickle_remaps_file(self):
+        """pickle ではパスとハッシュだけを送り、復元側で同じファイルを mmap し直す"""
+        compiled = compile_geometry(FakeCache(), self.path, HASHES)
+        payload = pickle.dumps(compiled)
+        self.assertLess(len(payload), 1024)
+
+        restored = pickle.loads(payload)
+        self.assertIsInstance(restored.lines["Test.Compiled"].lons, memoryview)
+        assert_same_geometry(self, restored.lines["Test.Compiled"], compiled.lines["Test.Compiled"])
+        self.assertEqual(dict(restored.station_positions), STATION_POSITIONS)
+
+        # 送り出した後に再コンパイルされたファイルは使わない
+        compile_geometry(FakeCache(), self.path, dict(HASHES, railways="r2"))
+        with self.assertRaises(ValueError):
+            pickle.loads(payload)
+
+        # ファイルに書き出せなかった（メモリ上のバイト列から読み込んだ）場合は内容ごと送る
+        in_memory = decode_compiled_geometry(self.path.read_bytes())
+        assert_same_geometry(
+            self, pickle.loads(pickle.dumps(in_memory)).lines["Test.Compiled"], in_memory.lines["Test.Compiled"]
+        )
+
+    def test_stale_or_broken_artifacts_are_ignored(self):
+        """ハッシュ・形式が一致しない、またはファイルが壊れている場合は読み込まない"""
+        self.assertIsNone(load_compiled_geometry(self.path, HASHES))
+
+        compile_geometry(FakeCache(), self.path, HASHES)
+        self.assertIsNotNone(load_compiled_geometry(self.path, HASHES))
+        self.assertIsNone(load_compiled_geometry(self.path, dict(HASHES, railways="r2")))
+
+        self.path.write_bytes(self.path.read_bytes()[:-16])
+        self.assertIsNone(load_compiled_geometry(self.path, HASHES))
+
+        self.path.write_bytes(b"")
+        self.assertIsNone(load_compiled_geometry(self.path, HASHES))
+
+
+class TestDataCacheCompiledGeometry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        data_dir = Path(self.tmp.name)
+        (data_dir / "mini-tokyo-3d").mkdir()
+        (data_dir / "mini-tokyo-3d/coordinates.json").write_text(json.dumps(COORDINATES), encoding="utf-8")
+        (data_dir / "mini-tokyo-3d/railways.json").write_text(json.dumps(RAILWAYS), encoding="utf-8")
+        self.data_dir = data_dir
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_cache(self):
+        cache = DataCache(self.data_dir)
+        cache.railways = RAILWAYS
+        cache.coordinates = COORDINATES
+        cache.station_positions = dict(STATION_POSITIONS)
+        return cache
+
+    def test_recompiles_only_when_sources_change(self):
+        """2回目の起動は保存済みの結果を読み込み、駅座標が変わると再コンパイルする"""
+        first = self.make_cache().load_compiled_geometry()
+
+        with mock.patch.object(geometry_compiler, "compile_geometry", side_effect=AssertionError("recompiled")):
+            cache = self.make_cache()
+            second = cache.load_compiled_geometry()
+        assert_same_geometry(self, second.lines["Test.Compiled"], first.lines["Test.Compiled"])
+        self.assertIs(cache.station_positions, second.station_positions)
+
+        cache = self.make_cache()
+        cache.station_positions["Test.Compiled.B"] = (139.7061, 35.6051)
+        self.assertEqual(cache.load_compiled_geometry().lines["Test.Compiled"].stations["Test.Compiled.B"].vertex, 2)
+
+    def test_shape_store_uses_compiled_coords(self):
+        """形状ストアはコンパイル済みのマージ済み座標をそのまま使う"""
+        cache = self.make_cache()
+        cache.load_compiled_geometry()
+        store = cache.build_shape_store()
+
+        self.assertEqual(
+            store.coords("Test.Compiled"), [[139.700, 35.600], [139.702, 35.603], [139.706, 35.605], [139.710, 35.611]]
+        )
+        self.assertIn("Test.Empty", store.known_ids)
+        # 座標リストに展開せず mmap 上の配列を参照する
+        compiled = cache.compiled_geometry.lines["Test.Compiled"]
+        self.assertIs(store.get("Test.Compiled").lons, compiled.lons)
+        self.assertEqual(list(get_merged_coords(cache, "Test.Compiled")), list(zip(compiled.lons, compiled.lats)))
+
+    def test_spawned_decode_worker_receives_data_cache(self):
+        """spawn で起動したデコード用ワーカーへ DataCache を渡せ、ワーカー側はファイルを mmap し直して使う"""
+        cache = self.make_cache()
+        cache.load_compiled_geometry()
+        cache._build_line_geometries()
+        cache.build_shape_store()
+        expected_lons = list(cache.line_geometries["Test.Compiled"].lons)
+
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=feed_decoder._init_worker,
+            initargs=(cache,),
+        ) as pool:
+            position, lons, mapped = pool.submit(worker_geometry, "Test.Compiled.B", "Test.Compiled").result(timeout=60)
+
+        self.assertEqual(position, STATION_POSITIONS["Test.Compiled.B"])
+        self.assertEqual(lons, expected_lons)
+        self.assertTrue(mapped)
+
+    def test_valid_file_skips_station_positions_dict(self):
+        """コンパイル済みファイルが有効なら DB の駅座標は行のハッシュだけ求め、辞書は作らない"""
+        rows = [(sid, *STATION_POSITIONS[sid]) for sid in sorted(STATION_POSITIONS)]
+        self.make_cache().load_compiled_geometry()
+
+        cache = DataCache(self.data_dir)
+        cache.coordinates = COORDINATES
+        with (
+            mock.patch.object(DataCache, "iter_station_positions_from_db", return_value=iter(rows)),
+            mock.patch.object(DataCache, "load_station_positions_from_db", side_effect=AssertionError("dict built")),
+            mock.patch.object(geometry_compiler, "compile_geometry", side_effect=AssertionError("recompiled")),
+        ):
+            compiled = cache.load_compiled_geometry()
+        self.assertEqual(dict(compiled.station_positions), STATION_POSITIONS)
+        self.assertEqual(station_rows_sha256(rows), station_positions_sha256(STATION_POSITIONS))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# backend/tests/test_position_delta.py
+"""
+列車位置レスポンスの差分 (position_delta) のテスト
+
+閾値未満しか動いていない列車は送らず、追加・変化・消えた列車だけが差分に入ること、
+少しずつ動く列車でもずれが積み重ならないことを検証する。
+"""
+
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+import mock_trip_generator
+import train_position_v4
+from position_delta import SnapshotRing, diff_rows
+from position_encoder import PositionRow
+from response_cache import MicroTTLCache, VersionedCache
+from time_manager import time_mgr
+from train_position_v4 import SegmentProgress
+
+# 緯度 0.000009 度 ≒ 1 m
+LAT_1M = 0.000009
+
+
+def progress(trip_id, status="running", next_station_id="S2"):
+    return SegmentProgress(
+        trip_id=trip_id,
+        train_number=trip_id,
+        direction="Outbound",
+        prev_station_id="S1",
+        next_station_id=next_station_id,
+        prev_seq=1,
+        next_seq=2,
+        now_ts=1760000000,
+        t0_departure=1759999900,
+        t1_arrival=1760000100,
+        progress=0.5,
+        status=status,
+    )
+
+
+def row(trip_id, lat, **kwargs):
+    return PositionRow.from_coord(progress(trip_id, **kwargs), (lat, 139.7, 0.0))
+
+
+class TestSnapshotRing(unittest.TestCase):
+    def setUp(self):
+        self.ring = SnapshotRing(history=3, threshold_m=5.0)
+
+    def test_small_moves_keep_previous_row(self):
+        """閾値未満の移動は前の版の行を引き継ぎ、状態の変化・閾値以上の移動は入れ替える"""
+        v1 = self.ring.append("L", [row("A", 35.0), row("B", 35.0), row("C", 35.0)], {})
+        v2 = self.ring.append(
+            "L",
+            [row("A", 35.0 + 2 * LAT_1M), row("B", 35.0 + 10 * LAT_1M), row("C", 35.0, status="stopped")],
+            {},
+        )
+        self.assertIs(v2.rows["A"], v1.rows["A"])
+        changed, removed = diff_rows(v1.rows, v2.rows)
+        self.assertEqual([r.progress.trip_id for r in changed], ["B", "C"])
+        self.assertEqual(removed, [])
+
+    def test_slow_drift_is_eventually_sent(self):
+        """1回ごとには閾値未満でも、最後に配った位置から閾値以上ずれたら送る"""
+        base = self.ring.append("L", [row("A", 35.0)], {})
+        sent = []
+        for i in range(1, 5):
+            latest = self.ring.append("L", [row("A", 35.0 + 2 * i * LAT_1M)], {})
+            sent.append(bool(diff_rows(base.rows, latest.rows)[0]))
+        self.assertEqual(sent, [False, False, True, True])
+
+    def test_added_removed_and_history(self):
+        """追加・消えた列車を返し、リングから外れた版は見つからない"""
+        v1 = self.ring.append("L", [row("A", 35.0)], {})
+        v2 = self.ring.append("L", [row("B", 35.0)], {})
+        changed, removed = diff_rows(v1.rows, v2.rows)
+        self.assertEqual([r.progress.trip_id for r in changed], ["B"])
+        self.assertEqual(removed, ["A"])
+
+        for _ in range(3):
+            self.ring.append("L", [], {})
+        self.assertIsNone(self.ring.get("L", v1.version))
+        self.assertIsNone(self.ring.get("Other", v2.version))
+
+
+class TestPositionsDeltaEndpoint(unittest.TestCase):
+    def setUp(self):
+        time_mgr.set_virtual_time("2026-02-12T08:30:00+09:00")
+        self.saved = (main._positions_cache, main._position_snapshots, main._delta_responses)
+        main._positions_cache = MicroTTLCache(0.0)
+        main._position_snapshots = SnapshotRing(history=8, threshold_m=5.0)
+        main._delta_responses = VersionedCache()
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        time_mgr.reset()
+        main._positions_cache, main._position_snapshots, main._delta_responses = self.saved
+
+    def get(self, results, coords, **params):
+        with (
+            mock.patch.object(mock_trip_generator, "generate_mock_schedules", return_value={"T": object()}),
+            mock.patch.object(train_position_v4, "compute_all_progress", return_value=results),
+            mock.patch.object(train_position_v4, "calculate_coordinates", side_effect=coords),
+        ):
+            response = self.client.get("/api/trains/chuo_rapid/positions/v4", params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_since_returns_changes_only(self):
+        """since に前回の version を渡すと、変化した列車と消えた列車だけを返す"""
+        first = self.get(
+            [progress("A"), progress("B"), progress("C")],
+            [(35.0, 139.7, 0.0), (35.0, 139.7, 0.0), (35.0, 139.7, 0.0)],
+        )
+        self.assertEqual(len(first["positions"]), 3)
+        self.assertNotIn("delta", first)
+
+        second = self.get(
+            [progress("A"), progress("B", next_station_id="S3")],
+            [(35.0 + LAT_1M, 139.7, 0.0), (35.0, 139.7, 0.0)],
+            since=first["version"],
+        )
+        self.assertTrue(second["delta"])
+        self.assertEqual(second["since"], first["version"])
+        self.assertNotEqual(second["version"], first["version"])
+        self.assertEqual([p["trip_id"] for p in second["positions"]], ["B"])
+        self.assertEqual(second["positions"][0]["segment"]["next_station_id"], "S3")
+        self.assertEqual(second["removed"], ["C"])
+        self.assertEqual(second["total_trains"], 2)
+
+    def test_unknown_since_returns_full_response(self):
+        """リングに無い版を指定された場合は全件を返す"""
+        body = self.get([progress("A")], [(35.0, 139.7, 0.0)], since="stale-1")
+        self.assertNotIn("delta", body)
+        self.assertEqual(len(body["positions"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+# backend/tests/test_position_encoder.py
+"""
+列車位置レスポンスのエンコード (position_encoder) のテスト
+
+PositionRow から直接書き出した JSON が、従来の辞書 + FastAPI の既定のエンコードと
+同じ内容になることを検証する。
+列指向のバイナリ形式は、読み戻した列が元の行と一致することを検証する。
+"""
+
+import json
+import math
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+import main
+import mock_trip_generator
+import train_position_v4
+from position_encoder import (
+    POSITIONS_COLUMNAR_MEDIA_TYPE,
+    PositionRow,
+    columnar_strings,
+    decode_positions_columnar,
+    encode_json_fallback,
+    encode_positions_columnar,
+    encode_positions_json,
+)
+from response_cache import MicroTTLCache
+from time_manager import time_mgr
+from train_position_v4 import SegmentProgress
+
+
+def progress(trip_id, train_number, direction, status="running", **kwargs):
+    return SegmentProgress(
+        trip_id=trip_id,
+        train_number=train_number,
+        direction=direction,
+        prev_station_id="JR-East.ChuoRapid.Tokyo",
+        next_station_id="JR-East.ChuoRapid.Kanda",
+        prev_seq=1,
+        next_seq=2,
+        now_ts=1760000000,
+        t0_departure=1759999900,
+        t1_arrival=1760000100,
+        progress=0.123456,
+        status=status,
+        feed_timestamp=1759999990,
+        **kwargs,
+    )
+
+
+EXPECTED = {
+    "trip_id": "T1",
+    "train_number": "1001T",
+    "direction": "Outbound",
+    "status": "running",
+    "progress": 0.1235,
+    "delay": 30,
+    "location": {"latitude": 35.681236, "longitude": 139.767125, "bearing": 271.57},
+    "segment": {
+        "prev_seq": 1,
+        "next_seq": 2,
+        "prev_station_id": "JR-East.ChuoRapid.Tokyo",
+        "next_station_id": "JR-East.ChuoRapid.Kanda",
+    },
+    "times": {"now_ts": 1760000000, "t0_departure": 1759999900, "t1_arrival": 1760000100},
+    "debug": {"feed_timestamp": 1759999990},
+    "is_starting_station": True,
+}
+
+
+class TestPositionEncoder(unittest.TestCase):
+    def test_row_shape(self):
+        """丸め・入れ子の形が従来のレスポンスと同じになる"""
+        row = PositionRow.from_coord(
+            progress("T1", "1001T", "Outbound", delay=30, is_starting_station=True),
+            (35.6812362, 139.7671248, 271.5678),
+        )
+        content = {"status": "success", "positions": [row]}
+        self.assertEqual(json.loads(encode_positions_json(content)), {"status": "success", "positions": [EXPECTED]})
+        legacy = JSONResponse(content=None).render({"status": "success", "positions": [EXPECTED]})
+        self.assertEqual(encode_json_fallback(content), legacy)
+
+    def test_missing_coord(self):
+        """座標が求まらない列車は緯度経度が null、方位角が 0"""
+        row = PositionRow.from_coord(progress("T2", "1002T", None, status="unknown"), None)
+        location = json.loads(encode_positions_json({"positions": [row]}))["positions"][0]["location"]
+        self.assertEqual(location, {"latitude": None, "longitude": None, "bearing": 0.0})
+
+    def test_columnar_round_trip(self):
+        """列指向形式: 路線ごとの行の範囲・型付き配列・trip_id の辞書を読み戻せる"""
+        lines = [
+            {
+                "line_id": "chuo_rapid",
+                "status": "success",
+                "positions": [
+                    PositionRow.from_coord(progress("T1", "1001T", "Outbound", delay=30), (35.68, 139.76, 271.5)),
+                    PositionRow.from_coord(progress("T2", "快速", "Inbound", status="stopped", delay=99999), None),
+                ],
+                "debug": {"status_stats": {}},
+            },
+            {"line_id": "yamanote", "status": "no_data", "positions": []},
+            {
+                "line_id": "sobu_local",
+                "status": "success",
+                "positions": [
+                    PositionRow.from_coord(progress("T3", None, "Outbound", status="unknown"), (35.7, 139.8))
+                ],
+            },
+        ]
+        buffer = encode_positions_columnar(lines, {"status": "success"})
+        manifest, columns = decode_positions_columnar(buffer)
+
+        self.assertEqual(manifest["status"], "success")
+        self.assertEqual(manifest["count"], 3)
+        self.assertEqual(
+            [(entry["line_id"], entry["start"], entry["count"]) for entry in manifest["lines"]],
+            [("chuo_rapid", 0, 2), ("yamanote", 2, 0), ("sobu_local", 2, 1)],
+        )
+        self.assertNotIn("positions", manifest["lines"][0])
+        self.assertNotIn("debug", manifest["lines"][0])
+        for offset, _count in manifest["sections"].values():
+            self.assertEqual(offset % 8, 0)
+
+        self.assertAlmostEqual(columns["lat"][0], 35.68, places=5)
+        self.assertAlmostEqual(columns["lon"][2], 139.8, places=5)
+        self.assertTrue(math.isnan(columns["lat"][1]) and math.isnan(columns["lon"][1]))
+        self.assertEqual(list(columns["bearing"]), [271.5, 0.0, 0.0])
+        self.assertEqual([manifest["statuses"][code] for code in columns["status"]], ["running", "stopped", "unknown"])
+        self.assertEqual(list(columns["delay"]), [30, 32767, 0])
+        self.assertEqual(columnar_strings(columns, "trip_ids"), ["T1", "T2", "T3"])
+        self.assertEqual(columnar_strings(columns, "train_numbers"), ["1001T", "快速", ""])
+
+
+class TestPositionsEndpoint(unittest.TestCase):
+    def setUp(self):
+        time_mgr.set_virtual_time("2026-02-12T08:30:00+09:00")
+        self.saved_cache = main._positions_cache
+        main._positions_cache = MicroTTLCache(0.0)
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        time_mgr.reset()
+        main._positions_cache = self.saved_cache
+
+    def test_sorted_positions(self):
+        """invalid を除き、direction → train_number の順に並べて返す"""
+        results = [
+            progress("T3", "1003T", "Outbound"),
+            progress("T4", "1004T", "Inbound", status="invalid"),
+            progress("T5", "0905T", "Outbound"),
+            progress("T6", "1006T", "Inbound"),
+        ]
+        with (
+            mock.patch.object(mock_trip_generator, "generate_mock_schedules", return_value={"T": object()}),
+            mock.patch.object(train_position_v4, "compute_all_progress", return_value=results),
+            mock.patch.object(train_position_v4, "calculate_coordinates", return_value=(35.68, 139.76, 90.0)),
+        ):
+            response = self.client.get("/api/trains/chuo_rapid/positions/v4")
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["status"], "success")
+        self.assertEqual([p["trip_id"] for p in body["positions"]], ["T6", "T5", "T3"])
+        self.assertEqual(body["total_trains"], 3)
+        self.assertEqual(body["debug"]["status_stats"], {"running": 3, "invalid": 1})
+        self.assertEqual(body["time_travel"]["mode"], "virtual")
+
+    def test_columnar_format(self):
+        """format=columnar または Accept で列指向形式を選べ、JSON と同じ列車を同じ順に返す"""
+        results = [progress("T3", "1003T", "Outbound"), progress("T6", "1006T", "Inbound")]
+        with (
+            mock.patch.object(mock_trip_generator, "generate_mock_schedules", return_value={"T": object()}),
+            mock.patch.object(train_position_v4, "compute_all_progress", return_value=results),
+            mock.patch.object(train_position_v4, "calculate_coordinates", return_value=(35.68, 139.76, 90.0)),
+        ):
+            by_param = self.client.get("/api/trains/chuo_rapid/positions/v4", params={"format": "columnar"})
+            by_accept = self.client.get(
+                "/api/trains/chuo_rapid/positions/v4", headers={"Accept": POSITIONS_COLUMNAR_MEDIA_TYPE}
+            )
+            invalid = self.client.get("/api/trains/chuo_rapid/positions/v4", params={"format": "xml"})
+
+        for response in (by_param, by_accept):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["content-type"], POSITIONS_COLUMNAR_MEDIA_TYPE)
+            self.assertIn("Accept", response.headers["vary"])
+            manifest, columns = decode_positions_columnar(response.content)
+            self.assertEqual(manifest["lines"][0]["line_id"], "chuo_rapid")
+            self.assertEqual(columnar_strings(columns, "trip_ids"), ["T6", "T3"])
+        self.assertEqual(invalid.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
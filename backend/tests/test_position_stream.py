@@ -0,0 +1,120 @@
+# backend/tests/test_position_stream.py
+"""
+列車位置のプッシュ配信 (position_stream) のテスト
+
+購読中の路線が1周期1回だけ計算されて全購読者に配られること、
+読み出しの遅い購読者には最新のフレームだけが渡ることを検証する。
+"""
+
+import asyncio
+import os
+import unittest
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+from position_stream import Frame, PositionBroadcaster, sse_stream
+
+
+class FakeSource:
+    """路線ごとの計算回数を数え、呼ばれるたびに内容の違うフレームを返す"""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def __call__(self, line_id):
+        n = self.calls[line_id] = self.calls.get(line_id, 0) + 1
+        return Frame(line_id, b'{"line_id":"%s","n":%d}' % (line_id.encode(), n), f'"{line_id}-{n}"')
+
+
+class TestPositionBroadcaster(unittest.TestCase):
+    def setUp(self):
+        self.source = FakeSource()
+        self.broadcaster = PositionBroadcaster(self.source, interval=3600.0)
+
+    def test_one_computation_shared_by_all_subscribers(self):
+        """同じ路線の購読者が何人いても1周期1回だけ計算し、同じフレームを配る"""
+
+        async def run():
+            subs = [self.broadcaster.subscribe(["chuo_rapid"]) for _ in range(5)]
+            subs.append(self.broadcaster.subscribe(["chuo_rapid", "yamanote"]))
+            await asyncio.sleep(0)  # 配信ループの初回 tick
+            frames = [await sub.next_frames() for sub in subs]
+            await self.broadcaster.stop()
+            return frames
+
+        frames = asyncio.run(run())
+        self.assertEqual(self.source.calls, {"chuo_rapid": 1, "yamanote": 1})
+        self.assertTrue(all(f[0] is frames[0][0] for f in frames))
+        self.assertEqual(sorted(f.line_id for f in frames[-1]), ["chuo_rapid", "yamanote"])
+
+    def test_slow_consumer_gets_latest_frame(self):
+        """読み出しが遅い購読者にはキューを溜めず、路線ごとに最新のフレームだけを渡す"""
+
+        async def run():
+            sub = self.broadcaster.subscribe(["chuo_rapid"])
+            for _ in range(3):
+                await self.broadcaster.tick()
+            frames = await sub.next_frames()
+            await self.broadcaster.stop()
+            return sub, frames
+
+        sub, frames = asyncio.run(run())
+        self.assertEqual([f.etag for f in frames], [f'"chuo_rapid-{self.source.calls["chuo_rapid"]}"'])
+        self.assertGreaterEqual(sub.dropped, 2)
+
+    def test_unchanged_frame_is_not_republished(self):
+        """前回と同じ ETag のフレームは配らない"""
+
+        async def same(line_id):
+            return Frame(line_id, b"{}", '"same"')
+
+        broadcaster = PositionBroadcaster(same, interval=3600.0)
+
+        async def run():
+            sub = broadcaster.subscribe(["chuo_rapid"])
+            await sub.next_frames()
+            await broadcaster.tick()
+            try:
+                return await asyncio.wait_for(sub.next_frames(), timeout=0.01)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                await broadcaster.stop()
+
+        self.assertIsNone(asyncio.run(run()))
+        self.assertEqual(broadcaster.stats["published"], 1)
+
+    def test_stream_unsubscribes_on_close(self):
+        """SSE のジェネレータはフレームと keepalive を送り、閉じると購読を解除して配信ループを止める"""
+
+        async def run():
+            stream = sse_stream(self.broadcaster, ["chuo_rapid"], heartbeat=0.01)
+            chunks = [await stream.__anext__() for _ in range(3)]
+            self.assertEqual(self.broadcaster.subscriber_count, 1)
+            await stream.aclose()
+            return chunks
+
+        chunks = asyncio.run(run())
+        self.assertTrue(chunks[0].startswith(b"retry: "))
+        self.assertEqual(chunks[1], b'event: positions\ndata: {"line_id":"chuo_rapid","n":1}\n\n')
+        self.assertEqual(chunks[2], b": keepalive\n\n")
+        self.assertEqual(self.broadcaster.subscriber_count, 0)
+        self.assertIsNone(self.broadcaster._task)
+
+
+class TestStreamEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(main.app)
+
+    def test_rejects_unknown_lines(self):
+        """未対応の路線や空の指定はストリームを開始せずにエラーを返す"""
+        self.assertEqual(self.client.get("/api/trains/positions/stream", params={"lines": ","}).status_code, 400)
+        response = self.client.get("/api/trains/positions/stream", params={"lines": "chuo_rapid,no_such_line"})
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
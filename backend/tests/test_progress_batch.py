@@ -0,0 +1,224 @@
+# backend/tests/test_progress_batch.py
+"""
+ベクトル化バッチエンジン (train_position_batch) のテスト
+
+ランダムに生成した時刻表に対して、engine="vectorized" の結果が
+スカラー版 compute_progress_for_train と完全に一致することを検証する。
+"""
+
+import random
+import unittest
+
+from gtfs_rt_tripupdate import RealtimeStationSchedule, TrainSchedule
+from gtfs_rt_vehicle import YamanoteTrainPosition
+from train_position_batch import NUMPY_AVAILABLE
+from train_position_v4 import (
+    ENGINE_SCALAR,
+    ENGINE_VECTORIZED,
+    calculate_physics_progress,
+    compute_all_progress,
+    compute_progress_for_train,
+    get_effective_times,
+)
+
+STATIONS = [
+    "JR-East.Yamanote.Tokyo",
+    "JR-East.Yamanote.Kanda",
+    "JR-East.Yamanote.Shinjuku",
+    "JR-East.ChuoRapid.Zero",
+    None,
+]
+
+
+class FakeDwellCache:
+    """駅ごとの停車時間を返す DataCache（0秒の駅を含む）"""
+
+    def get_station_dwell_time(self, station_id):
+        if station_id.endswith(".Zero"):
+            return 0
+        return 50 if station_id.endswith("Tokyo") else 20
+
+
+def random_schedule(rng, trip_no, base_ts):
+    schedules = {}
+    t = base_ts + rng.randint(-3600, 3600)
+    for seq in range(1, rng.randint(2, 12) + 1):
+        t += rng.randint(60, 240)
+        arr = t
+        dep = t + rng.choice([0, 0, 20, 45])  # 到着=発車（停車時間を加算するケース）を多めに
+        kind = rng.random()
+        if seq == 1 and kind < 0.5:
+            arr = None  # 始発駅
+        elif kind < 0.1:
+            dep = None
+        elif kind < 0.15:
+            arr = None
+        elif kind < 0.18:
+            dep = dep - 600  # 逆転した区間（t1 <= t0）
+        station = rng.choice(STATIONS)
+        schedules[seq] = RealtimeStationSchedule(
+            stop_sequence=seq,
+            station_id=station,
+            arrival_time=arr,
+            departure_time=dep,
+            resolved=station is not None,
+            raw_stop_id=rng.choice(["Tokyo", "1234", None]),
+            delay=rng.choice([0, 0, 30, 120]),
+        )
+        t = dep if dep is not None else t
+    return TrainSchedule(
+        trip_id=f"{trip_no:04d}G",
+        train_number=f"{trip_no}G",
+        start_date=None,
+        direction=rng.choice(["InnerLoop", "OuterLoop"]),
+        feed_timestamp=rng.choice([None, base_ts - 30, base_ts + 30]),
+        schedules_by_seq=schedules,
+    )
+
+
+@unittest.skipUnless(NUMPY_AVAILABLE, "numpy is not installed")
+class TestVectorizedProgress(unittest.TestCase):
+    def test_matches_scalar_engine(self):
+        """ランダムな時刻表で、ベクトル版とスカラー版の結果が完全に一致する"""
+        rng = random.Random(20240101)
+        base_ts = 1_700_000_000
+        schedules = {s.trip_id: s for s in (random_schedule(rng, i, base_ts) for i in range(400))}
+        vehicle_positions = {
+            trip_id: YamanoteTrainPosition(
+                trip_id=trip_id,
+                train_number=None,
+                direction=None,
+                latitude=35.0,
+                longitude=139.0,
+                stop_sequence=rng.choice([0, 1, 3]),
+                status=rng.choice([1, 2]),
+                timestamp=base_ts,
+            )
+            for trip_id in rng.sample(sorted(schedules), 40)
+        }
+
+        seen = set()
+        for data_cache in (None, FakeDwellCache()):
+            for offset in range(-4000, 4000, 199):
+                now_ts = base_ts + offset
+                scalar = compute_all_progress(schedules, now_ts, data_cache, vehicle_positions, engine=ENGINE_SCALAR)
+                vectorized = compute_all_progress(
+                    schedules, now_ts, data_cache, vehicle_positions, engine=ENGINE_VECTORIZED
+                )
+                self.assertEqual(vectorized, scalar, f"now_ts={now_ts}")
+                seen.update((r.status, r.is_starting_station) for r in scalar)
+
+        # 全ての判定分岐を通っていること
+        self.assertTrue({("running", False), ("stopped", False), ("stopped", True), ("unknown", False)} <= seen)
+
+    def test_physics_progress_array_matches_scalar(self):
+        """台形速度制御のベクトル版がスカラー版とビット単位で一致する"""
+        from train_position_batch import calculate_physics_progress_array
+
+        cases = [(e, d) for d in (-5, 0, 10, 54, 55, 56, 120, 600) for e in range(-10, d + 11, 3)]
+        expected = [calculate_physics_progress(e, d) for e, d in cases]
+        got = calculate_physics_progress_array([e for e, _ in cases], [d for _, d in cases]).tolist()
+        self.assertEqual(got, expected)
+
+
+class RankCache(FakeDwellCache):
+    """rank_version を持つ DataCache"""
+
+    def __init__(self):
+        self.rank_version = 0
+        self.dwell = 20
+
+    def get_station_dwell_time(self, station_id):
+        return self.dwell
+
+
+def simple_schedule(times):
+    """times: [(arr, dep), ...]"""
+    return TrainSchedule(
+        trip_id="T1",
+        train_number="1G",
+        start_date=None,
+        direction="OuterLoop",
+        feed_timestamp=None,
+        schedules_by_seq={
+            seq: RealtimeStationSchedule(
+                stop_sequence=seq,
+                station_id=f"JR-East.Yamanote.S{seq}",
+                arrival_time=arr,
+                departure_time=dep,
+                resolved=True,
+                raw_stop_id=None,
+            )
+            for seq, (arr, dep) in enumerate(times, start=1)
+        },
+    )
+
+
+class TestEffectiveTimes(unittest.TestCase):
+    def test_monotonic_schedule_uses_bisect_path(self):
+        """停車区間が時刻順に並ぶ列車は二分探索で判定され、結果は各時刻で正しい"""
+        schedule = simple_schedule([(None, 1000), (1100, 1100), (1200, 1230)])
+        eff = get_effective_times(schedule, RankCache())
+
+        self.assertTrue(eff.monotonic)
+        self.assertEqual(list(eff.stop_start), [980, 1100, 1200])  # 始発駅は発車 - 停車時間(20s)
+        self.assertEqual(list(eff.effective_departure), [1000, 1120, 1230])  # 到着=発車 → +20s
+
+        expected = {
+            999: ("stopped", 1),
+            1050: ("running", 1),
+            1110: ("stopped", 2),
+            1120: ("stopped", 2),
+            1150: ("running", 2),
+            1230: ("stopped", 3),
+            1300: ("unknown", 1),
+        }
+        for now_ts, (status, prev_seq) in expected.items():
+            result = compute_progress_for_train(schedule, now_ts, RankCache())
+            self.assertEqual((result.status, result.prev_seq), (status, prev_seq), now_ts)
+
+    def test_non_monotonic_schedule_falls_back_to_linear_scan(self):
+        """時刻が前後する列車は線形走査にフォールバックする"""
+        schedule = simple_schedule([(None, 1000), (1300, 1320), (1200, 1250)])
+        eff = get_effective_times(schedule, RankCache())
+
+        self.assertFalse(eff.monotonic)
+        result = compute_progress_for_train(schedule, 1210, RankCache())
+        self.assertEqual((result.status, result.prev_seq), ("stopped", 3))
+
+    def test_rank_update_invalidates_cached_times(self):
+        """駅ランクの更新 (rank_version) で実質時刻を作り直す"""
+        schedule = simple_schedule([(1000, 1000), (1100, 1100)])
+        cache = RankCache()
+
+        first = get_effective_times(schedule, cache)
+        self.assertIs(get_effective_times(schedule, cache), first)
+
+        cache.dwell = 50
+        cache.rank_version += 1
+        second = get_effective_times(schedule, cache)
+        self.assertIsNot(second, first)
+        self.assertEqual(list(second.effective_departure), [1050, 1150])
+
+    @unittest.skipUnless(NUMPY_AVAILABLE, "numpy is not installed")
+    def test_vectorized_engine_shares_cached_times(self):
+        """ベクトル版もスカラー版と同じ実質時刻のキャッシュを使い、ランク更新に追従する"""
+        schedule = simple_schedule([(None, 1000), (1100, 1100), (1200, 1230)])
+        cache = RankCache()
+
+        compute_all_progress({"T1": schedule}, 1110, cache, engine=ENGINE_VECTORIZED)
+        first = schedule.columns.effective
+        self.assertIsNotNone(first)
+        result = compute_all_progress({"T1": schedule}, 1110, cache, engine=ENGINE_VECTORIZED)[0]
+        self.assertIs(schedule.columns.effective, first)
+        self.assertEqual((result.status, result.prev_seq), ("stopped", 2))
+
+        cache.dwell = 5
+        cache.rank_version += 1
+        result = compute_all_progress({"T1": schedule}, 1110, cache, engine=ENGINE_VECTORIZED)[0]
+        self.assertIsNot(schedule.columns.effective, first)
+        self.assertEqual((result.status, result.prev_seq), ("running", 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
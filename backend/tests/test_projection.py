@@ -0,0 +1,77 @@
+# backend/tests/test_projection.py
+"""
+ローカルなメートル平面への投影 (projection) のテスト
+
+投影平面での距離・方位角が Haversine による値と十分一致し、
+区間上の最近点探索が投影平面だけで求まることを検証する。
+"""
+
+import random
+import unittest
+
+from projection import LocalProjection, closest_point_on_segment, planar_bearing, segment_metrics
+from train_position import estimate_segment_progress_extended
+from train_position_v4 import calculate_bearing, get_distance_meters
+
+TRACK = [
+    (139.700, 35.600),
+    (139.702, 35.603),
+    (139.706, 35.605),
+    (139.710, 35.611),
+    (139.711, 35.618),
+    (139.715, 35.620),
+    (139.720, 35.624),
+]
+
+
+class TestLocalProjection(unittest.TestCase):
+    def test_round_trip(self):
+        """投影して戻すと元の経緯度になる"""
+        projection = LocalProjection.for_coords(TRACK)
+        for lon, lat in TRACK:
+            back = projection.unproject(*projection.project(lon, lat))
+            self.assertAlmostEqual(back[0], lon, places=9)
+            self.assertAlmostEqual(back[1], lat, places=9)
+
+    def test_metrics_match_haversine(self):
+        """累積距離・方位角が Haversine による値と一致する（南北に長い路線でも）"""
+        track = TRACK + [(139.900, 36.300), (139.880, 36.560)]
+        cumulative, forward, backward = segment_metrics([c[0] for c in track], [c[1] for c in track])
+
+        total = 0.0
+        for i, ((lon1, lat1), (lon2, lat2)) in enumerate(zip(track, track[1:])):
+            total += get_distance_meters(lat1, lon1, lat2, lon2)
+            self.assertAlmostEqual(cumulative[i + 1], total, delta=total * 1e-5)
+            self.assertAlmostEqual(forward[i], calculate_bearing(lat1, lon1, lat2, lon2), delta=0.1)
+            self.assertAlmostEqual(backward[i], calculate_bearing(lat2, lon2, lat1, lon1), delta=0.1)
+
+    def test_planar_helpers(self):
+        """方位角は北=0度の時計回り、最近点は線分の範囲にクランプされる"""
+        self.assertEqual(planar_bearing(0.0, 1.0), 0.0)
+        self.assertEqual(planar_bearing(1.0, 0.0), 90.0)
+        self.assertEqual(planar_bearing(-1.0, 0.0), 270.0)
+
+        self.assertEqual(closest_point_on_segment(5.0, 3.0, 0.0, 0.0, 10.0, 0.0), (3.0, 5.0, 0.0, 0.5))
+        self.assertEqual(closest_point_on_segment(-4.0, 3.0, 0.0, 0.0, 10.0, 0.0), (5.0, 0.0, 0.0, 0.0))
+        self.assertEqual(closest_point_on_segment(3.0, 4.0, 0.0, 0.0, 0.0, 0.0), (5.0, 0.0, 0.0, 0.0))
+
+
+class TestSegmentProgress(unittest.TestCase):
+    def test_matches_haversine_distance(self):
+        """区間上の最近点までの距離が Haversine と一致し、最近点は線路上にある"""
+        rng = random.Random(3)
+        for _ in range(50):
+            lon = rng.uniform(139.700, 139.720)
+            lat = rng.uniform(35.600, 35.624)
+            result = estimate_segment_progress_extended(TRACK, lat, lon, max_dist=5000.0)
+            self.assertIsNotNone(result)
+            expected = get_distance_meters(lat, lon, result["lat"], result["lon"])
+            self.assertAlmostEqual(result["distance_m"], expected, delta=0.05 + expected * 1e-3)
+            self.assertGreaterEqual(result["progress"], 0.0)
+            self.assertLessEqual(result["progress"], 1.0)
+
+        self.assertIsNone(estimate_segment_progress_extended(TRACK, 35.7, 139.8, max_dist=500.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
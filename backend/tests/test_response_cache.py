@@ -0,0 +1,265 @@
+# backend/tests/test_response_cache.py
+"""
+エンコード済みレスポンスのキャッシュ (response_cache) のテスト
+
+同じキーの同時ミスが1回の計算にまとまり、時間バケットが変わると再計算されること、
+データ版が変わるまで路線・駅一覧の本文と ETag が使い回され、304 で応答できることを検証する。
+"""
+
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+import mock_trip_generator
+import train_position_v4
+from response_cache import MicroTTLCache, VersionedCache
+from time_manager import time_mgr
+from train_position_v4 import SegmentProgress
+
+
+class FakeClock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Counter:
+    """呼ばれた回数を数え、少し待ってから値を返すコルーチン関数"""
+
+    def __init__(self, value="body", error=None):
+        self.value = value
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return f"{self.value}-{self.calls}"
+
+
+class TestMicroTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = MicroTTLCache(1.0, clock=self.clock)
+
+    def test_concurrent_misses_share_one_computation(self):
+        """同じキーの同時ミスは1回の計算を待ち合わせ、以降はヒットになる"""
+        compute = Counter()
+
+        async def run():
+            results = await asyncio.gather(*(self.cache.get_or_compute("line", compute) for _ in range(20)))
+            results.append(await self.cache.get_or_compute("line", compute))
+            return results
+
+        self.assertEqual(asyncio.run(run()), ["body-1"] * 21)
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual(self.cache.stats, {"hits": 1, "misses": 1, "coalesced": 19})
+
+    def test_bucket_expiry(self):
+        """時間バケットが変わると再計算し、古いバケットの結果は捨てる"""
+        compute = Counter()
+        get = self.cache.get_or_compute
+
+        self.assertEqual(asyncio.run(get("line", compute)), "body-1")
+        self.clock.now = 100.9
+        self.assertEqual(asyncio.run(get("line", compute)), "body-1")
+        self.clock.now = 101.0
+        self.assertEqual(asyncio.run(get("line", compute)), "body-2")
+        self.assertEqual(len(self.cache), 1)
+
+    def test_errors_are_not_cached(self):
+        """例外と cacheable が偽の結果はキャッシュせず、次のリクエストで再計算する"""
+        failing = Counter(error=RuntimeError("feed down"))
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(self.cache.get_or_compute("line", failing))
+        self.assertEqual(failing.calls, 2)
+
+        compute = Counter()
+        for _ in range(2):
+            asyncio.run(self.cache.get_or_compute("other", compute, cacheable=lambda v: False))
+        self.assertEqual(compute.calls, 2)
+
+    def test_cancelled_waiter_does_not_cancel_computation(self):
+        """先頭のリクエストがキャンセルされても、待機中のリクエストには結果が届く"""
+        compute = Counter()
+
+        async def run():
+            first = asyncio.ensure_future(self.cache.get_or_compute("line", compute))
+            second = asyncio.ensure_future(self.cache.get_or_compute("line", compute))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second
+
+        self.assertEqual(asyncio.run(run()), "body-1")
+        self.assertEqual(compute.calls, 1)
+
+    def test_disabled(self):
+        """ttl=0 では毎回計算する"""
+        cache = MicroTTLCache(0.0)
+        compute = Counter()
+        asyncio.run(cache.get_or_compute("line", compute))
+        asyncio.run(cache.get_or_compute("line", compute))
+        self.assertEqual(compute.calls, 2)
+
+
+class TestVersionedCache(unittest.TestCase):
+    def test_rebuilds_when_version_changes(self):
+        """版が同じ間は作り直さず、版が変わったキーだけ作り直す"""
+        cache = VersionedCache(max_entries=2)
+        calls = []
+
+        def build(value):
+            def _build():
+                calls.append(value)
+                return value
+
+            return _build
+
+        self.assertEqual(cache.get_or_build("a", 1, build("a1")), "a1")
+        self.assertEqual(cache.get_or_build("a", 1, build("a1'")), "a1")
+        self.assertEqual(cache.get_or_build("a", 2, build("a2")), "a2")
+        self.assertEqual(calls, ["a1", "a2"])
+
+        # 上限を超えたら最も古く使われたキーから捨てる
+        cache.get_or_build("b", 1, build("b1"))
+        cache.get_or_build("a", 2, build("a2'"))
+        cache.get_or_build("c", 1, build("c1"))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_or_build("b", 1, build("b1'")), "b1'")
+
+
+def progress_result():
+    return SegmentProgress(
+        trip_id="T1",
+        train_number="1001T",
+        direction="Outbound",
+        prev_station_id=None,
+        next_station_id=None,
+        prev_seq=None,
+        next_seq=None,
+        now_ts=1760000000,
+        t0_departure=None,
+        t1_arrival=None,
+        progress=None,
+        status="unknown",
+    )
+
+
+STATIONS = [
+    {
+        "id": "Test.Line.A",
+        "railway": "Test.Line",
+        "title": {"ja": "エー", "en": "A"},
+        "coord": [139.7, 35.6],
+        "rank": "B",
+        "dwell_time": 20,
+    }
+]
+
+
+class TestStaticEndpointsETag(unittest.TestCase):
+    def setUp(self):
+        cache = main.data_cache
+        self.saved = (cache.railways, cache.station_rank_cache, main._static_responses)
+        cache.railways = [{"id": "Test.Line", "title": {"ja": "テスト線", "en": "Test"}, "stations": ["Test.Line.A"]}]
+        cache.station_rank_cache = {}
+        cache.data_version += 1
+        main._static_responses = VersionedCache()
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        cache = main.data_cache
+        cache.railways, cache.station_rank_cache, main._static_responses = self.saved
+        cache.data_version += 1
+
+    def test_lines_not_modified(self):
+        """路線一覧は ETag が一致すれば 304、max-age 付きで返す"""
+        response = self.client.get("/api/lines")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["lines"][0]["id"], "Test.Line")
+        self.assertEqual(response.headers["cache-control"], "public, max-age=300")
+
+        etag = response.headers["etag"]
+        cached = self.client.get("/api/lines", headers={"If-None-Match": etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+
+        detail = self.client.get("/api/lines/Test.Line")
+        self.assertEqual(detail.json()["name_ja"], "テスト線")
+        self.assertEqual(self.client.get("/api/lines/Test.Missing").status_code, 404)
+
+    def test_stations_revalidate_after_rank_update(self):
+        """駅一覧は DB を1回だけ引き、ランクが更新されると ETag が変わる"""
+        with mock.patch.object(main.data_cache, "get_stations_by_line", return_value=STATIONS) as query:
+            first = self.client.get("/api/stations", params={"lineId": "Test.Line"})
+            etag = first.headers["etag"]
+            self.assertEqual(first.headers["cache-control"], "no-cache")
+            cached = self.client.get("/api/stations", params={"lineId": "Test.Line"}, headers={"If-None-Match": etag})
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(query.call_count, 1)
+
+            main.data_cache.station_rank_cache["Test.Line.A"] = {"rank": "S", "dwell_time": 60}
+            main.data_cache.rank_version += 1
+            updated = self.client.get("/api/stations", params={"lineId": "Test.Line"}, headers={"If-None-Match": etag})
+            self.assertEqual(updated.status_code, 200)
+            self.assertNotEqual(updated.headers["etag"], etag)
+            self.assertEqual(updated.json()["stations"][0]["rank"], "S")
+
+
+class TestPositionsEndpointCache(unittest.TestCase):
+    def setUp(self):
+        time_mgr.set_virtual_time("2026-02-12T08:30:00+09:00")
+        self.saved_cache = main._positions_cache
+        main._positions_cache = MicroTTLCache(3600.0)
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        time_mgr.reset()
+        main._positions_cache = self.saved_cache
+
+    def test_repeated_requests_reuse_result(self):
+        """同じバケット内の繰り返しは再計算せず、仮想時刻を変えると別のキーになる"""
+        with (
+            mock.patch.object(mock_trip_generator, "generate_mock_schedules", return_value={"T1": object()}),
+            mock.patch.object(train_position_v4, "compute_all_progress", return_value=[progress_result()]) as compute,
+            mock.patch.object(train_position_v4, "calculate_coordinates", return_value=None),
+        ):
+            first = self.client.get("/api/trains/chuo_rapid/positions/v4")
+            second = self.client.get("/api/trains/chuo_rapid/positions/v4")
+            self.assertEqual(compute.call_count, 1)
+            self.assertEqual(first.content, second.content)
+
+            self.client.get("/api/trains/keihin_tohoku/positions/v4")
+            time_mgr.set_virtual_time("2026-02-12T09:30:00+09:00")
+            self.client.get("/api/trains/chuo_rapid/positions/v4")
+            self.assertEqual(compute.call_count, 3)
+
+    def test_not_modified_within_bucket(self):
+        """同じバケット内で ETag が一致すれば、本文を作り直さず 304 を返す"""
+        with (
+            mock.patch.object(mock_trip_generator, "generate_mock_schedules", return_value={"T1": object()}),
+            mock.patch.object(train_position_v4, "compute_all_progress", return_value=[progress_result()]) as compute,
+            mock.patch.object(train_position_v4, "calculate_coordinates", return_value=None),
+        ):
+            first = self.client.get("/api/trains/chuo_rapid/positions/v4")
+            self.assertEqual(first.headers["cache-control"], "no-cache")
+            cached = self.client.get(
+                "/api/trains/chuo_rapid/positions/v4", headers={"If-None-Match": first.headers["etag"]}
+            )
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(compute.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+# backend/tests/test_schedule_columns.py
+"""
+列指向の駅時刻テーブル (ScheduleColumns) のテスト
+
+従来の {seq: RealtimeStationSchedule} 形式との互換ビューと、
+プロセス間受け渡し (pickle) で内容が保たれるかを検証する。
+駅IDの interning (StringTable) は複数スレッドから同時に呼んでも壊れないことを検証する。
+"""
+
+import pickle
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from gtfs_rt_tripupdate import MISSING, RealtimeStationSchedule, ScheduleColumns, StringTable, TrainSchedule
+
+
+def make_schedule():
+    return TrainSchedule(
+        trip_id="4201301G",
+        train_number="301G",
+        start_date="20240101",
+        direction="OuterLoop",
+        feed_timestamp=1700000000,
+        ordered_sequences=[1, 2, 5],
+        schedules_by_seq={
+            5: RealtimeStationSchedule(
+                stop_sequence=5,
+                station_id=None,
+                arrival_time=1300,
+                departure_time=None,
+                resolved=False,
+                raw_stop_id="Unknown",
+            ),
+            1: RealtimeStationSchedule(
+                stop_sequence=1,
+                station_id="JR-East.Yamanote.Tokyo",
+                arrival_time=None,
+                departure_time=1030,
+                resolved=True,
+                raw_stop_id="Tokyo",
+            ),
+            2: RealtimeStationSchedule(
+                stop_sequence=2,
+                station_id="JR-East.Yamanote.Kanda",
+                arrival_time=1100,
+                departure_time=1120,
+                resolved=True,
+                raw_stop_id="Kanda",
+                delay=60,
+            ),
+        },
+    )
+
+
+class TestScheduleColumns(unittest.TestCase):
+    def test_compat_view_matches_original_rows(self):
+        """互換ビューが従来の schedules_by_seq / ordered_sequences と同じ内容を返す"""
+        schedule = make_schedule()
+
+        self.assertEqual(schedule.ordered_sequences, [1, 2, 5])
+        self.assertEqual(list(schedule.schedules_by_seq), [1, 2, 5])
+        self.assertEqual(len(schedule.schedules_by_seq), 3)
+        self.assertIsNone(schedule.schedules_by_seq.get(3))
+        self.assertEqual(
+            schedule.schedules_by_seq[2],
+            RealtimeStationSchedule(
+                stop_sequence=2,
+                station_id="JR-East.Yamanote.Kanda",
+                arrival_time=1100,
+                departure_time=1120,
+                resolved=True,
+                raw_stop_id="Kanda",
+                delay=60,
+            ),
+        )
+        self.assertIsNone(schedule.schedules_by_seq[1].arrival_time)
+        self.assertIsNone(schedule.schedules_by_seq[5].station_id)
+        self.assertFalse(schedule.schedules_by_seq[5].resolved)
+
+    def test_columns_store_missing_as_sentinel(self):
+        """欠損値は MISSING として列に格納される"""
+        columns = make_schedule().columns
+
+        self.assertEqual(columns.column(ScheduleColumns.ARRIVAL).tolist(), [MISSING, 1100, 1300])
+        self.assertEqual(columns.column(ScheduleColumns.DEPARTURE).tolist(), [1030, 1120, MISSING])
+        self.assertEqual(columns.value(ScheduleColumns.STATION, 2), MISSING)
+        self.assertEqual(columns.index_of(5), 2)
+        self.assertEqual(columns.index_of(4), -1)
+
+    def test_pickle_round_trip(self):
+        """pickle 後も同じ内容になる（プロセスプールからの受け渡し）"""
+        schedule = make_schedule()
+        restored = pickle.loads(pickle.dumps(schedule))
+
+        self.assertEqual(restored, schedule)
+        self.assertEqual(restored.schedules_by_seq[2].station_id, "JR-East.Yamanote.Kanda")
+
+    def test_with_feed_timestamp_shares_columns(self):
+        """feed_timestamp の差し替えでは列を複製しない"""
+        schedule = make_schedule()
+        updated = schedule.with_feed_timestamp(1700000030)
+
+        self.assertEqual(updated.feed_timestamp, 1700000030)
+        self.assertIs(updated.columns, schedule.columns)
+        self.assertEqual(schedule.feed_timestamp, 1700000000)
+
+
+class TestStringTable(unittest.TestCase):
+    def test_concurrent_intern(self):
+        """複数スレッドが同時に別々・同じ文字列を登録しても、インデックスは一意で正しい文字列を引ける"""
+        table = StringTable()
+        values = [f"JR-East.Line{i % 7}.Station{i}" for i in range(2000)]
+
+        def worker(offset):
+            ordered = values[offset:] + values[:offset]
+            return {value: table.intern(value) for value in ordered}
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # スレッドの切り替えを増やして競合を起こしやすくする
+        try:
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(worker, range(0, 2000, 250)))
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(len(table), len(values))
+        for result in results:
+            self.assertEqual(result, results[0])
+        for value, index in results[0].items():
+            self.assertEqual(table.lookup(index), value)
+        self.assertEqual(sorted(results[0].values()), list(range(len(values))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+# backend/tests/test_shape_store.py
+"""
+事前コンパイル済み線路形状ストア (shape_store) と /api/shapes のテスト
+"""
+
+import gzip
+import json
+import math
+import os
+import unittest
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+from geometry import simplify_douglas_peucker
+from shape_store import ShapeStore, build_shape_entry, tolerance_for_zoom
+
+COORDINATES = {
+    "railways": [
+        {
+            "id": "Test.Shape",
+            "color": "#80C241",
+            "sublines": [
+                {"type": "main", "coords": [[139.70, 35.60], [139.71, 35.61]]},
+                {"type": "main", "coords": [[139.71, 35.61], [139.72, 35.62]]},
+            ],
+        },
+        {"id": "Test.Empty", "sublines": []},
+    ]
+}
+
+
+class TestShapeStore(unittest.TestCase):
+    def test_body_is_pre_encoded_feature_collection(self):
+        """マージ済み座標の FeatureCollection が JSON バイト列として保持される"""
+        shape = ShapeStore.build(COORDINATES).get("Test.Shape").level().response
+
+        self.assertEqual(
+            json.loads(shape.body),
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "LineString",
+                            "coordinates": [[139.70, 35.60], [139.71, 35.61], [139.72, 35.62]],
+                        },
+                        "properties": {"line_id": "Test.Shape", "color": "#80C241", "segment_type": "main"},
+                    }
+                ],
+            },
+        )
+        self.assertEqual(gzip.decompress(shape.gzip_body), shape.body)
+        self.assertTrue(shape.etag.startswith('"') and shape.etag.endswith('"'))
+
+    def test_empty_lines_are_known_but_not_stored(self):
+        """座標が空の路線はエントリを持たないが、coordinates.json に存在することは分かる"""
+        store = ShapeStore.build(COORDINATES)
+
+        self.assertNotIn("Test.Empty", store)
+        self.assertIn("Test.Empty", store.known_ids)
+        self.assertIsNone(store.coords("Test.Empty"))
+
+    def test_select_encoding(self):
+        """Accept-Encoding に応じて圧縮済みの本文を選ぶ"""
+        shape = ShapeStore.build(COORDINATES).get("Test.Shape").level().response
+
+        self.assertEqual(shape.select("gzip, deflate"), (shape.gzip_body, "gzip"))
+        self.assertEqual(shape.select("gzip;q=0, identity"), (shape.body, None))
+        self.assertEqual(shape.select(None), (shape.body, None))
+
+
+def zigzag(n=200):
+    """東西に約 5.6km、南北に ±約 22m 振れる折れ線"""
+    return [[139.70 + i * 0.0003, 35.60 + (0.0002 if i % 2 else -0.0002)] for i in range(n)]
+
+
+class TestLevelOfDetail(unittest.TestCase):
+    def test_douglas_peucker(self):
+        """許容誤差より小さい振れ幅の頂点は間引かれ、始点・終点は残る"""
+        coords = zigzag()
+
+        self.assertEqual(simplify_douglas_peucker(coords, 0.0), coords)
+        self.assertEqual(len(simplify_douglas_peucker(coords, 10.0)), len(coords))
+        self.assertEqual(simplify_douglas_peucker(coords, 100.0), [coords[0], coords[-1]])
+
+    def test_level_selection(self):
+        """許容誤差を超えない範囲で最も粗いレベルを選ぶ"""
+        entry = build_shape_entry("Test.Zigzag", zigzag(), "#000000", tolerances=(0.0, 10.0, 100.0))
+
+        # 10m では間引けないのでレベルは 0m と 100m の2つ
+        self.assertEqual([level.tolerance for level in entry.levels], [0.0, 100.0])
+        self.assertEqual(len(entry.level(0.0).coords), 200)
+        self.assertEqual(len(entry.level(50.0).coords), 200)
+        self.assertEqual(len(entry.level(math.inf).coords), 2)
+
+    def test_tolerance_for_zoom(self):
+        """ズームアウトするほど許容誤差が大きくなる（1段で2倍）"""
+        self.assertAlmostEqual(tolerance_for_zoom(8) / tolerance_for_zoom(9), 2.0)
+        self.assertLess(tolerance_for_zoom(16), 1.0)
+
+
+class TestShapesEndpoint(unittest.TestCase):
+    def setUp(self):
+        cache = main.data_cache
+        self.saved = (cache.railways, cache.coordinates, cache.railway_index, cache.shape_store)
+        cache.railways = [{"id": "Test.Shape"}, {"id": "Test.Empty"}]
+        cache.coordinates = COORDINATES
+        cache.railway_index = None
+        cache.shape_store = None
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        cache = main.data_cache
+        cache.railways, cache.coordinates, cache.railway_index, cache.shape_store = self.saved
+
+    def test_returns_pre_encoded_bytes_with_etag(self):
+        """事前エンコード済みのバイト列を ETag 付きで返し、If-None-Match で 304 になる"""
+        response = self.client.get("/api/shapes", params={"lineId": "Test.Shape"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.json()["features"][0]["properties"]["line_id"], "Test.Shape")
+
+        etag = response.headers["etag"]
+        cached = self.client.get("/api/shapes", params={"lineId": "Test.Shape"}, headers={"If-None-Match": etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+
+    def test_zoom_and_multi_line(self):
+        """zoom で間引いたレベルを返し、lineIds で複数路線をまとめて返す"""
+        full = self.client.get("/api/shapes", params={"lineId": "Test.Shape"}).json()
+        coarse = self.client.get("/api/shapes", params={"lineId": "Test.Shape", "zoom": 4}).json()
+        self.assertEqual(len(full["features"][0]["geometry"]["coordinates"]), 3)
+        self.assertEqual(len(coarse["features"][0]["geometry"]["coordinates"]), 2)
+
+        multi = self.client.get("/api/shapes", params={"lineIds": "Test.Shape,Test.Shape", "tolerance": 0})
+        self.assertEqual(multi.status_code, 200)
+        self.assertEqual(multi.json()["features"], full["features"])
+
+        missing = self.client.get("/api/shapes", params={"lineIds": "Test.Shape,Test.Unknown"})
+        self.assertEqual(missing.status_code, 404)
+
+    def test_not_found(self):
+        """未知の路線・座標が空の路線は 404"""
+        self.assertEqual(self.client.get("/api/shapes", params={"lineId": "Test.Unknown"}).status_code, 404)
+        self.assertEqual(self.client.get("/api/shapes", params={"lineId": "Test.Empty"}).status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# backend/tests/test_spatial_index.py
+"""
+線路頂点の空間インデックス (spatial_index) のテスト
+
+グリッドによる絞り込みの結果が、全点の線形走査と同じになることを検証する。
+"""
+
+import math
+import random
+import unittest
+
+from spatial_index import GridIndex, RailwayIndex, squared_degree_distance
+
+
+def random_track(rng, n, lon=139.70, lat=35.65):
+    coords = []
+    for _ in range(n):
+        lon += rng.uniform(-0.002, 0.004)
+        lat += rng.uniform(-0.002, 0.004)
+        coords.append((lon, lat))
+    return coords
+
+
+def brute_force(index, coords, lon, lat):
+    x, y = index.project(lon, lat)
+    result = []
+    for i, (c_lon, c_lat) in enumerate(coords):
+        px, py = index.project(c_lon, c_lat)
+        result.append((math.hypot(px - x, py - y), i))
+    return sorted(result)
+
+
+class TestGridIndex(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(42)
+        self.coords = random_track(self.rng, 400)
+        self.index = GridIndex.from_coords(self.coords)
+
+    def queries(self, n=100):
+        for _ in range(n):
+            base = self.rng.choice(self.coords)
+            yield base[0] + self.rng.uniform(-0.02, 0.02), base[1] + self.rng.uniform(-0.02, 0.02)
+        # 点列から遠い点（全点走査への切り替え）
+        yield 140.5, 36.5
+
+    def test_nearest_matches_linear_scan(self):
+        """k 近傍が全点走査と一致する"""
+        for lon, lat in self.queries():
+            expected = brute_force(self.index, self.coords, lon, lat)[:5]
+            got = self.index.nearest(lon, lat, k=5)
+            self.assertEqual([key for _, key in got], [key for _, key in expected])
+            for (d, _), (e, _) in zip(got, expected):
+                self.assertAlmostEqual(d, e, places=6)
+
+    def test_within_matches_linear_scan(self):
+        """半径内検索が全点走査と一致する"""
+        for lon, lat in self.queries():
+            for radius in (0.0, 120.0, 800.0):
+                expected = [key for d, key in brute_force(self.index, self.coords, lon, lat) if d <= radius]
+                self.assertEqual([key for _, key in self.index.within(lon, lat, radius)], expected)
+
+    def test_within_bbox_matches_linear_scan(self):
+        """矩形内検索が全点走査と一致する（境界を含み、登録順に並ぶ）"""
+        for lon, lat in self.queries(50):
+            for half in (0.0005, 0.01, 0.2):
+                bbox = (lon - half, lat - half * 0.8, lon + half, lat + half * 0.8)
+                expected = [
+                    i
+                    for i, (c_lon, c_lat) in enumerate(self.coords)
+                    if bbox[0] <= c_lon <= bbox[2] and bbox[1] <= c_lat <= bbox[3]
+                ]
+                self.assertEqual(self.index.within_bbox(*bbox), expected)
+        self.assertEqual(self.index.within_bbox(*self.coords[7], *self.coords[7]), [7])
+        self.assertEqual(self.index.within_bbox(139.8, 35.7, 139.7, 35.8), [])
+
+    def test_nearest_by_degrees_matches_legacy_scan(self):
+        """度単位の最近傍が既存の線形探索（同距離は先頭の頂点）と一致する"""
+        coords = self.coords + [self.coords[10]]  # 重複頂点
+        index = GridIndex.from_coords(coords)
+        for lon, lat in list(self.queries()) + [self.coords[10]]:
+            expected = min(range(len(coords)), key=lambda i: (squared_degree_distance(lon, lat, *coords[i]), i))
+            self.assertEqual(index.nearest_by_degrees(lon, lat), expected)
+
+    def test_empty_index(self):
+        """点が無いインデックスは空の結果を返す"""
+        index = GridIndex()
+        self.assertEqual(index.nearest(139.7, 35.6, k=3), [])
+        self.assertEqual(index.within(139.7, 35.6, 1000.0), [])
+        self.assertEqual(index.within_bbox(139.6, 35.5, 139.8, 35.7), [])
+        self.assertIsNone(index.nearest_key(139.7, 35.6))
+
+
+class TestRailwayIndex(unittest.TestCase):
+    def test_per_line_and_cross_line_queries(self):
+        """路線指定では頂点インデックス、路線横断では (路線ID, 頂点インデックス) を返す"""
+        coordinates = {
+            "railways": [
+                {"id": "Line.A", "sublines": [{"coords": [[139.700, 35.600], [139.701, 35.600]]}]},
+                {"id": "Line.B", "sublines": [{"coords": [[139.7005, 35.6002], [139.710, 35.610]]}]},
+            ]
+        }
+        index = RailwayIndex.from_coordinates(coordinates)
+
+        self.assertIn("Line.A", index)
+        self.assertEqual([key for _, key in index.nearest(139.7004, 35.6002, railway_id="Line.A")], [0])
+        self.assertEqual(
+            [key for _, key in index.nearest(139.7004, 35.6002, k=2)],
+            [("Line.B", 0), ("Line.A", 0)],
+        )
+        self.assertEqual([key for _, key in index.within(139.7004, 35.6002, 50.0, railway_id="Line.B")], [0])
+        self.assertEqual(index.nearest(139.7, 35.6, railway_id="Line.Unknown"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
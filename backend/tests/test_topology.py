@@ -0,0 +1,129 @@
+# backend/tests/test_topology.py
+"""
+線路形状のトポロジー (topology) と /api/shapes/topology のテスト
+
+共有区間が1本のアークにまとまり、TopoJSON をデコードすると元の座標に戻ることを検証する。
+"""
+
+import os
+import unittest
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+
+import main
+from shape_store import ShapeStore
+from topology import OBJECT_NAME, Topology
+
+# Line.A と Line.B は中央の3頂点（B は逆向き）を共有し、Line.C は独立
+SHARED = [[139.71, 35.61], [139.72, 35.62], [139.73, 35.63]]
+COORDINATES = {
+    "railways": [
+        {
+            "id": "Line.A",
+            "color": "#111111",
+            "sublines": [{"type": "main", "coords": [[139.70, 35.60]] + SHARED + [[139.74, 35.60]]}],
+        },
+        {
+            "id": "Line.B",
+            "color": "#222222",
+            "sublines": [{"type": "main", "coords": [[139.75, 35.65]] + SHARED[::-1] + [[139.70, 35.65]]}],
+        },
+        {
+            "id": "Line.C",
+            "color": "#333333",
+            "sublines": [{"type": "main", "coords": [[139.80, 35.70], [139.81, 35.71]]}],
+        },
+    ]
+}
+
+
+def decode(topojson):
+    """TopoJSON を {路線ID: [(lon, lat), ...]} に戻す"""
+    (sx, sy), (tx, ty) = topojson["transform"]["scale"], topojson["transform"]["translate"]
+    arcs = []
+    for arc in topojson["arcs"]:
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x, y = x + dx, y + dy
+            points.append((x * sx + tx, y * sy + ty))
+        arcs.append(points)
+
+    lines = {}
+    for geometry in topojson["objects"][OBJECT_NAME]["geometries"]:
+        points = []
+        for ref in geometry["arcs"]:
+            arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+            points += arc if not points else arc[1:]
+        lines[geometry["id"]] = points
+    return lines
+
+
+class TestTopology(unittest.TestCase):
+    def setUp(self):
+        self.store = ShapeStore.build(COORDINATES)
+        self.topology = Topology.build(self.store)
+
+    def test_shared_section_is_one_arc(self):
+        """共有区間は1本のアークになり、逆向きの路線は ~i で参照する"""
+        a, b = self.topology.lines["Line.A"].arcs, self.topology.lines["Line.B"].arcs
+        self.assertEqual(len(a), 3)
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b[1], ~a[1])
+        self.assertEqual(self.topology.arcs[a[1]], [tuple(p) for p in SHARED])
+        self.assertEqual(len(self.topology.arcs), 6)
+
+    def test_round_trip(self):
+        """デコードすると量子化誤差の範囲で元の座標に戻り、使われないアークは含まれない"""
+        topojson = self.topology.to_topojson(["Line.B", "Line.A"])
+        self.assertEqual(len(topojson["arcs"]), 5)
+
+        for line_id, points in decode(topojson).items():
+            expected = self.store.coords(line_id)
+            self.assertEqual(len(points), len(expected))
+            for (lon, lat), (e_lon, e_lat) in zip(points, expected):
+                self.assertAlmostEqual(lon, e_lon, places=6)
+                self.assertAlmostEqual(lat, e_lat, places=6)
+
+    def test_simplified_arcs_keep_junctions(self):
+        """間引いても分岐点（アークの端点）は残る"""
+        lines = decode(self.topology.to_topojson(["Line.A", "Line.B"], tolerance=1e6))
+        self.assertEqual(len(lines["Line.A"]), 4)
+        self.assertAlmostEqual(lines["Line.A"][1][0], SHARED[0][0], places=6)
+        self.assertAlmostEqual(lines["Line.A"][2][0], SHARED[-1][0], places=6)
+
+
+class TestTopologyEndpoint(unittest.TestCase):
+    def setUp(self):
+        cache = main.data_cache
+        self.saved = (cache.railways, cache.shape_store, cache.shape_topology)
+        cache.railways = [{"id": "Line.A"}, {"id": "Line.B"}, {"id": "Line.C"}]
+        cache.shape_store = ShapeStore.build(COORDINATES)
+        cache.shape_topology = None
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        cache = main.data_cache
+        cache.railways, cache.shape_store, cache.shape_topology = self.saved
+
+    def test_selected_lines(self):
+        """lineIds で指定した路線だけを ETag 付きで返す"""
+        response = self.client.get("/api/shapes/topology", params={"lineIds": "Line.A,Line.C"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(decode(response.json())), ["Line.A", "Line.C"])
+
+        cached = self.client.get(
+            "/api/shapes/topology",
+            params={"lineIds": "Line.A,Line.C"},
+            headers={"If-None-Match": response.headers["etag"]},
+        )
+        self.assertEqual(cached.status_code, 304)
+
+        missing = self.client.get("/api/shapes/topology", params={"lineIds": "Line.A,Line.Unknown"})
+        self.assertEqual(missing.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# backend/tests/test_track_geometry.py
+"""
+線形参照ジオメトリ (track_geometry) のテスト
+
+累積距離の二分探索によるスナップが、従来の「駅間パスを切り出して
+先頭から距離を積み上げる」方式と同じ座標・方位角になることを検証する。
+"""
+
+import random
+import unittest
+
+from projection import segment_metrics
+from track_geometry import LineGeometry, build_line_geometry
+from train_position_v4 import SegmentProgress, calculate_coordinates
+
+LINE_ID = "Test.TrackGeometry"
+
+# 重複頂点（区間長0の辺）を含む折れ線
+TRACK = [
+    (139.700, 35.600),
+    (139.702, 35.603),
+    (139.702, 35.603),
+    (139.706, 35.605),
+    (139.710, 35.611),
+    (139.711, 35.618),
+    (139.715, 35.620),
+    (139.715, 35.620),
+    (139.720, 35.624),
+]
+
+STATIONS = {
+    "Test.TrackGeometry.A": (139.7001, 35.6001),
+    "Test.TrackGeometry.B": (139.7099, 35.6110),
+    "Test.TrackGeometry.C": (139.7150, 35.6201),
+    "Test.TrackGeometry.D": (139.7199, 35.6239),
+    "Test.TrackGeometry.Far": (139.800, 35.700),  # 線路から500m以上離れた駅
+}
+
+
+class FakeCache:
+    def __init__(self):
+        self.coordinates = {"railways": [{"id": LINE_ID, "sublines": [{"type": "main", "coords": TRACK}]}]}
+        self.railways = [{"id": LINE_ID, "stations": list(STATIONS)}]
+        self.station_positions = dict(STATIONS)
+        self.line_geometries = {}
+
+    def get_station_coord(self, station_id):
+        return self.station_positions.get(station_id)
+
+
+def reference_snap(coords, idx_prev, idx_next, progress):
+    """従来方式: 駅間パスを切り出して距離を先頭から積み上げ、線形探索する"""
+    path = coords[idx_prev : idx_next + 1] if idx_prev < idx_next else coords[idx_next : idx_prev + 1][::-1]
+    dists, bearings, _ = segment_metrics([p[0] for p in path], [p[1] for p in path])
+    target = dists[-1] * progress
+    found = next(i for i in range(len(dists) - 1) if dists[i] <= target <= dists[i + 1])
+    p_start, p_end = path[found], path[found + 1]
+    bearing = bearings[found]
+    seg_len = dists[found + 1] - dists[found]
+    if seg_len <= 0:
+        return (p_start[1], p_start[0], bearing)
+    ratio = (target - dists[found]) / seg_len
+    return (
+        p_start[1] + (p_end[1] - p_start[1]) * ratio,
+        p_start[0] + (p_end[0] - p_start[0]) * ratio,
+        bearing,
+    )
+
+
+def running(prev_station_id, next_station_id, progress):
+    return SegmentProgress(
+        trip_id="T1",
+        train_number="1G",
+        direction=None,
+        status="running",
+        progress=progress,
+        prev_station_id=prev_station_id,
+        next_station_id=next_station_id,
+        prev_seq=1,
+        next_seq=2,
+        now_ts=0,
+        t0_departure=None,
+        t1_arrival=None,
+    )
+
+
+class TestLineGeometry(unittest.TestCase):
+    def test_interpolate_matches_path_walk(self):
+        """累積距離の二分探索が従来のパス走査と同じ結果になる（順方向・逆方向）"""
+        geometry = LineGeometry.from_coords(LINE_ID, TRACK)
+        for station_id in STATIONS:
+            geometry.add_station(station_id, STATIONS[station_id])
+
+        rng = random.Random(7)
+        progresses = [0.0, 1.0] + [rng.random() for _ in range(50)]
+        on_track = [s for s in STATIONS if geometry.stations[s].on_track]
+        for prev_id in on_track:
+            for next_id in on_track:
+                prev, nxt = geometry.stations[prev_id], geometry.stations[next_id]
+                if prev.vertex == nxt.vertex:
+                    continue
+                for progress in progresses:
+                    got = geometry.interpolate(prev, nxt, progress)
+                    expected = reference_snap(TRACK, prev.vertex, nxt.vertex, progress)
+                    for g, e in zip(got, expected):
+                        self.assertAlmostEqual(g, e, places=9, msg=(prev_id, next_id, progress))
+
+    def test_station_chainage(self):
+        """駅は最寄り頂点の累積距離に対応付けられ、遠い駅は None になる"""
+        geometry = build_line_geometry(FakeCache(), LINE_ID)
+
+        self.assertEqual(geometry.station_chainage("Test.TrackGeometry.A"), 0.0)
+        self.assertEqual(geometry.station_chainage("Test.TrackGeometry.D"), geometry.length)
+        self.assertIsNone(geometry.station_chainage("Test.TrackGeometry.Far"))
+        self.assertIsNone(geometry.station_chainage("Unknown"))
+
+
+class TestCalculateCoordinatesWithGeometry(unittest.TestCase):
+    def test_far_station_falls_back_to_linear(self):
+        """線路から遠い駅を含む区間は駅間の直線補間になる"""
+        cache = FakeCache()
+        lat, lon, _ = calculate_coordinates(
+            running("Test.TrackGeometry.A", "Test.TrackGeometry.Far", 0.5), cache, LINE_ID
+        )
+
+        self.assertAlmostEqual(lon, (139.7001 + 139.800) / 2)
+        self.assertAlmostEqual(lat, (35.6001 + 35.700) / 2)
+
+    def test_unlisted_station_is_registered_on_demand(self):
+        """路線の駅リストに無い駅は初回のスナップ時に対応付けて再利用する"""
+        cache = FakeCache()
+        cache.station_positions["Other.Line.X"] = (139.7101, 35.6181)
+
+        result = calculate_coordinates(running("Test.TrackGeometry.A", "Other.Line.X", 0.5), cache, LINE_ID)
+
+        geometry = cache.line_geometries[LINE_ID]
+        self.assertEqual(geometry.stations["Other.Line.X"].vertex, 5)
+        expected = reference_snap(TRACK, 0, 5, 0.5)
+        for g, e in zip(result, expected):
+            self.assertAlmostEqual(g, e, places=9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+# backend/tests/test_vector_tiles.py
+"""
+ベクタータイル (vector_tiles) と /tiles/{z}/{x}/{y}.mvt のテスト
+
+エンコード結果は vector_tile.proto の定義から組み立てた protobuf メッセージで
+デコードして検証する。
+"""
+
+import asyncio
+import gzip
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("ODPT_API_KEY", "ci_dummy_key")
+
+from fastapi.testclient import TestClient
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+import main
+from shape_store import ShapeStore
+from vector_tiles import (
+    LAYER_RAIL,
+    LAYER_STATIONS,
+    MVT_MEDIA_TYPE,
+    TILE_EXTENT,
+    TileCache,
+    TileSource,
+    clip_polyline,
+    is_valid_tile,
+    lonlat_to_mercator,
+    tile_for_lonlat,
+)
+
+COORDINATES = {
+    "railways": [
+        {
+            "id": "Test.Tile",
+            "color": "#80C241",
+            "sublines": [{"type": "main", "coords": [[139.700, 35.650], [139.760, 35.690], [139.800, 35.700]]}],
+        },
+        {
+            "id": "Test.Far",
+            "color": "#000000",
+            "sublines": [{"type": "main", "coords": [[140.500, 36.500], [140.510, 36.510]]}],
+        },
+    ]
+}
+
+STATIONS = [
+    {"id": "Test.Tile.A", "line_id": "Test.Tile", "name_ja": "駅A", "name_en": "A", "lon": 139.7601, "lat": 35.6901},
+    {"id": "Test.Tile.B", "line_id": "Test.Tile", "name_ja": "駅B", "name_en": None, "lon": 139.70, "lat": 35.65},
+]
+
+
+def _vector_tile_class():
+    """vector_tile.proto (v2) の Tile メッセージクラスを組み立てる"""
+    T = descriptor_pb2.FieldDescriptorProto
+    file_proto = descriptor_pb2.FileDescriptorProto(name="test_vector_tile.proto", package="test_vector_tile")
+    tile = file_proto.message_type.add(name="Tile")
+
+    def field(message, name, number, field_type, label=T.LABEL_OPTIONAL, type_name=None, packed=False):
+        f = message.field.add(name=name, number=number, type=field_type, label=label)
+        if type_name:
+            f.type_name = type_name
+        if packed:
+            f.options.packed = True
+
+    value = tile.nested_type.add(name="Value")
+    field(value, "string_value", 1, T.TYPE_STRING)
+    field(value, "double_value", 3, T.TYPE_DOUBLE)
+    field(value, "uint_value", 5, T.TYPE_UINT64)
+    field(value, "sint_value", 6, T.TYPE_SINT64)
+    field(value, "bool_value", 7, T.TYPE_BOOL)
+
+    feature = tile.nested_type.add(name="Feature")
+    field(feature, "id", 1, T.TYPE_UINT64)
+    field(feature, "tags", 2, T.TYPE_UINT32, T.LABEL_REPEATED, packed=True)
+    field(feature, "type", 3, T.TYPE_UINT32)
+    field(feature, "geometry", 4, T.TYPE_UINT32, T.LABEL_REPEATED, packed=True)
+
+    layer = tile.nested_type.add(name="Layer")
+    field(layer, "version", 15, T.TYPE_UINT32)
+    field(layer, "name", 1, T.TYPE_STRING)
+    field(layer, "features", 2, T.TYPE_MESSAGE, T.LABEL_REPEATED, ".test_vector_tile.Tile.Feature")
+    field(layer, "keys", 3, T.TYPE_STRING, T.LABEL_REPEATED)
+    field(layer, "values", 4, T.TYPE_MESSAGE, T.LABEL_REPEATED, ".test_vector_tile.Tile.Value")
+    field(layer, "extent", 5, T.TYPE_UINT32)
+
+    field(tile, "layers", 3, T.TYPE_MESSAGE, T.LABEL_REPEATED, ".test_vector_tile.Tile.Layer")
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName("test_vector_tile.Tile"))
+
+
+Tile = _vector_tile_class()
+
+
+def decode_tile(body):
+    """{レイヤー名: [(properties, 部分線のリスト)]} にデコードする"""
+    tile = Tile.FromString(body)
+    layers = {}
+    for layer in tile.layers:
+        assert layer.version == 2 and layer.extent == TILE_EXTENT
+        features = []
+        for feature in layer.features:
+            properties = {}
+            for k, v in zip(feature.tags[::2], feature.tags[1::2]):
+                value = layer.values[v]
+                properties[layer.keys[k]] = value.string_value if value.HasField("string_value") else value.uint_value
+            features.append((properties, decode_geometry(feature.geometry)))
+        layers[layer.name] = features
+    return layers
+
+
+def decode_geometry(geometry):
+    parts, x, y, i = [], 0, 0, 0
+    while i < len(geometry):
+        command, count = geometry[i] & 0x7, geometry[i] >> 3
+        i += 1
+        if command == 1:
+            parts.append([])
+        for _ in range(count):
+            dx, dy = geometry[i], geometry[i + 1]
+            x += (dx >> 1) ^ -(dx & 1)
+            y += (dy >> 1) ^ -(dy & 1)
+            parts[-1].append((x, y))
+            i += 2
+    return parts
+
+
+def tile_coord(lon, lat, z, x, y):
+    mx, my = lonlat_to_mercator(lon, lat)
+    return round((mx * 2**z - x) * TILE_EXTENT), round((my * 2**z - y) * TILE_EXTENT)
+
+
+class TestTileMath(unittest.TestCase):
+    def test_tile_for_lonlat(self):
+        """東京駅を含むタイル番号と範囲チェック"""
+        self.assertEqual(tile_for_lonlat(139.767, 35.681, 10), (909, 403))
+        self.assertEqual(tile_for_lonlat(0.0, 0.0, 0), (0, 0))
+        self.assertTrue(is_valid_tile(10, 909, 403))
+        self.assertFalse(is_valid_tile(2, 4, 0))
+        self.assertFalse(is_valid_tile(-1, 0, 0))
+
+    def test_clip_polyline(self):
+        """範囲を出入りするたびに部分線に分かれ、範囲外の線は捨てられる"""
+        xs = [-10.0, 50.0, 150.0, 50.0]
+        ys = [50.0, 50.0, 50.0, 80.0]
+        self.assertEqual(clip_polyline(xs, ys, 0, 100), [[(0, 50), (50, 50), (100, 50)], [(100, 65), (50, 80)]])
+        self.assertEqual(clip_polyline([200.0, 300.0], [0.0, 0.0], 0, 100), [])
+
+
+class TestTileSource(unittest.TestCase):
+    def setUp(self):
+        self.source = TileSource.build(ShapeStore.build(COORDINATES), STATIONS)
+
+    def test_rail_and_station_layers(self):
+        """タイルに含まれる路線・駅だけがタイル内座標でエンコードされる"""
+        z = 12
+        x, y = tile_for_lonlat(139.7601, 35.6901, z)
+        layers = decode_tile(self.source.render(z, x, y))
+
+        self.assertEqual([props["line_id"] for props, _ in layers[LAYER_RAIL]], ["Test.Tile"])
+        props, parts = layers[LAYER_RAIL][0]
+        self.assertEqual(props["color"], "#80C241")
+        self.assertIn(tile_coord(139.760, 35.690, z, x, y), parts[0])
+
+        self.assertEqual(len(layers[LAYER_STATIONS]), 1)
+        props, parts = layers[LAYER_STATIONS][0]
+        self.assertEqual(props, {"id": "Test.Tile.A", "line_id": "Test.Tile", "name_ja": "駅A", "name_en": "A"})
+        self.assertEqual(parts, [[tile_coord(139.7601, 35.6901, z, x, y)]])
+
+    def test_low_zoom_and_empty_tiles(self):
+        """広域のタイルに駅は含まれず、何も無いタイルは空になる"""
+        layers = decode_tile(self.source.render(5, *tile_for_lonlat(139.76, 35.69, 5)))
+        self.assertEqual(sorted(props["line_id"] for props, _ in layers[LAYER_RAIL]), ["Test.Far", "Test.Tile"])
+        self.assertNotIn(LAYER_STATIONS, layers)
+
+        self.assertEqual(self.source.render(12, 0, 0), b"")
+
+
+class CountingSource:
+    def __init__(self, source):
+        self.source = source
+        self.version = source.version
+        self.rendered = []
+        self.on_event_loop = []  # 生成がイベントループのスレッドで行われたか
+
+    def render(self, z, x, y):
+        self.rendered.append((z, x, y))
+        try:
+            asyncio.get_running_loop()
+            self.on_event_loop.append(True)
+        except RuntimeError:
+            self.on_event_loop.append(False)
+        return self.source.render(z, x, y)
+
+
+class TestTileCache(unittest.TestCase):
+    def setUp(self):
+        self.source = CountingSource(TileSource.build(ShapeStore.build(COORDINATES), STATIONS))
+
+    def test_memory_lru(self):
+        """同じタイルは再生成せず、上限を超えると最も古いタイルから捨てる"""
+        cache = TileCache(self.source, max_entries=2)
+        first = cache.get(5, 28, 12)
+        self.assertIs(cache.get(5, 28, 12), first)
+        cache.get(5, 0, 0)
+        cache.get(5, 1, 0)
+
+        self.assertEqual(len(cache), 2)
+        cache.get(5, 28, 12)
+        self.assertEqual(self.source.rendered, [(5, 28, 12), (5, 0, 0), (5, 1, 0), (5, 28, 12)])
+        self.assertEqual(gzip.decompress(first.gzip_body), first.body)
+
+    def test_disk_cache(self):
+        """ディスクに保存したタイルは別のキャッシュからも再生成せずに読める"""
+        with tempfile.TemporaryDirectory() as tmp:
+            body = TileCache(self.source, cache_dir=Path(tmp)).get(5, 28, 12).body
+            self.assertTrue((Path(tmp) / self.source.version / "5" / "28" / "12.mvt").exists())
+
+            other = CountingSource(self.source.source)
+            self.assertEqual(TileCache(other, cache_dir=Path(tmp)).get(5, 28, 12).body, body)
+            self.assertEqual(other.rendered, [])
+
+
+class TestTilesEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.saved = main.data_cache.tile_cache
+        main.data_cache.tile_cache = TileCache(TileSource.build(ShapeStore.build(COORDINATES), STATIONS))
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        main.data_cache.tile_cache = self.saved
+
+    def test_returns_tile_with_etag(self):
+        """MVT を gzip・ETag 付きで返し、If-None-Match で 304 になる"""
+        response = self.client.get("/tiles/5/28/12.mvt")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], MVT_MEDIA_TYPE)
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertIn(LAYER_RAIL, decode_tile(response.content))
+
+        cached = self.client.get("/tiles/5/28/12.mvt", headers={"If-None-Match": response.headers["etag"]})
+        self.assertEqual(cached.status_code, 304)
+
+    def test_renders_off_event_loop(self):
+        """メモリに無いタイルの生成はイベントループ外で行い、2回目以降はメモリから返す"""
+        source = CountingSource(main.data_cache.tile_cache.source)
+        main.data_cache.tile_cache = TileCache(source)
+
+        first = self.client.get("/tiles/5/28/12.mvt")
+        second = self.client.get("/tiles/5/28/12.mvt")
+
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(source.rendered, [(5, 28, 12)])
+        self.assertEqual(source.on_event_loop, [False])
+
+    def test_out_of_range(self):
+        """範囲外のタイル番号は 404"""
+        self.assertEqual(self.client.get("/tiles/2/4/0.mvt").status_code, 404)
+        self.assertEqual(self.client.get("/tiles/25/0/0.mvt").status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
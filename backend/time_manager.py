@@ -37,6 +37,11 @@ class TimeManager:
         """現在時刻を JST datetime で返す"""
         return datetime.fromtimestamp(self.now(), tz=JST)
 
+    @property
+    def offset_sec(self) -> int:
+        """real time からのオフセット（秒）。仮想時刻が無効なら 0"""
+        return self._offset_sec
+
     def is_virtual(self) -> bool:
         """仮想時刻モードかどうか"""
         return self._virtual
@@ -0,0 +1,230 @@
+# backend/topology.py
+"""
+線路形状のトポロジー（TopoJSON 形式、/api/shapes/topology 用）
+
+coordinates.json の type=sub のサブラインや Base.* 路線は、同じ物理的な線路を
+参照先の座標の切り出し（resolve_subline_coords）で共有している。
+路線ごとの GeoJSON を並べると共有区間の座標が路線の数だけ繰り返されるので、
+TopoJSON と同様に路線を分岐点で「アーク」に切り分けて共有区間を1本にまとめ、
+各路線はアーク番号の列で表す。
+
+- アークは ShapeStore のマージ済み座標（間引きなし）から起動後に1回だけ作る
+- 座標は整数に量子化し、アーク内は差分で表す
+- 詳細度はアークごとに Douglas-Peucker で間引く（端点=分岐点は必ず残るので、
+  共有区間は間引いた後も全路線で一致する）
+"""
+
+from __future__ import annotations
+
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from geometry import douglas_peucker_importance, simplify_douglas_peucker
+from shape_store import COLLECTION_GZIP_LEVEL, LOD_TOLERANCES, EncodedBody, ShapeStore, encode_json
+
+logger = logging.getLogger(__name__)
+
+# 量子化の分解能（全体の外接矩形の各辺をこの数で等分する）
+# 首都圏（経度3度程度）で 0.3m 程度の格子になる
+TOPOLOGY_QUANTIZATION = 1_000_000
+
+# TopoJSON の objects のキー
+OBJECT_NAME = "railways"
+
+# リクエスト時にエンコードした路線の組み合わせを保持する数
+ENCODED_CACHE_SIZE = 64
+
+Point = Tuple[float, float]
+
+
+# ============================================================================
+# Topology Construction
+# ============================================================================
+
+
+def _dedupe(coords: Iterable[Iterable[float]]) -> List[Point]:
+    """連続する重複頂点を除いた (lon, lat) のタプル列"""
+    points: List[Point] = []
+    for lon, lat in coords:
+        point = (lon, lat)
+        if not points or points[-1] != point:
+            points.append(point)
+    return points
+
+
+def find_junctions(lines: List[List[Point]]) -> set[Point]:
+    """
+    アークの切れ目になる頂点（TopoJSON の join）を求める。
+
+    路線の端点と、同じ頂点を通る路線どうしで前後の頂点が一致しない頂点（分岐・合流点）が切れ目になる。
+    """
+    junctions: set[Point] = set()
+    neighbors: Dict[Point, Tuple[Optional[Point], Optional[Point]]] = {}
+    for points in lines:
+        if not points:
+            continue
+        junctions.add(points[0])
+        junctions.add(points[-1])
+        for i in range(1, len(points) - 1):
+            point = points[i]
+            prev, nxt = points[i - 1], points[i + 1]
+            # 向きに依らない前後の組
+            pair = (prev, nxt) if prev <= nxt else (nxt, prev)
+            seen = neighbors.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+
+def cut_arcs(points: List[Point], junctions: set[Point]) -> List[List[Point]]:
+    """路線を切れ目の頂点で分割する（隣り合うアークは端点を共有する）"""
+    arcs: List[List[Point]] = []
+    start = 0
+    for i in range(1, len(points)):
+        if points[i] in junctions or i == len(points) - 1:
+            arcs.append(points[start : i + 1])
+            start = i
+    return arcs
+
+
+@dataclass
+class TopologyLine:
+    line_id: str
+    color: str
+    arcs: List[int]  # アーク番号（~i は i 番のアークを逆向きにたどる）
+
+
+class Topology:
+    """全路線の共有アークと、路線ごとのアーク番号列（起動後は読み取りのみ）"""
+
+    def __init__(self, arcs: List[List[Point]], lines: Dict[str, TopologyLine]) -> None:
+        self.arcs = arcs
+        self.lines = lines
+        self._importance: List[Optional[List[float]]] = [None] * len(arcs)
+        self._encoded: OrderedDict[Tuple[Tuple[str, ...], float], EncodedBody] = OrderedDict()
+
+    @classmethod
+    def build(cls, shape_store: ShapeStore) -> "Topology":
+        entries = [shape_store.entries[line_id] for line_id in sorted(shape_store.entries)]
+        points_by_line = [_dedupe(entry.points()) for entry in entries]
+        junctions = find_junctions(points_by_line)
+
+        arcs: List[List[Point]] = []
+        arc_index: Dict[Tuple[Point, ...], int] = {}
+        lines: Dict[str, TopologyLine] = {}
+        total_points = 0
+        for entry, points in zip(entries, points_by_line):
+            total_points += len(points)
+            refs: List[int] = []
+            for arc in cut_arcs(points, junctions):
+                key = tuple(arc)
+                if key in arc_index:
+                    refs.append(arc_index[key])
+                    continue
+                reversed_key = key[::-1]
+                if reversed_key in arc_index:
+                    refs.append(~arc_index[reversed_key])
+                    continue
+                arc_index[key] = len(arcs)
+                refs.append(len(arcs))
+                arcs.append(arc)
+            lines[entry.line_id] = TopologyLine(entry.line_id, entry.color, refs)
+
+        logger.info(
+            "Shape topology built: %d lines, %d arcs, %d -> %d points",
+            len(lines),
+            len(arcs),
+            total_points,
+            sum(len(arc) for arc in arcs),
+        )
+        return cls(arcs, lines)
+
+    def __contains__(self, line_id: str) -> bool:
+        return line_id in self.lines
+
+    def _simplified(self, arc_id: int, tolerance: float) -> List[Point]:
+        if tolerance <= 0:
+            return self.arcs[arc_id]
+        importance = self._importance[arc_id]
+        if importance is None:
+            importance = self._importance[arc_id] = douglas_peucker_importance(self.arcs[arc_id])
+        return simplify_douglas_peucker(self.arcs[arc_id], tolerance, importance)
+
+    def to_topojson(self, line_ids: List[str], tolerance: float = 0.0) -> Dict:
+        """
+        指定路線の TopoJSON を組み立てる。
+
+        使われるアークだけを番号を詰めて含め、座標は TOPOLOGY_QUANTIZATION で量子化する。
+        """
+        remap: Dict[int, int] = {}
+        used: List[List[Point]] = []
+        geometries = []
+        for line_id in line_ids:
+            line = self.lines[line_id]
+            refs = []
+            for ref in line.arcs:
+                arc_id = ref if ref >= 0 else ~ref
+                if arc_id not in remap:
+                    remap[arc_id] = len(used)
+                    used.append(self._simplified(arc_id, tolerance))
+                refs.append(remap[arc_id] if ref >= 0 else ~remap[arc_id])
+            geometries.append(
+                {
+                    "type": "LineString",
+                    "id": line_id,
+                    "arcs": refs,
+                    "properties": {"line_id": line_id, "color": line.color},
+                }
+            )
+
+        lons = [lon for arc in used for lon, _ in arc]
+        lats = [lat for arc in used for _, lat in arc]
+        if not lons:
+            lons, lats = [0.0], [0.0]
+        min_lon, max_lon, min_lat, max_lat = min(lons), max(lons), min(lats), max(lats)
+        kx = (max_lon - min_lon) / (TOPOLOGY_QUANTIZATION - 1) or 1.0
+        ky = (max_lat - min_lat) / (TOPOLOGY_QUANTIZATION - 1) or 1.0
+
+        encoded_arcs = []
+        for arc in used:
+            deltas: List[List[int]] = []
+            px = py = 0
+            for i, (lon, lat) in enumerate(arc):
+                x, y = round((lon - min_lon) / kx), round((lat - min_lat) / ky)
+                if i and x == px and y == py and i < len(arc) - 1:
+                    # 量子化で重なった頂点は除く（端点は共有のため残す）
+                    continue
+                deltas.append([x - px, y - py] if deltas else [x, y])
+                px, py = x, y
+            encoded_arcs.append(deltas)
+
+        return {
+            "type": "Topology",
+            "bbox": [min_lon, min_lat, max_lon, max_lat],
+            "transform": {"scale": [kx, ky], "translate": [min_lon, min_lat]},
+            "objects": {OBJECT_NAME: {"type": "GeometryCollection", "geometries": geometries}},
+            "arcs": encoded_arcs,
+        }
+
+    def encode(self, line_ids: List[str], tolerance: float = 0.0) -> EncodedBody:
+        """
+        指定路線の TopoJSON をエンコード・圧縮する。
+
+        許容誤差は LOD_TOLERANCES のレベルに丸め、路線の組み合わせごとに結果を保持する。
+        """
+        level = max((t for t in LOD_TOLERANCES if t <= tolerance), default=0.0)
+        key = (tuple(line_ids), level)
+        encoded = self._encoded.get(key)
+        if encoded is not None:
+            self._encoded.move_to_end(key)
+            return encoded
+
+        encoded = EncodedBody.encode(
+            encode_json(self.to_topojson(line_ids, level)), gzip_level=COLLECTION_GZIP_LEVEL, use_brotli=False
+        )
+        self._encoded[key] = encoded
+        if len(self._encoded) > ENCODED_CACHE_SIZE:
+            self._encoded.popitem(last=False)
+        return encoded
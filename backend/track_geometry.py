@@ -0,0 +1,248 @@
+# backend/track_geometry.py
+"""
+線形参照 (linear referencing) による線路形状
+
+路線ごとに線路点群の累積距離 (chainage) と駅の最寄り頂点を起動時に1回だけ計算しておき、
+列車位置のスナップを「駅間の距離を progress で補間 → 累積距離を二分探索」で行う。
+
+従来の calculate_coordinates は列車ごとに全頂点との Haversine 距離を計算していたため、
+O(頂点数) の三角関数が毎リクエスト・毎列車で発生していた。
+ここでは距離・方位角を辺ごとに事前計算するので、ホットループは bisect と線形補間のみになる。
+
+距離・方位角は辺ごとの局所的なメートル平面 (projection.segment_metrics) で事前に求め、
+駅の最寄り頂点は路線の投影平面 (projection.LocalProjection) 上の距離で探す。
+"""
+
+from __future__ import annotations
+
+import logging
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from projection import segment_metrics
+from spatial_index import GridIndex
+from train_position_v4 import get_merged_coords
+
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
+logger = logging.getLogger(__name__)
+
+# 駅が線路からこれ以上離れている場合はスナップしない (m)
+STATION_SNAP_GUARD_METERS = 500.0
+
+
+# ============================================================================
+# Data Models
+# ============================================================================
+
+
+@dataclass
+class StationChainage:
+    """駅の線路上の位置"""
+
+    vertex: int  # 最寄り頂点のインデックス
+    offset: float  # 駅座標から最寄り頂点までの距離 (m)
+
+    @property
+    def on_track(self) -> bool:
+        return self.offset <= STATION_SNAP_GUARD_METERS
+
+
+@dataclass
+class LineGeometry:
+    """
+    1路線分の線路形状（線形参照）
+
+    頂点 i の累積距離を cumulative[i]、辺 i (頂点 i → i+1) の方位角を
+    forward_bearing[i]、逆向き (i+1 → i) を backward_bearing[i] に持つ。
+    コンパイル済みファイルから読み込んだ場合、配列は mmap 上の memoryview になる。
+    """
+
+    line_id: str
+    lons: array
+    lats: array
+    cumulative: array
+    forward_bearing: array
+    backward_bearing: array
+    stations: Dict[str, StationChainage] = field(default_factory=dict)
+    index: Optional[GridIndex] = field(default=None, repr=False, compare=False)  # 頂点の空間インデックス（遅延構築）
+
+    @classmethod
+    def from_coords(cls, line_id: str, coords: Sequence[Tuple[float, float]]) -> "LineGeometry":
+        """線路点群 [(lon, lat), ...] から累積距離と辺ごとの方位角を計算する"""
+        lons = array("d", (c[0] for c in coords))
+        lats = array("d", (c[1] for c in coords))
+        cumulative, forward, backward = segment_metrics(lons, lats)
+        return cls(line_id, lons, lats, cumulative, forward, backward)
+
+    def __len__(self) -> int:
+        return len(self.lons)
+
+    @property
+    def length(self) -> float:
+        return self.cumulative[-1] if len(self.cumulative) else 0.0
+
+    # ------------------------------------------------------------------------
+    # Station chainage
+    # ------------------------------------------------------------------------
+
+    def nearest_vertex(self, lon: float, lat: float) -> Tuple[int, float]:
+        """最寄り頂点のインデックスと投影平面上の距離 (m) を返す（駅登録時のみ使用）"""
+        if self.index is None:
+            self.index = GridIndex.from_coords(list(zip(self.lons, self.lats)))
+        result = self.index.nearest(lon, lat, 1)
+        if not result:
+            return -1, float("inf")
+        offset, idx = result[0]
+        return idx, offset
+
+    def add_station(self, station_id: str, coord: Tuple[float, float]) -> StationChainage:
+        """駅 (lon, lat) を最寄り頂点に対応付けて登録する"""
+        vertex, offset = self.nearest_vertex(coord[0], coord[1])
+        chainage = StationChainage(vertex=vertex, offset=offset)
+        self.stations[station_id] = chainage
+        return chainage
+
+    def station_chainage(self, station_id: str) -> Optional[float]:
+        """駅の累積距離 (m)。未登録または線路から遠い駅は None"""
+        entry = self.stations.get(station_id)
+        if entry is None or not entry.on_track:
+            return None
+        return self.cumulative[entry.vertex]
+
+    # ------------------------------------------------------------------------
+    # Snapping
+    # ------------------------------------------------------------------------
+
+    def interpolate(
+        self,
+        prev_station: StationChainage,
+        next_station: StationChainage,
+        progress: float,
+    ) -> Optional[Tuple[float, float, float]]:
+        """
+        駅間の進捗率 progress から線路上の (lat, lon, bearing) を求める。
+
+        駅が線路から遠い・同じ頂点に対応する・区間長が0の場合は None
+        （呼び出し側で直線補間にフォールバックする）。
+        """
+        if not prev_station.on_track or not next_station.on_track:
+            return None
+        i_prev, i_next = prev_station.vertex, next_station.vertex
+        if i_prev == i_next:
+            return None
+
+        cum = self.cumulative
+        c_prev = cum[i_prev]
+        total = abs(cum[i_next] - c_prev)
+        if total <= 0:
+            return None
+
+        lons, lats = self.lons, self.lats
+        if i_prev < i_next:
+            target = min(c_prev + total * progress, cum[i_next])
+            # target を含む最初の辺 (cum[k] <= target <= cum[k + 1])
+            k = bisect_left(cum, target, i_prev + 1, i_next + 1) - 1
+            k = min(max(k, i_prev), i_next - 1)
+            seg_len = cum[k + 1] - cum[k]
+            bearing = self.forward_bearing[k]
+            if seg_len <= 0:
+                return (lats[k], lons[k], bearing)
+            ratio = (target - cum[k]) / seg_len
+            start, end = k, k + 1
+        else:
+            # 逆方向: 頂点 i_prev から i_next に向かって累積距離を減らしていく
+            target = max(c_prev - total * progress, cum[i_next])
+            k = bisect_right(cum, target, i_next, i_prev) - 1
+            k = min(max(k, i_next), i_prev - 1)
+            seg_len = cum[k + 1] - cum[k]
+            bearing = self.backward_bearing[k]
+            if seg_len <= 0:
+                return (lats[k + 1], lons[k + 1], bearing)
+            ratio = (cum[k + 1] - target) / seg_len
+            start, end = k + 1, k
+
+        lat = lats[start] + (lats[end] - lats[start]) * ratio
+        lon = lons[start] + (lons[end] - lons[start]) * ratio
+        return (lat, lon, bearing)
+
+
+# ============================================================================
+# Builder
+# ============================================================================
+
+
+def _railway_station_ids(cache: "DataCache", line_id: str) -> List[str]:
+    entry = next((r for r in getattr(cache, "railways", None) or [] if r.get("id") == line_id), None)
+    return list(entry.get("stations", [])) if entry else []
+
+
+def build_line_geometry(
+    cache: "DataCache",
+    line_id: str,
+    coords: Optional[Sequence[Tuple[float, float]]] = None,
+) -> Optional[LineGeometry]:
+    """
+    coordinates.json の線路形状から LineGeometry を構築し、
+    railways.json の駅リストを累積距離に対応付ける。
+
+    coords を省略した場合はマージ済み座標 (get_merged_coords) を使う。
+    """
+    if coords is None:
+        coords = get_merged_coords(cache, line_id)
+    if len(coords) < 2:
+        return None
+
+    geometry = LineGeometry.from_coords(line_id, coords)
+    positions = getattr(cache, "station_positions", None) or {}
+    far = 0
+    for station_id in _railway_station_ids(cache, line_id):
+        coord = positions.get(station_id)
+        if coord is None:
+            continue
+        if not geometry.add_station(station_id, coord).on_track:
+            far += 1
+    if far:
+        logger.debug("%s: %d stations are farther than %.0fm from track", line_id, far, STATION_SNAP_GUARD_METERS)
+    return geometry
+
+
+def build_line_geometries(cache: "DataCache", line_ids: Iterable[str]) -> Dict[str, LineGeometry]:
+    """複数路線の LineGeometry をまとめて構築する（起動時）"""
+    geometries: Dict[str, LineGeometry] = {}
+    for line_id in line_ids:
+        if line_id in geometries:
+            continue
+        geometry = build_line_geometry(cache, line_id)
+        if geometry is not None:
+            geometries[line_id] = geometry
+    return geometries
+
+
+# DataCache が line_geometries を持たない場合（テスト用のモックなど）の遅延構築先
+_GEOMETRY_CACHE: Dict[str, Optional[LineGeometry]] = {}
+
+
+def get_line_geometry(cache: "DataCache", line_id: str) -> Optional[LineGeometry]:
+    """路線の LineGeometry を返す。未構築なら構築してキャッシュする"""
+    store = getattr(cache, "line_geometries", None)
+    if not isinstance(store, dict):
+        store = _GEOMETRY_CACHE
+    if line_id not in store:
+        store[line_id] = build_line_geometry(cache, line_id)
+    return store[line_id]
+
+
+def get_station_chainage(
+    geometry: LineGeometry,
+    station_id: str,
+    coord: Tuple[float, float],
+) -> StationChainage:
+    """駅の対応付けを返す。railways.json に無い駅（他路線の駅など）は初回だけ探索して登録する"""
+    entry = geometry.stations.get(station_id)
+    if entry is None:
+        entry = geometry.add_station(station_id, coord)
+    return entry
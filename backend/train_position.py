@@ -3,8 +3,12 @@ from __future__ import annotations
 
 import logging
 import math
+from array import array
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from projection import LocalProjection, closest_point_on_segment
+from spatial_index import GridIndex
 
 if TYPE_CHECKING:
     from data_cache import DataCache
@@ -217,25 +221,6 @@ def get_adjacent_segments(
     return segments
 
 
-def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    R = 6371000
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
-    return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-
-def point_to_segment_distance(px, py, ax, ay, bx, by):
-    dx, dy = bx - ax, by - ay
-    if dx == 0 and dy == 0:
-        return haversine_distance(py, px, ay, ax), ax, ay, 0.0
-    t = ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)
-    t = max(0.0, min(1.0, t))
-    nx, ny = ax + t * dx, ay + t * dy
-    return haversine_distance(py, px, ny, nx), nx, ny, t
-
-
 def get_segment_coords(from_id: str, to_id: str, direction: str, cache: DataCache) -> Optional[list[list[float]]]:
     # 線路データ取得（変更なし）
     if not cache.track_points:
@@ -249,37 +234,110 @@ def get_segment_coords(from_id: str, to_id: str, direction: str, cache: DataCach
     return [[p[0], p[1]] for p in path]
 
 
+# 投影誤差・辺上の最近点のずれを吸収する余裕（候補の取りこぼし防止）
+_SEGMENT_SEARCH_MARGIN = 1.05
+
+
+@dataclass
+class SegmentPath:
+    """
+    区間の線路点群と、その投影座標・累積距離・頂点の空間インデックス
+
+    estimate_segment_progress_extended に渡すと、最近傍の辺を
+    インデックスで絞り込んだ候補だけから探す。距離は空間インデックスと同じ投影平面で測る。
+    """
+
+    coords: list[list[float]]
+    xs: array
+    ys: array
+    dists: list[float]
+    max_edge: float
+    index: GridIndex
+
+    @property
+    def projection(self) -> LocalProjection:
+        return self.index.projection
+
+    @classmethod
+    def build(cls, segment_coords: list[list[float]]) -> "SegmentPath":
+        index = GridIndex.from_coords(segment_coords)
+        xs, ys = index.projection.project_coords(segment_coords)
+        dists = [0.0]
+        max_edge = 0.0
+        for i in range(len(segment_coords) - 1):
+            d = math.hypot(xs[i + 1] - xs[i], ys[i + 1] - ys[i])
+            dists.append(dists[-1] + d)
+            max_edge = max(max_edge, d)
+        return cls(segment_coords, xs, ys, dists, max_edge, index)
+
+    def candidate_edges(self, target_lat: float, target_lon: float, max_dist: float) -> list[int]:
+        """
+        目標点から max_dist 以内にある可能性のある辺のインデックス（昇順）
+
+        辺上の点から最寄りの端点までは高々 辺長/2 なので、
+        端点が max_dist + 最大辺長/2 以内の辺だけを調べればよい。
+        """
+        radius = (max_dist + self.max_edge / 2) * _SEGMENT_SEARCH_MARGIN
+        last = len(self.coords) - 2
+        edges = set()
+        for _, i in self.index.within(target_lon, target_lat, radius):
+            if i > 0:
+                edges.add(i - 1)
+            if i <= last:
+                edges.add(i)
+        return sorted(edges)
+
+
+_SEGMENT_PATH_CACHE: Dict[tuple, SegmentPath] = {}
+
+
+def get_segment_path(from_id: str, to_id: str, direction: str, cache: DataCache) -> Optional[SegmentPath]:
+    """get_segment_coords の結果を SegmentPath としてキャッシュする（線路・駅対応は起動後不変）"""
+    key = (id(cache.track_points), from_id, to_id, direction)
+    path = _SEGMENT_PATH_CACHE.get(key)
+    if path is None:
+        coords = get_segment_coords(from_id, to_id, direction, cache)
+        if not coords:
+            return None
+        path = _SEGMENT_PATH_CACHE[key] = SegmentPath.build(coords)
+    return path
+
+
 def estimate_segment_progress_extended(segment_coords, target_lat, target_lon, max_dist=500.0):
-    if not segment_coords or len(segment_coords) < 2:
+    """
+    区間の線路上で目標点に最も近い位置を探し、区間内の進捗率を返す。
+
+    segment_coords には座標リストか SegmentPath を渡す。
+    """
+    if not segment_coords:
+        return None
+    path = segment_coords if isinstance(segment_coords, SegmentPath) else None
+    if path is None:
+        if len(segment_coords) < 2:
+            return None
+        path = SegmentPath.build(segment_coords)
+    segment_coords = path.coords
+    if len(segment_coords) < 2:
         return None
 
-    # 区間全長計算
-    dists = [0.0]
-    for i in range(len(segment_coords) - 1):
-        d = haversine_distance(
-            segment_coords[i][1], segment_coords[i][0], segment_coords[i + 1][1], segment_coords[i + 1][0]
-        )
-        dists.append(dists[-1] + d)
+    # 区間全長
+    dists = path.dists
     total_len = dists[-1]
     if total_len < 1.0:
         return None
 
     min_d = float("inf")
     best_t_global = 0.0
-    best_pt = (0, 0)
-
-    for i in range(len(segment_coords) - 1):
-        d, nx, ny, t_local = point_to_segment_distance(
-            target_lon,
-            target_lat,
-            segment_coords[i][0],
-            segment_coords[i][1],
-            segment_coords[i + 1][0],
-            segment_coords[i + 1][1],
-        )
+    best_xy = (0.0, 0.0)
+
+    # 目標点を1回だけ投影し、辺との距離は平面上で測る
+    xs, ys = path.xs, path.ys
+    px, py = path.projection.project(target_lon, target_lat)
+    for i in path.candidate_edges(target_lat, target_lon, max_dist):
+        d, nx, ny, t_local = closest_point_on_segment(px, py, xs[i], ys[i], xs[i + 1], ys[i + 1])
         if d < min_d:
             min_d = d
-            best_pt = (nx, ny)
+            best_xy = (nx, ny)
             seg_start_d = dists[i]
             seg_len = dists[i + 1] - dists[i]
             best_t_global = (seg_start_d + t_local * seg_len) / total_len
@@ -287,7 +345,8 @@ def estimate_segment_progress_extended(segment_coords, target_lat, target_lon, m
     if min_d > max_dist:
         return None
 
-    return {"progress": max(0.0, min(1.0, best_t_global)), "distance_m": min_d, "lon": best_pt[0], "lat": best_pt[1]}
+    lon, lat = path.projection.unproject(*best_xy)
+    return {"progress": max(0.0, min(1.0, best_t_global)), "distance_m": min_d, "lon": lon, "lat": lat}
 
 
 def find_train_on_segments(
@@ -310,11 +369,11 @@ def find_train_on_segments(
     best_dist = float("inf")
 
     for idx, (sf, st) in enumerate(segments):
-        coords = get_segment_coords(sf, st, direction, cache)
-        if not coords:
+        path = get_segment_path(sf, st, direction, cache)
+        if path is None:
             continue
 
-        res = estimate_segment_progress_extended(coords, gtfs_lat, gtfs_lon, max_distance_m)
+        res = estimate_segment_progress_extended(path, gtfs_lat, gtfs_lon, max_distance_m)
         if res and res["distance_m"] < best_dist:
             best_dist = res["distance_m"]
             best_res = {
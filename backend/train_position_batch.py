@@ -0,0 +1,264 @@
+# backend/train_position_batch.py
+"""
+列車位置計算のベクトル化バッチエンジン
+
+compute_progress_for_train() を列車ごとに呼ぶ代わりに、全列車の駅時刻の列
+(ScheduleColumns) を1本の配列に連結し、停車・走行区間の判定と
+台形速度制御の進捗計算を NumPy でまとめて行う。
+
+判定の優先順位と各フィールドの値はスカラー版と完全に一致させる:
+  1. VehiclePosition による始発駅オーバーライド（列車単位でスカラー処理）
+  2. 駅数 2 未満 → invalid
+  3. TripUpdate-only の始発駅判定（最初の駅の発車時刻前 ORIGIN_STATION_BUFFER_SEC 以内）
+  4. 停車判定（最初に arrival <= now <= 実質発車時刻 を満たす駅）
+  5. 区間判定（最初に t0 <= now <= t1 を満たす区間）
+  6. いずれも該当しない → unknown
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, List, Mapping, Optional, Tuple
+
+from gtfs_rt_tripupdate import MISSING, ScheduleColumns, TrainSchedule
+from gtfs_rt_vehicle import YamanoteTrainPosition
+from train_position_v4 import (
+    ORIGIN_STATION_BUFFER_SEC,
+    SegmentProgress,
+    compute_progress_for_train,
+    get_effective_times,
+)
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy 未導入環境ではスカラー版にフォールバック
+    np = None
+
+if TYPE_CHECKING:
+    from data_cache import DataCache
+
+logger = logging.getLogger(__name__)
+
+NUMPY_AVAILABLE = np is not None
+
+# calculate_physics_progress と同じ定数 (E235系)
+T_ACC = 30.0  # 加速時間 (0->90km/h)
+T_DEC = 25.0  # 減速時間 (90km/h->0)
+
+# 判定結果のステータスコード
+_UNKNOWN = 0
+_ORIGIN = 1
+_STOPPED = 2
+_RUNNING = 3
+
+
+# ============================================================================
+# Vectorized Physics
+# ============================================================================
+
+
+def calculate_physics_progress_array(elapsed: "np.ndarray", duration: "np.ndarray") -> "np.ndarray":
+    """
+    calculate_physics_progress() のベクトル版。
+    要素ごとにスカラー版と同じ演算順序で計算するため、結果はビット単位で一致する。
+    """
+    elapsed = np.asarray(elapsed, dtype=np.float64)
+    duration = np.asarray(duration, dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        short = duration < (T_ACC + T_DEC)
+        factor = np.where(short, duration / (T_ACC + T_DEC), 1.0)
+        t_acc = np.where(short, T_ACC * factor, T_ACC)
+        t_dec = np.where(short, T_DEC * factor, T_DEC)
+        t_const = duration - t_acc - t_dec
+        v_peak = 1.0 / (0.5 * t_acc + t_const + 0.5 * t_dec)
+
+        accel = 0.5 * (v_peak / t_acc) * (elapsed**2)
+        cruise = 0.5 * v_peak * t_acc + v_peak * (elapsed - t_acc)
+        decel = 1.0 - 0.5 * (v_peak / t_dec) * ((duration - elapsed) ** 2)
+
+        result = np.where(elapsed < t_acc, accel, np.where(elapsed < (t_acc + t_const), cruise, decel))
+
+    result = np.where(elapsed >= duration, 1.0, result)
+    result = np.where(elapsed <= 0, 0.0, result)
+    return np.where(duration <= 0, 1.0, result)
+
+
+# ============================================================================
+# Batch Engine
+# ============================================================================
+
+
+def _first_true_per_group(mask: "np.ndarray", starts: "np.ndarray", ends: "np.ndarray") -> "np.ndarray":
+    """
+    グループ [starts[k], ends[k]) ごとに mask が最初に True になる位置を返す（無ければ -1）。
+    True の位置の昇順リストに対する searchsorted で一括に求める。
+    """
+    hits = np.flatnonzero(mask)
+    if hits.size == 0:
+        return np.full(starts.shape, -1, dtype=np.int64)
+    pos = np.searchsorted(hits, starts)
+    first = hits[np.minimum(pos, hits.size - 1)]
+    return np.where((pos < hits.size) & (first < ends), first, -1)
+
+
+def compute_all_progress_vectorized(
+    schedules: Mapping[str, TrainSchedule],
+    now_ts: int,
+    data_cache: "DataCache" | None = None,
+    vehicle_positions: Optional[Mapping[str, YamanoteTrainPosition]] = None,
+) -> List[SegmentProgress]:
+    """
+    全列車の現在位置・進捗を一括計算する（compute_all_progress の engine="vectorized"）。
+
+    Returns:
+        schedules の順序どおりの SegmentProgress のリスト
+    """
+    results: List[Optional[SegmentProgress]] = [None] * len(schedules)
+
+    # --- 1. 列車単位で処理するもの（VehiclePosition オーバーライド・駅数不足）を先に分ける ---
+    batch: List[Tuple[int, TrainSchedule]] = []
+    for k, (trip_id, schedule) in enumerate(schedules.items()):
+        vp = vehicle_positions.get(trip_id) if vehicle_positions else None
+        override = vp is not None and vp.status == 1 and vp.stop_sequence <= 1
+        if override or schedule.columns.size < 2:
+            results[k] = compute_progress_for_train(schedule, now_ts, data_cache, vp)
+        else:
+            batch.append((k, schedule))
+
+    if not batch:
+        return results
+
+    # --- 2. 全列車の列を連結する ---
+    columns_list = [schedule.columns for _, schedule in batch]
+    sizes = np.fromiter((c.size for c in columns_list), dtype=np.int64, count=len(columns_list))
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    table = np.concatenate(
+        [np.frombuffer(c.buffer, dtype=np.int64).reshape(ScheduleColumns.NUM_COLUMNS, c.size) for c in columns_list],
+        axis=1,
+    )
+    dep = table[ScheduleColumns.DEPARTURE]
+    trip_of_row = np.repeat(np.arange(len(batch)), sizes)
+
+    # 列車ごとの現在時刻（feed_timestamp より過去に戻さない）
+    feed_ts = np.array(
+        [MISSING if s.feed_timestamp is None else s.feed_timestamp for _, s in batch],
+        dtype=np.int64,
+    )
+    now_trip = np.where((feed_ts != MISSING) & (now_ts < feed_ts), feed_ts, now_ts)
+    now_row = now_trip[trip_of_row]
+
+    # --- 3. 実質時刻（スカラー版と同じ EffectiveTimes を列車ごとに再利用して連結）---
+    effective = [get_effective_times(schedule, data_cache) for _, schedule in batch]
+    stop_start = np.concatenate([np.frombuffer(e.stop_start, dtype=np.int64) for e in effective])
+    eff_dep = np.concatenate([np.frombuffer(e.effective_departure, dtype=np.int64) for e in effective])
+    eff_arr = np.concatenate([np.frombuffer(e.effective_arrival, dtype=np.int64) for e in effective])
+    has_eff = eff_dep != MISSING
+
+    # --- 4. 始発駅判定（各列車の最初の駅）---
+    first_dep = dep[starts]
+    origin = (first_dep != MISSING) & (first_dep - ORIGIN_STATION_BUFFER_SEC <= now_trip) & (now_trip <= first_dep)
+
+    # --- 5. 停車判定（_is_stopped_at_station と同じ規則）---
+    stopped_mask = has_eff & (stop_start <= now_row) & (now_row <= eff_dep)
+    first_stopped = _first_true_per_group(stopped_mask, starts, ends)
+
+    # --- 6. 区間判定: 区間 i は行 i → 行 i+1（同じ列車内のみ）---
+    t0 = eff_dep[:-1]
+    t1 = eff_arr[1:]
+    seg_now = now_row[:-1]
+    running_mask = (
+        (trip_of_row[:-1] == trip_of_row[1:])
+        & has_eff[:-1]
+        & has_eff[1:]
+        & (t1 > t0)
+        & (t0 <= seg_now)
+        & (seg_now <= t1)
+    )
+    first_running = _first_true_per_group(running_mask, starts, ends - 1)
+
+    # --- 7. 優先順位でステータスを決定し、走行中の進捗をまとめて計算 ---
+    status = np.full(len(batch), _UNKNOWN, dtype=np.int8)
+    status[first_running >= 0] = _RUNNING
+    status[first_stopped >= 0] = _STOPPED
+    status[origin] = _ORIGIN
+
+    running_rows = first_running[status == _RUNNING]
+    progress = calculate_physics_progress_array(
+        now_trip[status == _RUNNING] - t0[running_rows],
+        t1[running_rows] - t0[running_rows],
+    )
+    progress_by_trip = dict(zip(np.flatnonzero(status == _RUNNING).tolist(), progress.tolist()))
+
+    # --- 8. SegmentProgress を組み立てる ---
+    status_list = status.tolist()
+    for b, (k, schedule) in enumerate(batch):
+        c = columns_list[b]
+        n = c.size
+        now_b = int(now_trip[b])
+        code = status_list[b]
+        base = dict(
+            trip_id=schedule.trip_id,
+            train_number=schedule.train_number,
+            direction=schedule.direction,
+            now_ts=now_b,
+            feed_timestamp=schedule.feed_timestamp,
+            segment_count=n - 1,
+        )
+
+        if code == _ORIGIN or code == _STOPPED:
+            i = 0 if code == _ORIGIN else int(first_stopped[b] - starts[b])
+            station_id = c.station_id(i)
+            arrival = c.time_or_none(ScheduleColumns.ARRIVAL, i)
+            results[k] = SegmentProgress(
+                prev_station_id=station_id,
+                next_station_id=station_id,
+                prev_seq=c.value(ScheduleColumns.SEQ, i),
+                next_seq=c.value(ScheduleColumns.SEQ, i),
+                t0_departure=c.time_or_none(ScheduleColumns.DEPARTURE, i),
+                t1_arrival=arrival,
+                progress=0.0,
+                status="stopped",
+                delay=c.value(ScheduleColumns.DELAY, i),
+                is_starting_station=code == _ORIGIN or (i == 0 and arrival is None),
+                **base,
+            )
+        elif code == _RUNNING:
+            row = int(first_running[b])
+            i = row - int(starts[b])
+            results[k] = SegmentProgress(
+                prev_station_id=c.station_id(i),
+                next_station_id=c.station_id(i + 1),
+                prev_seq=c.value(ScheduleColumns.SEQ, i),
+                next_seq=c.value(ScheduleColumns.SEQ, i + 1),
+                t0_departure=int(t0[row]),
+                t1_arrival=int(t1[row]),
+                progress=progress_by_trip[b],
+                status="running",
+                delay=c.value(ScheduleColumns.DELAY, i + 1),
+                **base,
+            )
+        else:
+            first_arr, first_dep_v = (
+                c.time_or_none(ScheduleColumns.ARRIVAL, 0),
+                c.time_or_none(ScheduleColumns.DEPARTURE, 0),
+            )
+            last_arr, last_dep = (
+                c.time_or_none(ScheduleColumns.ARRIVAL, n - 1),
+                c.time_or_none(ScheduleColumns.DEPARTURE, n - 1),
+            )
+            results[k] = SegmentProgress(
+                prev_station_id=c.station_id(0),
+                next_station_id=c.station_id(n - 1),
+                prev_seq=c.value(ScheduleColumns.SEQ, 0),
+                next_seq=c.value(ScheduleColumns.SEQ, n - 1),
+                t0_departure=first_arr or first_dep_v,
+                t1_arrival=last_dep or last_arr,
+                progress=None,
+                status="unknown",
+                delay=0,
+                **base,
+            )
+
+    return results
@@ -10,11 +10,13 @@ from __future__ import annotations
 import logging
 import math
 import time
+from array import array
+from bisect import bisect_right
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
 
-from geometry import build_all_railways_cache, merge_sublines_v2
-from gtfs_rt_tripupdate import RealtimeStationSchedule, TrainSchedule
+from geometry import LonLatView, build_all_railways_cache, merge_sublines_v2
+from gtfs_rt_tripupdate import MISSING, RealtimeStationSchedule, ScheduleColumns, TrainSchedule
 from gtfs_rt_vehicle import YamanoteTrainPosition  # Type hint
 from station_ranks import get_station_dwell_time
 
@@ -209,6 +211,91 @@ def _get_arrival_time(schedule: RealtimeStationSchedule) -> Optional[int]:
     return schedule.departure_time
 
 
+# ============================================================================
+# 実質時刻の事前計算 (Effective Times)
+# ============================================================================
+
+
+@dataclass
+class EffectiveTimes:
+    """
+    停車時間を反映した列車ごとの実質時刻（ScheduleColumns と同じ行順、欠損は MISSING）。
+
+    - stop_start[i]: 停車判定の開始時刻（到着時刻。始発駅など到着が無ければ発車 - 停車時間）
+    - effective_departure[i]: _get_departure_time() の結果（停車判定の終了・区間の t0）
+    - effective_arrival[i]: _get_arrival_time() の結果（区間の t1）
+
+    monotonic が True のとき、停車区間は
+    stop_start[0] <= effective_departure[0] < stop_start[1] <= ... と重ならずに並んでおり、
+    状態判定は stop_start に対する1回の二分探索で済む。
+    """
+
+    key: tuple  # (停車時間の取得元, DataCache.rank_version)
+    stop_start: array
+    effective_departure: array
+    effective_arrival: array
+    monotonic: bool
+
+
+def _dwell_source_key(data_cache: "DataCache" | None) -> tuple:
+    if data_cache is None:
+        return (None, 0)
+    return (id(data_cache), getattr(data_cache, "rank_version", 0))
+
+
+def get_effective_times(schedule: TrainSchedule, data_cache: "DataCache" | None = None) -> EffectiveTimes:
+    """
+    列車の実質時刻を返す。ScheduleColumns に保持したものを再利用し、
+    停車時間の取得元や駅ランクが変わっていれば作り直す。
+    """
+    columns = schedule.columns
+    key = _dwell_source_key(data_cache)
+    cached = columns.effective
+    if cached is not None and cached.key == key:
+        return cached
+
+    n = columns.size
+    stop_start = array("q", [MISSING]) * n
+    eff_dep = array("q", [MISSING]) * n
+    eff_arr = array("q", [MISSING]) * n
+    monotonic = n > 0
+
+    for i in range(n):
+        stu = columns.row(i)
+        arr = stu.arrival_time
+        dep = _get_departure_time(stu, data_cache)
+        if dep is not None:
+            eff_dep[i] = dep
+            if arr is not None:
+                stop_start[i] = arr
+            else:
+                stop_start[i] = dep - (_get_dwell_seconds(stu, data_cache) or 60)
+        arrival = _get_arrival_time(stu)
+        if arrival is not None:
+            eff_arr[i] = arrival
+
+        if stop_start[i] == MISSING or stop_start[i] > eff_dep[i]:
+            monotonic = False
+        elif i > 0 and monotonic and not eff_dep[i - 1] < stop_start[i]:
+            monotonic = False
+
+    effective = EffectiveTimes(
+        key=key,
+        stop_start=stop_start,
+        effective_departure=eff_dep,
+        effective_arrival=eff_arr,
+        monotonic=monotonic,
+    )
+    columns.effective = effective
+    return effective
+
+
+def precompute_effective_times(schedules: Dict[str, TrainSchedule], data_cache: "DataCache" | None = None) -> None:
+    """取り込み時に全列車の実質時刻を計算しておく（リクエスト時の計算を省く）"""
+    for schedule in schedules.values():
+        get_effective_times(schedule, data_cache)
+
+
 # ============================================================================
 # Main Calculation Functions
 # ============================================================================
@@ -244,7 +331,6 @@ def compute_progress_for_train(
     train_number = schedule.train_number
     direction = schedule.direction
     seqs = schedule.ordered_sequences
-    seqs = schedule.ordered_sequences
     schedules_by_seq = schedule.schedules_by_seq
 
     # 1.5 MS13: VehiclePosition による始発駅オーバーライド
@@ -335,79 +421,89 @@ def compute_progress_for_train(
                 is_starting_station=True,
             )
 
-    # 3. 停車判定（各駅の arrival <= now <= departure をチェック）
-    for seq in seqs:
-        stu = schedules_by_seq.get(seq)
-        if stu and _is_stopped_at_station(stu, now_ts, data_cache):
-            # 始発駅かどうかを判定: 最初のseq かつ arrival_time がない
-            is_origin = seq == seqs[0] and stu.arrival_time is None
-            return SegmentProgress(
-                trip_id=trip_id,
-                train_number=train_number,
-                direction=direction,
-                prev_station_id=stu.station_id,
-                next_station_id=stu.station_id,
-                prev_seq=seq,
-                next_seq=seq,
-                now_ts=now_ts,
-                t0_departure=stu.departure_time,
-                t1_arrival=stu.arrival_time,
-                progress=0.0,  # 停車中は 0.0
-                status="stopped",
-                feed_timestamp=schedule.feed_timestamp,
-                segment_count=len(seqs) - 1,
-                delay=stu.delay,
-                is_starting_station=is_origin,
-            )
-
-    # 4. 区間判定（走行中）
-    # ordered_sequences を i=0..len-2 で走査
-    for i in range(len(seqs) - 1):
-        prev_seq = seqs[i]
-        next_seq = seqs[i + 1]
-
-        prev_stu = schedules_by_seq.get(prev_seq)
-        next_stu = schedules_by_seq.get(next_seq)
-
-        if prev_stu is None or next_stu is None:
-            continue
-
-        # t0 = 前駅の発車時刻、t1 = 次駅の到着時刻
-        t0 = _get_departure_time(prev_stu, data_cache)
-        t1 = _get_arrival_time(next_stu)
-
-        # 両方存在チェック
-        if t0 is None or t1 is None:
-            continue
+    # 3-4. 停車判定・区間判定（事前計算した実質時刻を使う）
+    cols = schedule.columns
+    eff = get_effective_times(schedule, data_cache)
+    stop_start = eff.stop_start
+    eff_dep = eff.effective_departure
+    eff_arr = eff.effective_arrival
+    n = cols.size
+
+    stopped_index = -1
+    running_index = -1
+    if eff.monotonic:
+        # 停車区間が重ならず時刻順に並んでいる → 二分探索1回で判定
+        i = bisect_right(stop_start, now_ts) - 1
+        if i >= 0 and now_ts <= eff_dep[i]:
+            stopped_index = i
+        elif 0 <= i < n - 1:
+            running_index = i
+    else:
+        # 時刻が前後している列車は従来どおり線形に走査する
+        for i in range(n):
+            if stop_start[i] != MISSING and stop_start[i] <= now_ts <= eff_dep[i]:
+                stopped_index = i
+                break
+        else:
+            for i in range(n - 1):
+                t0, t1 = eff_dep[i], eff_arr[i + 1]
+                if t0 == MISSING or t1 == MISSING or t1 <= t0:
+                    continue
+                if t0 <= now_ts <= t1:
+                    running_index = i
+                    break
 
-        # 無効区間（t1 <= t0）はスキップ
-        if t1 <= t0:
-            continue
+    if stopped_index >= 0:
+        i = stopped_index
+        seq = cols.value(ScheduleColumns.SEQ, i)
+        station_id = cols.station_id(i)
+        arrival = cols.time_or_none(ScheduleColumns.ARRIVAL, i)
+        # 始発駅かどうかを判定: 最初のseq かつ arrival_time がない
+        is_origin = i == 0 and arrival is None
+        return SegmentProgress(
+            trip_id=trip_id,
+            train_number=train_number,
+            direction=direction,
+            prev_station_id=station_id,
+            next_station_id=station_id,
+            prev_seq=seq,
+            next_seq=seq,
+            now_ts=now_ts,
+            t0_departure=cols.time_or_none(ScheduleColumns.DEPARTURE, i),
+            t1_arrival=arrival,
+            progress=0.0,  # 停車中は 0.0
+            status="stopped",
+            feed_timestamp=schedule.feed_timestamp,
+            segment_count=len(seqs) - 1,
+            delay=cols.value(ScheduleColumns.DELAY, i),
+            is_starting_station=is_origin,
+        )
 
-        # 現在時刻がこの区間内か判定
-        if t0 <= now_ts <= t1:
-            # MS8: 物理演算ベースの台形速度制御
-            elapsed = now_ts - t0
-            duration = t1 - t0
-            eased_progress = calculate_physics_progress(elapsed, duration)
+    if running_index >= 0:
+        i = running_index
+        # t0 = 前駅の実質発車時刻、t1 = 次駅の到着時刻
+        t0 = eff_dep[i]
+        t1 = eff_arr[i + 1]
+        # MS8: 物理演算ベースの台形速度制御
+        eased_progress = calculate_physics_progress(now_ts - t0, t1 - t0)
 
-            return SegmentProgress(
-                trip_id=trip_id,
-                train_number=train_number,
-                direction=direction,
-                prev_station_id=prev_stu.station_id,
-                next_station_id=next_stu.station_id,
-                prev_seq=prev_seq,
-                next_seq=next_seq,
-                now_ts=now_ts,
-                t0_departure=t0,
-                t1_arrival=t1,
-                progress=eased_progress,  # MS8: 物理演算適用済み
-                status="running",
-                feed_timestamp=schedule.feed_timestamp,
-                segment_count=len(seqs) - 1,
-                delay=next_stu.delay,
-            )
+        return SegmentProgress(
+            trip_id=trip_id,
+            train_number=train_number,
+            direction=direction,
+            prev_station_id=cols.station_id(i),
+            next_station_id=cols.station_id(i + 1),
+            prev_seq=cols.value(ScheduleColumns.SEQ, i),
+            next_seq=cols.value(ScheduleColumns.SEQ, i + 1),
+            now_ts=now_ts,
+            t0_departure=t0,
+            t1_arrival=t1,
+            progress=eased_progress,  # MS8: 物理演算適用済み
+            status="running",
+            feed_timestamp=schedule.feed_timestamp,
+            segment_count=len(seqs) - 1,
+            delay=cols.value(ScheduleColumns.DELAY, i + 1),
+        )
 
     # 5. 区間も停車も見つからない → unknown
     # デバッグ用：最初と最後の時刻を記録
@@ -441,11 +537,17 @@ def compute_progress_for_train(
     )
 
 
+# compute_all_progress の計算方式
+ENGINE_SCALAR = "scalar"  # 列車ごとに compute_progress_for_train を呼ぶ
+ENGINE_VECTORIZED = "vectorized"  # NumPy で全列車を一括計算 (train_position_batch)
+
+
 def compute_all_progress(
     schedules: Dict[str, TrainSchedule],
     now_ts: Optional[int] = None,
     data_cache: "DataCache" | None = None,
     vehicle_positions: Dict[str, YamanoteTrainPosition] = None,
+    engine: str = ENGINE_SCALAR,
 ) -> List[SegmentProgress]:
     """
     複数列車の現在位置・進捗をまとめて計算する。
@@ -454,6 +556,7 @@ def compute_all_progress(
         schedules: {trip_id: TrainSchedule} の辞書（MS1の出力）
         now_ts: 現在時刻（unix seconds）。None なら time.time() を使用。
         vehicle_positions: {trip_id: VehiclePosition} の辞書 (MS13)
+        engine: "scalar" / "vectorized"。どちらも同じ結果を返す。
 
     Returns:
         SegmentProgress のリスト
@@ -462,6 +565,17 @@ def compute_all_progress(
     if now_ts is None:
         now_ts = int(time.time())
 
+    if engine == ENGINE_VECTORIZED:
+        from train_position_batch import NUMPY_AVAILABLE, compute_all_progress_vectorized
+
+        if NUMPY_AVAILABLE:
+            try:
+                return compute_all_progress_vectorized(schedules, now_ts, data_cache, vehicle_positions)
+            except Exception as e:
+                logger.error(f"Vectorized progress engine failed, falling back to scalar: {e}")
+        else:
+            logger.warning("numpy is not installed: falling back to scalar progress engine")
+
     results: List[SegmentProgress] = []
 
     for trip_id, schedule in schedules.items():
@@ -539,7 +653,19 @@ def get_distance_meters(lat1, lon1, lat2, lon2):
     return R * c
 
 
-def get_merged_coords(cache, line_id) -> List[tuple[float, float]]:
+def get_merged_coords(cache, line_id) -> Sequence[tuple[float, float]]:
+    # コンパイル済み（起動時に構築済み）の LineGeometry があれば経度・緯度配列をコピーせずに参照する
+    compiled = getattr(cache, "compiled_geometry", None)
+    for geometries in (getattr(cache, "line_geometries", None), getattr(compiled, "lines", None)):
+        if isinstance(geometries, dict) and line_id in geometries:
+            geometry = geometries[line_id]
+            return LonLatView(geometry.lons, geometry.lats)
+
+    # 起動時に構築した形状ストアがあればマージ済み座標を再利用する
+    shape_store = getattr(cache, "shape_store", None)
+    if shape_store is not None and line_id in shape_store:
+        return shape_store.get(line_id).points()
+
     if line_id in _SHAPE_CACHE:
         return _SHAPE_CACHE[line_id]
 
@@ -551,14 +677,23 @@ def get_merged_coords(cache, line_id) -> List[tuple[float, float]]:
         return []
 
     # 2. Build cache for reference resolution
-    # Note: For performance, we could cache this globally, but per-line is fine due to _SHAPE_CACHE.
-    all_railways_cache = build_all_railways_cache(cache.coordinates)
+    # DataCache が空間インデックスを持っていれば、その座標キャッシュと最近傍探索を使う
+    spatial_index = getattr(cache, "railway_index", None)
+    if spatial_index is not None:
+        all_railways_cache = spatial_index.coords
+    else:
+        all_railways_cache = build_all_railways_cache(cache.coordinates)
 
     # 3. Specific loop flag
     is_loop = entry.get("loop", False)
 
     # 4. robust merge
-    merged_list = merge_sublines_v2(entry.get("sublines", []), is_loop=is_loop, all_railways_cache=all_railways_cache)
+    merged_list = merge_sublines_v2(
+        entry.get("sublines", []),
+        is_loop=is_loop,
+        all_railways_cache=all_railways_cache,
+        spatial_index=spatial_index,
+    )
 
     # Convert to list of tuples (lon, lat)
     merged_tuples = [(c[0], c[1]) for c in merged_list]
@@ -656,9 +791,11 @@ def calculate_coordinates(
             return None
 
         try:
-            # 線路点群の取得
-            coords = get_merged_coords(cache, line_id)
-            if not coords:
+            # 線路形状（累積距離・駅の対応付けは起動時に構築済み）
+            from track_geometry import get_line_geometry, get_station_chainage
+
+            geometry = get_line_geometry(cache, line_id)
+            if geometry is None:
                 return linear_fallback()
 
             # 前駅・次駅の座標
@@ -667,86 +804,14 @@ def calculate_coordinates(
             if not s_coord or not e_coord:
                 return linear_fallback()
 
-            s_lon, s_lat = s_coord
-            e_lon, e_lat = e_coord
-
-            # 最近傍探索 (距離ガード: 500m)
-            idx_prev = -1
-            min_d_prev = float("inf")
-            idx_next = -1
-            min_d_next = float("inf")
-
-            # 単純全探索
-            for i, (lon, lat) in enumerate(coords):
-                d_prev = get_distance_meters(s_lat, s_lon, lat, lon)
-                if d_prev < min_d_prev:
-                    min_d_prev = d_prev
-                    idx_prev = i
-
-                d_next = get_distance_meters(e_lat, e_lon, lat, lon)
-                if d_next < min_d_next:
-                    min_d_next = d_next
-                    idx_next = i
-
-            if min_d_prev > 500 or min_d_next > 500:
-                # 駅が線路から遠すぎる
-                # logger.debug(f"Stations too far from rail ({line_id}): {min_d_prev:.1f}m, {min_d_next:.1f}m")
-                return linear_fallback()
-
-            if idx_prev == idx_next:
-                return linear_fallback()
-
-            # パス切り出し
-            if idx_prev < idx_next:
-                path = coords[idx_prev : idx_next + 1]
-            else:
-                path = coords[idx_next : idx_prev + 1][::-1]
-
-            # パス長計算 & 位置特定
-            total_dist = 0.0
-            dists = [0.0]
-            for i in range(len(path) - 1):
-                p1 = path[i]
-                p2 = path[i + 1]
-                d = get_distance_meters(p1[1], p1[0], p2[1], p2[0])
-                total_dist += d
-                dists.append(total_dist)
-
-            if total_dist <= 0:
-                return linear_fallback()
-
-            target_dist = total_dist * progress
-
-            # target_dist に対応する区間を探す
-            found_idx = 0
-            for i in range(len(dists) - 1):
-                if dists[i] <= target_dist <= dists[i + 1]:
-                    found_idx = i
-                    break
-
-            # 区間内補間
-            # d_start = dists[found_idx] # unused
-            d_end = dists[found_idx + 1]
-            seg_len = d_end - dists[found_idx]
-
-            # p_start, p_end for bearing calculation
-            p_start = path[found_idx]  # (lon, lat)
-            p_end = path[found_idx + 1]  # (lon, lat)
-
-            if seg_len <= 0:
-                # 区間長0なら始点座標
-                bearing = calculate_bearing(p_start[1], p_start[0], p_end[1], p_end[0]) if len(path) > 1 else 0
-                return (p_start[1], p_start[0], bearing)
-
-            ratio = (target_dist - dists[found_idx]) / seg_len
-
-            res_lon = p_start[0] + (p_end[0] - p_start[0]) * ratio
-            res_lat = p_start[1] + (p_end[1] - p_start[1]) * ratio
-
-            # 方位角の計算
-            bearing = calculate_bearing(p_start[1], p_start[0], p_end[1], p_end[0])
-
-            return (res_lat, res_lon, bearing)
+            # 駅間の累積距離を progress で補間し、二分探索で辺を特定する
+            # (駅が線路から500m以上離れている・同一頂点・区間長0 の場合は None)
+            snapped = geometry.interpolate(
+                get_station_chainage(geometry, prev_station_id, s_coord),
+                get_station_chainage(geometry, next_station_id, e_coord),
+                progress,
+            )
+            return snapped if snapped is not None else linear_fallback()
 
         except Exception as e:
             logger.debug(f"Snap failed for {line_id}, fallback: {e}")
@@ -0,0 +1,565 @@
+# backend/vector_tiles.py
+"""
+線路形状・駅のベクタータイル（Mapbox Vector Tile v2, /tiles/{z}/{x}/{y}.mvt 用）
+
+路線ごとの GeoJSON (/api/shapes) と駅一覧 (/api/stations) を全部取得する代わりに、
+表示範囲のタイルに含まれる形状だけを返す。
+
+- 線路形状は ShapeStore のマージ済み座標（ズームに応じた詳細度レベル）を使う
+- 駅は stations テーブルの座標を使う
+- 全レベルの座標を起動後に1回だけ Web メルカトルへ投影しておき、
+  タイル生成はクリッピングと整数化・エンコードだけにする
+- 生成したタイルはメモリ上の LRU と（設定されていれば）ディスクにキャッシュする
+
+MVT のエンコードは protobuf のワイヤ形式を直接書き出す（専用ライブラリは不要）。
+"""
+
+from __future__ import annotations
+
+import bisect
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from shape_store import EncodedBody, ShapeStore, tolerance_for_zoom
+
+logger = logging.getLogger(__name__)
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+# タイル内座標の分解能と、隣接タイルとの継ぎ目を隠すためのはみ出し幅（タイル内座標）
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
+MAX_TILE_ZOOM = 24
+
+# これより広域のタイルには駅を含めない
+STATION_MIN_ZOOM = 10
+
+LAYER_RAIL = "rail"
+LAYER_STATIONS = "stations"
+
+# タイルはリクエスト時に生成するので、圧縮は速度優先
+TILE_GZIP_LEVEL = 6
+
+# 頂点をこの数ごとの区間に分けて外接矩形を持ち、タイルと交差しない区間は読み飛ばす
+CHUNK_SIZE = 32
+
+# Web メルカトルで表現できる緯度の上限
+_MAX_LAT = 85.0511287798066
+
+
+# ============================================================================
+# Web Mercator
+# ============================================================================
+
+
+def lonlat_to_mercator(lon: float, lat: float) -> Tuple[float, float]:
+    """経度・緯度を Web メルカトルの正規化座標 (0〜1, 北西が原点) に変換する"""
+    lat = max(-_MAX_LAT, min(_MAX_LAT, lat))
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def tile_for_lonlat(lon: float, lat: float, z: int) -> Tuple[int, int]:
+    """経度・緯度を含むタイルの (x, y)"""
+    n = 2**z
+    x, y = lonlat_to_mercator(lon, lat)
+    return min(n - 1, max(0, int(x * n))), min(n - 1, max(0, int(y * n)))
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+# ============================================================================
+# Protobuf / MVT Encoding
+# ============================================================================
+
+# protobuf のワイヤタイプ
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_BYTES = 2
+
+# ジオメトリ種別 (vector_tile.proto の GeomType)
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+
+# ジオメトリコマンド
+_CMD_MOVE_TO = 1
+_CMD_LINE_TO = 2
+
+
+def _write_varint(buf: bytearray, value: int) -> None:
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _write_key(buf: bytearray, field: int, wire_type: int) -> None:
+    _write_varint(buf, (field << 3) | wire_type)
+
+
+def _write_bytes(buf: bytearray, field: int, data: bytes) -> None:
+    _write_key(buf, field, _WIRE_BYTES)
+    _write_varint(buf, len(data))
+    buf.extend(data)
+
+
+def _write_packed(buf: bytearray, field: int, values: Iterable[int]) -> None:
+    packed = bytearray()
+    for value in values:
+        _write_varint(packed, value)
+    _write_bytes(buf, field, bytes(packed))
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _command(command: int, count: int) -> int:
+    return (command & 0x7) | (count << 3)
+
+
+def encode_point_geometry(x: int, y: int) -> List[int]:
+    return [_command(_CMD_MOVE_TO, 1), _zigzag(x), _zigzag(y)]
+
+
+def encode_line_geometry(parts: List[List[Tuple[int, int]]]) -> List[int]:
+    """(Multi)LineString のジオメトリ列。カーソルは部分線をまたいで引き継ぐ"""
+    geometry: List[int] = []
+    cx = cy = 0
+    for part in parts:
+        x, y = part[0]
+        geometry += [_command(_CMD_MOVE_TO, 1), _zigzag(x - cx), _zigzag(y - cy)]
+        cx, cy = x, y
+        geometry.append(_command(_CMD_LINE_TO, len(part) - 1))
+        for x, y in part[1:]:
+            geometry += [_zigzag(x - cx), _zigzag(y - cy)]
+            cx, cy = x, y
+    return geometry
+
+
+def _encode_value(value: Any) -> bytes:
+    """Layer.values の Value メッセージ"""
+    buf = bytearray()
+    if isinstance(value, bool):
+        _write_key(buf, 7, _WIRE_VARINT)
+        _write_varint(buf, int(value))
+    elif isinstance(value, int):
+        if value >= 0:
+            _write_key(buf, 5, _WIRE_VARINT)  # uint_value
+            _write_varint(buf, value)
+        else:
+            _write_key(buf, 6, _WIRE_VARINT)  # sint_value
+            _write_varint(buf, _zigzag(value))
+    elif isinstance(value, float):
+        _write_key(buf, 3, _WIRE_FIXED64)  # double_value
+        buf.extend(struct.pack("<d", value))
+    else:
+        _write_bytes(buf, 1, str(value).encode("utf-8"))  # string_value
+    return bytes(buf)
+
+
+class LayerBuilder:
+    """1レイヤー分の Feature を溜めて Layer メッセージにエンコードする"""
+
+    def __init__(self, name: str, extent: int = TILE_EXTENT) -> None:
+        self.name = name
+        self.extent = extent
+        self._keys: Dict[str, int] = {}
+        self._values: Dict[Tuple[str, Any], int] = {}
+        self._features: List[bytes] = []
+
+    def __len__(self) -> int:
+        return len(self._features)
+
+    def _tags(self, properties: Dict[str, Any]) -> List[int]:
+        tags: List[int] = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(self._keys.setdefault(key, len(self._keys)))
+            tags.append(self._values.setdefault((type(value).__name__, value), len(self._values)))
+        return tags
+
+    def add_feature(self, geom_type: int, geometry: List[int], properties: Dict[str, Any], feature_id: int) -> None:
+        buf = bytearray()
+        _write_key(buf, 1, _WIRE_VARINT)  # id
+        _write_varint(buf, feature_id)
+        tags = self._tags(properties)
+        if tags:
+            _write_packed(buf, 2, tags)
+        _write_key(buf, 3, _WIRE_VARINT)  # type
+        _write_varint(buf, geom_type)
+        _write_packed(buf, 4, geometry)
+        self._features.append(bytes(buf))
+
+    def encode(self) -> bytes:
+        buf = bytearray()
+        _write_key(buf, 15, _WIRE_VARINT)  # version
+        _write_varint(buf, 2)
+        _write_bytes(buf, 1, self.name.encode("utf-8"))
+        for feature in self._features:
+            _write_bytes(buf, 2, feature)
+        for key in self._keys:
+            _write_bytes(buf, 3, key.encode("utf-8"))
+        for _, value in self._values:
+            _write_bytes(buf, 4, _encode_value(value))
+        _write_key(buf, 5, _WIRE_VARINT)  # extent
+        _write_varint(buf, self.extent)
+        return bytes(buf)
+
+
+def encode_tile(layers: List[LayerBuilder]) -> bytes:
+    """Feature を持つレイヤーだけを Tile メッセージにまとめる（空タイルは 0 バイト）"""
+    buf = bytearray()
+    for layer in layers:
+        if len(layer):
+            _write_bytes(buf, 3, layer.encode())
+    return bytes(buf)
+
+
+# ============================================================================
+# Clipping
+# ============================================================================
+
+
+def _clip_segment(x0: float, y0: float, x1: float, y1: float, lo: float, hi: float) -> Optional[Tuple[float, float]]:
+    """Liang-Barsky 法で線分を正方形 [lo, hi]² に切り取り、(t0, t1) を返す（外なら None）"""
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - lo), (dx, hi - x0), (-dy, y0 - lo), (dy, hi - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return t0, t1
+
+
+def clip_polyline(xs: List[float], ys: List[float], lo: float, hi: float) -> List[List[Tuple[int, int]]]:
+    """
+    タイル内座標の折れ線を正方形 [lo, hi]² に切り取り、整数化した部分線のリストを返す。
+
+    範囲を出入りするたびに部分線が分かれる。整数化で重なった連続頂点は除き、
+    2点未満になった部分線は捨てる。
+    """
+    parts: List[List[Tuple[int, int]]] = []
+    current: List[Tuple[int, int]] = []
+
+    def flush() -> None:
+        if len(current) >= 2:
+            parts.append(list(current))
+        current.clear()
+
+    def push(x: float, y: float) -> None:
+        point = (round(x), round(y))
+        if not current or current[-1] != point:
+            current.append(point)
+
+    for i in range(len(xs) - 1):
+        x0, y0, x1, y1 = xs[i], ys[i], xs[i + 1], ys[i + 1]
+        clipped = _clip_segment(x0, y0, x1, y1, lo, hi)
+        if clipped is None:
+            flush()
+            continue
+        t0, t1 = clipped
+        if t0 > 0:
+            # 範囲外から入ってきた
+            flush()
+        if not current:
+            push(x0 + (x1 - x0) * t0, y0 + (y1 - y0) * t0)
+        push(x0 + (x1 - x0) * t1, y0 + (y1 - y0) * t1)
+        if t1 < 1:
+            # 範囲外へ出ていく
+            flush()
+    flush()
+    return parts
+
+
+# ============================================================================
+# Tile Source
+# ============================================================================
+
+
+BBox = Tuple[float, float, float, float]  # (min_x, min_y, max_x, max_y)
+
+
+def _intersects(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+@dataclass
+class ProjectedLevel:
+    """1詳細度分の投影済み座標（Web メルカトル正規化座標）"""
+
+    tolerance: float
+    xs: array
+    ys: array
+    # 区間 i（頂点 i*chunk_size 〜 (i+1)*chunk_size、隣の区間と端点を共有）の外接矩形
+    chunks: List[BBox]
+    chunk_size: int
+
+    @classmethod
+    def build(
+        cls, tolerance: float, coords: Iterable[Tuple[float, float]], chunk_size: int = CHUNK_SIZE
+    ) -> "ProjectedLevel":
+        xs, ys = array("d"), array("d")
+        for lon, lat in coords:
+            x, y = lonlat_to_mercator(lon, lat)
+            xs.append(x)
+            ys.append(y)
+        chunks = []
+        for start in range(0, max(len(xs) - 1, 1), chunk_size):
+            cx, cy = xs[start : start + chunk_size + 1], ys[start : start + chunk_size + 1]
+            chunks.append((min(cx), min(cy), max(cx), max(cy)))
+        return cls(tolerance, xs, ys, chunks, chunk_size)
+
+    def ranges(self, bbox: BBox) -> List[Tuple[int, int]]:
+        """bbox と交差する区間をつないだ頂点範囲 [start, end) のリスト"""
+        ranges: List[Tuple[int, int]] = []
+        for i, chunk in enumerate(self.chunks):
+            if not _intersects(chunk, bbox):
+                continue
+            start, end = i * self.chunk_size, min((i + 1) * self.chunk_size + 1, len(self.xs))
+            if ranges and ranges[-1][1] - 1 == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+
+@dataclass
+class RailFeature:
+    line_id: str
+    color: str
+    levels: List[ProjectedLevel]  # tolerance の昇順
+    bbox: BBox
+
+    def level(self, tolerance: float) -> ProjectedLevel:
+        """許容誤差を超えない範囲で最も粗いレベル（ShapeEntry.level と同じ選び方）"""
+        chosen = self.levels[0]
+        for level in self.levels:
+            if level.tolerance > tolerance:
+                break
+            chosen = level
+        return chosen
+
+
+@dataclass
+class StationFeature:
+    station_id: str
+    line_id: Optional[str]
+    name_ja: Optional[str]
+    name_en: Optional[str]
+    x: float
+    y: float
+
+
+class TileSource:
+    """タイル生成元（投影済みの線路形状と駅）。起動後は読み取りのみ"""
+
+    def __init__(self, rails: List[RailFeature], stations: List[StationFeature], version: str) -> None:
+        self.rails = rails
+        # x 座標順に並べておき、タイルの横幅で二分探索する
+        self.stations = sorted(stations, key=lambda s: s.x)
+        self._station_xs = [s.x for s in self.stations]
+        # 元データのハッシュ（ディスクキャッシュのディレクトリ名に使う）
+        self.version = version
+
+    @classmethod
+    def build(
+        cls, shape_store: ShapeStore, stations: List[Dict[str, Any]], chunk_size: int = CHUNK_SIZE
+    ) -> "TileSource":
+        """
+        Args:
+            shape_store: 線路形状ストア
+            stations: 駅の辞書 (id, line_id, name_ja, name_en, lon, lat) のリスト
+            chunk_size: 外接矩形で読み飛ばす頂点区間の長さ
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        rails: List[RailFeature] = []
+        for line_id in sorted(shape_store.entries):
+            entry = shape_store.entries[line_id]
+            levels = [ProjectedLevel.build(level.tolerance, level.points(), chunk_size) for level in entry.levels]
+            full = levels[0]
+            bbox = (min(full.xs), min(full.ys), max(full.xs), max(full.ys))
+            rails.append(RailFeature(line_id, entry.color, levels, bbox))
+            # 間引きなしの本文のハッシュに形状と色の両方が反映される
+            digest.update(entry.levels[0].response.etag.encode("utf-8"))
+
+        projected: List[StationFeature] = []
+        for station in stations:
+            x, y = lonlat_to_mercator(station["lon"], station["lat"])
+            projected.append(
+                StationFeature(
+                    station_id=station["id"],
+                    line_id=station.get("line_id"),
+                    name_ja=station.get("name_ja"),
+                    name_en=station.get("name_en"),
+                    x=x,
+                    y=y,
+                )
+            )
+            digest.update(repr(sorted(station.items())).encode("utf-8"))
+
+        logger.info("Tile source built: %d lines, %d stations", len(rails), len(projected))
+        return cls(rails, projected, digest.hexdigest())
+
+    def render(self, z: int, x: int, y: int) -> bytes:
+        """タイル (z, x, y) の MVT バイト列（含まれる形状が無ければ空）"""
+        scale = float(2**z)
+        buffer = TILE_BUFFER / TILE_EXTENT / scale
+        min_x, max_x = x / scale - buffer, (x + 1) / scale + buffer
+        min_y, max_y = y / scale - buffer, (y + 1) / scale + buffer
+        tile_bbox = (min_x, min_y, max_x, max_y)
+        lo, hi = -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+
+        rail_layer = LayerBuilder(LAYER_RAIL)
+        tolerance = tolerance_for_zoom(z)
+        for feature_id, rail in enumerate(self.rails):
+            if not _intersects(rail.bbox, tile_bbox):
+                continue
+            level = rail.level(tolerance)
+            parts = []
+            for start, end in level.ranges(tile_bbox):
+                xs = [(v * scale - x) * TILE_EXTENT for v in level.xs[start:end]]
+                ys = [(v * scale - y) * TILE_EXTENT for v in level.ys[start:end]]
+                parts += clip_polyline(xs, ys, lo, hi)
+            if parts:
+                rail_layer.add_feature(
+                    GEOM_LINESTRING,
+                    encode_line_geometry(parts),
+                    {"line_id": rail.line_id, "color": rail.color},
+                    feature_id,
+                )
+
+        station_layer = LayerBuilder(LAYER_STATIONS)
+        if z >= STATION_MIN_ZOOM:
+            start = bisect.bisect_left(self._station_xs, min_x)
+            end = bisect.bisect_right(self._station_xs, max_x)
+            for feature_id in range(start, end):
+                station = self.stations[feature_id]
+                if not min_y <= station.y <= max_y:
+                    continue
+                station_layer.add_feature(
+                    GEOM_POINT,
+                    encode_point_geometry(
+                        round((station.x * scale - x) * TILE_EXTENT),
+                        round((station.y * scale - y) * TILE_EXTENT),
+                    ),
+                    {
+                        "id": station.station_id,
+                        "line_id": station.line_id,
+                        "name_ja": station.name_ja,
+                        "name_en": station.name_en,
+                    },
+                    feature_id,
+                )
+
+        return encode_tile([rail_layer, station_layer])
+
+
+# ============================================================================
+# Tile Cache
+# ============================================================================
+
+
+class TileCache:
+    """
+    生成済みタイルのキャッシュ（メモリ上の LRU + 任意でディスク）
+
+    ディスクには TileSource.version ごとのディレクトリに生の MVT を保存するので、
+    線路形状や駅が変わったときに古いタイルを返すことはない。
+
+    get はタイル生成・ディスク I/O を含むのでイベントループ外（スレッドプール）から呼ぶ。
+    メモリ上の LRU だけを見る cached はループ上で呼んでよい。
+    同じタイルを同時に生成することはあり得るが、結果は同じなのでどちらを残してもよい。
+    """
+
+    def __init__(self, source: TileSource, max_entries: int = 4096, cache_dir: Optional[Path] = None) -> None:
+        self.source = source
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) / source.version if cache_dir else None
+        self._memory: OrderedDict[Tuple[int, int, int], EncodedBody] = OrderedDict()
+        self._lock = threading.Lock()  # _memory の更新（生成・I/O はロックの外で行う）
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def _disk_path(self, z: int, x: int, y: int) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / str(z) / str(x) / f"{y}.mvt"
+
+    def _read_disk(self, z: int, x: int, y: int) -> Optional[bytes]:
+        path = self._disk_path(z, x, y)
+        if path is None:
+            return None
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Failed to read tile cache %s: %s", path, e)
+            return None
+
+    def _write_disk(self, z: int, x: int, y: int, body: bytes) -> None:
+        path = self._disk_path(z, x, y)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 書きかけのファイルを読まれないよう、一時ファイルから置き換える
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(body)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Failed to write tile cache %s: %s", path, e)
+
+    def cached(self, z: int, x: int, y: int) -> Optional[EncodedBody]:
+        """メモリ上にあるタイルだけを返す（I/O・生成をしないのでイベントループ上で呼べる）"""
+        key = (z, x, y)
+        with self._lock:
+            encoded = self._memory.get(key)
+            if encoded is not None:
+                self._memory.move_to_end(key)
+            return encoded
+
+    def get(self, z: int, x: int, y: int) -> EncodedBody:
+        """タイル (z, x, y) のエンコード済み本文（メモリ → ディスク → 生成 の順に探す）"""
+        encoded = self.cached(z, x, y)
+        if encoded is not None:
+            return encoded
+
+        body = self._read_disk(z, x, y)
+        if body is None:
+            body = self.source.render(z, x, y)
+            self._write_disk(z, x, y, body)
+
+        encoded = EncodedBody.encode(body, gzip_level=TILE_GZIP_LEVEL, use_brotli=False)
+        with self._lock:
+            self._memory[(z, x, y)] = encoded
+            if len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+        return encoded
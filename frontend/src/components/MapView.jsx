@@ -7,6 +7,8 @@ import { extractTrainNumber, isSameTrain } from "../utils/trainUtils";
 import "./MapView.css";
 
 const TRAIN_UPDATE_INTERVAL_MS = 2000;
+// プッシュ配信のフレームがこれより古ければ HTTP ポーリングに戻す
+const STREAM_STALE_MS = 10000;
 
 
 
@@ -1112,6 +1114,60 @@ function MapView({
   useEffect(() => {
     let intervalId = null;
 
+    // 列車位置のプッシュ配信 (SSE)。受信済みの路線は HTTP ポーリングを省略する
+    let eventSource = null;
+    let streamKey = "";
+    const streamed = {}; // lineId -> { positions, source, receivedAt }
+
+    const ensureStream = (lineIds) => {
+      if (typeof EventSource === "undefined") return;
+      const key = [...lineIds].sort().join(",");
+      if (key === streamKey) return;
+      if (eventSource) eventSource.close();
+      Object.keys(streamed).forEach((lineId) => delete streamed[lineId]);
+      streamKey = key;
+      if (!key) return;
+      eventSource = new EventSource(`/api/trains/positions/stream?lines=${encodeURIComponent(key)}`);
+      eventSource.addEventListener("positions", (event) => {
+        try {
+          const json = JSON.parse(event.data);
+          streamed[json.line_id] = { positions: json.positions || [], source: json.source, receivedAt: Date.now() };
+        } catch (err) {
+          console.error("[stream] invalid frame:", err);
+        }
+      });
+    };
+
+    const fetchPositions = async (lineIds) => {
+      const positions = [];
+      const missing = [];
+      lineIds.forEach((lineId) => {
+        const frame = streamed[lineId];
+        if (frame && Date.now() - frame.receivedAt < STREAM_STALE_MS) {
+          positions.push(...frame.positions.map((p) => ({ ...p, source: frame.source })));
+        } else {
+          missing.push(lineId);
+        }
+      });
+      if (missing.length === 0) return positions;
+
+      // ストリームで受信できていない路線は1回のリクエストでまとめて取得する
+      try {
+        const res = await fetch(`/api/trains/positions?lines=${encodeURIComponent(missing.join(","))}`);
+        if (res.ok) {
+          const json = await res.json();
+          Object.values(json.lines || {}).forEach((line) => {
+            // デバッグ用に source を各 position に付与
+            const source = line.source;
+            (line.positions || []).forEach((p) => positions.push({ ...p, source }));
+          });
+        }
+      } catch (err) {
+        console.error(`[My Train] Failed to fetch positions for ${missing.join(",")}:`, err);
+      }
+      return positions;
+    };
+
     const fetchAndUpdate = async () => {
       const map = mapRef.current;
       if (!map || !map.getSource("trains-source")) return;
@@ -1128,27 +1184,13 @@ function MapView({
         console.log("[MapView Polling] Looking for trains:", myTrainIdsRef.current);
       }
 
+      ensureStream(lineIdsToFetch.filter(Boolean));
+
       try {
         const allPositions = [];
 
-        // 複数路線を並行取得
-        const fetchPromises = lineIdsToFetch.map(async (lineId) => {
-          try {
-            const res = await fetch(`/api/trains/${lineId}/positions/v4`);
-            if (res.ok) {
-              const json = await res.json();
-              // デバッグ用に source を各 position に付与
-              const source = json.source;
-              return (json.positions || []).map(p => ({ ...p, source }));
-            }
-          } catch (err) {
-            console.error(`[My Train] Failed to fetch positions for ${lineId}:`, err);
-          }
-          return [];
-        });
-
-        const results = await Promise.all(fetchPromises);
-        results.forEach((positions) => allPositions.push(...positions));
+        // 複数路線をまとめて取得（プッシュ配信で受信済みの路線はそれを使う）
+        allPositions.push(...(await fetchPositions(lineIdsToFetch.filter(Boolean))));
 
         const now = performance.now();
 
@@ -1224,7 +1266,10 @@ function MapView({
     fetchAndUpdate();
     intervalId = setInterval(fetchAndUpdate, TRAIN_UPDATE_INTERVAL_MS);
 
-    return () => clearInterval(intervalId);
+    return () => {
+      clearInterval(intervalId);
+      if (eventSource) eventSource.close();
+    };
   }, []);
 
   return (
@@ -0,0 +1,64 @@
+// frontend/src/utils/positionsColumnar.js
+
+/** 列指向形式の列車位置のメディアタイプ（Accept に指定する） */
+export const POSITIONS_COLUMNAR_MEDIA_TYPE = "application/vnd.nowtrain.positions+columnar";
+
+const MAGIC = "NTPC";
+const FORMAT_VERSION = 1;
+const HEADER_SIZE = 12;
+
+const SECTION_TYPES = {
+  lat: Float32Array,
+  lon: Float32Array,
+  bearing: Float32Array,
+  status: Uint8Array,
+  delay: Int16Array,
+  trip_id_offsets: Uint32Array,
+  trip_ids: Uint8Array,
+  train_number_offsets: Uint32Array,
+  train_numbers: Uint8Array,
+};
+
+const pad8 = (n) => (n + 7) & ~7;
+
+/**
+ * 列指向形式の列車位置（/api/trains/positions?format=columnar など）を型付き配列として読む
+ *
+ * 各セクションは ArrayBuffer 上のビューなのでコピーしない。
+ * lat / lon は座標が無い列車で NaN、status は manifest.statuses の番号。
+ * 路線ごとの行の範囲は manifest.lines[i].start / count。
+ *
+ * @param {ArrayBuffer} buffer - レスポンス本文 (await res.arrayBuffer())
+ * @returns {{manifest: Object, columns: Object<string, TypedArray>}}
+ */
+export function decodePositionsColumnar(buffer) {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  const version = view.getUint16(4, true);
+  if (magic !== MAGIC || version !== FORMAT_VERSION) {
+    throw new Error(`Unsupported columnar positions format: ${magic} v${version}`);
+  }
+  const manifestLength = view.getUint32(8, true);
+  const manifest = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, HEADER_SIZE, manifestLength)));
+  const dataStart = pad8(HEADER_SIZE + manifestLength);
+
+  const columns = {};
+  Object.entries(SECTION_TYPES).forEach(([name, Type]) => {
+    const [offset, count] = manifest.sections[name];
+    columns[name] = new Type(buffer, dataStart + offset, count);
+  });
+  return { manifest, columns };
+}
+
+/**
+ * trip_ids / train_numbers の i 番目の文字列を取り出す
+ *
+ * @param {Object} columns - decodePositionsColumnar の columns
+ * @param {"trip_ids"|"train_numbers"} name
+ * @param {number} i - 行番号
+ * @returns {string}
+ */
+export function columnarString(columns, name, i) {
+  const offsets = columns[name.replace(/s$/, "_offsets")];
+  return new TextDecoder().decode(columns[name].subarray(offsets[i], offsets[i + 1]));
+}